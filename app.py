@@ -48,6 +48,9 @@ import calendar
 import csv
 import io
 import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 from flask_migrate import Migrate
 import time
@@ -146,6 +149,24 @@ from time import monotonic
 import html as html_lib
 
 from utils.encrypted_type import EncryptedType
+from utils.backup_stream import ChunkedEncryptWriter, S3MultipartWriter, derive_stream_key, open_backup_plaintext, open_backup_seekable
+from utils.blind_index import iter_field_tokens, query_token_groups, value_matches as _blind_index_value_matches
+from utils.presence import build_presence_registry
+from utils.scheduler_lease import LeaderLease
+from utils.dosage_index import DosageIndexBook
+from utils.stock_reservation import reserve_stock
+from utils.receipt_queue import ReceiptRenderQueue
+from utils.pdf_cache import PdfCache
+from utils.catalog_search import (
+    CatalogSearchIndex,
+    ensure_trgm_indexes,
+    normalize as catalog_normalize,
+    query_terms as catalog_query_terms,
+    sql_match_filter as catalog_sql_match_filter,
+    sql_rank as catalog_sql_rank,
+    sql_similarity as catalog_sql_similarity,
+)
+from utils.message_search import highlight_snippet, is_searchable as _message_is_searchable, message_search_index, query_terms as _message_query_terms
 from utils.stamp_signature import generate_rubber_stamp, generate_digital_signature
 from utils.whatsapp_meta import normalize_msisdn, send_document, send_text, WhatsAppConfigError
 from utils.whatsapp_settings_store import load_whatsapp_settings, save_whatsapp_settings, mask_token
@@ -153,6 +174,7 @@ from utils.mfa_totp import MFAManager, MFASession, setup_user_mfa, verify_mfa_co
 from utils.message_encryption import MessageEncryption
 from utils.zero_knowledge import ZeroKnowledgeEncryption
 from utils.upload_encryption import encrypt_file_inplace as _encrypt_upload_file_inplace, decrypt_file_to_bytes as _decrypt_upload_file_to_bytes, is_encrypted_file as _is_encrypted_upload_file
+from utils.upload_encryption import encrypt_bytes as _encrypt_upload_bytes, decrypt_bytes as _decrypt_upload_bytes, get_upload_encryption_key_bytes
 from utils.adaptive_auth import AdaptiveAuthentication, DeviceFingerprint, RiskAssessment
 from utils.ai_threat_detection import AIThreatDetector, BehavioralProfile, ThreatPatterns
 from utils.comprehensive_audit import AuditEntry, AuditEventType, AuditSeverity, ComprehensiveAuditSystem
@@ -342,6 +364,10 @@ limiter.init_app(app)
 
 # Initialize Custom WAF (Web Application Firewall) - Phase 2
 from utils.custom_waf import init_waf, waf
+# Characters of query args, form fields and JSON allowed per request (0 = no limit); larger requests get 413.
+app.config['WAF_MAX_SCAN_BYTES'] = int(os.getenv('WAF_MAX_SCAN_BYTES', str(256 * 1024)))
+# Comma-separated path prefixes allowed past that limit (bulk/upload routes); only field heads and tails are scanned there.
+app.config['WAF_SCAN_EXEMPT_PATHS'] = [p.strip() for p in os.getenv('WAF_SCAN_EXEMPT_PATHS', '').split(',') if p.strip()]
 init_waf(app)
 app.logger.info("Custom WAF (Web Application Firewall) initialized successfully")
 
@@ -382,6 +408,15 @@ try:
 except Exception:
     pass
 
+# SIEM event writer: events are buffered and written in batches by a background thread.
+app.config['SIEM_BUFFERED'] = os.getenv('SIEM_BUFFERED', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+app.config['SIEM_BUFFER_MAX_EVENTS'] = int(os.getenv('SIEM_BUFFER_MAX_EVENTS', '10000'))
+app.config['SIEM_FLUSH_EVENTS'] = int(os.getenv('SIEM_FLUSH_EVENTS', '200'))
+app.config['SIEM_FLUSH_INTERVAL_SECONDS'] = float(os.getenv('SIEM_FLUSH_INTERVAL_SECONDS', '1.0'))
+# drop: discard INFO/WARNING events when the buffer is full; block: wait SIEM_BLOCK_TIMEOUT_SECONDS first.
+app.config['SIEM_OVERFLOW_POLICY'] = os.getenv('SIEM_OVERFLOW_POLICY', 'drop').strip().lower()
+app.config['SIEM_BLOCK_TIMEOUT_SECONDS'] = float(os.getenv('SIEM_BLOCK_TIMEOUT_SECONDS', '0.05'))
+
 # Initialize Phase 3: Monitoring & Compliance (safe to skip on failure)
 try:
     from utils.phase3_init import init_phase3
@@ -582,30 +617,47 @@ class SafeDateTime(TypeDecorator):
 if _socketio_async_mode == 'eventlet':
     # Eventlet + Python 3.12 can trip over SQLAlchemy's QueuePool synchronization
     # primitives (seen on Render as: "cannot notify on un-acquired lock").
-    # NullPool avoids the internal condition/queue and is safe for correctness.
+    # GreenQueuePool (utils/green_pool.py) pools connections without
+    # threading.Condition. SQLALCHEMY_EVENTLET_POOL=null restores the old
+    # NullPool behaviour (a new connection per checkout).
     try:
-        from sqlalchemy.pool import NullPool
-
         app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
         _engine_opts = app.config['SQLALCHEMY_ENGINE_OPTIONS']
-        # NullPool does not accept QueuePool sizing/timeout options.
-        for _k in ('pool_size', 'max_overflow', 'pool_timeout'):
-            try:
+        if (os.getenv('SQLALCHEMY_EVENTLET_POOL') or 'green').strip().lower() == 'null':
+            from sqlalchemy.pool import NullPool
+
+            # NullPool does not accept QueuePool sizing/timeout options.
+            for _k in ('pool_size', 'max_overflow', 'pool_timeout'):
                 _engine_opts.pop(_k, None)
-            except Exception:
-                pass
-        _engine_opts.update(
-            {
-                'poolclass': NullPool,
-                'pool_pre_ping': True,
-            }
-        )
+            _engine_opts.update({'poolclass': NullPool, 'pool_pre_ping': True})
+        else:
+            from utils.green_pool import GreenQueuePool
+
+            _engine_opts.update(
+                {
+                    'poolclass': GreenQueuePool,
+                    'pool_pre_ping': True,
+                    'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', '300')),
+                    'pool_timeout': int(os.getenv('SQLALCHEMY_POOL_TIMEOUT', '30')),
+                    'pool_size': int(os.getenv('SQLALCHEMY_POOL_SIZE', '5')),
+                    'max_overflow': int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', '10')),
+                }
+            )
     except Exception:
         pass
 db = SQLAlchemy(app, session_options={"autoflush": False, "autocommit": False})
 migrate = Migrate(app, db)
 
 # Enhanced Database Activity Monitoring (SIEM + audit) - Phase 3
+# aggregate: per-statement counters + periodic SIEM summaries; individual events only for
+# slow statements, DDL and a sample. per_statement: one SIEM event per statement.
+app.config['DB_ACTIVITY_MODE'] = os.getenv('DB_ACTIVITY_MODE', 'aggregate').strip().lower()
+app.config['DB_ACTIVITY_SLOW_MS'] = float(os.getenv('DB_ACTIVITY_SLOW_MS', '500'))
+app.config['DB_ACTIVITY_SAMPLE_RATE'] = float(os.getenv('DB_ACTIVITY_SAMPLE_RATE', '0.01'))
+app.config['DB_ACTIVITY_SUMMARY_SECONDS'] = float(os.getenv('DB_ACTIVITY_SUMMARY_SECONDS', '60'))
+app.config['DB_ACTIVITY_SUMMARY_TOP'] = int(os.getenv('DB_ACTIVITY_SUMMARY_TOP', '50'))
+# Every write statement gets a Comprehensive Audit entry in both modes (not sampled); set false to opt out.
+app.config['DB_ACTIVITY_AUDIT_WRITES'] = os.getenv('DB_ACTIVITY_AUDIT_WRITES', '1').strip().lower() not in ('0', 'false', 'no', 'off')
 try:
     from utils.db_activity_monitor import init_db_activity_monitor
 
@@ -899,6 +951,11 @@ class Message(db.Model):
     conversation = db.relationship('Conversation', back_populates='messages')
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
+
+    # Keyset pagination of conversation history walks (conversation_id, created_at, id).
+    __table_args__ = (
+        db.Index('ix_messages_conversation_created_id', 'conversation_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Message {self.message_id}>'
@@ -944,6 +1001,18 @@ class UserOnlineStatus(db.Model):
         return f'<UserOnlineStatus user_id={self.user_id} online={self.is_online}>'
 
 
+class SocketPresence(db.Model):
+    """Socket.IO sid -> user rows shared by workers (PRESENCE_BACKEND=database)."""
+    __tablename__ = 'socket_presence'
+
+    sid = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # epoch seconds
+
+    def __repr__(self):
+        return f'<SocketPresence sid={self.sid} user_id={self.user_id} expires_at={self.expires_at}>'
+
+
 class TypingIndicator(db.Model):
     """Tracks who is typing in which conversation"""
     __tablename__ = 'typing_indicators'
@@ -1002,6 +1071,25 @@ class ConversationSettings(db.Model):
     conversation = db.relationship('Conversation', backref='settings')
 
 
+class MessageUnreadCounter(db.Model):
+    """Denormalized count of unread messages per (recipient, sender) pair.
+
+    Maintained from Message inserts/read flags by a flush hook, so unread badges
+    and the user directory never COUNT(*) the messages table.
+    """
+    __tablename__ = 'message_unread_counters'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)  # recipient
+    other_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # sender
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=get_eat_now, onupdate=get_eat_now)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'other_user_id', name='uq_message_unread_counters_pair'),
+    )
+
+
 class MessageEdit(db.Model):
     """Stores message edit history."""
     __tablename__ = 'message_edits'
@@ -1099,6 +1187,10 @@ class BackupRecord(db.Model):
     checksum = db.Column(db.String(64))  # SHA-256 checksum
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     notes = db.Column(db.Text)
+    backup_mode = db.Column(db.String(20), default='full')  # 'full', 'incremental'
+    base_backup_id = db.Column(db.String(36))  # full backup an incremental chain starts from
+    parent_backup_id = db.Column(db.String(36))  # previous backup in the chain (incremental only)
+    watermarks = db.Column(db.Text)  # JSON per-table high-water marks for the next incremental
     
     user = db.relationship('User', backref='backups')
     
@@ -1225,6 +1317,34 @@ class BackupScheduleConfig(db.Model):
     updated_at = db.Column(db.DateTime, default=get_eat_now, onupdate=get_eat_now)
 
 
+class SchedulerLease(db.Model):
+    """Leader lease for the background scheduler (one row per lease name; times are naive UTC)."""
+    __tablename__ = 'scheduler_leases'
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(128), nullable=False)
+    acquired_at = db.Column(db.DateTime)
+    renewed_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class SchedulerJobRun(db.Model):
+    """One execution of a cluster-wide scheduled job (written by the lease holder only)."""
+    __tablename__ = 'scheduler_job_runs'
+    __table_args__ = (
+        db.Index('ix_scheduler_job_runs_job_started', 'job_id', 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(100), nullable=False)
+    holder = db.Column(db.String(128))
+    started_at = db.Column(db.DateTime, default=get_eat_now, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Integer)
+    status = db.Column(db.String(20), default='running')  # running | success | failed
+    error = db.Column(db.Text)
+
+
 class BackupLoginUser(db.Model):
     """User credentials for backup feature access (separate from main system login)."""
     __tablename__ = 'backup_login_users'
@@ -1843,7 +1963,9 @@ class Drug(db.Model):
     selling_price = db.Column(db.Numeric(10, 2), nullable=False)          # Use Numeric for money
     stocked_quantity = db.Column(db.Integer, nullable=False)
     sold_quantity = db.Column(db.Integer, default=0)
-    expiry_date = db.Column(db.Date, nullable=False)
+    # Stored stocked - sold, kept in step by _stock_on_hand_before_flush so stock filters can use an index.
+    on_hand_quantity = db.Column('remaining_quantity', db.Integer, index=True)
+    expiry_date = db.Column(db.Date, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=get_eat_now)
     updated_at = db.Column(db.DateTime, default=get_eat_now, onupdate=get_eat_now)
     
@@ -1856,7 +1978,7 @@ class Drug(db.Model):
     
     @remaining_quantity.expression
     def remaining_quantity(cls):
-        return cls.stocked_quantity - (cls.sold_quantity or 0)
+        return cls.on_hand_quantity
     
     def update_stock(self, quantity):
         """Safe method to update stock quantities"""
@@ -1879,11 +2001,12 @@ class Drug(db.Model):
     
     @stock_status.expression
     def stock_status(cls):
-        return case([
-            (cls.remaining_quantity == 0, 'out-of-stock'),
+        return case(
+            (cls.remaining_quantity <= 0, 'out-of-stock'),
             (cls.remaining_quantity < 10, 'low-stock'),
-            (cls.expiry_date <= date.today() + timedelta(days=30), 'expiring-soon')
-        ], else_='in-stock')
+            (cls.expiry_date <= date.today() + timedelta(days=30), 'expiring-soon'),
+            else_='in-stock',
+        )
     
     def update_stock(self, quantity):
         """Safe method to update stock quantities"""
@@ -1904,7 +2027,8 @@ class ControlledDrug(db.Model):
     selling_price = db.Column(db.Numeric(10, 2), nullable=False)
     stocked_quantity = db.Column(db.Integer, nullable=False)
     sold_quantity = db.Column(db.Integer, default=0)
-    expiry_date = db.Column(db.Date, nullable=False)
+    on_hand_quantity = db.Column('remaining_quantity', db.Integer, index=True)  # see Drug.on_hand_quantity
+    expiry_date = db.Column(db.Date, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=get_eat_now)
     updated_at = db.Column(
         db.DateTime,
@@ -1921,7 +2045,7 @@ class ControlledDrug(db.Model):
 
     @remaining_quantity.expression
     def remaining_quantity(cls):
-        return cls.stocked_quantity - (cls.sold_quantity or 0)
+        return cls.on_hand_quantity
 
     @hybrid_property
     def stock_status(self):
@@ -2100,47 +2224,76 @@ def _normalize_drug_name(name: str) -> str:
     return (name or '').strip().lower()
 
 
+def _log_dosage_index_error(path: str, e: Exception) -> None:
+    app.logger.error(f"Failed to load dosage index book from {path}: {str(e)}", exc_info=True)
+
+
+# Parsed once per process; re-read when the file's mtime/size changes.
+_dosage_index_book = DosageIndexBook(
+    [
+        os.path.join(app.instance_path, 'dosage_index.json'),
+        os.path.join(app.root_path, 'static', 'dosage_index.json'),
+        os.path.join(app.root_path, 'dosage_index.json'),
+    ],
+    on_error=_log_dosage_index_error,
+)
+
+
 def _load_dosage_index_book():
     """Load dosage index book JSON if present.
 
     Expected format:
-      {"entries": [{"name": "Paracetamol", "indication": "...", "dosage_adults": "...", ...}]}
+      {"entries": [{"name": "Paracetamol", "aliases": ["Panadol"], "indication": "...", "dosage_adults": "...", ...}]}
     """
-    candidates = [
-        os.path.join(app.instance_path, 'dosage_index.json'),
-        os.path.join(app.root_path, 'static', 'dosage_index.json'),
-        os.path.join(app.root_path, 'dosage_index.json'),
-    ]
-    for path in candidates:
-        try:
-            if os.path.exists(path):
-                with open(path, 'r', encoding='utf-8') as f:
-                    data = json.load(f) or {}
-                entries = data.get('entries')
-                if isinstance(entries, list):
-                    return entries
-        except Exception as e:
-            current_app.logger.error(f"Failed to load dosage index book from {path}: {str(e)}", exc_info=True)
-    return []
+    return _dosage_index_book.entries()
 
 
-def _lookup_index_dosage_by_name(drug_name: str):
-    key = _normalize_drug_name(drug_name)
-    if not key:
+def _dosage_fields_from_index_entry(entry: dict) -> dict:
+    return {
+        'indication': entry.get('indication'),
+        'contraindication': entry.get('contraindication'),
+        'interaction': entry.get('interaction'),
+        'side_effects': entry.get('side_effects'),
+        'dosage_peds': entry.get('dosage_peds'),
+        'dosage_adults': entry.get('dosage_adults'),
+        'dosage_geriatrics': entry.get('dosage_geriatrics'),
+        'important_notes': entry.get('important_notes'),
+    }
+
+
+def _lookup_index_dosage_by_name(drug_name: str, fuzzy: bool = False):
+    match = _dosage_index_book.lookup(drug_name, fuzzy=fuzzy)
+    if not match:
         return None
-    for entry in _load_dosage_index_book():
-        if _normalize_drug_name(entry.get('name')) == key:
-            return {
-                'indication': entry.get('indication'),
-                'contraindication': entry.get('contraindication'),
-                'interaction': entry.get('interaction'),
-                'side_effects': entry.get('side_effects'),
-                'dosage_peds': entry.get('dosage_peds'),
-                'dosage_adults': entry.get('dosage_adults'),
-                'dosage_geriatrics': entry.get('dosage_geriatrics'),
-                'important_notes': entry.get('important_notes'),
-            }
-    return None
+    return _dosage_fields_from_index_entry(match['entry'])
+
+
+def _split_dosage_index_matches(drugs) -> tuple[list, list]:
+    """Match `drugs` against the index book.
+
+    Returns (exact, review): exact is [(drug, entry)] for case-insensitive name/alias
+    matches, safe to apply; review lists normalized/fuzzy candidates (Prednisone vs
+    Prednisolone, "Losartan Plus" vs Losartan) that an admin must confirm first.
+    """
+    names = [drug.name for drug in drugs]
+    matches = _dosage_index_book.lookup_many(names, fuzzy=False)
+    suggestions = _dosage_index_book.lookup_many(names, fuzzy=True)
+    exact, review = [], []
+    for drug in drugs:
+        match = matches.get(drug.name)
+        if match and match['match'] == 'exact':
+            exact.append((drug, match['entry']))
+            continue
+        suggestion = suggestions.get(drug.name)
+        if suggestion and suggestion['entry'].get('name'):
+            review.append({
+                'drug_id': drug.id,
+                'drug_name': drug.name,
+                'entry_name': suggestion['entry'].get('name'),
+                'match': suggestion['match'],
+                'score': suggestion['score'],
+            })
+    return exact, review
 
 
 def _get_dosage_ai_client():
@@ -3490,6 +3643,139 @@ class Patient(db.Model):
         return "\n".join(summary) if summary else "No AI recommendations available"
 
 
+# Encrypted Patient fields that get blind-index search tokens (see utils/blind_index.py).
+PATIENT_SEARCH_FIELDS = ('name', 'phone', 'nok_name', 'nok_contact')
+
+
+class PatientSearchToken(db.Model):
+    """Keyed search tokens for encrypted Patient fields.
+
+    Patient name/phone values are Fernet ciphertext, so SQL LIKE cannot match them.
+    Each row holds one HMAC token of a normalized fragment; searches tokenise the
+    input the same way and match with an indexed equality lookup.
+    """
+
+    __tablename__ = 'patient_search_tokens'
+
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.String(20), nullable=False)
+    token = db.Column(db.String(64), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_patient_search_tokens_token_patient', 'token', 'patient_id'),
+    )
+
+
+def rebuild_patient_search_tokens(conn, patient_id: int, values: dict) -> int:
+    """Replace the search tokens of `patient_id` for the fields in `values` (field -> plaintext)."""
+    key = Config.BLIND_INDEX_KEY
+    if not key or not values:
+        return 0
+    table = PatientSearchToken.__table__
+    conn.execute(
+        table.delete().where(table.c.patient_id == patient_id, table.c.field.in_(list(values.keys())))
+    )
+    rows = [
+        {'patient_id': patient_id, 'field': field, 'token': tok}
+        for field, tok in iter_field_tokens(key, values)
+    ]
+    if rows:
+        conn.execute(table.insert(), rows)
+    return len(rows)
+
+
+def patient_search_values(patient, fields=PATIENT_SEARCH_FIELDS) -> dict:
+    return {field: Patient._safe_decrypt(getattr(patient, field, None)) for field in fields}
+
+
+@event.listens_for(db.session, 'after_flush')
+def _patient_search_index_after_flush(session, flush_context):
+    """Keep patient_search_tokens in step with inserts/updates/deletes of Patient rows."""
+    try:
+        pending = []
+        for obj in session.new:
+            if isinstance(obj, Patient) and obj.id is not None:
+                pending.append((obj.id, patient_search_values(obj)))
+        for obj in session.dirty:
+            if not isinstance(obj, Patient) or obj.id is None:
+                continue
+            state = sa_inspect(obj)
+            changed = tuple(f for f in PATIENT_SEARCH_FIELDS if state.attrs[f].history.has_changes())
+            if changed:
+                pending.append((obj.id, patient_search_values(obj, changed)))
+        deleted_ids = [obj.id for obj in session.deleted if isinstance(obj, Patient) and obj.id is not None]
+        if not pending and not deleted_ids:
+            return
+        # Savepoint: an index failure must not abort the caller's transaction (PostgreSQL).
+        with session.connection().begin_nested() as sp:
+            conn = sp.connection
+            for patient_id, values in pending:
+                rebuild_patient_search_tokens(conn, patient_id, values)
+            if deleted_ids:
+                table = PatientSearchToken.__table__
+                conn.execute(table.delete().where(table.c.patient_id.in_(deleted_ids)))
+    except Exception as e:
+        try:
+            app.logger.warning(f"Patient search index update failed: {e}")
+        except Exception:
+            pass
+
+
+def patient_search_clause(query: str, fields=('name',)):
+    """SQL filter for patients whose encrypted `fields` contain `query`.
+
+    Returns None when the input is too short to search on. Matches are candidates:
+    trigram lookups can return rare false positives, which callers drop with
+    `patient_search_hits` / `patient_matches_search`.
+    """
+    key = Config.BLIND_INDEX_KEY
+    if not key or not query:
+        return None
+    table = PatientSearchToken.__table__
+    clauses = []
+    for field in fields:
+        for group in query_token_groups(key, field, query):
+            matching_ids = (
+                db.select(table.c.patient_id)
+                .where(table.c.token.in_(sorted(group)))
+                .group_by(table.c.patient_id)
+                .having(func.count(func.distinct(table.c.token)) == len(group))
+            )
+            clauses.append(Patient.id.in_(matching_ids))
+    if not clauses:
+        return None
+    return or_(*clauses)
+
+
+def prefetch_patient_decryption(patients, fields=('name',)):
+    """Batch-decrypt `fields` for a list of patients so rendering hits the decrypt cache."""
+    try:
+        Config.decrypt_many([getattr(p, f, None) for p in patients for f in fields])
+    except Exception as e:
+        app.logger.warning(f"Patient decrypt prefetch failed: {e}")
+    return patients
+
+
+def patient_matches_search(patient, query: str, fields=('name',)) -> bool:
+    """Plaintext re-check of a blind-index candidate."""
+    return any(
+        _blind_index_value_matches(field, Patient._safe_decrypt(getattr(patient, field, None)), query)
+        for field in fields
+    )
+
+
+def patient_search_hits(patients, query: str, fields=('name',)):
+    """Drop blind-index false positives: keep patients whose OP/IP number or `fields` contain `query`."""
+    needle = (query or '').lower()
+    return [
+        p for p in patients
+        if needle in (p.op_number or '').lower()
+        or needle in (p.ip_number or '').lower()
+        or patient_matches_search(p, query, fields=fields)
+    ]
+
+
 class PatientNumberCounter(db.Model):
     """Atomic counters for OP/IP patient numbers.
 
@@ -4600,6 +4886,9 @@ class Sale(db.Model):
     total_amount = db.Column(db.Float, nullable=False)
     discount = db.Column(db.Float, default=0)
     payment_method = db.Column(db.String(20))
+    # Cash tendered and change at checkout; receipts are rendered from these.
+    amount_given = db.Column(db.Float)
+    change_amount = db.Column(db.Float)
     status = db.Column(db.String(20), default='completed')
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=get_eat_now)
@@ -5993,6 +6282,11 @@ class CashFlowDaily(db.Model):
     closing_balance = db.Column(db.Float, default=0)
     net_change = db.Column(db.Float, default=0)
     
+    # Financial rollup marker: bumped on every invalidation; the row's figures are only trusted
+    # while rollup_stale is False (see FINANCIAL DAILY ROLLUP).
+    rollup_version = db.Column(db.Integer, default=0)
+    rollup_stale = db.Column(db.Boolean, default=True)
+    
     created_at = db.Column(db.DateTime, default=get_eat_now)
     updated_at = db.Column(db.DateTime, default=get_eat_now, onupdate=get_eat_now)
 
@@ -6377,6 +6671,7 @@ def _ensure_all_tables_and_columns(engine) -> tuple[int, int]:
 
     - Creates any missing tables declared in db.metadata
     - Adds any missing columns declared in db.metadata tables
+    - Creates any missing non-unique indexes declared in db.metadata tables
 
     Important: for compatibility/safety, added columns are created WITHOUT
     NOT NULL / UNIQUE / FK constraints, even if the ORM model has them.
@@ -6456,6 +6751,25 @@ def _ensure_all_tables_and_columns(engine) -> tuple[int, int]:
                     except Exception:
                         pass
 
+        # 3) Ensure declared (non-unique) indexes exist, e.g. ones added for query performance
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables or not table.indexes:
+                continue
+            try:
+                existing_indexes = {ix.get('name') for ix in inspector.get_indexes(table.name)}
+            except Exception:
+                continue
+            for index in table.indexes:
+                if index.unique or not index.name or index.name in existing_indexes:
+                    continue
+                try:
+                    index.create(bind=engine, checkfirst=True)
+                except Exception:
+                    try:
+                        current_app.logger.exception('Schema sync: failed creating index %s', index.name)
+                    except Exception:
+                        pass
+
         return tables_created, columns_added
     except Exception:
         try:
@@ -6706,6 +7020,10 @@ def ensure_database_initialized():
                 # Targeted, known schema compatibility fixes (production-safe).
                 _ensure_known_backward_compat_columns(engine)
                 _backfill_user_email_verified(engine)
+                _ensure_message_search_index(engine)
+                _ensure_unread_counters(engine)
+                _ensure_catalog_search_index(engine)
+                _ensure_stock_on_hand(engine)
                 # Silently skip schema sync logs
                 # if created_tables or added_cols:
                 #     app.logger.info(
@@ -8749,7 +9067,7 @@ def admin_dashboard():
     try:
         total_drugs = db.session.query(func.count(Drug.id)).scalar()
         low_stock = db.session.query(func.count(Drug.id)).filter(
-            Drug.stocked_quantity - Drug.sold_quantity < 10
+            Drug.remaining_quantity < 10
         ).scalar()
 
         expiring_soon = db.session.query(func.count(Drug.id)).filter(
@@ -9004,29 +9322,13 @@ def get_financial_metrics(start_date: date, end_date: date, period_type: str = '
             'date_range': f"{start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
         }
         
-        # REVENUE CALCULATIONS
-        metrics.update(_calculate_revenue_metrics(start_date, end_date))
-        
-        # EXPENSE CALCULATIONS
-        metrics.update(_calculate_expense_metrics(start_date, end_date))
-        
-        # REFUNDS AND ADJUSTMENTS
-        metrics['refunds'] = float(db.session.query(func.sum(Refund.total_amount)).filter(
-            Refund.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Refund.created_at < datetime.combine(end_date, datetime.max.time())
-        ).scalar() or 0)
-        
-        # NET CALCULATIONS
-        total_revenue = metrics.get('total_revenue', 0)
-        total_expense = metrics.get('total_expense', 0)
-        refunds = metrics.get('refunds', 0)
-        
-        metrics['gross_profit'] = total_revenue - refunds
-        metrics['net_profit'] = metrics['gross_profit'] - total_expense
-        metrics['profit_margin'] = (metrics['net_profit'] / total_revenue * 100) if total_revenue > 0 else 0
-        
-        # CASH FLOW
-        metrics.update(_calculate_cashflow_metrics(start_date, end_date))
+        # REVENUE, EXPENSES, REFUNDS, NET AND CASH FLOW (from the daily rollup)
+        try:
+            metrics.update(get_financial_rollup_metrics(start_date, end_date))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Financial rollup unavailable, computing live: {str(e)}")
+            metrics.update(_calculate_live_financial_totals(start_date, end_date))
         
         # OUTSTANDING AND OVERDUE
         metrics.update(_calculate_outstanding_metrics(start_date, end_date))
@@ -9040,51 +9342,112 @@ def get_financial_metrics(start_date: date, end_date: date, period_type: str = '
         return {}
 
 
+def _calculate_live_financial_totals(start_date: date, end_date: date) -> dict:
+    """Revenue, expense, refund, net and cash-flow metrics straight from the source tables."""
+    metrics = {}
+
+    # REVENUE CALCULATIONS
+    metrics.update(_calculate_revenue_metrics(start_date, end_date))
+    
+    # EXPENSE CALCULATIONS
+    metrics.update(_calculate_expense_metrics(start_date, end_date))
+    
+    # REFUNDS AND ADJUSTMENTS
+    metrics['refunds'] = float(db.session.query(func.sum(Refund.total_amount)).filter(
+        Refund.created_at >= datetime.combine(start_date, datetime.min.time()),
+        Refund.created_at < datetime.combine(end_date, datetime.max.time())
+    ).scalar() or 0)
+    
+    # NET CALCULATIONS
+    total_revenue = metrics.get('total_revenue', 0)
+    total_expense = metrics.get('total_expense', 0)
+    refunds = metrics.get('refunds', 0)
+    
+    metrics['gross_profit'] = total_revenue - refunds
+    metrics['net_profit'] = metrics['gross_profit'] - total_expense
+    metrics['profit_margin'] = (metrics['net_profit'] / total_revenue * 100) if total_revenue > 0 else 0
+    
+    # CASH FLOW
+    metrics.update(_calculate_cashflow_metrics(start_date, end_date))
+    return metrics
+
+
+def _financial_window(start_date: date, end_date: date):
+    """Return the [start, end) datetime window covering start_date..end_date inclusive."""
+    return (
+        datetime.combine(start_date, datetime.min.time()),
+        datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+    )
+
+
+def _aggregate_bucket_sums(value_col, buckets: dict, *criteria, select_from=None, joins=(), group_by=None) -> dict:
+    """Sum value_col into several named buckets with a single scan.
+
+    Each bucket is a SQL boolean expression; rows contribute to every bucket whose
+    condition holds (CASE WHEN cond THEN value ELSE 0 END), which keeps the
+    semantics of running one filtered SUM() per bucket while touching the table once.
+    Returns {bucket_name: float}, or {group_value: {bucket_name: float}} when
+    group_by is given.
+    """
+    columns = [
+        func.coalesce(func.sum(case((cond, value_col), else_=0)), 0).label(name)
+        for name, cond in buckets.items()
+    ]
+    if group_by is not None:
+        columns.insert(0, group_by)
+    q = db.session.query(*columns)
+    if select_from is not None:
+        q = q.select_from(select_from)
+    for target in joins:
+        q = q.join(target)
+    if criteria:
+        q = q.filter(*criteria)
+    if group_by is None:
+        row = q.one()
+        return {name: float(row[idx] or 0) for idx, name in enumerate(buckets.keys())}
+    out = {}
+    for row in q.group_by(group_by).all():
+        out[row[0]] = {name: float(row[idx + 1] or 0) for idx, name in enumerate(buckets.keys())}
+    return out
+
+
+def _aggregate_grouped_sums(value_col, group_cols, *criteria) -> dict:
+    """Sum value_col grouped by group_cols in one query.
+
+    Returns {tuple(group values): float}; groups with no rows are simply absent.
+    """
+    q = db.session.query(*group_cols, func.coalesce(func.sum(value_col), 0)).filter(*criteria).group_by(*group_cols)
+    out = {}
+    for row in q.all():
+        out[tuple(row[:-1])] = float(row[-1] or 0)
+    return out
+
+
 def _calculate_revenue_metrics(start_date: date, end_date: date) -> dict:
     """Calculate revenue by category"""
     try:
-        metrics = {}
-        
-        # Pharmacy revenue
-        pharmacy_revenue = db.session.query(func.sum(SaleItem.total_price)).join(Sale).filter(
-            SaleItem.drug_id.isnot(None),
-            Sale.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Sale.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Sale.status == 'completed'
-        ).scalar() or 0
-        metrics['pharmacy_revenue'] = float(pharmacy_revenue)
-        
-        # Lab revenue
-        lab_revenue = db.session.query(func.sum(SaleItem.total_price)).join(Sale).filter(
-            SaleItem.lab_test_id.isnot(None),
-            Sale.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Sale.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Sale.status == 'completed'
-        ).scalar() or 0
-        metrics['lab_revenue'] = float(lab_revenue)
-        
-        # Imaging revenue
-        imaging_revenue = db.session.query(func.sum(SaleItem.total_price)).join(Sale).filter(
-            SaleItem.imaging_test_id.isnot(None),
-            Sale.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Sale.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Sale.status == 'completed'
-        ).scalar() or 0
-        metrics['imaging_revenue'] = float(imaging_revenue)
-        
-        # Service/Consultation revenue
-        consultation_revenue = db.session.query(func.sum(SaleItem.total_price)).join(Sale).filter(
-            SaleItem.service_id.isnot(None),
-            Sale.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Sale.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Sale.status == 'completed'
-        ).scalar() or 0
-        metrics['consultation_revenue'] = float(consultation_revenue)
-        
+        window_start, window_end = _financial_window(start_date, end_date)
+
+        # Pharmacy / lab / imaging / consultation revenue in one pass over SaleItem→Sale.
+        metrics = _aggregate_bucket_sums(
+            SaleItem.total_price,
+            {
+                'pharmacy_revenue': SaleItem.drug_id.isnot(None),
+                'lab_revenue': SaleItem.lab_test_id.isnot(None),
+                'imaging_revenue': SaleItem.imaging_test_id.isnot(None),
+                'consultation_revenue': SaleItem.service_id.isnot(None),
+            },
+            Sale.created_at >= window_start,
+            Sale.created_at < window_end,
+            Sale.status == 'completed',
+            select_from=SaleItem,
+            joins=(Sale,),
+        )
+
         # Insurance claims paid
         insurance_revenue = db.session.query(func.sum(InsuranceClaim.paid_amount)).filter(
-            InsuranceClaim.created_at >= datetime.combine(start_date, datetime.min.time()),
-            InsuranceClaim.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+            InsuranceClaim.created_at >= window_start,
+            InsuranceClaim.created_at < window_end,
             InsuranceClaim.status == 'paid'
         ).scalar() or 0
         metrics['insurance_revenue'] = float(insurance_revenue)
@@ -9093,8 +9456,8 @@ def _calculate_revenue_metrics(start_date: date, end_date: date) -> dict:
         other_revenue = db.session.query(func.sum(Transaction.amount)).filter(
             Transaction.direction == 'IN',
             Transaction.transaction_type.notin_(['sale', 'lab', 'imaging', 'insurance']),
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+            Transaction.created_at >= window_start,
+            Transaction.created_at < window_end,
             Transaction.status == 'posted'
         ).scalar() or 0
         metrics['other_revenue'] = float(other_revenue)
@@ -9122,11 +9485,12 @@ def _calculate_expense_metrics(start_date: date, end_date: date) -> dict:
     """Calculate expenses by category"""
     try:
         metrics = {}
+        window_start, window_end = _financial_window(start_date, end_date)
         
         # Payroll expenses
         payroll_expense = db.session.query(func.sum(Payroll.amount)).filter(
-            Payroll.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Payroll.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+            Payroll.created_at >= window_start,
+            Payroll.created_at < window_end,
             Payroll.status == 'pending'
         ).scalar() or 0
         metrics['payroll_expense'] = float(payroll_expense)
@@ -9139,40 +9503,26 @@ def _calculate_expense_metrics(start_date: date, end_date: date) -> dict:
         ).scalar() or 0
         metrics['pharmacy_expense'] = float(pharmacy_expense)
         
-        # Equipment and maintenance
-        equipment_expense = db.session.query(func.sum(Expense.amount)).filter(
-            Expense.expense_type.ilike('%equipment%'),
-            Expense.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Expense.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Expense.status == 'paid'
-        ).scalar() or 0
-        metrics['equipment_expense'] = float(equipment_expense)
-        
-        # Utilities
-        utilities_expense = db.session.query(func.sum(Expense.amount)).filter(
-            Expense.expense_type.ilike('%utilit%'),
-            Expense.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Expense.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Expense.status == 'paid'
-        ).scalar() or 0
-        metrics['utilities_expense'] = float(utilities_expense)
+        # Equipment, utilities and other paid expenses in one pass over Expense.
+        metrics.update(_aggregate_bucket_sums(
+            Expense.amount,
+            {
+                'equipment_expense': Expense.expense_type.ilike('%equipment%'),
+                'utilities_expense': Expense.expense_type.ilike('%utilit%'),
+                'other_expense': Expense.expense_type.notin_(['equipment', 'utility', 'payroll']),
+            },
+            Expense.created_at >= window_start,
+            Expense.created_at < window_end,
+            Expense.status == 'paid',
+        ))
         
         # Debt payments
         debt_payment = db.session.query(func.sum(DebtorPayment.amount)).filter(
-            DebtorPayment.created_at >= datetime.combine(start_date, datetime.min.time()),
-            DebtorPayment.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+            DebtorPayment.created_at >= window_start,
+            DebtorPayment.created_at < window_end
         ).scalar() or 0
         metrics['debt_payment'] = float(debt_payment)
         
-        # Other expenses
-        other_expense = db.session.query(func.sum(Expense.amount)).filter(
-            Expense.expense_type.notin_(['equipment', 'utility', 'payroll']),
-            Expense.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Expense.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Expense.status == 'paid'
-        ).scalar() or 0
-        metrics['other_expense'] = float(other_expense)
-        
         metrics['total_expense'] = (
             metrics['payroll_expense'] + 
             metrics['pharmacy_expense'] + 
@@ -9192,111 +9542,42 @@ def _calculate_expense_metrics(start_date: date, end_date: date) -> dict:
         }
 
 
+CASHFLOW_PAYMENT_METHODS = ('cash', 'mpesa', 'card', 'bank')
+
+
 def _calculate_cashflow_metrics(start_date: date, end_date: date) -> dict:
     """Calculate cash flow by payment method"""
     try:
         metrics = {}
-        
-        # Cash receipts
-        cash_in = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'IN',
-            Transaction.payment_method == 'cash',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+        window_start, window_end = _financial_window(start_date, end_date)
+
+        # One GROUP BY (direction, payment_method) instead of a SUM per combination.
+        grouped = _aggregate_grouped_sums(
+            Transaction.amount,
+            (Transaction.direction, Transaction.payment_method),
+            Transaction.direction.in_(['IN', 'OUT']),
+            Transaction.payment_method.in_(list(CASHFLOW_PAYMENT_METHODS)),
+            Transaction.created_at >= window_start,
+            Transaction.created_at < window_end,
             Transaction.status == 'posted'
-        ).scalar() or 0
-        metrics['cash_in'] = float(cash_in)
-        
-        # MPESA receipts
-        mpesa_in = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'IN',
-            Transaction.payment_method == 'mpesa',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0
-        metrics['mpesa_in'] = float(mpesa_in)
-        
-        # Card receipts
-        card_in = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'IN',
-            Transaction.payment_method == 'card',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0
-        metrics['card_in'] = float(card_in)
-        
-        # Bank transfers
-        bank_in = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'IN',
-            Transaction.payment_method == 'bank',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0
-        metrics['bank_in'] = float(bank_in)
-        
+        )
+
+        for method in CASHFLOW_PAYMENT_METHODS:
+            metrics[f'{method}_in'] = grouped.get(('IN', method), 0.0)
         metrics['total_cash_in'] = metrics['cash_in'] + metrics['mpesa_in'] + metrics['card_in'] + metrics['bank_in']
-        
-        # Similar for OUT
-        cash_out = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'OUT',
-            Transaction.payment_method == 'cash',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0
-        metrics['cash_out'] = float(cash_out)
-        
-        metrics['mpesa_out'] = float(db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'OUT',
-            Transaction.payment_method == 'mpesa',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0)
-        
-        metrics['card_out'] = float(db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'OUT',
-            Transaction.payment_method == 'card',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0)
-        
-        metrics['bank_out'] = float(db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.direction == 'OUT',
-            Transaction.payment_method == 'bank',
-            Transaction.created_at >= datetime.combine(start_date, datetime.min.time()),
-            Transaction.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
-            Transaction.status == 'posted'
-        ).scalar() or 0)
-        
+
+        for method in CASHFLOW_PAYMENT_METHODS:
+            metrics[f'{method}_out'] = grouped.get(('OUT', method), 0.0)
         metrics['total_cash_out'] = metrics['cash_out'] + metrics['mpesa_out'] + metrics['card_out'] + metrics['bank_out']
         
         # Create cashflow breakdown object for template
         metrics['cashflow_breakdown'] = {
-            'cash': {
-                'inflow': metrics['cash_in'],
-                'outflow': metrics['cash_out'],
-                'net': metrics['cash_in'] - metrics['cash_out']
-            },
-            'mpesa': {
-                'inflow': metrics['mpesa_in'],
-                'outflow': metrics['mpesa_out'],
-                'net': metrics['mpesa_in'] - metrics['mpesa_out']
-            },
-            'card': {
-                'inflow': metrics['card_in'],
-                'outflow': metrics['card_out'],
-                'net': metrics['card_in'] - metrics['card_out']
-            },
-            'bank': {
-                'inflow': metrics['bank_in'],
-                'outflow': metrics['bank_out'],
-                'net': metrics['bank_in'] - metrics['bank_out']
+            method: {
+                'inflow': metrics[f'{method}_in'],
+                'outflow': metrics[f'{method}_out'],
+                'net': metrics[f'{method}_in'] - metrics[f'{method}_out']
             }
+            for method in CASHFLOW_PAYMENT_METHODS
         }
         
         return metrics
@@ -9453,6 +9734,509 @@ def get_yearly_financial_summary(year: int = None) -> dict:
     return get_financial_metrics(start, end, 'yearly')
 
 
+# =================================================================================================
+# FINANCIAL DAILY ROLLUP
+# =================================================================================================
+#
+# Additive, day-local metrics (revenue/expense categories, refunds and cash flow) are materialized
+# per day into DepartmentRevenue / DepartmentExpense (period_type='daily') and CashFlowDaily.
+# A CashFlowDaily row doubles as the "this day is materialized" marker. Committing any change to
+# a source table bumps the marker's rollup_version and flags it stale (inserting a stale marker if
+# the day has none), so a refresh that read the older version cannot mark its result current.
+# Rollups are only written by the scheduler jobs below, in their own transaction; readers never
+# write and compute missing or stale days live with a fixed number of GROUP BY queries.
+# Point-in-time metrics (outstanding balances, distinct patient counts) are still queried live.
+
+FINANCIAL_ROLLUP_PERIOD = 'daily'
+
+# department -> metric key in get_financial_metrics()
+FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS = {
+    'pharmacy': 'pharmacy_revenue',
+    'lab': 'lab_revenue',
+    'imaging': 'imaging_revenue',
+    'consultation': 'consultation_revenue',
+    'insurance': 'insurance_revenue',
+    'other': 'other_revenue',
+}
+FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS = {
+    'payroll': 'payroll_expense',
+    'pharmacy': 'pharmacy_expense',
+    'equipment': 'equipment_expense',
+    'utilities': 'utilities_expense',
+    'debt': 'debt_payment',
+    'other': 'other_expense',
+}
+# Refunds are stored alongside revenue so a day stays self-contained; they are excluded from
+# department performance and revenue totals.
+FINANCIAL_ROLLUP_REFUNDS_DEPARTMENT = 'refunds'
+# Days the 15-minute job keeps current; older stale days wait for the nightly backfill
+# (readers compute them live meanwhile).
+FINANCIAL_ROLLUP_RECENT_DAYS = 62
+
+
+def _rollup_day(value) -> date | None:
+    """Normalize a func.date() / Date / DateTime value to a date."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+    except Exception:
+        return None
+
+
+def _empty_rollup_day() -> dict:
+    day = {key: 0.0 for key in FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS.values()}
+    day.update({key: 0.0 for key in FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS.values()})
+    day['refunds'] = 0.0
+    for method in CASHFLOW_PAYMENT_METHODS:
+        day[f'{method}_in'] = 0.0
+        day[f'{method}_out'] = 0.0
+    return day
+
+
+def _compute_financial_rollup_days(start_date: date, end_date: date) -> dict:
+    """Compute raw per-day additive metrics from the source tables.
+
+    Uses one grouped query per source table, so cost is independent of the number of days.
+    Returns {date: metrics_dict} for every day in start_date..end_date.
+    """
+    window_start, window_end = _financial_window(start_date, end_date)
+    days = {}
+    current = start_date
+    while current <= end_date:
+        days[current] = _empty_rollup_day()
+        current += timedelta(days=1)
+
+    def _merge(grouped: dict) -> None:
+        for raw_day, values in grouped.items():
+            d = _rollup_day(raw_day)
+            if d in days:
+                for key, value in values.items():
+                    days[d][key] += float(value or 0)
+
+    sale_day = func.date(Sale.created_at)
+    _merge(_aggregate_bucket_sums(
+        SaleItem.total_price,
+        {
+            'pharmacy_revenue': SaleItem.drug_id.isnot(None),
+            'lab_revenue': SaleItem.lab_test_id.isnot(None),
+            'imaging_revenue': SaleItem.imaging_test_id.isnot(None),
+            'consultation_revenue': SaleItem.service_id.isnot(None),
+        },
+        Sale.created_at >= window_start,
+        Sale.created_at < window_end,
+        Sale.status == 'completed',
+        select_from=SaleItem,
+        joins=(Sale,),
+        group_by=sale_day,
+    ))
+
+    _merge(_aggregate_bucket_sums(
+        InsuranceClaim.paid_amount,
+        {'insurance_revenue': InsuranceClaim.status == 'paid'},
+        InsuranceClaim.created_at >= window_start,
+        InsuranceClaim.created_at < window_end,
+        group_by=func.date(InsuranceClaim.created_at),
+    ))
+
+    _merge(_aggregate_bucket_sums(
+        Payroll.amount,
+        {'payroll_expense': Payroll.status == 'pending'},
+        Payroll.created_at >= window_start,
+        Payroll.created_at < window_end,
+        group_by=func.date(Payroll.created_at),
+    ))
+
+    _merge(_aggregate_bucket_sums(
+        Purchase.amount,
+        {'pharmacy_expense': Purchase.purchase_type.ilike('%drug%')},
+        Purchase.purchase_date >= start_date,
+        Purchase.purchase_date <= end_date,
+        group_by=Purchase.purchase_date,
+    ))
+
+    _merge(_aggregate_bucket_sums(
+        Expense.amount,
+        {
+            'equipment_expense': Expense.expense_type.ilike('%equipment%'),
+            'utilities_expense': Expense.expense_type.ilike('%utilit%'),
+            'other_expense': Expense.expense_type.notin_(['equipment', 'utility', 'payroll']),
+        },
+        Expense.created_at >= window_start,
+        Expense.created_at < window_end,
+        Expense.status == 'paid',
+        group_by=func.date(Expense.created_at),
+    ))
+
+    _merge({
+        key[0]: {'debt_payment': value}
+        for key, value in _aggregate_grouped_sums(
+            DebtorPayment.amount,
+            (func.date(DebtorPayment.created_at),),
+            DebtorPayment.created_at >= window_start,
+            DebtorPayment.created_at < window_end,
+        ).items()
+    })
+
+    _merge({
+        key[0]: {'refunds': value}
+        for key, value in _aggregate_grouped_sums(
+            Refund.total_amount,
+            (func.date(Refund.created_at),),
+            Refund.created_at >= window_start,
+            Refund.created_at < window_end,
+        ).items()
+    })
+
+    # Ledger: other revenue plus cash flow by (direction, payment method) in one scan.
+    ledger_buckets = {
+        'other_revenue': and_(
+            Transaction.direction == 'IN',
+            Transaction.transaction_type.notin_(['sale', 'lab', 'imaging', 'insurance']),
+        ),
+    }
+    for method in CASHFLOW_PAYMENT_METHODS:
+        ledger_buckets[f'{method}_in'] = and_(Transaction.direction == 'IN', Transaction.payment_method == method)
+        ledger_buckets[f'{method}_out'] = and_(Transaction.direction == 'OUT', Transaction.payment_method == method)
+    _merge(_aggregate_bucket_sums(
+        Transaction.amount,
+        ledger_buckets,
+        Transaction.created_at >= window_start,
+        Transaction.created_at < window_end,
+        Transaction.status == 'posted',
+        group_by=func.date(Transaction.created_at),
+    ))
+
+    return days
+
+
+def _financial_rollup_marker_versions(start_date: date, end_date: date) -> dict:
+    """Return {day: (rollup_version, is_current)} for the CashFlowDaily markers in range."""
+    return {
+        _rollup_day(flow_date): (int(version or 0), stale is False)
+        for flow_date, version, stale in db.session.query(
+            CashFlowDaily.flow_date, CashFlowDaily.rollup_version, CashFlowDaily.rollup_stale
+        ).filter(
+            CashFlowDaily.flow_date >= start_date,
+            CashFlowDaily.flow_date <= end_date,
+        ).all()
+    }
+
+
+def refresh_financial_rollup(start_date: date, end_date: date, days: set | None = None) -> int:
+    """Recompute and persist the daily rollup for start_date..end_date.
+
+    Meant for scheduler jobs, not request handlers: the current session's (read-only)
+    transaction is ended and the rollup is written in a separate transaction. A day is
+    only written if its marker version is unchanged since before the recompute, so a
+    change committed meanwhile is never hidden behind a current marker.
+    If `days` is given, only those days (within the range) are rewritten.
+    Returns the number of days written.
+    """
+    if start_date > end_date:
+        return 0
+    # Read marker versions before the source tables: any invalidation not visible here
+    # belongs to a commit the recompute below may not see either.
+    versions = _financial_rollup_marker_versions(start_date, end_date)
+    computed = _compute_financial_rollup_days(start_date, end_date)
+    # Release the read transaction; SQLite would otherwise block the write below.
+    db.session.rollback()
+    targets = sorted(d for d in computed if days is None or d in days)
+    if not targets:
+        return 0
+
+    flow_table = CashFlowDaily.__table__
+    revenue_table = DepartmentRevenue.__table__
+    expense_table = DepartmentExpense.__table__
+    written = 0
+    with db.engine.begin() as conn:
+        for d in targets:
+            values = computed[d]
+            total_receipts = sum(values[f'{m}_in'] for m in CASHFLOW_PAYMENT_METHODS)
+            total_payments = sum(values[f'{m}_out'] for m in CASHFLOW_PAYMENT_METHODS)
+            marker = dict(
+                cash_receipts=values['cash_in'],
+                mpesa_receipts=values['mpesa_in'],
+                card_receipts=values['card_in'],
+                bank_receipts=values['bank_in'],
+                total_receipts=total_receipts,
+                cash_payments=values['cash_out'],
+                mpesa_payments=values['mpesa_out'],
+                card_payments=values['card_out'],
+                bank_payments=values['bank_out'],
+                total_payments=total_payments,
+                net_change=total_receipts - total_payments,
+                rollup_stale=False,
+            )
+            try:
+                with conn.begin_nested():
+                    if d in versions:
+                        # Also takes the row lock, serializing concurrent refreshes of this day.
+                        updated = conn.execute(
+                            flow_table.update().where(
+                                flow_table.c.flow_date == d,
+                                func.coalesce(flow_table.c.rollup_version, 0) == versions[d][0],
+                            ).values(**marker)
+                        ).rowcount
+                        if updated != 1:
+                            continue  # invalidated since the versions were read
+                    else:
+                        conn.execute(flow_table.insert().values(flow_date=d, rollup_version=0, **marker))
+
+                    conn.execute(revenue_table.delete().where(
+                        revenue_table.c.period_type == FINANCIAL_ROLLUP_PERIOD,
+                        revenue_table.c.metric_date == d,
+                    ))
+                    conn.execute(expense_table.delete().where(
+                        expense_table.c.period_type == FINANCIAL_ROLLUP_PERIOD,
+                        expense_table.c.metric_date == d,
+                    ))
+                    revenue_rows = [
+                        dict(metric_date=d, period_type=FINANCIAL_ROLLUP_PERIOD,
+                             department=department, revenue_amount=values[key])
+                        for department, key in FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS.items()
+                        if values[key]
+                    ]
+                    if values['refunds']:
+                        revenue_rows.append(dict(
+                            metric_date=d, period_type=FINANCIAL_ROLLUP_PERIOD,
+                            department=FINANCIAL_ROLLUP_REFUNDS_DEPARTMENT, revenue_amount=values['refunds'],
+                        ))
+                    expense_rows = [
+                        dict(metric_date=d, period_type=FINANCIAL_ROLLUP_PERIOD,
+                             department=department, expense_amount=values[key])
+                        for department, key in FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS.items()
+                        if values[key]
+                    ]
+                    if revenue_rows:
+                        conn.execute(revenue_table.insert(), revenue_rows)
+                    if expense_rows:
+                        conn.execute(expense_table.insert(), expense_rows)
+                written += 1
+            except IntegrityError:
+                # Another refresh or an invalidation created the marker first; leave the day to it.
+                continue
+    return written
+
+
+def _ensure_financial_rollup(start_date: date, end_date: date) -> int:
+    """Materialize every day in range whose marker is missing or stale (future days are skipped).
+
+    Scheduler use only. Missing days are refreshed in contiguous runs so one old stale day
+    does not recompute the whole range. Returns the number of days written.
+    """
+    end_date = min(end_date, get_eat_today())
+    if start_date > end_date:
+        return 0
+    markers = _financial_rollup_marker_versions(start_date, end_date)
+    runs = []
+    current = start_date
+    while current <= end_date:
+        if not markers.get(current, (0, False))[1]:
+            if runs and runs[-1][1] == current - timedelta(days=1):
+                runs[-1][1] = current
+            else:
+                runs.append([current, current])
+        current += timedelta(days=1)
+    written = 0
+    for run_start, run_end in runs:
+        written += refresh_financial_rollup(run_start, run_end)
+    return written
+
+
+def _finalize_rollup_metrics(values: dict) -> dict:
+    """Derive totals/profit/cash-flow fields from raw additive rollup values."""
+    metrics = dict(values)
+    metrics['total_revenue'] = sum(metrics[k] for k in FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS.values())
+    metrics['total_expense'] = sum(metrics[k] for k in FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS.values())
+    metrics['gross_profit'] = metrics['total_revenue'] - metrics['refunds']
+    metrics['net_profit'] = metrics['gross_profit'] - metrics['total_expense']
+    metrics['profit_margin'] = (metrics['net_profit'] / metrics['total_revenue'] * 100) if metrics['total_revenue'] > 0 else 0
+    metrics['total_cash_in'] = sum(metrics[f'{m}_in'] for m in CASHFLOW_PAYMENT_METHODS)
+    metrics['total_cash_out'] = sum(metrics[f'{m}_out'] for m in CASHFLOW_PAYMENT_METHODS)
+    metrics['cashflow_breakdown'] = {
+        m: {
+            'inflow': metrics[f'{m}_in'],
+            'outflow': metrics[f'{m}_out'],
+            'net': metrics[f'{m}_in'] - metrics[f'{m}_out'],
+        }
+        for m in CASHFLOW_PAYMENT_METHODS
+    }
+    return metrics
+
+
+def _read_financial_rollup_days(start_date: date, end_date: date) -> tuple[dict, set]:
+    """Read materialized days from the rollup tables.
+
+    Returns ({date: raw values}, current_days); only days with a current marker are usable.
+    """
+    days = {}
+    current = start_date
+    while current <= end_date:
+        days[current] = _empty_rollup_day()
+        current += timedelta(days=1)
+
+    current_days = set()
+    for row in CashFlowDaily.query.filter(
+        CashFlowDaily.flow_date >= start_date,
+        CashFlowDaily.flow_date <= end_date,
+    ).all():
+        d = _rollup_day(row.flow_date)
+        if d not in days or row.rollup_stale is not False:
+            continue
+        current_days.add(d)
+        for method in CASHFLOW_PAYMENT_METHODS:
+            days[d][f'{method}_in'] = float(getattr(row, f'{method}_receipts') or 0)
+            days[d][f'{method}_out'] = float(getattr(row, f'{method}_payments') or 0)
+    if not current_days:
+        return days, current_days
+
+    revenue_keys = dict(FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS)
+    revenue_keys[FINANCIAL_ROLLUP_REFUNDS_DEPARTMENT] = 'refunds'
+    for metric_date, department, amount in db.session.query(
+        DepartmentRevenue.metric_date, DepartmentRevenue.department, DepartmentRevenue.revenue_amount
+    ).filter(
+        DepartmentRevenue.period_type == FINANCIAL_ROLLUP_PERIOD,
+        DepartmentRevenue.metric_date >= start_date,
+        DepartmentRevenue.metric_date <= end_date,
+    ).all():
+        d = _rollup_day(metric_date)
+        key = revenue_keys.get(department)
+        if d in current_days and key:
+            days[d][key] += float(amount or 0)
+
+    for metric_date, department, amount in db.session.query(
+        DepartmentExpense.metric_date, DepartmentExpense.department, DepartmentExpense.expense_amount
+    ).filter(
+        DepartmentExpense.period_type == FINANCIAL_ROLLUP_PERIOD,
+        DepartmentExpense.metric_date >= start_date,
+        DepartmentExpense.metric_date <= end_date,
+    ).all():
+        d = _rollup_day(metric_date)
+        key = FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS.get(department)
+        if d in current_days and key:
+            days[d][key] += float(amount or 0)
+
+    return days, current_days
+
+
+def get_financial_rollup_days(start_date: date, end_date: date) -> dict:
+    """Return {date: metrics} for every day in range, read from the daily rollup.
+
+    Read-only: days without a current marker (today, just-changed days, days the scheduler
+    has not built yet) are computed live from the source tables instead. Each day's dict
+    carries the same revenue, expense, refund, profit and cash-flow keys as get_financial_metrics().
+    """
+    try:
+        days, current_days = _read_financial_rollup_days(start_date, end_date)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Financial rollup unreadable, computing live: {str(e)}")
+        days, current_days = {}, set()
+        current = start_date
+        while current <= end_date:
+            days[current] = _empty_rollup_day()
+            current += timedelta(days=1)
+
+    live_days = sorted(d for d in days if d not in current_days and d <= get_eat_today())
+    if live_days:
+        computed = _compute_financial_rollup_days(live_days[0], live_days[-1])
+        for d in live_days:
+            days[d] = computed[d]
+
+    return {d: _finalize_rollup_metrics(values) for d, values in days.items()}
+
+
+def sum_financial_rollup_days(day_metrics) -> dict:
+    """Sum per-day rollup metrics (from get_financial_rollup_days) into one period."""
+    total = _empty_rollup_day()
+    for values in day_metrics:
+        for key in total:
+            total[key] += float(values.get(key) or 0)
+    return _finalize_rollup_metrics(total)
+
+
+def get_financial_rollup_metrics(start_date: date, end_date: date) -> dict:
+    """Additive financial metrics for a range, read from the daily rollup."""
+    return sum_financial_rollup_days(get_financial_rollup_days(start_date, end_date).values())
+
+
+def _financial_rollup_source_day(obj) -> set:
+    """Return the rollup days touched by a pending change to a source-table row."""
+    days = set()
+    attr_name = 'purchase_date' if isinstance(obj, Purchase) else 'created_at'
+    try:
+        hist = sa_inspect(obj).attrs[attr_name].history
+        values = list(hist.added or []) + list(hist.unchanged or []) + list(hist.deleted or [])
+    except Exception:
+        values = [getattr(obj, attr_name, None)]
+    if isinstance(obj, SaleItem):
+        # Only use the parent sale if it is already loaded; never lazy-load inside a flush.
+        sale = obj.__dict__.get('sale')
+        if sale is not None:
+            values.append(getattr(sale, 'created_at', None))
+    for v in values:
+        d = _rollup_day(v)
+        if d is not None:
+            days.add(d)
+    return days
+
+
+_FINANCIAL_ROLLUP_SOURCES = (Sale, SaleItem, Refund, Transaction, Expense, Payroll, Purchase, DebtorPayment, InsuranceClaim)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _financial_rollup_track_changes(session, flush_context):
+    try:
+        dirty_days = session.info.setdefault('financial_rollup_dirty_days', set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, _FINANCIAL_ROLLUP_SOURCES):
+                dirty_days.update(_financial_rollup_source_day(obj))
+                if not getattr(obj, 'created_at', None) and not isinstance(obj, Purchase):
+                    dirty_days.add(get_eat_today())
+    except Exception:
+        pass
+
+
+@event.listens_for(db.session, 'after_commit')
+def _financial_rollup_invalidate(session):
+    dirty_days = session.info.pop('financial_rollup_dirty_days', None)
+    if not dirty_days:
+        return
+    # The committing session can no longer emit SQL here; use a short separate transaction.
+    # Markers are versioned rather than deleted, so a refresh that computed before this commit
+    # cannot write its (stale) result back as current.
+    table = CashFlowDaily.__table__
+    try:
+        with db.engine.begin() as conn:
+            for d in sorted(dirty_days):
+                bump = table.update().where(table.c.flow_date == d).values(
+                    rollup_version=func.coalesce(table.c.rollup_version, 0) + 1,
+                    rollup_stale=True,
+                )
+                if conn.execute(bump).rowcount:
+                    continue
+                try:
+                    with conn.begin_nested():
+                        conn.execute(table.insert().values(flow_date=d, rollup_version=1, rollup_stale=True))
+                except IntegrityError:
+                    conn.execute(bump)  # a refresh inserted the marker meanwhile
+    except Exception as e:
+        try:
+            app.logger.warning(f"Financial rollup invalidation failed: {e}")
+        except Exception:
+            pass
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _financial_rollup_discard_changes(session):
+    session.info.pop('financial_rollup_dirty_days', None)
+
+
 # Backup utility functions (implementation is below under BACKUP IMPLEMENTATION)
 
 @app.route('/admin/beds', methods=['GET', 'POST'])
@@ -11411,8 +12195,9 @@ def api_financial_dashboard_daily():
             total_expense = 0
             total_profit = 0
             
+            rollup_days = get_financial_rollup_days(start_date, end_date)
             while current <= end_date:
-                metrics = get_daily_financial_summary(current)
+                metrics = rollup_days[current]
                 daily_data.append({
                     'date': current,
                     'revenue': metrics.get('total_revenue', 0),
@@ -11679,8 +12464,15 @@ def api_financial_dashboard_monthly():
             total_expense = 0
             total_profit = 0
             
+            last_day = calendar.monthrange(end_date.year, end_date.month)[1]
+            rollup_days = get_financial_rollup_days(
+                date(start_date.year, start_date.month, 1),
+                date(end_date.year, end_date.month, last_day)
+            )
             while (current_year, current_month) <= (end_date.year, end_date.month):
-                m_metrics = get_monthly_financial_summary(current_year, current_month)
+                m_metrics = sum_financial_rollup_days(
+                    v for d, v in rollup_days.items() if (d.year, d.month) == (current_year, current_month)
+                )
                 monthly_data.append({
                     'year': current_year,
                     'month': current_month,
@@ -11908,8 +12700,9 @@ def api_financial_dashboard_yearly():
             total_expense = 0
             total_profit = 0
             
+            rollup_days = get_financial_rollup_days(date(start_date.year, 1, 1), date(end_date.year, 12, 31))
             for y in range(start_date.year, end_date.year + 1):
-                y_metrics = get_yearly_financial_summary(y)
+                y_metrics = sum_financial_rollup_days(v for d, v in rollup_days.items() if d.year == y)
                 yearly_data.append({
                     'year': y,
                     'revenue': y_metrics.get('total_revenue', 0),
@@ -12047,9 +12840,10 @@ def api_financial_dashboard_yearly_daily_breakdown():
         days_in_month = calendar.monthrange(year, month)[1]
 
         daily_rows = []
+        rollup_days = get_financial_rollup_days(date(year, month, 1), date(year, month, days_in_month))
         for day in range(1, days_in_month + 1):
             target_date = date(year, month, day)
-            metrics = get_daily_financial_summary(target_date)
+            metrics = rollup_days[target_date]
 
             revenue_breakdown = {
                 'pharmacy': metrics.get('pharmacy_revenue', 0),
@@ -12125,9 +12919,10 @@ def api_financial_dashboard_yearly_export():
             writer.writerow(['Date', 'Total Income (KES)', 'Total Expense (KES)', 'Net Profit (KES)', 'Margin %'])
 
             days_in_month = calendar.monthrange(year, month)[1]
+            rollup_days = get_financial_rollup_days(date(year, month, 1), date(year, month, days_in_month))
             for day in range(1, days_in_month + 1):
                 target_date = date(year, month, day)
-                metrics = get_daily_financial_summary(target_date)
+                metrics = rollup_days[target_date]
                 writer.writerow([
                     target_date.strftime('%Y-%m-%d'),
                     round(metrics.get('total_revenue', 0), 2),
@@ -12165,27 +12960,30 @@ def _calculate_percentage_change(old_value: float, new_value: float) -> float:
 def _get_daily_breakdown(start_date: date, end_date: date) -> list:
     """Get daily metrics breakdown for a date range"""
     breakdown = []
-    current = start_date
-    while current <= end_date:
-        metrics = get_daily_financial_summary(current)
+    for current, metrics in sorted(get_financial_rollup_days(start_date, end_date).items()):
         breakdown.append({
             'date': current,
             'revenue': metrics.get('total_revenue', 0),
             'expense': metrics.get('total_expense', 0),
             'profit': metrics.get('net_profit', 0)
         })
-        current += timedelta(days=1)
     return breakdown
 
 
 def _get_weekly_breakdown(start_date: date, end_date: date) -> list:
     """Get weekly metrics breakdown for a date range"""
     breakdown = []
+    if start_date > end_date:
+        return breakdown
+    first_week_start = start_date - timedelta(days=start_date.weekday())
+    days = get_financial_rollup_days(first_week_start, end_date)
     current = start_date
     while current <= end_date:
         week_start = current - timedelta(days=current.weekday())
         week_end = min(week_start + timedelta(days=6), end_date)
-        metrics = get_financial_metrics(week_start, week_end, 'weekly')
+        metrics = sum_financial_rollup_days(
+            days[week_start + timedelta(days=i)] for i in range((week_end - week_start).days + 1)
+        )
         breakdown.append({
             'start_date': week_start,
             'end_date': week_end,
@@ -12202,8 +13000,9 @@ def _get_weekly_breakdown(start_date: date, end_date: date) -> list:
 def _get_monthly_breakdown(year: int) -> list:
     """Get monthly metrics breakdown for a year with detailed revenue and expense breakdowns"""
     breakdown = []
+    days = get_financial_rollup_days(date(year, 1, 1), date(year, 12, 31))
     for month in range(1, 13):
-        metrics = get_monthly_financial_summary(year, month)
+        metrics = sum_financial_rollup_days(v for d, v in days.items() if d.month == month)
         month_name = datetime(year, month, 1).strftime('%B')
         month_abbr = datetime(year, month, 1).strftime('%b')
         total_revenue = metrics.get('total_revenue', 0)
@@ -12218,19 +13017,19 @@ def _get_monthly_breakdown(year: int) -> list:
             'profit': metrics.get('net_profit', 0),
             'margin': (metrics.get('net_profit', 0) / total_revenue * 100) if total_revenue > 0 else 0,
             # Revenue breakdown by source (always present)
-            'pharmacy_revenue': metrics.get('pharmacy_revenue', 0) if metrics.get('pharmacy_revenue') is not None else 0,
-            'lab_revenue': metrics.get('lab_revenue', 0) if metrics.get('lab_revenue') is not None else 0,
-            'imaging_revenue': metrics.get('imaging_revenue', 0) if metrics.get('imaging_revenue') is not None else 0,
-            'consultation_revenue': metrics.get('consultation_revenue', 0) if metrics.get('consultation_revenue') is not None else 0,
-            'insurance_revenue': metrics.get('insurance_revenue', 0) if metrics.get('insurance_revenue') is not None else 0,
-            'other_revenue': metrics.get('other_revenue', 0) if metrics.get('other_revenue') is not None else 0,
+            'pharmacy_revenue': metrics.get('pharmacy_revenue', 0),
+            'lab_revenue': metrics.get('lab_revenue', 0),
+            'imaging_revenue': metrics.get('imaging_revenue', 0),
+            'consultation_revenue': metrics.get('consultation_revenue', 0),
+            'insurance_revenue': metrics.get('insurance_revenue', 0),
+            'other_revenue': metrics.get('other_revenue', 0),
             # Expense breakdown by category (always present)
-            'payroll_expense': metrics.get('payroll_expense', 0) if metrics.get('payroll_expense') is not None else 0,
-            'pharmacy_expense': metrics.get('pharmacy_expense', 0) if metrics.get('pharmacy_expense') is not None else 0,
-            'equipment_expense': metrics.get('equipment_expense', 0) if metrics.get('equipment_expense') is not None else 0,
-            'utilities_expense': metrics.get('utilities_expense', 0) if metrics.get('utilities_expense') is not None else 0,
-            'debt_payment': metrics.get('debt_payment', 0) if metrics.get('debt_payment') is not None else 0,
-            'other_expense': metrics.get('other_expense', 0) if metrics.get('other_expense') is not None else 0
+            'payroll_expense': metrics.get('payroll_expense', 0),
+            'pharmacy_expense': metrics.get('pharmacy_expense', 0),
+            'equipment_expense': metrics.get('equipment_expense', 0),
+            'utilities_expense': metrics.get('utilities_expense', 0),
+            'debt_payment': metrics.get('debt_payment', 0),
+            'other_expense': metrics.get('other_expense', 0)
         })
     return breakdown
 
@@ -12265,30 +13064,19 @@ def _get_budget_variance(year: int, month: int) -> dict:
 def _get_department_performance(start_date: date, end_date: date) -> dict:
     """Get department-wise revenue and expense performance"""
     try:
-        dept_revenue = db.session.query(
-            DepartmentRevenue.department,
-            func.sum(DepartmentRevenue.revenue_amount).label('total_revenue')
-        ).filter(
-            DepartmentRevenue.metric_date >= start_date,
-            DepartmentRevenue.metric_date <= end_date
-        ).group_by(DepartmentRevenue.department).all()
-        
-        dept_expense = db.session.query(
-            DepartmentExpense.department,
-            func.sum(DepartmentExpense.expense_amount).label('total_expense')
-        ).filter(
-            DepartmentExpense.metric_date >= start_date,
-            DepartmentExpense.metric_date <= end_date
-        ).group_by(DepartmentExpense.department).all()
-        
+        metrics = get_financial_rollup_metrics(start_date, end_date)
+
         departments = {}
-        for dept, revenue in dept_revenue:
-            departments[dept] = {'revenue': float(revenue or 0), 'expense': 0}
+        for dept, key in FINANCIAL_ROLLUP_REVENUE_DEPARTMENTS.items():
+            if metrics.get(key):
+                departments[dept] = {'revenue': float(metrics[key]), 'expense': 0}
         
-        for dept, expense in dept_expense:
+        for dept, key in FINANCIAL_ROLLUP_EXPENSE_DEPARTMENTS.items():
+            if not metrics.get(key):
+                continue
             if dept not in departments:
                 departments[dept] = {'revenue': 0, 'expense': 0}
-            departments[dept]['expense'] = float(expense or 0)
+            departments[dept]['expense'] = float(metrics[key])
         
         dept_perf = []
         for dept, data in departments.items():
@@ -15114,7 +15902,13 @@ BACKUP_CONFIG = {
         'debtors', 'drug', 'drug_dosage', 'employees', 'expenses', 
         'patients', 'patient_services', 'payroll', 'purchase_items', 'purchases', 'sales', 
         'service_items', 'services', 'transactions', 'user', 'wards'
-    ]
+    ],
+    'export_workers': max(1, int(Config.BACKUP_EXPORT_WORKERS or 1)),
+    'chunk_size_bytes': max(64 * 1024, int(Config.BACKUP_CHUNK_SIZE_BYTES or 0)),
+    'restore_batch_rows': max(1, int(Config.BACKUP_RESTORE_BATCH_ROWS or 1)),
+    'incremental_enabled': bool(Config.BACKUP_INCREMENTAL_ENABLED),
+    'full_interval_days': max(1, int(Config.BACKUP_FULL_INTERVAL_DAYS or 1)),
+    'max_increments': max(1, int(Config.BACKUP_MAX_INCREMENTS or 1)),
 }
 if not BACKUP_CONFIG['encryption_key']:
     raise RuntimeError("Missing BACKUP_ENCRYPTION_KEY")
@@ -15270,14 +16064,10 @@ def backup_management():
                         mimetype='application/octet-stream'
                     )
                 else:
-                    # Decrypt in memory to avoid writing sensitive data to disk
+                    # Decrypt on the fly to avoid writing sensitive data to disk
+                    # (chunked backups stream; legacy ones are decrypted in memory).
                     try:
-                        encrypted_data = backup_file.read()
-                        cipher = Fernet(BACKUP_CONFIG['encryption_key'].encode())
-                        decrypted_data = cipher.decrypt(encrypted_data)
-                        
-                        # Create an in-memory file-like object
-                        decrypted_file = io.BytesIO(decrypted_data)
+                        decrypted_file = open_backup_plaintext(backup_file, BACKUP_CONFIG['encryption_key'])
                         
                         response = send_file(
                             decrypted_file,
@@ -15306,6 +16096,11 @@ def backup_management():
                     flash('Backups are immutable and cannot be deleted (override disabled).', 'warning')
                     return redirect(url_for('backup_management'))
 
+                # Incrementals replay on top of their parents; keep the chain intact.
+                if BackupRecord.query.filter_by(parent_backup_id=backup.backup_id).first():
+                    flash('This backup is the base of later incremental backups and cannot be deleted.', 'warning')
+                    return redirect(url_for('backup_management'))
+
                 # Delete from storage
                 delete_backup_file(backup)
                 
@@ -16186,6 +16981,78 @@ def backup_schedule_update():
     return redirect(url_for('backup_management'))
 
 
+@app.route('/admin/scheduler/runs')
+@login_required
+def scheduler_job_runs():
+    if current_user.role != 'admin':
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('home'))
+
+    job_filter = (request.args.get('job') or '').strip()
+    lease = None
+    runs = []
+    summaries = []
+    try:
+        lease = db.session.get(SchedulerLease, SCHEDULER_LEASE_NAME)
+
+        q = SchedulerJobRun.query
+        if job_filter:
+            q = q.filter(SchedulerJobRun.job_id == job_filter)
+        runs = q.order_by(SchedulerJobRun.started_at.desc(), SchedulerJobRun.id.desc()).limit(200).all()
+
+        rows = (
+            db.session.query(
+                SchedulerJobRun.job_id,
+                func.count(SchedulerJobRun.id),
+                func.max(SchedulerJobRun.started_at),
+                func.avg(SchedulerJobRun.duration_ms),
+                func.max(SchedulerJobRun.duration_ms),
+                func.sum(case((SchedulerJobRun.status == 'failed', 1), else_=0)),
+            )
+            .group_by(SchedulerJobRun.job_id)
+            .order_by(SchedulerJobRun.job_id)
+            .all()
+        )
+        summaries = [
+            {
+                'job_id': job_id,
+                'runs': int(count or 0),
+                'last_started_at': last_started,
+                'avg_ms': int(avg_ms) if avg_ms is not None else None,
+                'max_ms': int(max_ms) if max_ms is not None else None,
+                'failures': int(failures or 0),
+            }
+            for job_id, count, last_started, avg_ms, max_ms, failures in rows
+        ]
+    except Exception as e:
+        app.logger.error(f'Error loading scheduler job runs: {e}')
+        flash('Scheduler history is not available yet.', 'warning')
+
+    local_lease = _scheduler_lease_obj
+    return render_template(
+        'admin/scheduler_runs.html',
+        lease=lease,
+        lease_active=bool(lease and lease.expires_at and lease.expires_at > datetime.now(timezone.utc).replace(tzinfo=None)),
+        this_worker=local_lease.holder if local_lease else None,
+        runs=runs,
+        summaries=summaries,
+        job_filter=job_filter,
+    )
+
+
+@app.route('/admin/db/pool-stats')
+@login_required
+def db_pool_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    pool = db.engine.pool
+    data = {'pool_class': type(pool).__name__, 'status': pool.status()}
+    if hasattr(pool, 'stats'):
+        data.update(pool.stats())
+    return jsonify(data)
+
+
 @app.route('/admin/backup/access/set', methods=['POST'])
 @login_required
 def backup_access_set_for_admin():
@@ -16409,6 +17276,8 @@ def backup_status(backup_id):
         'status': backup.status,
         'timestamp': isoformat_eat(backup.timestamp),
         'size_bytes': backup.size_bytes,
+        'backup_mode': backup.backup_mode or 'full',
+        'parent_backup_id': backup.parent_backup_id,
         'notes': _backup_strip_restore_status(_backup_strip_stats(backup.notes)),
         'stats': stats,
         'restore': restore,
@@ -16430,6 +17299,7 @@ def backup_logs():
         'timestamp': isoformat_eat(b.timestamp),
         'type': b.backup_type,
         'status': b.status,
+        'mode': b.backup_mode or 'full',
         'size_mb': round(b.size_bytes / (1024 * 1024), 2) if b.size_bytes else None,
         'user': b.user.username if b.user else 'System'
     } for b in backups])
@@ -16637,6 +17507,18 @@ def _compute_sha256_bytes(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
 
+def _compute_sha256_stream(fh) -> str:
+    h = hashlib.sha256()
+    fh.seek(0)
+    while True:
+        chunk = fh.read(1024 * 1024)
+        if not chunk:
+            break
+        h.update(chunk)
+    fh.seek(0)
+    return h.hexdigest()
+
+
 def _is_main_admin(user: User) -> bool:
     # Simplest interpretation: the first admin user is the "main admin".
     try:
@@ -16756,11 +17638,11 @@ def _send_backup_email(
         app.logger.error(f"Failed to start backup email thread: {e}")
 
 
-def _restore_table_order(engine, tables: list[str]) -> list[str]:
+def _restore_table_order(bind, tables: list[str]) -> list[str]:
     try:
         from sqlalchemy import inspect as sa_inspect
 
-        insp = sa_inspect(engine)
+        insp = sa_inspect(bind)
         existing = set(insp.get_table_names())
         tables = [t for t in tables if t in existing]
 
@@ -16793,138 +17675,681 @@ def _restore_table_order(engine, tables: list[str]) -> list[str]:
         return tables
 
 
-def _restore_zip_to_engine(engine, zip_bytes: bytes, allowed_tables: set[str] | None) -> dict:
-    from sqlalchemy import inspect as sa_inspect
+_RESTORE_PROGRESS_INTERVAL_SECONDS = 5.0
+# Keys per DELETE ... IN (...) statement; stays under SQLite's bound-parameter limit.
+_RESTORE_DELETE_CHUNK = 500
 
-    insp = sa_inspect(engine)
-    existing_tables = set(insp.get_table_names())
 
-    with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as z:
-        try:
-            metadata = json.loads(z.read('metadata.json').decode('utf-8'))
-        except Exception:
-            metadata = {}
+def _restore_upsert_statement(conn, table, pk_col, columns):
+    """Build an insert-or-update-by-primary-key statement, or None if the dialect has no upsert."""
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    stmt = dialect_insert(table)
+    update_cols = {k: stmt.excluded[k] for k in columns if k != pk_col.name}
+    if not update_cols:
+        return stmt.on_conflict_do_nothing(index_elements=[pk_col.name])
+    return stmt.on_conflict_do_update(index_elements=[pk_col.name], set_=update_cols)
 
-        tables_in_backup = metadata.get('tables_backed_up') or []
-        if not tables_in_backup:
-            for name in z.namelist():
-                if name.endswith('.ndjson'):
-                    tables_in_backup.append(name[:-len('.ndjson')])
-                elif name.endswith('.json') and name != 'metadata.json':
-                    tables_in_backup.append(name[:-len('.json')])
-            tables_in_backup = sorted(set(tables_in_backup))
 
-        restore_tables = [t for t in tables_in_backup if _safe_table_name(t) and t in existing_tables]
-        if allowed_tables:
-            filtered = [t for t in restore_tables if t in allowed_tables]
-            if filtered:
-                restore_tables = filtered
+def _restore_delete_keys(conn, table, pk_col, keys: list) -> None:
+    for i in range(0, len(keys), _RESTORE_DELETE_CHUNK):
+        conn.execute(table.delete().where(pk_col.in_(keys[i:i + _RESTORE_DELETE_CHUNK])))
 
-        restore_tables = _restore_table_order(engine, restore_tables)
 
-        restored_counts: dict[str, int] = {}
+def _restore_apply_key_manifest(conn, table, pk_col, z, member: str) -> int:
+    """Delete rows whose primary key is absent from an incremental's key manifest."""
+    from sqlalchemy import select as sa_select
 
-        with engine.begin() as conn:
-            try:
-                if insp.dialect.name == 'sqlite':
-                    conn.execute(text('PRAGMA foreign_keys=OFF'))
-            except Exception:
-                pass
+    keep = set()
+    with z.open(member) as fh:
+        for raw_line in fh:
+            line = raw_line.strip()
+            if not line:
+                continue
+            value = json.loads(line).get(pk_col.name)
+            if value is not None:
+                keep.add(int(value))
+    stale = [pk for (pk,) in conn.execute(sa_select(pk_col)) if pk is not None and int(pk) not in keep]
+    _restore_delete_keys(conn, table, pk_col, stale)
+    return len(stale)
 
-            for table_name in restore_tables:
-                # Strict identifier allowlist: only operate on real existing tables
-                # with safe identifier shape.
-                if not _safe_table_name(table_name) or table_name not in existing_tables:
-                    continue
-                table_sql = _quote_ident(table_name)
-                ndjson_name = f"{table_name}.ndjson"
-                json_name = f"{table_name}.json"
-                if ndjson_name not in z.namelist() and json_name not in z.namelist():
-                    continue
 
-                meta = MetaData()
-                table = Table(table_name, meta, autoload_with=engine)
-                col_names = set(c.name for c in table.columns)
-                col_by_name = {c.name: c for c in table.columns}
+def _restore_reset_sequences(conn, tables) -> None:
+    """Move PostgreSQL serial sequences past restored explicit ids."""
+    if conn.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        pk_col, _ = _backup_watermark_columns(table)
+        if pk_col is None:
+            continue
+        try:
+            conn.execute(
+                text(
+                    f'SELECT setval(pg_get_serial_sequence(:t, :c), '
+                    f'COALESCE(MAX({_quote_ident(pk_col.name)}), 0) + 1, false) '
+                    f'FROM {_quote_ident(table.name)}'
+                ),
+                {'t': table.name, 'c': pk_col.name},
+            )
+        except Exception as e:
+            app.logger.warning(f'Could not reset sequence for {table.name}: {e}')
 
-                # Clear
-                if insp.dialect.name == 'postgresql':
-                    conn.execute(text(f'TRUNCATE TABLE {table_sql} RESTART IDENTITY CASCADE'))
-                else:
-                    # Use SQLAlchemy Core to avoid string-SQL for data deletes.
-                    conn.execute(table.delete())
-                    if insp.dialect.name == 'sqlite':
-                        try:
-                            conn.execute(text('DELETE FROM sqlite_sequence WHERE name=:n'), {'n': table_name})
-                        except Exception:
-                            pass
 
-                inserted = 0
-                batch: list[dict] = []
-                batch_size = 1000
+def _restore_zip_to_engine(
+    engine,
+    zip_source,
+    allowed_tables: set[str] | None,
+    *,
+    increments=(),
+    batch_size: int | None = None,
+    progress=None,
+) -> dict:
+    """Restore tables from a backup zip (plus any incrementals) into `engine` in one transaction.
+
+    `zip_source` and each entry of `increments` are either zip bytes or seekable
+    plaintext file objects (see `open_backup_seekable`), so large archives are
+    read member by member and line by line. The first archive replaces each
+    table's contents; incrementals, applied in order, first drop rows missing
+    from their key manifests and then upsert their rows by primary key. Rows
+    are written with executemany in batches of `batch_size`. `progress`, if
+    given, is called with a status dict after each table and periodically
+    within large tables.
+    """
+    from sqlalchemy import inspect as sa_inspect
 
-                def flush_batch():
-                    nonlocal inserted, batch
-                    if batch:
+    insp = sa_inspect(engine)
+    existing_tables = set(insp.get_table_names())
+    batch_size = max(1, int(batch_size or BACKUP_CONFIG.get('restore_batch_rows') or 1000))
+    archives = [zip_source, *increments]
+
+    restored_counts: dict[str, int] = {}
+    deleted_counts: dict[str, int] = {}
+    touched: dict[str, object] = {}
+    started = time.monotonic()
+    total_inserted = 0
+    last_report = started
+    state = {'archive': 0, 'tables_total': 0, 'tables_done': 0}
+
+    def report(current_table: str | None, table_rows: int, force: bool = False) -> None:
+        nonlocal last_report
+        if progress is None:
+            return
+        now = time.monotonic()
+        if not force and now - last_report < _RESTORE_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_report = now
+        elapsed = max(now - started, 1e-6)
+        rows_so_far = total_inserted + table_rows
+        try:
+            progress({
+                'archive': state['archive'],
+                'archives_total': len(archives),
+                'tables_total': state['tables_total'],
+                'tables_done': state['tables_done'],
+                'current_table': current_table,
+                'current_table_rows': table_rows,
+                'rows_restored': rows_so_far,
+                'elapsed_seconds': round(elapsed, 1),
+                'rows_per_second': int(rows_so_far / elapsed),
+            })
+        except Exception:
+            pass
+
+    with engine.begin() as conn:
+        try:
+            if insp.dialect.name == 'sqlite':
+                conn.execute(text('PRAGMA foreign_keys=OFF'))
+        except Exception:
+            pass
+
+        for position, source in enumerate(archives):
+            zip_fh = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+            with zipfile.ZipFile(zip_fh, 'r') as z:
+                names = set(z.namelist())
+                try:
+                    metadata = json.loads(z.read('metadata.json').decode('utf-8'))
+                except Exception:
+                    metadata = {}
+                incremental = position > 0 and metadata.get('backup_mode') == 'incremental'
+
+                tables_in_backup = metadata.get('tables_backed_up') or []
+                if not tables_in_backup:
+                    for name in names:
+                        if name.endswith('.ndjson'):
+                            tables_in_backup.append(name[:-len('.ndjson')])
+                        elif name.endswith('.json') and name != 'metadata.json':
+                            tables_in_backup.append(name[:-len('.json')])
+                    tables_in_backup = sorted(set(tables_in_backup))
+
+                restore_tables = [t for t in tables_in_backup if _safe_table_name(t) and t in existing_tables]
+                if allowed_tables:
+                    filtered = [t for t in restore_tables if t in allowed_tables]
+                    if filtered:
+                        restore_tables = filtered
+
+                # Inspect through the restore connection: on SQLite a second connection
+                # would block on this transaction's write lock.
+                restore_tables = _restore_table_order(conn, restore_tables)
+                restore_tables = [t for t in restore_tables if f"{t}.ndjson" in names or f"{t}.json" in names]
+                reflected, _ = _reflect_backup_tables(conn, restore_tables)
+                state.update(archive=position + 1, tables_total=len(restore_tables), tables_done=0)
+
+                if incremental:
+                    # Deletions run child-first so parents are never removed under their children.
+                    for table_name in reversed(restore_tables):
+                        table = reflected.get(table_name)
+                        member = f"{table_name}.keys.ndjson"
+                        if table is None or member not in names:
+                            continue
+                        pk_col, _ = _backup_watermark_columns(table)
+                        if pk_col is None:
+                            continue
+                        deleted = _restore_apply_key_manifest(conn, table, pk_col, z, member)
+                        deleted_counts[table_name] = deleted_counts.get(table_name, 0) + deleted
+
+                for table_name in restore_tables:
+                    # Strict identifier allowlist: only operate on real existing tables
+                    # with safe identifier shape.
+                    if not _safe_table_name(table_name) or table_name not in existing_tables:
+                        continue
+                    table = reflected.get(table_name)
+                    if table is None:
+                        table = Table(table_name, MetaData(), autoload_with=conn)
+                    touched[table_name] = table
+                    table_sql = _quote_ident(table_name)
+                    ndjson_name = f"{table_name}.ndjson"
+                    json_name = f"{table_name}.json"
+                    col_by_name = {c.name: c for c in table.columns}
+                    pk_col, _ = _backup_watermark_columns(table)
+                    upsert = incremental and pk_col is not None
+
+                    # Clear; incrementals merge into what earlier archives restored instead.
+                    if not upsert:
+                        if insp.dialect.name == 'postgresql' and not incremental:
+                            conn.execute(text(f'TRUNCATE TABLE {table_sql} RESTART IDENTITY CASCADE'))
+                        else:
+                            # Use SQLAlchemy Core to avoid string-SQL for data deletes.
+                            conn.execute(table.delete())
+                            if insp.dialect.name == 'sqlite':
+                                try:
+                                    conn.execute(text('DELETE FROM sqlite_sequence WHERE name=:n'), {'n': table_name})
+                                except Exception:
+                                    pass
+
+                    inserted = 0
+                    batch: list[dict] = []
+                    insert_stmt = table.insert()
+                    upsert_stmts: dict[tuple, object] = {}
+
+                    def add_row(row) -> None:
+                        nonlocal inserted, batch
+                        if not isinstance(row, dict):
+                            return
                         # Coerce values to column types (esp. SQLite Date/DateTime).
-                        to_insert = []
-                        for row in batch:
-                            if not isinstance(row, dict):
+                        coerced = {}
+                        for k, v in row.items():
+                            col = col_by_name.get(k)
+                            if col is None:
                                 continue
-                            coerced = dict(row)
-                            for k, v in list(coerced.items()):
-                                col = col_by_name.get(k)
-                                if col is None:
-                                    continue
-                                coerced[k] = _restore_coerce_value_for_column(col, v)
-                            to_insert.append(coerced)
-                        if to_insert:
-                            conn.execute(table.insert(), to_insert)
+                            coerced[k] = _restore_coerce_value_for_column(col, _restore_value(v))
+                        batch.append(coerced)
+                        if len(batch) >= batch_size:
+                            flush_batch()
+
+                    def flush_batch() -> None:
+                        nonlocal inserted, batch
+                        if not batch:
+                            return
+                        if upsert:
+                            columns = tuple(batch[0].keys())
+                            if columns not in upsert_stmts:
+                                upsert_stmts[columns] = _restore_upsert_statement(conn, table, pk_col, columns)
+                            stmt = upsert_stmts[columns]
+                            if stmt is None:
+                                keys = [r[pk_col.name] for r in batch if r.get(pk_col.name) is not None]
+                                _restore_delete_keys(conn, table, pk_col, keys)
+                                conn.execute(insert_stmt, batch)
+                            else:
+                                conn.execute(stmt, batch)
+                        else:
+                            conn.execute(insert_stmt, batch)
                         inserted += len(batch)
                         batch = []
+                        report(table_name, inserted)
 
-                if ndjson_name in z.namelist():
-                    with z.open(ndjson_name) as fh:
-                        for raw_line in fh:
-                            line = raw_line.decode('utf-8').strip()
-                            if not line:
-                                continue
-                            row = json.loads(line)
-                            if not isinstance(row, dict):
-                                continue
-                            restored = {k: _restore_value(v) for k, v in row.items() if k in col_names}
-                            batch.append(restored)
-                            if len(batch) >= batch_size:
-                                flush_batch()
+                    if ndjson_name in names:
+                        with z.open(ndjson_name) as fh:
+                            for raw_line in fh:
+                                line = raw_line.strip()
+                                if not line:
+                                    continue
+                                add_row(json.loads(line))
+                    else:
+                        rows = json.loads(z.read(json_name).decode('utf-8'))
+                        if isinstance(rows, list):
+                            for row in rows:
+                                add_row(row)
                     flush_batch()
-                else:
-                    rows = json.loads(z.read(json_name).decode('utf-8'))
-                    if isinstance(rows, list):
-                        for row in rows:
-                            if not isinstance(row, dict):
-                                continue
-                            restored = {k: _restore_value(v) for k, v in row.items() if k in col_names}
-                            batch.append(restored)
-                            if len(batch) >= batch_size:
-                                flush_batch()
-                        flush_batch()
 
-                restored_counts[table_name] = inserted
+                    restored_counts[table_name] = restored_counts.get(table_name, 0) + inserted
+                    total_inserted += inserted
+                    state['tables_done'] += 1
+                    report(None, 0, force=True)
 
-            try:
-                if insp.dialect.name == 'sqlite':
-                    conn.execute(text('PRAGMA foreign_keys=ON'))
-            except Exception:
-                pass
+        _restore_reset_sequences(conn, touched.values())
 
+        try:
+            if insp.dialect.name == 'sqlite':
+                conn.execute(text('PRAGMA foreign_keys=ON'))
+        except Exception:
+            pass
+
+    elapsed = max(time.monotonic() - started, 1e-6)
     return {
         'tables_restored': len(restored_counts),
         'row_counts': restored_counts,
+        'rows_deleted': deleted_counts,
+        'archives_applied': len(archives),
+        'rows_restored': total_inserted,
+        'elapsed_seconds': round(elapsed, 1),
+        'rows_per_second': int(total_inserted / elapsed),
+        'batch_size': batch_size,
+    }
+
+
+_BACKUP_EXPORT_BATCH_ROWS = 500
+_BACKUP_EXPORT_QUEUE_BATCHES = 8
+
+
+def _backup_export_table_worker(engine, stmt, out_q: queue.Queue, cancel: threading.Event) -> None:
+    """Stream the rows of one SELECT (a whole table or its delta) as NDJSON batches into out_q.
+
+    Emits ('data', bytes) items followed by ('done', row_count) or ('error', exc).
+    The queue is bounded, so a slow writer applies backpressure to the export.
+    """
+    def put(item) -> bool:
+        while not cancel.is_set():
+            try:
+                out_q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        rc = 0
+        lines: list[str] = []
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(stmt)
+            for row in result:
+                row_dict = {k: _jsonable_value(v) for k, v in dict(row._mapping).items()}
+                lines.append(json.dumps(row_dict, default=str))
+                rc += 1
+                if len(lines) >= _BACKUP_EXPORT_BATCH_ROWS:
+                    if not put(('data', ("\n".join(lines) + "\n").encode('utf-8'))):
+                        return
+                    lines = []
+        if lines and not put(('data', ("\n".join(lines) + "\n").encode('utf-8'))):
+            return
+        put(('done', rc))
+    except Exception as e:
+        put(('error', e))
+
+
+def _backup_export_worker_count(engine) -> int:
+    """Bound export concurrency by the configured worker count and the engine's pool capacity."""
+    workers = int(BACKUP_CONFIG.get('export_workers') or 1)
+    try:
+        pool = engine.pool
+        size = pool.size() if hasattr(pool, 'size') else None
+        overflow = pool._max_overflow if hasattr(pool, '_max_overflow') else 0
+        if size:
+            # Leave one connection for the request/job that triggered the backup.
+            workers = min(workers, max(1, int(size) + max(0, int(overflow)) - 1))
+    except Exception:
+        pass
+    return max(1, workers)
+
+
+def _reflect_backup_tables(bind, table_names: list[str]) -> tuple[dict, list[str]]:
+    """Reflect all tables once into a shared MetaData; fall back per table on failure.
+
+    `bind` is an engine or a connection (restores reflect inside their transaction).
+    """
+    meta = MetaData()
+    try:
+        meta.reflect(bind=bind, only=table_names)
+    except Exception:
+        for name in table_names:
+            if name in meta.tables:
+                continue
+            try:
+                Table(name, meta, autoload_with=bind)
+            except Exception as e:
+                app.logger.error(f'Error reflecting table {name} for backup: {str(e)}')
+    tables = {name: meta.tables[name] for name in table_names if name in meta.tables}
+    failed = [name for name in table_names if name not in tables]
+    return tables, failed
+
+
+# Rows whose timestamp lags the recorded high-water mark by less than this are
+# re-exported, covering transactions that committed after the previous backup read it.
+_BACKUP_WATERMARK_OVERLAP = timedelta(minutes=5)
+
+
+def _backup_watermark_columns(table) -> tuple:
+    """Return (integer primary key column, change timestamp column) for a table; either may be None.
+
+    Only `updated_at` tracks changes: `created_at` says nothing about later UPDATEs, so
+    tables without `updated_at` are change-detected by content checksum instead.
+    """
+    from sqlalchemy.sql.sqltypes import DateTime, Integer
+
+    pk_cols = list(table.primary_key.columns)
+    pk_col = pk_cols[0] if len(pk_cols) == 1 and isinstance(pk_cols[0].type, Integer) else None
+    ts_col = table.c.get('updated_at')
+    if ts_col is not None and not isinstance(ts_col.type, DateTime):
+        ts_col = None
+    return pk_col, ts_col
+
+
+def _backup_table_checksum(conn, table, pk_col) -> str:
+    """SHA-256 over a table's rows in primary-key order (change detection without updated_at)."""
+    from sqlalchemy import select as sa_select
+
+    digest = hashlib.sha256()
+    result = conn.execution_options(stream_results=True).execute(sa_select(table).order_by(pk_col))
+    for row in result:
+        digest.update(json.dumps([_jsonable_value(v) for v in row], default=str).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def _collect_backup_watermarks(engine, tables: dict, previous: dict | None) -> dict:
+    """Read per-table high-water marks (max PK, max updated_at, row count).
+
+    Tables without `updated_at` get a content checksum instead. When `previous`
+    watermarks are given, also counts the rows still at or below the previous max PK
+    so deletions since then can be detected.
+    """
+    from sqlalchemy import select as sa_select
+
+    marks: dict[str, dict] = {}
+    with engine.connect() as conn:
+        for name, table in tables.items():
+            pk_col, ts_col = _backup_watermark_columns(table)
+            if pk_col is None:
+                continue
+            prev = (previous or {}).get(name) or {}
+            cols = [func.count(), func.max(pk_col)]
+            cols.append(func.max(ts_col) if ts_col is not None else literal(None))
+            if prev.get('max_pk') is not None:
+                cols.append(func.sum(case((pk_col <= int(prev['max_pk']), 1), else_=0)))
+            try:
+                row = conn.execute(sa_select(*cols).select_from(table)).one()
+            except Exception as e:
+                app.logger.warning(f'Could not read backup watermark for {name}: {e}')
+                continue
+            max_ts = row[2]
+            marks[name] = {
+                'rows': int(row[0] or 0),
+                'max_pk': int(row[1]) if row[1] is not None else None,
+                'ts_column': ts_col.name if ts_col is not None else None,
+                'max_ts': max_ts.isoformat() if isinstance(max_ts, datetime) else None,
+            }
+            if len(row) > 3:
+                marks[name]['rows_at_or_below_prev_pk'] = int(row[3] or 0)
+            if ts_col is None:
+                try:
+                    marks[name]['checksum'] = _backup_table_checksum(conn, table, pk_col)
+                except Exception as e:
+                    # Without a checksum the table is shipped in full (see _plan_incremental_exports).
+                    app.logger.warning(f'Could not checksum {name} for backup: {e}')
+    return marks
+
+
+def _plan_incremental_exports(tables: dict, current: dict, previous: dict) -> dict:
+    """Decide what an incremental backup exports per table.
+
+    Returns {table: spec} where spec is None (unchanged since the parent backup) or
+    {'mode': 'delta'|'full', 'where': clause|None, 'keys': bool}. 'keys' adds a manifest
+    of every current primary key so the restore can replay deletions.
+    """
+    plan: dict[str, dict | None] = {}
+    for name, table in tables.items():
+        cur = current.get(name)
+        prev = previous.get(name)
+        pk_col, _ = _backup_watermark_columns(table)
+        if cur is None or pk_col is None:
+            # No usable watermark: always ship the whole table.
+            plan[name] = {'mode': 'full', 'where': None, 'keys': False}
+            continue
+        if prev is None:
+            # New since the parent: ship everything plus a key manifest so the restore
+            # also drops rows the target had that this database never did.
+            plan[name] = {'mode': 'full', 'where': None, 'keys': True}
+            continue
+
+        if not cur.get('ts_column'):
+            # No updated_at: a PK delta would miss UPDATEs, so any content change ships the
+            # whole table, with a key manifest so the restore also replays deletions.
+            if cur.get('checksum') and cur.get('checksum') == prev.get('checksum'):
+                plan[name] = None
+            else:
+                plan[name] = {'mode': 'full', 'where': None, 'keys': True}
+            continue
+
+        unchanged = (
+            cur.get('max_pk') == prev.get('max_pk')
+            and cur.get('max_ts') == prev.get('max_ts')
+            and cur.get('rows') == prev.get('rows')
+        )
+        if unchanged:
+            plan[name] = None
+            continue
+        if prev.get('max_pk') is None:
+            # Was empty at the parent: every row is new.
+            plan[name] = {'mode': 'delta', 'where': None, 'keys': False}
+            continue
+
+        ts_name = cur['ts_column']
+        if ts_name != prev.get('ts_column') or not prev.get('max_ts'):
+            # The parent has no comparable updated_at mark (older backup, or every value was NULL).
+            plan[name] = {'mode': 'full', 'where': None, 'keys': True}
+            continue
+        deleted = int(cur.get('rows_at_or_below_prev_pk', cur['rows'])) < int(prev.get('rows') or 0)
+        since = datetime.fromisoformat(prev['max_ts']) - _BACKUP_WATERMARK_OVERLAP
+        where = or_(pk_col > int(prev['max_pk']), table.c[ts_name] > since)
+        plan[name] = {'mode': 'delta', 'where': where, 'keys': deleted}
+    return plan
+
+
+def _write_backup_stream(
+    raw,
+    backup_uuid: str,
+    engine,
+    selected: list[str],
+    configured: list[str],
+    dialect_name: str,
+    *,
+    parent_watermarks: dict | None = None,
+    extra_metadata: dict | None = None,
+) -> dict:
+    """Export `selected` tables into an encrypted, chunked zip written to `raw`.
+
+    Tables are exported concurrently on a bounded pool of connections; the zip is
+    assembled in table order from bounded per-table queues, so peak memory does not
+    grow with table size. With `parent_watermarks` the backup is incremental: only
+    rows past the parent's high-water marks are exported (see
+    `_plan_incremental_exports`). Returns row counts, failures, the new watermarks
+    and the plaintext checksum.
+    """
+    from sqlalchemy import select as sa_select
+
+    enc = ChunkedEncryptWriter(
+        raw,
+        derive_stream_key(BACKUP_CONFIG['encryption_key']),
+        chunk_size=int(BACKUP_CONFIG.get('chunk_size_bytes') or 1024 * 1024),
+    )
+    tables, failed_tables = _reflect_backup_tables(engine, selected)
+    # Watermarks are read before exporting so rows changed during the export are
+    # picked up again by the next incremental.
+    watermarks = _collect_backup_watermarks(engine, tables, parent_watermarks)
+    incremental = parent_watermarks is not None
+    plan = _plan_incremental_exports(tables, watermarks, parent_watermarks) if incremental else {}
+
+    exports: list[tuple[str, str, object]] = []
+    for name in selected:
+        if name not in tables:
+            continue
+        spec = plan.get(name, {'mode': 'full', 'where': None, 'keys': False})
+        if spec is None:
+            continue
+        stmt = sa_select(tables[name])
+        if spec['where'] is not None:
+            stmt = stmt.where(spec['where'])
+        exports.append((name, f"{name}.ndjson", stmt))
+        if spec['keys']:
+            exports.append((name, f"{name}.keys.ndjson", sa_select(*tables[name].primary_key.columns)))
+
+    row_counts: dict[str, int] = {}
+    key_counts: dict[str, int] = {}
+    workers = _backup_export_worker_count(engine)
+    cancel = threading.Event()
+
+    with zipfile.ZipFile(enc, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup-export') as pool:
+            pending: deque = deque()
+            remaining = iter(exports)
+
+            def submit_next() -> None:
+                job = next(remaining, None)
+                if job is None:
+                    return
+                name, member, stmt = job
+                q: queue.Queue = queue.Queue(maxsize=_BACKUP_EXPORT_QUEUE_BATCHES)
+                pool.submit(_backup_export_table_worker, engine, stmt, q, cancel)
+                pending.append((name, member, q))
+
+            try:
+                for _ in range(workers):
+                    submit_next()
+                while pending:
+                    table_name, member, q = pending.popleft()
+                    with zipf.open(member, 'w', force_zip64=True) as zf:
+                        while True:
+                            kind, payload = q.get()
+                            if kind == 'data':
+                                zf.write(payload)
+                                continue
+                            if kind == 'done':
+                                counts = key_counts if member.endswith('.keys.ndjson') else row_counts
+                                counts[table_name] = int(payload)
+                            else:
+                                app.logger.error(f'Error backing up table {table_name}: {str(payload)}')
+                                if table_name not in failed_tables:
+                                    failed_tables.append(table_name)
+                            break
+                    submit_next()
+            finally:
+                cancel.set()
+
+        # A failed table keeps no watermark, so the next incremental ships it in full.
+        for name in failed_tables:
+            watermarks.pop(name, None)
+
+        metadata = {
+            'backup_id': backup_uuid,
+            'timestamp': get_eat_now().isoformat(),
+            'database_url': str(engine.url),
+            'tables_requested': configured,
+            'tables_backed_up': sorted(row_counts.keys()),
+            'tables_total': int(len(selected)),
+            'tables_failed': int(len(failed_tables)),
+            'failed_tables': failed_tables[:200],
+            'row_counts': row_counts,
+            'dialect': dialect_name,
+            'format': 'ndjson-v2',
+            'key_id': 'fernet-v1',
+            'encryption': 'aesgcm-chunked-v2',
+            'backup_mode': 'incremental' if incremental else 'full',
+            'table_modes': {name: spec['mode'] for name, spec in plan.items() if spec is not None},
+            'key_counts': key_counts,
+            'watermarks': watermarks,
+            **(extra_metadata or {}),
+        }
+        zipf.writestr('metadata.json', json.dumps(metadata, indent=2))
+
+    enc.close()
+    return {
+        'row_counts': row_counts,
+        'failed_tables': failed_tables,
+        'tables_unchanged': sum(1 for spec in plan.values() if spec is None),
+        'watermarks': watermarks,
+        'checksum': enc.plaintext_sha256,
+        'size_bytes': int(enc.ciphertext_bytes),
+        'export_workers': workers,
     }
 
 
+def _select_backup_parent() -> BackupRecord | None:
+    """Return the backup the next incremental should build on, or None when a full base is due.
+
+    A new full base is taken when incrementals are disabled, there is no completed
+    backup with watermarks, the chain's base is older than `full_interval_days`, or
+    the chain already has `max_increments` links.
+    """
+    if not BACKUP_CONFIG.get('incremental_enabled'):
+        return None
+    latest = (
+        BackupRecord.query
+        .filter(BackupRecord.status == 'completed', BackupRecord.watermarks.isnot(None))
+        .order_by(BackupRecord.timestamp.desc(), BackupRecord.id.desc())
+        .first()
+    )
+    if not latest:
+        return None
+    base_id = latest.base_backup_id if latest.backup_mode == 'incremental' else latest.backup_id
+    base = BackupRecord.query.filter_by(backup_id=base_id, status='completed').first() if base_id else None
+    if not base or not base.timestamp:
+        return None
+    base_ts = base.timestamp.replace(tzinfo=None)
+    if base_ts < get_eat_now().replace(tzinfo=None) - timedelta(days=int(BACKUP_CONFIG['full_interval_days'])):
+        return None
+    links = BackupRecord.query.filter_by(base_backup_id=base.backup_id, backup_mode='incremental').count()
+    if links >= int(BACKUP_CONFIG['max_increments']):
+        return None
+    return latest
+
+
+def _backup_chain(backup: BackupRecord) -> list[BackupRecord]:
+    """Return [full base, ..., backup] for a backup by following parent links."""
+    chain = [backup]
+    seen = {backup.backup_id}
+    current = backup
+    while (current.backup_mode or 'full') == 'incremental':
+        parent = BackupRecord.query.filter_by(backup_id=current.parent_backup_id).first() if current.parent_backup_id else None
+        if not parent or parent.status != 'completed':
+            raise ValueError(f'backup chain is broken: parent {current.parent_backup_id} of {current.backup_id} is missing')
+        if parent.backup_id in seen:
+            raise ValueError('backup chain contains a cycle')
+        seen.add(parent.backup_id)
+        chain.append(parent)
+        current = parent
+    chain.reverse()
+    return chain
+
+
 def create_backup(backup_id, created_by_user_id=None):
-    """Create a database backup in background"""
+    """Create a database backup in background.
+
+    Backups flagged `backup_mode='incremental'` export only rows changed since the
+    parent chosen by `_select_backup_parent`, falling back to a full base when one is due.
+    """
     with app.app_context():
         backup = db.session.get(BackupRecord, backup_id)
         if not backup:
@@ -16940,115 +18365,112 @@ def create_backup(backup_id, created_by_user_id=None):
             # Always back up all tables (excluding alembic_version) so new tables/columns are included.
             selected = sorted(t for t in existing_tables if _safe_table_name(t) and t != 'alembic_version')
 
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zip_path = os.path.join(temp_dir, f'backup_{backup.backup_id}.zip')
-                row_counts: dict[str, int] = {}
-                failed_tables: list[str] = []
-
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for table_name in selected:
-                        try:
-                            rc = 0
-                            with db.engine.connect() as conn:
-                                if not _safe_table_name(table_name) or table_name not in existing_tables:
-                                    continue
-                                # Use SQLAlchemy Core select to avoid string-SQL.
-                                from sqlalchemy import MetaData, Table, select as sa_select
-
-                                meta = MetaData()
-                                table = Table(table_name, meta, autoload_with=db.engine)
-                                result = conn.execution_options(stream_results=True).execute(sa_select(table))
-                                with zipf.open(f"{table_name}.ndjson", 'w') as zf:
-                                    for row in result:
-                                        row_dict = {k: _jsonable_value(v) for k, v in dict(row._mapping).items()}
-                                        zf.write((json.dumps(row_dict, default=str) + "\n").encode('utf-8'))
-                                        rc += 1
-                            row_counts[table_name] = rc
-                        except Exception as e:
-                            app.logger.error(f'Error backing up table {table_name}: {str(e)}')
-                            failed_tables.append(table_name)
-                            continue
-
-                    stats = {
-                        'tables_total': int(len(selected)),
-                        'tables_backed_up': int(len(row_counts)),
-                        'tables_failed': int(len(failed_tables)),
-                        'failed_tables': failed_tables[:200],
-                    }
-
-                    metadata = {
-                        'backup_id': backup.backup_id,
-                        'timestamp': get_eat_now().isoformat(),
-                        'database_url': str(db.engine.url),
-                        'tables_requested': configured,
-                        'tables_backed_up': sorted(row_counts.keys()),
-                        'tables_total': stats['tables_total'],
-                        'tables_failed': stats['tables_failed'],
-                        'failed_tables': stats['failed_tables'],
-                        'row_counts': row_counts,
-                        'dialect': insp.dialect.name,
-                        'format': 'ndjson-v2',
-                        'key_id': 'fernet-v1',
-                    }
-                    zipf.writestr('metadata.json', json.dumps(metadata, indent=2))
-
-                checksum = _compute_sha256_file(zip_path)
-
-                cipher_suite = Fernet(BACKUP_CONFIG['encryption_key'].encode())
-                with open(zip_path, 'rb') as f:
-                    encrypted_bytes = cipher_suite.encrypt(f.read())
-
-                enc_path = os.path.join(temp_dir, f'backup_{backup.backup_id}.zip.enc')
-                with open(enc_path, 'wb') as f:
-                    f.write(encrypted_bytes)
-
-                file_size = os.path.getsize(enc_path)
+            parent = _select_backup_parent() if backup.backup_mode == 'incremental' else None
+            parent_watermarks = None
+            if parent is not None:
+                try:
+                    parent_watermarks = json.loads(parent.watermarks or '')
+                except Exception:
+                    parent_watermarks = None
+            if isinstance(parent_watermarks, dict):
+                backup.backup_mode = 'incremental'
+                backup.parent_backup_id = parent.backup_id
+                backup.base_backup_id = parent.base_backup_id if parent.backup_mode == 'incremental' else parent.backup_id
+            else:
+                parent_watermarks = None
+                backup.backup_mode = 'full'
+                backup.parent_backup_id = None
+                backup.base_backup_id = None
+            chain_metadata = {
+                'base_backup_id': backup.base_backup_id,
+                'parent_backup_id': backup.parent_backup_id,
+            }
 
-                uploaded_to_s3 = False
-                if s3_client:
-                    try:
-                        bucket = (BACKUP_CONFIG.get('s3_bucket') or '').strip()
-                        if not _is_valid_s3_bucket_name(bucket):
-                            raise ValueError('Invalid AWS_BACKUP_BUCKET; refusing S3 upload')
-
-                        s3_key = f'backups/{backup.backup_id}.zip.enc'
-                        s3_client.upload_file(
-                            enc_path,
-                            bucket,
-                            s3_key,
-                            ExtraArgs={
-                                'ServerSideEncryption': 'AES256',
-                                'ACL': 'private',
-                                'Metadata': {
-                                    'backup-id': backup.backup_id,
-                                    'checksum': checksum,
-                                    'created-by': str(created_by_user_id) if created_by_user_id is not None else 'system'
-                                }
+            result = None
+            storage_location = None
+            if s3_client:
+                writer = None
+                try:
+                    bucket = (BACKUP_CONFIG.get('s3_bucket') or '').strip()
+                    if not _is_valid_s3_bucket_name(bucket):
+                        raise ValueError('Invalid AWS_BACKUP_BUCKET; refusing S3 upload')
+
+                    s3_key = f'backups/{backup.backup_id}.zip.enc'
+                    # The plaintext checksum is only known once the stream ends; it is kept on
+                    # the BackupRecord rather than in the object metadata.
+                    writer = S3MultipartWriter(
+                        s3_client,
+                        bucket,
+                        s3_key,
+                        extra_args={
+                            'ServerSideEncryption': 'AES256',
+                            'ACL': 'private',
+                            'Metadata': {
+                                'backup-id': backup.backup_id,
+                                'format': 'aesgcm-chunked-v2',
+                                'created-by': str(created_by_user_id) if created_by_user_id is not None else 'system'
                             }
+                        },
+                    )
+                    result = _write_backup_stream(
+                        writer, backup.backup_id, db.engine, selected, configured, insp.dialect.name,
+                        parent_watermarks=parent_watermarks, extra_metadata=chain_metadata,
+                    )
+                    writer.close()
+                    storage_location = f's3://{bucket}/{s3_key}'
+                except Exception as s3_exc:
+                    if writer is not None:
+                        try:
+                            writer.abort()
+                        except Exception:
+                            pass
+                    result = None
+                    app.logger.error(f'S3 upload failed; falling back to local storage: {s3_exc}', exc_info=True)
+
+            if storage_location is None:
+                local_backup_dir = BACKUP_CONFIG['local_storage_path']
+                os.makedirs(local_backup_dir, exist_ok=True)
+                dest = os.path.join(local_backup_dir, f'{backup.backup_id}.zip.enc')
+                part_path = dest + '.part'
+                try:
+                    with open(part_path, 'wb') as raw:
+                        result = _write_backup_stream(
+                            raw, backup.backup_id, db.engine, selected, configured, insp.dialect.name,
+                            parent_watermarks=parent_watermarks, extra_metadata=chain_metadata,
                         )
-                        storage_location = f's3://{bucket}/{s3_key}'
-                        uploaded_to_s3 = True
-                    except Exception as s3_exc:
-                        app.logger.error(f'S3 upload failed; falling back to local storage: {s3_exc}', exc_info=True)
-
-                if not uploaded_to_s3:
-                    local_backup_dir = BACKUP_CONFIG['local_storage_path']
-                    os.makedirs(local_backup_dir, exist_ok=True)
-                    dest = os.path.join(local_backup_dir, f'{backup.backup_id}.zip.enc')
-                    os.replace(enc_path, dest)
-                    storage_location = dest
-
-                backup.status = 'completed'
-                backup.size_bytes = file_size
-                backup.storage_location = storage_location
-                backup.checksum = checksum
-                backup.notes = _backup_notes_with_stats(backup.notes, {
-                    **stats,
-                    'size_bytes': int(file_size),
-                })
-                db.session.commit()
+                    os.replace(part_path, dest)
+                finally:
+                    if os.path.exists(part_path):
+                        try:
+                            os.remove(part_path)
+                        except Exception:
+                            pass
+                storage_location = dest
+
+            failed_tables = result['failed_tables']
+            stats = {
+                'backup_mode': backup.backup_mode,
+                'tables_total': int(len(selected)),
+                'tables_backed_up': int(len(result['row_counts'])),
+                'tables_unchanged': int(result['tables_unchanged']),
+                'tables_failed': int(len(failed_tables)),
+                'failed_tables': failed_tables[:200],
+                'rows_exported': int(sum(result['row_counts'].values())),
+            }
+            file_size = int(result['size_bytes'])
+
+            backup.status = 'completed'
+            backup.size_bytes = file_size
+            backup.storage_location = storage_location
+            backup.checksum = result['checksum']
+            backup.watermarks = json.dumps(result['watermarks'], separators=(',', ':'))
+            backup.notes = _backup_notes_with_stats(backup.notes, {
+                **stats,
+                'size_bytes': file_size,
+            })
+            db.session.commit()
 
-                app.logger.info(f'Backup completed: {backup.backup_id} ({file_size} bytes)')
+            app.logger.info(f'Backup completed: {backup.backup_id} ({backup.backup_mode}, {file_size} bytes, {result["export_workers"]} export workers)')
 
         except Exception as e:
             app.logger.error(f'Backup failed: {str(e)}', exc_info=True)
@@ -17057,6 +18479,45 @@ def create_backup(backup_id, created_by_user_id=None):
             db.session.commit()
 
 
+def _open_backup_zip_source(backup):
+    """Open a backup as a seekable plaintext stream for zipfile, or None if missing.
+
+    Chunked (v2) backups are decrypted frame by frame as zipfile reads them, so
+    neither the archive nor its plaintext is ever held in memory as a whole.
+    """
+    fh = get_backup_file(backup)
+    if not fh:
+        return None
+    try:
+        return open_backup_seekable(fh, BACKUP_CONFIG['encryption_key'])
+    except Exception:
+        try:
+            fh.close()
+        except Exception:
+            pass
+        raise
+
+
+def _write_restore_progress(backup_pk: int, notes_base: str | None, status: dict) -> bool:
+    """Persist in-flight restore progress on its own short transaction.
+
+    The restore holds table locks on another connection (and may be rewriting
+    backup_records itself), so the update gives up quickly instead of waiting.
+    """
+    try:
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text("SET LOCAL lock_timeout = '500ms'"))
+            conn.execute(
+                BackupRecord.__table__.update()
+                .where(BackupRecord.__table__.c.id == backup_pk)
+                .values(notes=_backup_notes_with_restore_status(notes_base, status))
+            )
+        return True
+    except Exception:
+        return False
+
+
 def restore_backup(backup_id):
     """Restore database from backup"""
     with app.app_context():
@@ -17064,11 +18525,13 @@ def restore_backup(backup_id):
         if not backup:
             return
 
+        sources = []
         try:
+            started_at = get_eat_now().isoformat()
             try:
                 backup.notes = _backup_notes_with_restore_status(backup.notes, {
                     'status': 'in_progress',
-                    'started_at': get_eat_now().isoformat(),
+                    'started_at': started_at,
                     'message': 'Restore started. Please wait...',
                 })
                 db.session.commit()
@@ -17078,26 +18541,22 @@ def restore_backup(backup_id):
                 except Exception:
                     pass
 
-            fh = get_backup_file(backup)
-            if not fh:
-                backup.notes = 'Restore error: backup file not found'
-                db.session.commit()
-                return
-            try:
-                encrypted_bytes = fh.read()
-            finally:
-                try:
-                    fh.close()
-                except Exception:
-                    pass
-
-            cipher_suite = Fernet(BACKUP_CONFIG['encryption_key'].encode())
-            zip_bytes = cipher_suite.decrypt(encrypted_bytes)
+            # An incremental restores its full base first, then every link up to itself.
+            chain = _backup_chain(backup)
+            for member in chain:
+                source = _open_backup_zip_source(member)
+                if not source:
+                    backup.notes = f'Restore error: backup file not found ({member.backup_id})'
+                    db.session.commit()
+                    return
+                sources.append(source)
 
-            if backup.checksum and _compute_sha256_bytes(zip_bytes) != backup.checksum:
-                backup.notes = 'Restore error: checksum mismatch (backup may be corrupted)'
-                db.session.commit()
-                return
+                # Legacy backups carry a whole-archive checksum; chunked backups are
+                # authenticated frame by frame while the restore reads them.
+                if member.checksum and isinstance(source, io.BytesIO) and _compute_sha256_stream(source) != member.checksum:
+                    backup.notes = 'Restore error: checksum mismatch (backup may be corrupted)'
+                    db.session.commit()
+                    return
 
             # Ensure schema exists (safe no-op if already created)
             try:
@@ -17105,30 +18564,77 @@ def restore_backup(backup_id):
             except Exception:
                 app.logger.exception('Schema initialization before restore failed')
 
+            backup_pk = backup.id
+            notes_base = backup.notes
+            label = str(backup.backup_id)
+            # End the session's read transaction so it does not hold locks the
+            # restore connection needs (TRUNCATE waits on open readers).
+            db.session.commit()
+
+            progress_enabled = db.engine.dialect.name != 'sqlite'
+
+            def on_progress(status: dict) -> None:
+                nonlocal progress_enabled
+                app.logger.info(
+                    "Restore progress: backup_id=%s tables=%s/%s rows=%s rate=%s rows/s current=%s",
+                    label, status.get('tables_done'), status.get('tables_total'),
+                    status.get('rows_restored'), status.get('rows_per_second'), status.get('current_table') or '-',
+                )
+                if not progress_enabled:
+                    return
+                done, total = status.get('tables_done'), status.get('tables_total')
+                archive, archives = status.get('archive'), status.get('archives_total')
+                step = f" of backup {archive}/{archives}" if archives and archives > 1 else ''
+                payload = dict(status, status='in_progress', started_at=started_at,
+                               message=f"Restoring tables ({done}/{total}){step}...")
+                if not _write_restore_progress(backup_pk, notes_base, payload):
+                    progress_enabled = False
+
             # Restore all backed-up tables that exist in the current schema.
-            result = _restore_zip_to_engine(db.engine, zip_bytes, allowed_tables=None)
+            result = _restore_zip_to_engine(
+                db.engine, sources[0], allowed_tables=None, increments=sources[1:], progress=on_progress,
+            )
+            # backup_records may itself have been restored from the snapshot.
+            db.session.expire_all()
+            backup = db.session.get(BackupRecord, backup_id)
+            if not backup:
+                app.logger.warning(
+                    "Restore completed but backup record %s is not present in the restored data", label
+                )
+                return
             backup.notes = _backup_notes_with_restore_status(backup.notes, {
                 'status': 'completed',
+                'started_at': started_at,
                 'finished_at': get_eat_now().isoformat(),
                 'tables_restored': int(result.get('tables_restored') or 0),
+                'archives_applied': int(result.get('archives_applied') or 1),
+                'rows_restored': int(result.get('rows_restored') or 0),
+                'rows_deleted': int(sum((result.get('rows_deleted') or {}).values())),
+                'elapsed_seconds': result.get('elapsed_seconds'),
+                'rows_per_second': result.get('rows_per_second'),
+                'row_counts': {t: n for t, n in (result.get('row_counts') or {}).items() if n},
                 'message': f"Restore completed successfully (tables: {result.get('tables_restored')})",
             })
             db.session.commit()
 
-            try:
-                rc = result.get('row_counts') or {}
-                total_rows = sum(int(v or 0) for v in rc.values()) if isinstance(rc, dict) else None
-                app.logger.info(
-                    "Restore completed: backup_id=%s tables=%s rows=%s",
-                    str(getattr(backup, 'backup_id', backup_id)),
-                    str(result.get('tables_restored')),
-                    str(total_rows) if total_rows is not None else 'unknown',
-                )
-            except Exception:
-                pass
+            app.logger.info(
+                "Restore completed: backup_id=%s tables=%s rows=%s elapsed=%ss rate=%s rows/s",
+                label,
+                str(result.get('tables_restored')),
+                str(result.get('rows_restored')),
+                str(result.get('elapsed_seconds')),
+                str(result.get('rows_per_second')),
+            )
 
         except Exception as e:
             app.logger.error(f'Restore failed: {str(e)}', exc_info=True)
+            try:
+                db.session.rollback()
+            except Exception:
+                pass
+            backup = db.session.get(BackupRecord, backup_id)
+            if not backup:
+                return
             try:
                 backup.notes = _backup_notes_with_restore_status(backup.notes, {
                     'status': 'failed',
@@ -17138,39 +18644,42 @@ def restore_backup(backup_id):
             except Exception:
                 backup.notes = f'Restore error: {str(e)}'
             db.session.commit()
+        finally:
+            for source in sources:
+                try:
+                    source.close()
+                except Exception:
+                    pass
 
 
 def test_disaster_recovery(plan_id, backup_id):
-    """Test disaster recovery plan by verifying the latest backup can be decrypted and parsed."""
+    """Test disaster recovery plan by verifying the latest backup can be decrypted and parsed.
+
+    The archive is streamed: the checksum pass reads it in fixed-size chunks and
+    zipfile reads members through the same seekable decrypting view, so memory
+    stays flat regardless of backup size.
+    """
     with app.app_context():
         plan = _db_get(DisasterRecoveryPlan, plan_id)
         backup = _db_get(BackupRecord, backup_id)
         if not plan or not backup:
             return
 
+        source = None
         try:
-            fh = get_backup_file(backup)
-            if not fh:
+            source = _open_backup_zip_source(backup)
+            if not source:
                 plan.last_tested = get_eat_now()
                 plan.test_results = 'Backup file not found'
                 db.session.commit()
                 return
-            try:
-                encrypted_bytes = fh.read()
-            finally:
-                try:
-                    fh.close()
-                except Exception:
-                    pass
-
-            cipher_suite = Fernet(BACKUP_CONFIG['encryption_key'].encode())
-            zip_bytes = cipher_suite.decrypt(encrypted_bytes)
 
+            started = time.monotonic()
             checksum_ok = True
             if backup.checksum:
-                checksum_ok = (_compute_sha256_bytes(zip_bytes) == backup.checksum)
+                checksum_ok = (_compute_sha256_stream(source) == backup.checksum)
 
-            with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as z:
+            with zipfile.ZipFile(source, 'r') as z:
                 names = z.namelist()
                 has_metadata = 'metadata.json' in names
                 meta = {}
@@ -17205,14 +18714,25 @@ def test_disaster_recovery(plan_id, backup_id):
                 'has_metadata': has_metadata,
                 'table_count': len(tables),
                 'parse_errors': parse_errors,
+                'elapsed_seconds': round(time.monotonic() - started, 1),
             }, indent=2)
             db.session.commit()
 
         except Exception as e:
             app.logger.error(f'Disaster recovery test failed: {str(e)}', exc_info=True)
+            try:
+                db.session.rollback()
+            except Exception:
+                pass
             plan.last_tested = get_eat_now()
             plan.test_results = f"Test failed: {str(e)}"
             db.session.commit()
+        finally:
+            if source is not None:
+                try:
+                    source.close()
+                except Exception:
+                    pass
 
 
 def verify_backup_exists(backup):
@@ -17291,6 +18811,7 @@ def scheduled_backup():
             # Create backup record
             backup = BackupRecord(
                 backup_type='scheduled',
+                backup_mode='incremental',
                 notes='Automated scheduled backup',
                 status='in_progress'
             )
@@ -17312,6 +18833,7 @@ def disaster_recovery_backup_job():
                 return
             backup = BackupRecord(
                 backup_type='disaster_recovery',
+                backup_mode='incremental',
                 notes='Automated disaster recovery backup (30-minute interval)',
                 status='in_progress'
             )
@@ -17322,6 +18844,178 @@ def disaster_recovery_backup_job():
             app.logger.error(f'Error in disaster recovery backup job: {str(e)}', exc_info=True)
 
 
+# ======================
+# SCHEDULER LEADER ELECTION
+# ======================
+# Every gunicorn worker starts a BackgroundScheduler. Workers compete for the
+# `scheduler_leases` row; only the current holder runs cluster jobs, and each
+# run is recorded in `scheduler_job_runs`. Non-leaders keep the same job
+# schedule so a takeover needs no reconfiguration.
+
+SCHEDULER_LEASE_NAME = 'apscheduler'
+SCHEDULER_LEASE_TTL_SECONDS = int(os.getenv('SCHEDULER_LEASE_TTL_SECONDS', '60') or 60)
+SCHEDULER_HEARTBEAT_SECONDS = max(5, SCHEDULER_LEASE_TTL_SECONDS // 3)
+# scheduler_job_runs retention: rows older than this are pruned, except each job's latest runs.
+SCHEDULER_JOB_RUN_RETENTION_DAYS = int(os.getenv('SCHEDULER_JOB_RUN_RETENTION_DAYS', '30') or 30)
+SCHEDULER_JOB_RUN_KEEP_LATEST = int(os.getenv('SCHEDULER_JOB_RUN_KEEP_LATEST', '50') or 50)
+_scheduler_lease_obj = None
+_scheduler_lease_lock = threading.Lock()
+
+
+def _scheduler_lease():
+    global _scheduler_lease_obj
+    if _scheduler_lease_obj is None:
+        with _scheduler_lease_lock:
+            if _scheduler_lease_obj is None:
+                _scheduler_lease_obj = LeaderLease(
+                    db.engine,
+                    SchedulerLease.__table__,
+                    SCHEDULER_LEASE_NAME,
+                    ttl_seconds=SCHEDULER_LEASE_TTL_SECONDS,
+                )
+    return _scheduler_lease_obj
+
+
+def _scheduler_leader_heartbeat() -> bool:
+    """Acquire or renew the scheduler lease; returns True when this worker is the leader."""
+    try:
+        with app.app_context():
+            lease = _scheduler_lease()
+            was_leader = lease.is_leader()
+            leader = lease.try_acquire()
+            if leader and not was_leader:
+                app.logger.info(f'Scheduler leadership acquired by {lease.holder}')
+            elif was_leader and not leader:
+                app.logger.warning(f'Scheduler leadership lost by {lease.holder}')
+            return leader
+    except Exception as e:
+        try:
+            app.logger.error(f'Scheduler lease heartbeat failed: {e}')
+        except Exception:
+            pass
+        return False
+
+
+def _cluster_singleton(job_id: str, func):
+    """Wrap a scheduled job so it only runs on the lease holder and records a SchedulerJobRun."""
+    @wraps(func)
+    def _run(*args, **kwargs):
+        lease = None
+        run_id = None
+        try:
+            with app.app_context():
+                lease = _scheduler_lease()
+                if not lease.is_leader() and not _scheduler_leader_heartbeat():
+                    return None
+                run = SchedulerJobRun(job_id=job_id, holder=lease.holder, started_at=get_eat_now(), status='running')
+                db.session.add(run)
+                db.session.commit()
+                run_id = run.id
+        except Exception as e:
+            try:
+                app.logger.error(f'Scheduler job {job_id}: could not record run start: {e}')
+            except Exception:
+                pass
+            if lease is None or not lease.is_leader():
+                return None
+
+        started = time.perf_counter()
+        status, error = 'success', None
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'[:4000]
+            app.logger.error(f'Scheduled job {job_id} failed: {e}', exc_info=True)
+            return None
+        finally:
+            if run_id is not None:
+                try:
+                    with app.app_context():
+                        run = db.session.get(SchedulerJobRun, run_id)
+                        if run is not None:
+                            run.finished_at = get_eat_now()
+                            run.duration_ms = int((time.perf_counter() - started) * 1000)
+                            run.status = status
+                            run.error = error
+                            db.session.commit()
+                except Exception as e:
+                    try:
+                        app.logger.error(f'Scheduler job {job_id}: could not record run end: {e}')
+                    except Exception:
+                        pass
+    return _run
+
+
+def _add_cluster_job(scheduler: BackgroundScheduler, func, *args, **kwargs):
+    """scheduler.add_job for jobs that must run once cluster-wide (requires id=...)."""
+    return scheduler.add_job(_cluster_singleton(kwargs['id'], func), *args, **kwargs)
+
+
+def prune_scheduler_job_runs(retention_days: int | None = None, keep_latest: int | None = None) -> int:
+    """Delete scheduler_job_runs older than `retention_days`, keeping each job's `keep_latest` newest runs.
+
+    Monthly/daily jobs would otherwise lose all history to a short window, so the
+    per-job floor always survives. Returns the number of rows deleted.
+    """
+    retention_days = SCHEDULER_JOB_RUN_RETENTION_DAYS if retention_days is None else int(retention_days)
+    keep_latest = SCHEDULER_JOB_RUN_KEEP_LATEST if keep_latest is None else int(keep_latest)
+    if retention_days <= 0:
+        return 0
+    cutoff = get_eat_now() - timedelta(days=retention_days)
+    deleted = 0
+    job_ids = [row[0] for row in db.session.query(SchedulerJobRun.job_id).distinct().all()]
+    for job_id in job_ids:
+        q = SchedulerJobRun.query.filter(
+            SchedulerJobRun.job_id == job_id,
+            SchedulerJobRun.started_at < cutoff,
+        )
+        if keep_latest > 0:
+            floor = (
+                db.session.query(SchedulerJobRun.id)
+                .filter(SchedulerJobRun.job_id == job_id)
+                .order_by(SchedulerJobRun.id.desc())
+                .offset(keep_latest - 1)
+                .limit(1)
+                .scalar()
+            )
+            if floor is None:
+                continue  # fewer than keep_latest runs
+            q = q.filter(SchedulerJobRun.id < floor)
+        deleted += q.delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def _prune_scheduler_job_runs_job() -> None:
+    try:
+        with app.app_context():
+            deleted = prune_scheduler_job_runs()
+            if deleted:
+                app.logger.info(f'Pruned {deleted} scheduler job run(s)')
+    except Exception as e:
+        try:
+            app.logger.error(f'Scheduler job run pruning failed: {e}', exc_info=True)
+        except Exception:
+            pass
+
+
+def _scheduler_apply_maintenance_jobs(scheduler: BackgroundScheduler):
+    # Daily at 03:15 EAT, after the nightly backup.
+    _add_cluster_job(
+        scheduler,
+        _prune_scheduler_job_runs_job,
+        'cron',
+        hour=3,
+        minute=15,
+        timezone=EAT,
+        id='scheduler_job_runs_prune',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=60 * 60 * 12,
+    )
+
+
 def _scheduler_apply_backup_jobs(scheduler: BackgroundScheduler):
     """(Re)configure backup jobs based on DB settings; falls back to defaults if unavailable."""
     hour, minute = 2, 0
@@ -17345,7 +19039,8 @@ def _scheduler_apply_backup_jobs(scheduler: BackgroundScheduler):
         pass
 
     # Always add jobs with IDs; jobs can early-return if disabled.
-    scheduler.add_job(
+    _add_cluster_job(
+        scheduler,
         scheduled_backup,
         'cron',
         hour=hour,
@@ -17355,7 +19050,8 @@ def _scheduler_apply_backup_jobs(scheduler: BackgroundScheduler):
         max_instances=1,
         coalesce=True,
     )
-    scheduler.add_job(
+    _add_cluster_job(
+        scheduler,
         disaster_recovery_backup_job,
         'interval',
         minutes=disaster_minutes,
@@ -17793,7 +19489,8 @@ def _scheduler_apply_reporting_jobs(scheduler: BackgroundScheduler):
         if today.month == 1 and today.day == 1:
             _send_admin_sales_report('yearly')
 
-    scheduler.add_job(
+    _add_cluster_job(
+        scheduler,
         _nightly_reports,
         'cron',
         hour=22,
@@ -17815,7 +19512,8 @@ def _scheduler_apply_reporting_jobs(scheduler: BackgroundScheduler):
             year, month = now_eat.year, now_eat.month - 1
         _send_admin_monthly_financial_report(year=year, month=month)
 
-    scheduler.add_job(
+    _add_cluster_job(
+        scheduler,
         _monthly_financial_report_job,
         'cron',
         day=1,
@@ -17830,67 +19528,59 @@ def _scheduler_apply_reporting_jobs(scheduler: BackgroundScheduler):
     )
 
 
+STOCK_ALERT_LOW_THRESHOLD = 10
+STOCK_ALERT_EXPIRY_DAYS = 30
+
+
+def _stock_alert_rows(model, kind: str, today) -> list:
+    """Flagged rows of one stock table, classified in SQL.
+
+    The WHERE clause only touches the indexed remaining_quantity and
+    expiry_date columns, so healthy stock is never loaded.
+    """
+    remaining = model.on_hand_quantity
+    expiry = model.expiry_date
+    soon = today + timedelta(days=STOCK_ALERT_EXPIRY_DAYS)
+    status = case(
+        (expiry < today, 'expired'),
+        (or_(remaining.is_(None), remaining <= 0), 'out-of-stock'),
+        (remaining < STOCK_ALERT_LOW_THRESHOLD, 'low-stock'),
+        (expiry < soon, 'expiring-soon'),
+        else_=None,
+    ).label('status')
+    query = (
+        db.session.query(model.id, model.name, remaining, expiry, status)
+        .filter(or_(
+            expiry < soon,
+            remaining < STOCK_ALERT_LOW_THRESHOLD,
+            remaining.is_(None),
+        ))
+    )
+    rows = []
+    for row_id, name, qty, exp, row_status in query.all():
+        if not row_status:
+            continue
+        rows.append({
+            'kind': kind,
+            'id': int(row_id),
+            'name': str(name),
+            'remaining': int(qty or 0),
+            'expiry': exp.isoformat() if exp else None,
+            'status': row_status,
+        })
+    return rows
+
+
 def _stock_alert_snapshot() -> dict:
     """Build a stable snapshot of current stock alerts."""
     today = get_eat_now().date()
 
-    def drug_rows():
-        rows = []
-        for d in Drug.query.all():
-            try:
-                remaining = int(d.remaining_quantity or 0)
-                exp = d.expiry_date
-                status = None
-                if exp and exp < today:
-                    status = 'expired'
-                elif remaining <= 0:
-                    status = 'out-of-stock'
-                elif remaining < 10:
-                    status = 'low-stock'
-                elif exp and (exp - today).days < 30:
-                    status = 'expiring-soon'
-                if status:
-                    rows.append({
-                        'kind': 'drug',
-                        'id': int(d.id),
-                        'name': str(d.name),
-                        'remaining': remaining,
-                        'expiry': exp.isoformat() if exp else None,
-                        'status': status,
-                    })
-            except Exception:
-                continue
-        return rows
-
-    def controlled_rows():
-        rows = []
-        for d in ControlledDrug.query.all():
-            try:
-                remaining = int(d.remaining_quantity or 0)
-                exp = d.expiry_date
-                status = None
-                if exp and exp < today:
-                    status = 'expired'
-                elif remaining <= 0:
-                    status = 'out-of-stock'
-                elif remaining < 10:
-                    status = 'low-stock'
-                elif exp and (exp - today).days < 30:
-                    status = 'expiring-soon'
-                if status:
-                    rows.append({
-                        'kind': 'controlled',
-                        'id': int(d.id),
-                        'name': str(d.name),
-                        'remaining': remaining,
-                        'expiry': exp.isoformat() if exp else None,
-                        'status': status,
-                    })
-            except Exception:
-                continue
-        return rows
-
-    alerts = drug_rows() + controlled_rows()
+    alerts = []
+    for model, kind in ((Drug, 'drug'), (ControlledDrug, 'controlled')):
+        try:
+            alerts.extend(_stock_alert_rows(model, kind, today))
+        except Exception as e:
+            app.logger.error(f"Stock alert query failed for {kind}: {e}")
     # Stable ordering for dedupe
     alerts.sort(key=lambda x: (x.get('kind', ''), x.get('status', ''), x.get('name', ''), x.get('id', 0)))
 
@@ -17908,6 +19598,34 @@ def _stock_alert_snapshot() -> dict:
     }
 
 
+def _stock_alert_states(snap: dict) -> dict:
+    """{'<kind>:<id>': status} for a snapshot (what the diff compares)."""
+    return {f"{a['kind']}:{a['id']}": a['status'] for a in (snap.get('alerts') or [])}
+
+
+def _stock_alert_diff(previous_states: dict, snap: dict) -> dict:
+    """Alerts that changed state since the previous snapshot.
+
+    new:      items that were not flagged before
+    changed:  items whose status changed (e.g. low-stock -> out-of-stock)
+    resolved: keys flagged before and no longer flagged (restocked/removed)
+    Remaining-quantity changes within the same status are not transitions.
+    """
+    previous_states = previous_states if isinstance(previous_states, dict) else {}
+    new, changed = [], []
+    current = {}
+    for a in snap.get('alerts') or []:
+        key = f"{a['kind']}:{a['id']}"
+        current[key] = a['status']
+        before = previous_states.get(key)
+        if before is None:
+            new.append(a)
+        elif before != a['status']:
+            changed.append(dict(a, previous_status=before))
+    resolved = sorted(k for k in previous_states if k not in current)
+    return {'new': new, 'changed': changed, 'resolved': resolved}
+
+
 def _send_admin_stock_alerts() -> None:
     try:
         with app.app_context():
@@ -17916,26 +19634,24 @@ def _send_admin_stock_alerts() -> None:
                 return
 
             snap = _stock_alert_snapshot()
-            # Only send when there are alerts
-            total_alerts = int(sum((snap.get('counts') or {}).values()))
-            if total_alerts <= 0:
-                return
-
-            key = 'admin_stock_alerts'
-            # Dedupe by comparing snapshot hash
-            payload = json.dumps(snap, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
-            digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
+            # Only email on state transitions (newly flagged or status changed),
+            # not because a flagged item's remaining quantity moved.
             state = _load_instance_json('auto_stock_state.json', default={})
-            last = (state.get('last_digest') if isinstance(state, dict) else None) or None
-            if last == digest:
-                return
-            state['last_digest'] = digest
-            state['last_sent_at'] = get_eat_now().isoformat()
+            if not isinstance(state, dict):
+                state = {}
+            diff = _stock_alert_diff(state.get('last_states') or {}, snap)
+            state['last_states'] = _stock_alert_states(snap)
+            state['last_snapshot_at'] = get_eat_now().isoformat()
+            transitions = diff['new'] + diff['changed']
+            if transitions:
+                state['last_sent_at'] = state['last_snapshot_at']
             try:
                 _save_instance_json('auto_stock_state.json', state)
             except Exception:
                 pass
+            if not transitions:
+                return
 
             counts = snap.get('counts') or {}
             subject = f"Drugs Report (Low/Out/Expiry) - {snap.get('date')}"
@@ -17946,6 +19662,16 @@ def _send_admin_stock_alerts() -> None:
             shown = alerts[:max_rows]
             omitted = max(0, len(alerts) - len(shown))
 
+            change_rows = []
+            for a in transitions[:max_rows]:
+                change_rows.append({
+                    'type': 'Controlled Drug' if a.get('kind') == 'controlled' else 'Drug',
+                    'name': a.get('name', ''),
+                    'change': f"{a['previous_status']} -> {a['status']}" if a.get('previous_status') else f"new: {a.get('status', '')}",
+                    'remaining': a.get('remaining', ''),
+                    'expiry': a.get('expiry', '') or '',
+                })
+
             table_rows = []
             for a in shown:
                 table_rows.append({
@@ -17966,6 +19692,9 @@ def _send_admin_stock_alerts() -> None:
                 f"<li>Expiring soon (&lt;30 days): <strong>{escape(str(counts.get('expiring-soon', 0)))}</strong></li>",
                 f"<li>Expired: <strong>{escape(str(counts.get('expired', 0)))}</strong></li>",
                 "</ul>",
+                f"<h3>Changes since last report ({len(diff['new'])} new, {len(diff['changed'])} changed, {len(diff['resolved'])} resolved)</h3>",
+                _render_table(change_rows, [('type', 'Type'), ('name', 'Item'), ('change', 'Change'), ('remaining', 'Remaining'), ('expiry', 'Expiry')]),
+                "<h3>All current alerts</h3>",
                 _render_table(table_rows, [('type', 'Type'), ('name', 'Item'), ('status', 'Status'), ('remaining', 'Remaining'), ('expiry', 'Expiry')]),
                 (f"<p style='color:#777;font-size:12px;'>Showing first {max_rows} alerts; {omitted} more not shown.</p>" if omitted else ""),
                 "</div>",
@@ -17977,6 +19706,7 @@ def _send_admin_stock_alerts() -> None:
                 f"Low stock: {counts.get('low-stock', 0)}\n"
                 f"Expiring soon: {counts.get('expiring-soon', 0)}\n"
                 f"Expired: {counts.get('expired', 0)}\n"
+                f"Changes: {len(diff['new'])} new, {len(diff['changed'])} changed, {len(diff['resolved'])} resolved\n"
             )
 
             for r in recipients:
@@ -17991,9 +19721,96 @@ def _send_admin_stock_alerts() -> None:
             pass
 
 
+# ======================
+# STOCK ON HAND
+# ======================
+# drug.remaining_quantity / controlled_drugs.remaining_quantity store
+# stocked_quantity - sold_quantity so low-stock and out-of-stock filters are
+# index range scans. Every ORM write refreshes it in before_flush; the
+# reconciliation job repairs rows changed outside the ORM (raw SQL, restores).
+
+@event.listens_for(db.session, 'before_flush')
+def _stock_on_hand_before_flush(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, (Drug, ControlledDrug)):
+            continue
+        try:
+            value = int(obj.stocked_quantity or 0) - int(obj.sold_quantity or 0)
+        except (TypeError, ValueError):
+            continue
+        if obj.on_hand_quantity != value:
+            obj.on_hand_quantity = value
+
+
+def reconcile_stock_on_hand(engine, fix: bool = True) -> dict:
+    """Find (and optionally repair) rows whose stored remaining_quantity drifted.
+
+    Returns {table_name: [drifted ids]}.
+    """
+    drift = {}
+    with engine.begin() as conn:
+        for model in (Drug, ControlledDrug):
+            t = model.__table__
+            expected = t.c.stocked_quantity - func.coalesce(t.c.sold_quantity, 0)
+            stale = or_(t.c.remaining_quantity.is_(None), t.c.remaining_quantity != expected)
+            ids = [r[0] for r in conn.execute(db.select(t.c.id).where(stale)).all()]
+            if ids and fix:
+                conn.execute(t.update().where(stale).values(remaining_quantity=expected))
+            drift[t.name] = ids
+    return drift
+
+
+def _ensure_stock_on_hand(engine) -> None:
+    """Fill the stored remaining_quantity for rows that predate the column."""
+    try:
+        drift = reconcile_stock_on_hand(engine, fix=True)
+        fixed = sum(len(ids) for ids in drift.values())
+        if fixed:
+            app.logger.info("Stock on hand backfilled for %d rows.", fixed)
+    except Exception as e:
+        app.logger.warning(f"Stock on hand backfill failed: {e}")
+
+
+def _stock_reservation_error(reservation, id_key: str, not_found_message: str):
+    """400 response for the first failed line of a reserve_stock() result."""
+    line = reservation.failed
+    if line is None:
+        return jsonify({'success': False, 'error': 'Cart is empty'}), 400
+    if line.error == 'not_found':
+        return jsonify({'success': False, 'error': not_found_message.format(id=line.item_id)}), 400
+    if line.error == 'invalid_quantity':
+        return jsonify({'success': False, 'error': f'Invalid quantity for item {line.index + 1}'}), 400
+    return jsonify({
+        'success': False,
+        'error': f'Insufficient stock for {line.record.name}',
+        'available': line.available,
+        'requested': line.quantity,
+        id_key: line.item_id,
+        'lines': [
+            {'index': l.index, id_key: l.item_id, 'requested': l.quantity, 'available': l.available, 'ok': l.ok, 'error': l.error}
+            for l in reservation.lines
+        ],
+    }), 400
+
+
+def _reconcile_stock_on_hand_job() -> None:
+    try:
+        with app.app_context():
+            drift = reconcile_stock_on_hand(db.engine, fix=True)
+            for table, ids in drift.items():
+                if ids:
+                    app.logger.warning(f"Stock on hand drift repaired in {table}: ids {ids[:50]}{' ...' if len(ids) > 50 else ''}")
+    except Exception as e:
+        try:
+            app.logger.error(f"Stock on hand reconciliation failed: {e}", exc_info=True)
+        except Exception:
+            pass
+
+
 def _scheduler_apply_stock_jobs(scheduler: BackgroundScheduler):
     # Daily scan at 22:10 EAT
-    scheduler.add_job(
+    _add_cluster_job(
+        scheduler,
         _send_admin_stock_alerts,
         'cron',
         hour=22,
@@ -18005,6 +19822,69 @@ def _scheduler_apply_stock_jobs(scheduler: BackgroundScheduler):
         coalesce=True,
         misfire_grace_time=60 * 60 * 48,
     )
+    _add_cluster_job(
+        scheduler,
+        _reconcile_stock_on_hand_job,
+        'interval',
+        hours=1,
+        id='stock_on_hand_reconcile',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+
+
+def _refresh_recent_financial_rollup() -> None:
+    """Rebuild stale or missing days of the last FINANCIAL_ROLLUP_RECENT_DAYS days."""
+    try:
+        with app.app_context():
+            today = get_eat_today()
+            _ensure_financial_rollup(today - timedelta(days=FINANCIAL_ROLLUP_RECENT_DAYS), today)
+    except Exception as e:
+        try:
+            app.logger.error(f"Financial rollup refresh failed: {e}", exc_info=True)
+        except Exception:
+            pass
+
+
+def _backfill_financial_rollup(days: int = 400) -> None:
+    """Materialize any day in the last `days` days whose rollup is missing or stale."""
+    try:
+        with app.app_context():
+            today = get_eat_today()
+            _ensure_financial_rollup(today - timedelta(days=int(days)), today)
+    except Exception as e:
+        try:
+            app.logger.error(f"Financial rollup backfill failed: {e}", exc_info=True)
+        except Exception:
+            pass
+
+
+def _scheduler_apply_financial_rollup_jobs(scheduler: BackgroundScheduler):
+    _add_cluster_job(
+        scheduler,
+        _refresh_recent_financial_rollup,
+        'interval',
+        minutes=15,
+        id='financial_rollup_recent',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    # Nightly gap fill at 01:30 EAT (before the 02:00 default backup).
+    _add_cluster_job(
+        scheduler,
+        _backfill_financial_rollup,
+        'cron',
+        hour=1,
+        minute=30,
+        timezone=EAT,
+        id='financial_rollup_backfill',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=60 * 60 * 12,
+    )
 
 
 def _send_admin_monthly_financial_report(*, year: int, month: int) -> None:
@@ -18025,6 +19905,15 @@ def _send_admin_monthly_financial_report(*, year: int, month: int) -> None:
             if not _should_send_once(key, period_id):
                 return
 
+            # Rebuild the month's rollup so the emailed figures are authoritative.
+            try:
+                refresh_financial_rollup(
+                    date(year, month, 1),
+                    date(year, month, calendar.monthrange(year, month)[1])
+                )
+            except Exception as e:
+                app.logger.warning(f"Monthly report rollup refresh failed: {e}")
+
             metrics = get_monthly_financial_summary(year, month) or {}
 
             start_date = metrics.get('start_date')
@@ -18185,7 +20074,10 @@ if not app.config.get('FAST_DEV') and not app.config.get('DEBUG'):
         _scheduler_apply_backup_jobs(scheduler)
         _scheduler_apply_reporting_jobs(scheduler)
         _scheduler_apply_stock_jobs(scheduler)
-        scheduler.add_job(
+        _scheduler_apply_financial_rollup_jobs(scheduler)
+        _scheduler_apply_maintenance_jobs(scheduler)
+        _add_cluster_job(
+            scheduler,
             scheduled_ai_dosage_agent,
             'interval',
             minutes=30,
@@ -18194,6 +20086,17 @@ if not app.config.get('FAST_DEV') and not app.config.get('DEBUG'):
             max_instances=1,
             coalesce=True,
         )
+        # Not wrapped: every worker keeps competing for the lease.
+        scheduler.add_job(
+            _scheduler_leader_heartbeat,
+            'interval',
+            seconds=SCHEDULER_HEARTBEAT_SECONDS,
+            id='scheduler_leader_heartbeat',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+        )
+        _scheduler_leader_heartbeat()
         scheduler.start()
 elif app.config.get('DEBUG'):
     app.logger.info('DEBUG mode: background schedulers disabled for faster startup.')
@@ -21081,25 +22984,13 @@ def admin_load_dosage_index_book():
         flash('Dosage index book not found or empty. Place it at instance/dosage_index.json or static/dosage_index.json', 'warning')
         return redirect(url_for('manage_dosage'))
 
-    name_map = { _normalize_drug_name(e.get('name')): e for e in entries if e.get('name') }
     created = 0
+    review = []
     try:
         drugs = Drug.query.filter(~Drug.dosages.any()).all()
-        for drug in drugs:
-            e = name_map.get(_normalize_drug_name(drug.name))
-            if not e:
-                continue
-            d = DrugDosage(
-                drug_id=drug.id,
-                indication=e.get('indication'),
-                contraindication=e.get('contraindication'),
-                interaction=e.get('interaction'),
-                side_effects=e.get('side_effects'),
-                dosage_peds=e.get('dosage_peds'),
-                dosage_adults=e.get('dosage_adults'),
-                dosage_geriatrics=e.get('dosage_geriatrics'),
-                important_notes=e.get('important_notes'),
-            )
+        exact, review = _split_dosage_index_matches(drugs)
+        for drug, entry in exact:
+            d = DrugDosage(drug_id=drug.id, **_dosage_fields_from_index_entry(entry))
             db.session.add(d)
             created += 1
         db.session.commit()
@@ -21107,9 +22998,52 @@ def admin_load_dosage_index_book():
     except Exception as e:
         db.session.rollback()
         flash(f'Failed to load dosage index book: {str(e)}', 'danger')
+        review = []
 
+    if review:
+        return render_template('admin/dosage_index_review.html', kind='drug', review=review,
+                               back_url=url_for('manage_dosage'))
     return redirect(url_for('manage_dosage'))
 
+
+@app.route('/admin/dosage/load-index-book/confirm', methods=['POST'])
+@login_required
+def admin_confirm_dosage_index_matches():
+    """Apply the approximate index-book matches an admin ticked on the review page."""
+    if current_user.role != 'admin':
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('home'))
+
+    kind = (request.form.get('kind') or 'drug').strip().lower()
+    back = 'manage_controlled_dosage' if kind == 'controlled' else 'manage_dosage'
+    created = 0
+    try:
+        for value in request.form.getlist('confirm'):
+            drug_id, _, entry_name = str(value).partition(':')
+            match = _dosage_index_book.lookup(entry_name, fuzzy=False)
+            if not drug_id.isdigit() or not match or match['match'] != 'exact':
+                continue
+            fields = _dosage_fields_from_index_entry(match['entry'])
+            if kind == 'controlled':
+                drug = db.session.get(ControlledDrug, int(drug_id))
+                if drug is None or drug.dosages:
+                    continue
+                db.session.add(ControlledDrugDosage(controlled_drug_id=drug.id, **fields))
+            else:
+                drug = db.session.get(Drug, int(drug_id))
+                if drug is None or drug.dosages:
+                    continue
+                db.session.add(DrugDosage(drug_id=drug.id, **fields))
+            created += 1
+            app.logger.info(f"Dosage index book: admin confirmed '{drug.name}' -> '{entry_name}'")
+        db.session.commit()
+        flash(f'Applied {created} confirmed dosage index book match(es).', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Failed to apply dosage index book matches: {str(e)}', 'danger')
+
+    return redirect(url_for(back))
+
 @app.before_request
 def log_request_info():
     """Log detailed information about each request"""
@@ -22321,28 +24255,24 @@ def process_controlled_sale():
         # Save prescription image
         prescription_path = _save_prescription_image(prescription_image)
         
-        # Validate stock and compute totals
-        resolved_items = []
-        total_amount = 0.0
         for idx, item in enumerate(items):
-            cd_id = item.get('controlled_drug_id')
-            qty = int(item.get('quantity', 0))
-            
-            if not cd_id or qty <= 0:
+            if not item.get('controlled_drug_id') or int(item.get('quantity', 0)) <= 0:
                 return jsonify({'success': False, 'error': f'Invalid quantity for item {idx+1}'}), 400
-            
-            cd = db.session.get(ControlledDrug, int(cd_id))
-            if not cd:
-                return jsonify({'success': False, 'error': f'Controlled drug not found: {cd_id}'}), 400
-            
-            if cd.remaining_quantity < qty:
-                return jsonify({
-                    'success': False, 
-                    'error': f'Insufficient stock for {cd.name}',
-                    'available': cd.remaining_quantity,
-                    'requested': qty
-                }), 400
-            
+        
+        # Lock, validate and decrement stock for every cart line in one pass.
+        reservation = reserve_stock(
+            db.session, ControlledDrug,
+            [(item.get('controlled_drug_id'), int(item.get('quantity', 0))) for item in items],
+        )
+        if not reservation.ok:
+            db.session.rollback()
+            return _stock_reservation_error(reservation, 'controlled_drug_id', 'Controlled drug not found: {id}')
+        
+        # Compute totals
+        resolved_items = []
+        total_amount = 0.0
+        for line in reservation.lines:
+            cd, qty = line.record, line.quantity
             unit_price = float(cd.selling_price or 0)
             line_total = unit_price * qty
             total_amount += line_total
@@ -22393,11 +24323,6 @@ def process_controlled_sale():
                 total_price=float(unit_price) * int(qty),
                 created_at=get_eat_now()
             ))
-            
-            # Deduct from remaining quantity
-            cd.remaining_quantity = (cd.remaining_quantity or 0) - int(qty)
-            cd.sold_quantity = (cd.sold_quantity or 0) + int(qty)
-            db.session.add(cd)
         
         # Generate receipt HTML before committing so we can store it and post to the ledger atomically.
         receipt_html = ''
@@ -22731,25 +24656,13 @@ def admin_load_controlled_dosage_index_book():
         flash('Dosage index book not found or empty. Place it at instance/dosage_index.json or static/dosage_index.json', 'warning')
         return redirect(url_for('manage_controlled_dosage'))
 
-    name_map = { _normalize_drug_name(e.get('name')): e for e in entries if e.get('name') }
     created = 0
+    review = []
     try:
         drugs = ControlledDrug.query.filter(~ControlledDrug.dosages.any()).all()
-        for drug in drugs:
-            e = name_map.get(_normalize_drug_name(drug.name))
-            if not e:
-                continue
-            d = ControlledDrugDosage(
-                controlled_drug_id=drug.id,
-                indication=e.get('indication'),
-                contraindication=e.get('contraindication'),
-                interaction=e.get('interaction'),
-                side_effects=e.get('side_effects'),
-                dosage_peds=e.get('dosage_peds'),
-                dosage_adults=e.get('dosage_adults'),
-                dosage_geriatrics=e.get('dosage_geriatrics'),
-                important_notes=e.get('important_notes'),
-            )
+        exact, review = _split_dosage_index_matches(drugs)
+        for drug, entry in exact:
+            d = ControlledDrugDosage(controlled_drug_id=drug.id, **_dosage_fields_from_index_entry(entry))
             db.session.add(d)
             created += 1
         db.session.commit()
@@ -22757,7 +24670,11 @@ def admin_load_controlled_dosage_index_book():
     except Exception as e:
         db.session.rollback()
         flash(f'Failed to load controlled dosage index book: {str(e)}', 'danger')
+        review = []
 
+    if review:
+        return render_template('admin/dosage_index_review.html', kind='controlled', review=review,
+                               back_url=url_for('manage_controlled_dosage'))
     return redirect(url_for('manage_controlled_dosage'))
 
 
@@ -23636,22 +25553,24 @@ def pharmacist_controlled_cart_sale():
             if not patient:
                 return jsonify({'success': False, 'error': 'Selected patient not found'}), 400
 
-        # Validate stock + compute totals
-        resolved_items = []
-        total_amount = 0.0
         for idx, it in enumerate(items):
-            cd_id = it.get('controlled_drug_id')
-            qty = int(it.get('quantity') or 0)
-            if not cd_id or qty <= 0:
+            if not it.get('controlled_drug_id') or int(it.get('quantity') or 0) <= 0:
                 return jsonify({'success': False, 'error': f'Invalid item at position {idx + 1}'}), 400
 
-            cd = db.session.get(ControlledDrug, int(cd_id))
-            if not cd:
-                return jsonify({'success': False, 'error': f'Controlled drug not found: {cd_id}'}), 400
-
-            if cd.remaining_quantity < qty:
-                return jsonify({'success': False, 'error': f'Insufficient stock for {cd.name}', 'available': cd.remaining_quantity, 'requested': qty, 'controlled_drug_id': cd.id}), 400
+        # Lock, validate and decrement stock for every cart line in one pass.
+        reservation = reserve_stock(
+            db.session, ControlledDrug,
+            [(it.get('controlled_drug_id'), int(it.get('quantity') or 0)) for it in items],
+        )
+        if not reservation.ok:
+            db.session.rollback()
+            return _stock_reservation_error(reservation, 'controlled_drug_id', 'Controlled drug not found: {id}')
 
+        # Compute totals
+        resolved_items = []
+        total_amount = 0.0
+        for line, it in zip(reservation.lines, items):
+            cd, qty = line.record, line.quantity
             unit_price = float(cd.selling_price)
             line_total = unit_price * qty
             total_amount += line_total
@@ -23699,9 +25618,6 @@ def pharmacist_controlled_cart_sale():
                 created_at=get_eat_now(),
             ))
 
-            cd.sold_quantity = (cd.sold_quantity or 0) + int(qty)
-            db.session.add(cd)
-
         receipt_html = None
         try:
             db.session.flush()
@@ -24284,6 +26200,143 @@ def pharmacist_dispensed_controlled_items_api():
         return jsonify({'success': False, 'error': 'Failed to load dispensed controlled drugs'}), 500
 
 
+# ======================
+# RECEIPT RENDER QUEUE
+# ======================
+# Sale receipts are rendered after the checkout commits (utils/receipt_queue.py).
+# queue_sale_receipt() stashes the job on the session; it is handed to the
+# worker only if the transaction commits. generate_receipt serves the stored
+# HTML, or renders on demand when the job has not run yet. Everything a receipt
+# shows (including cash tendered/change) is read from the sale row, so a job
+# lost to a restart or queued in another worker renders the same receipt.
+# When the receipt PDF cache is enabled the job also builds the sale's PDF
+# into it (as the cashier who made the sale), so the first download is a
+# cache hit; without the cache the PDF endpoint still builds it on request.
+
+RECEIPT_RENDER_MAX_ATTEMPTS = int(os.getenv('RECEIPT_RENDER_MAX_ATTEMPTS', '5') or 5)
+RECEIPT_RENDER_RETRY_SECONDS = float(os.getenv('RECEIPT_RENDER_RETRY_SECONDS', '2') or 2)
+
+
+def _render_sale_receipt_html(sale_id: int) -> Optional[str]:
+    """Render pharmacist/receipt.html for a sale (needs a request context)."""
+    sale = db.session.query(Sale).options(
+        db.joinedload(Sale.user),
+        db.joinedload(Sale.items).joinedload(SaleItem.drug),
+        db.joinedload(Sale.patient)
+    ).where(Sale.id == sale_id).first()
+    if not sale:
+        return None
+
+    related_sales = []
+    if sale.bulk_sale_number:
+        related_sales = db.session.query(Sale).filter(
+            Sale.bulk_sale_number == sale.bulk_sale_number,
+            Sale.id != sale.id
+        ).options(
+            db.joinedload(Sale.items).joinedload(SaleItem.drug)
+        ).all()
+
+    return render_template(
+        'pharmacist/receipt.html',
+        sale=sale,
+        related_sales=related_sales,
+        now=datetime.now(),
+        amount_given=sale.amount_given,
+        change=sale.change_amount,
+    )
+
+
+def _receipt_html_is_valid(html) -> bool:
+    # Receipts rendered before their items were flushed have no rows.
+    return bool(html) and 'No items found for this sale.' not in html
+
+
+def _prebuild_sale_receipt_pdf(sale_id: int, base_url: str) -> None:
+    """Warm the receipt PDF cache for a sale through the PDF endpoint (best-effort)."""
+    if not _REPORTLAB_AVAILABLE or _get_receipt_pdf_cache() is None:
+        return
+    sale = db.session.get(Sale, sale_id)
+    cashier = getattr(sale, 'user', None) if sale else None
+    if cashier is None:
+        return
+    from flask import g
+
+    with app.test_request_context(f'/api/sales/{sale_id}/receipt.pdf', base_url=base_url):
+        try:
+            g._login_user = cashier  # current_user for the endpoint, without a login
+            api_sale_receipt_pdf(sale_id)
+        except Exception as e:
+            app.logger.warning(f"Receipt PDF prebuild for sale {sale_id} failed: {e}")
+
+
+def _render_queued_sale_receipt(key, payload) -> None:
+    """Worker job: store the receipt HTML on the sale's transaction and warm its PDF (idempotent)."""
+    _, sale_id = key
+    payload = payload or {}
+    base_url = payload.get('base_url') or 'http://localhost/'
+    with app.test_request_context(f'/pharmacist/sale/{sale_id}/receipt', base_url=base_url):
+        try:
+            tx = _get_transaction_for_sale(sale_id)
+            if tx is None:
+                return
+            if not _receipt_html_is_valid(tx.receipt_html):
+                html = _render_sale_receipt_html(sale_id)
+                if html is None:
+                    return
+                _ensure_transaction_receipt(tx, html, prefix='SALE', force=True)
+                db.session.commit()
+            _prebuild_sale_receipt_pdf(sale_id, base_url)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+def _log_receipt_render_error(key, error, attempt) -> None:
+    try:
+        app.logger.warning(f"Receipt render {key} failed (attempt {attempt}/{RECEIPT_RENDER_MAX_ATTEMPTS}): {error}")
+    except Exception:
+        pass
+
+
+receipt_render_queue = ReceiptRenderQueue(
+    _render_queued_sale_receipt,
+    max_attempts=RECEIPT_RENDER_MAX_ATTEMPTS,
+    retry_delay=RECEIPT_RENDER_RETRY_SECONDS,
+    on_error=_log_receipt_render_error,
+)
+
+
+def queue_sale_receipt(sale_id: int) -> None:
+    """Render the sale's receipt once the current transaction commits."""
+    payload = {}
+    try:
+        payload['base_url'] = request.url_root
+    except RuntimeError:
+        pass
+    db.session.info.setdefault('receipt_render_jobs', {})[('sale', int(sale_id))] = payload
+
+
+@event.listens_for(db.session, 'after_commit')
+def _receipt_render_after_commit(session):
+    for key, payload in (session.info.pop('receipt_render_jobs', None) or {}).items():
+        receipt_render_queue.enqueue(key, payload)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _receipt_render_after_rollback(session):
+    session.info.pop('receipt_render_jobs', None)
+
+
+@app.route('/admin/receipts/render-queue')
+@login_required
+def receipt_render_queue_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(receipt_render_queue.stats())
+
+
 @app.route('/pharmacist/cart_sale', methods=['POST'])
 @login_required
 def process__cart_sale():
@@ -24315,6 +26368,20 @@ def process__cart_sale():
             if 'unit_price' not in item:
                 return jsonify({'success': False, 'error': f'Missing unit_price in item {i+1}'}), 400
         
+        # Lock, validate and decrement stock for every cart line in one pass.
+        sale_lines = [
+            (item_index, item_data) for item_index, item_data in enumerate(items)
+            if item_data.get('drug_id') and int(item_data.get('quantity', 1)) > 0
+        ]
+        reservation = reserve_stock(
+            db.session, Drug,
+            [(item_data.get('drug_id'), int(item_data.get('quantity', 1))) for _, item_data in sale_lines],
+        )
+        if not reservation.ok:
+            db.session.rollback()
+            return _stock_reservation_error(reservation, 'drug_id', 'Drug with ID {id} not found')
+        drugs_by_id = reservation.records()
+
         # Generate sale numbers
         sale_number = f"SALE-{datetime.now().strftime('%Y%m%d%H%M%S')}-{random.randint(100, 999)}"
         
@@ -24335,40 +26402,20 @@ def process__cart_sale():
             pharmacist_name=f"{current_user.username}",
             total_amount=total_amount,
             payment_method=payment_method,
+            amount_given=amount_given if payment_method == 'cash' else None,
+            change_amount=change if payment_method == 'cash' and amount_given is not None else None,
             status='completed',
             created_at=get_eat_now(),
         )
         db.session.add(sale)
         db.session.flush()
         
-        # Process each item
-        for item_index, item_data in enumerate(items):
+        # Process each item (stock was already reserved above)
+        for item_index, item_data in sale_lines:
             drug_id = item_data.get('drug_id')
             quantity = int(item_data.get('quantity', 1))
             unit_price = float(item_data.get('unit_price', 0))
-            
-            if not drug_id or quantity <= 0:
-                continue
-            
-            # Get drug from database
-            drug = db.session.get(Drug, drug_id)
-            if not drug:
-                db.session.rollback()
-                return jsonify({
-                    'success': False,
-                    'error': f'Drug with ID {drug_id} not found'
-                }), 400
-            
-            # Check stock availability
-            if drug.remaining_quantity < quantity:
-                db.session.rollback()
-                return jsonify({
-                    'success': False,
-                    'error': f'Insufficient stock for {drug.name}',
-                    'available': drug.remaining_quantity,
-                    'requested': quantity,
-                    'drug_id': drug.id
-                }), 400
+            drug = drugs_by_id[int(drug_id)]
             
             # Create sale item
             sale_item = SaleItem(
@@ -24384,10 +26431,6 @@ def process__cart_sale():
                 created_at=get_eat_now(),
             )
             db.session.add(sale_item)
-            
-            # Update drug stock
-            drug.sold_quantity += quantity
-            db.session.add(drug)
         
         # Create transaction record
         transaction = Transaction(
@@ -24410,35 +26453,9 @@ def process__cart_sale():
         )
         db.session.add(transaction)
 
-        # Store sale receipt HTML for reprinting (best-effort)
-        try:
-            # Session autoflush is disabled; flush pending SaleItems so receipt queries can see them.
-            db.session.flush()
-            sale_for_receipt = db.session.query(Sale).options(
-                db.joinedload(Sale.user),
-                db.joinedload(Sale.items).joinedload(SaleItem.drug),
-                db.joinedload(Sale.patient)
-            ).filter(Sale.id == sale.id).first()
-
-            related_sales = []
-            if sale_for_receipt and sale_for_receipt.bulk_sale_number:
-                related_sales = db.session.query(Sale).filter(
-                    Sale.bulk_sale_number == sale_for_receipt.bulk_sale_number,
-                    Sale.id != sale_for_receipt.id
-                ).options(db.joinedload(Sale.items).joinedload(SaleItem.drug)).all()
-
-            receipt_html = render_template(
-                'pharmacist/receipt.html',
-                sale=sale_for_receipt,
-                related_sales=related_sales,
-                now=datetime.now(),
-                amount_given=amount_given,
-                change=change,
-            )
-            _ensure_transaction_receipt(transaction, receipt_html, prefix='SALE')
-        except Exception as e:
-            current_app.logger.error(f"Failed to store sale receipt HTML: {str(e)}", exc_info=True)
-        
+        # The receipt is rendered after commit by the receipt render queue.
+        queue_sale_receipt(sale.id)
+
         # Commit all changes
         db.session.commit()
         
@@ -24479,9 +26496,20 @@ def generate_receipt(sale_id):
     if getattr(sale_owner, 'role', None) != 'pharmacist':
         abort(403)
     
-    tx = _get_transaction_for_sale(sale_id)
     embedded_requested = request.args.get('embedded') == '1'
 
+    # Receipt queued at checkout: a job still waiting is rendered here instead,
+    # one the worker is running right now is awaited. Embedded views never
+    # store the fragment, so they leave the job queued.
+    render_key = ('sale', sale_id)
+    queued, queued_payload = False, None
+    if not embedded_requested:
+        queued, queued_payload = receipt_render_queue.take(render_key)
+        if not queued:
+            receipt_render_queue.wait(render_key, timeout=5.0)
+
+    tx = _get_transaction_for_sale(sale_id)
+
     reprint_requested = request.args.get('reprint') == '1'
     stored_invalid = False
 
@@ -24511,39 +26539,23 @@ def generate_receipt(sale_id):
                 return Response(_inject_reprint_banner(stored_html, tx.receipt_reprinted_at, tx.receipt_reprint_count), mimetype='text/html')
             return Response(stored_html, mimetype='text/html')
 
-    sale = db.session.query(Sale).options(
-        db.joinedload(Sale.user),
-        db.joinedload(Sale.items).joinedload(SaleItem.drug),
-        db.joinedload(Sale.patient)
-    ).where(Sale.id == sale_id).first()
-    
-    if not sale:
+    try:
+        rendered = _render_sale_receipt_html(sale_id)
+    except Exception:
+        if queued:
+            # Hand the job back so the worker retries storing it.
+            receipt_render_queue.enqueue(render_key, queued_payload)
+        raise
+    if rendered is None:
         abort(404)
-    
-    related_sales = []
-    if sale.bulk_sale_number:
-        related_sales = db.session.query(Sale).filter(
-            Sale.bulk_sale_number == sale.bulk_sale_number,
-            Sale.id != sale.id
-        ).options(
-            db.joinedload(Sale.items).joinedload(SaleItem.drug)
-        ).all()
-    
-    rendered = render_template(
-        'pharmacist/receipt.html',
-        sale=sale,
-        related_sales=related_sales,
-        now=datetime.now(),
-        amount_given=None,
-        change=None,
-    )
 
     # Persist for future reprints if transaction exists
     try:
         if not tx:
             tx = _get_transaction_for_sale(sale_id)
         if tx:
-            _ensure_transaction_receipt(tx, rendered, prefix='SALE', force=stored_invalid)
+            if not embedded_requested:
+                _ensure_transaction_receipt(tx, rendered, prefix='SALE', force=stored_invalid)
 
             if reprint_requested:
                 tx.receipt_reprint_count = int(tx.receipt_reprint_count or 0) + 1
@@ -24552,6 +26564,8 @@ def generate_receipt(sale_id):
             db.session.commit()
     except Exception:
         db.session.rollback()
+        if queued:
+            receipt_render_queue.enqueue(render_key, queued_payload)
 
     if embedded_requested:
         return Response(rendered, mimetype='text/html')
@@ -25866,6 +27880,7 @@ def doctor_patients():
     
     base_completed_query = Patient.query.filter_by(status='completed')
     completed_patients = filter_accessible_patients(base_completed_query, current_user).order_by(Patient.updated_at.desc()).all()
+    prefetch_patient_decryption(active_patients + completed_patients)
 
     # Filter outpatients and inpatients
     # FIXED: Check for op_number/ip_number truthiness (not empty string)
@@ -28763,18 +30778,24 @@ def old_patients():
 
     # Apply search filter if provided
     if search_query:
-        query = query.filter(
-            or_(
-                Patient.name.ilike(f'%{search_query}%'),
-                Patient.op_number.ilike(f'%{search_query}%'),
-                Patient.ip_number.ilike(f'%{search_query}%')
-            )
-        )
+        # Names are encrypted at rest; match them through the blind index.
+        conditions = [
+            Patient.op_number.ilike(f'%{search_query}%'),
+            Patient.ip_number.ilike(f'%{search_query}%')
+        ]
+        name_clause = patient_search_clause(search_query)
+        if name_clause is not None:
+            conditions.append(name_clause)
+        query = query.filter(or_(*conditions))
 
     # Get paginated results ordered by completion date (newest first)
     completed_patients = query.order_by(
         Patient.updated_at.desc()
     ).paginate(page=page, per_page=per_page, error_out=False)
+    prefetch_patient_decryption(completed_patients.items)
+    if search_query:
+        # Blind-index candidates are re-checked; a page can show fewer than per_page rows.
+        completed_patients.items = patient_search_hits(completed_patients.items, search_query)
 
     if request.method == 'POST':
         action = request.form.get('action')
@@ -31297,21 +33318,31 @@ def labtech_lab_requests():
 
     if q:
         like = f"%{q}%"
+        conditions = [
+            Patient.op_number.ilike(like),
+            Patient.ip_number.ilike(like),
+            LabTest.name.ilike(like),
+        ]
+        name_clause = patient_search_clause(q)
+        if name_clause is not None:
+            conditions.append(name_clause)
         query = (
             query
             .join(Patient, Patient.id == LabRequest.patient_id)
             .join(LabTest, LabTest.id == LabRequest.test_id)
-            .filter(
-                or_(
-                    Patient.name.ilike(like),
-                    Patient.op_number.ilike(like),
-                    Patient.ip_number.ilike(like),
-                    LabTest.name.ilike(like),
-                )
-            )
+            .filter(or_(*conditions))
         )
 
     requests_list = query.order_by(LabRequest.created_at.desc()).limit(500).all()
+    if q:
+        # Drop requests that only matched through a blind-index false positive.
+        needle = q.lower()
+        prefetch_patient_decryption([r.patient for r in requests_list if r.patient])
+        requests_list = [
+            r for r in requests_list
+            if (r.test and needle in (r.test.name or '').lower())
+            or (r.patient and patient_search_hits([r.patient], q))
+        ]
 
     departments = []
     try:
@@ -31509,7 +33540,12 @@ def receptionist_patients():
     if not _require_role({'receptionist', 'admin'}):
         return redirect(url_for('home'))
     
-    patients = Patient.query.order_by(Patient.created_at.desc()).all()
+    page = request.args.get('page', 1, type=int)
+    per_page = 50  # Patients per page
+
+    patients = Patient.query.order_by(Patient.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    # Only the rendered page: the whole table would overflow the decrypt caches.
+    prefetch_patient_decryption(patients.items)
     return render_template('receptionist/patients.html', patients=patients)
 
 @app.route('/receptionist/patient/<int:patient_id>')
@@ -32914,10 +34950,10 @@ def api_drug_stats():
     if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    total_value = db.session.query(func.sum(Drug.selling_price * (Drug.stocked_quantity - Drug.sold_quantity))).scalar() or 0
-    low_stock = db.session.query(func.count(Drug.id)).filter(Drug.stocked_quantity - Drug.sold_quantity < 10).filter(Drug.stocked_quantity - Drug.sold_quantity > 0).scalar()
+    total_value = db.session.query(func.sum(Drug.selling_price * Drug.remaining_quantity)).scalar() or 0
+    low_stock = db.session.query(func.count(Drug.id)).filter(Drug.remaining_quantity < 10).filter(Drug.remaining_quantity > 0).scalar()
     expiring_soon = db.session.query(func.count(Drug.id)).filter(Drug.expiry_date <= date.today() + timedelta(days=30)).filter(Drug.expiry_date >= date.today()).scalar()
-    out_of_stock = db.session.query(func.count(Drug.id)).filter(Drug.stocked_quantity - Drug.sold_quantity <= 0).scalar()
+    out_of_stock = db.session.query(func.count(Drug.id)).filter(Drug.remaining_quantity <= 0).scalar()
     
     return jsonify({
         'total_value': float(total_value),
@@ -33004,10 +35040,10 @@ def api_controlled_drug_stats():
     if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    total_value = db.session.query(func.sum(ControlledDrug.selling_price * (ControlledDrug.stocked_quantity - ControlledDrug.sold_quantity))).scalar() or 0
-    low_stock = db.session.query(func.count(ControlledDrug.id)).filter(ControlledDrug.stocked_quantity - ControlledDrug.sold_quantity < 10).filter(ControlledDrug.stocked_quantity - ControlledDrug.sold_quantity > 0).scalar()
+    total_value = db.session.query(func.sum(ControlledDrug.selling_price * ControlledDrug.remaining_quantity)).scalar() or 0
+    low_stock = db.session.query(func.count(ControlledDrug.id)).filter(ControlledDrug.remaining_quantity < 10).filter(ControlledDrug.remaining_quantity > 0).scalar()
     expiring_soon = db.session.query(func.count(ControlledDrug.id)).filter(ControlledDrug.expiry_date <= date.today() + timedelta(days=30)).filter(ControlledDrug.expiry_date >= date.today()).scalar()
-    out_of_stock = db.session.query(func.count(ControlledDrug.id)).filter(ControlledDrug.stocked_quantity - ControlledDrug.sold_quantity <= 0).scalar()
+    out_of_stock = db.session.query(func.count(ControlledDrug.id)).filter(ControlledDrug.remaining_quantity <= 0).scalar()
     
     return jsonify({
         'total_value': float(total_value),
@@ -33047,13 +35083,21 @@ def api_patients():
     
     query = Patient.query
     if search:
-        query = query.filter(
-            (Patient.op_number.ilike(f'%{search}%')) |
-            (Patient.ip_number.ilike(f'%{search}%')) |
-            (Patient.name.ilike(f'%{search}%'))
-        )
+        conditions = [
+            Patient.op_number.ilike(f'%{search}%'),
+            Patient.ip_number.ilike(f'%{search}%'),
+        ]
+        blind_clause = patient_search_clause(search, fields=('name', 'phone'))
+        if blind_clause is not None:
+            conditions.append(blind_clause)
+        query = query.filter(or_(*conditions))
     
-    patients = query.limit(limit).all()
+    if not search:
+        patients = prefetch_patient_decryption(query.limit(limit).all())
+    else:
+        # Over-fetch, then drop blind-index false positives with a plaintext re-check.
+        candidates = prefetch_patient_decryption(query.limit(limit * 2).all(), fields=('name', 'phone'))
+        patients = patient_search_hits(candidates, search, fields=('name', 'phone'))[:limit]
     
     return jsonify([{
         'id': patient.id,
@@ -33302,48 +35346,187 @@ def api_receptionist_bills():
     return jsonify(out)
 
 
-def _draw_rubber_stamp_pdf(c, page_w, y, facility_name='MAKOKHA MEDICAL CENTRE', phone1='0741 256 531', phone2='0713 580 997'):
+# ======================
+# RECEIPT PDF CACHE
+# ======================
+# Generated receipt PDFs are cached on disk (utils/pdf_cache.py), keyed by the
+# record id plus everything drawn on the page, so downloads, reprints and
+# WhatsApp shares of an unchanged receipt are served from the cache. Bump
+# RECEIPT_PDF_LAYOUT_VERSION when the drawing code changes.
+
+RECEIPT_PDF_LAYOUT_VERSION = 1
+RECEIPT_PDF_CACHE_MAX_MB = int(os.getenv('RECEIPT_PDF_CACHE_MAX_MB', '200') or 200)
+# Draw the PDF rubber stamp from the memoized PNG (utils/stamp_signature.rubber_stamp_png)
+# instead of vector text. Vector stays the default: ReportLab re-encodes an image in
+# every document, so the raster stamp is larger and slower per PDF.
+STAMP_PDF_RASTER = str(os.getenv('STAMP_PDF_RASTER', '')).strip().lower() in ('1', 'true', 'yes', 'on')
+_receipt_pdf_cache: Optional[PdfCache] = None
+_receipt_pdf_cache_lock = threading.Lock()
+_receipt_pdf_assets: dict = {}
+
+
+def _get_receipt_pdf_cache() -> Optional[PdfCache]:
+    global _receipt_pdf_cache
+    if _receipt_pdf_cache is not None or RECEIPT_PDF_CACHE_MAX_MB <= 0:
+        return _receipt_pdf_cache
+    with _receipt_pdf_cache_lock:
+        if _receipt_pdf_cache is None:
+            try:
+                # Receipts carry patient details: keep them encrypted at rest like uploads.
+                key = get_upload_encryption_key_bytes()
+                _receipt_pdf_cache = PdfCache(
+                    os.path.join(app.instance_path, 'pdf_cache'),
+                    max_bytes=RECEIPT_PDF_CACHE_MAX_MB * 1024 * 1024,
+                    encrypt=lambda data: _encrypt_upload_bytes(data, key=key),
+                    decrypt=lambda blob: _decrypt_upload_bytes(blob, key=key),
+                    on_error=lambda where, e: app.logger.warning(f"Receipt PDF cache {where} failed: {e}"),
+                )
+            except Exception as e:
+                app.logger.warning(f"Receipt PDF cache disabled: {e}")
+                return None
+    return _receipt_pdf_cache
+
+
+def _receipt_pdf_logo():
+    """Logo ImageReader, decoded once and reused until logo.png changes."""
+    logo_path = os.path.join(app.root_path, 'static', 'images', 'logo.png')
+    try:
+        mtime = os.stat(logo_path).st_mtime_ns
+    except OSError:
+        return None, None
+    cached = _receipt_pdf_assets.get('logo')
+    if cached and cached[0] == mtime:
+        return cached[1], mtime
+    reader = ImageReader(logo_path)
+    _receipt_pdf_assets['logo'] = (mtime, reader)
+    return reader, mtime
+
+
+def _receipt_pdf_stamp_style() -> dict:
+    """Rubber-stamp typography with colours resolved once per process."""
+    style = _receipt_pdf_assets.get('stamp_style')
+    if style is not None:
+        return style
     try:
         from utils.stamp_signature import get_stamp_typography
         typo = get_stamp_typography()
-        stamp_color = typo.get('colors', {}).get('stamp', '#2e3192')
-        date_color = typo.get('colors', {}).get('date', '#dc143c')
         pdf_style = typo.get('pdf', {})
-        font_bold = pdf_style.get('font_bold', 'Helvetica-Bold')
-        font_regular = pdf_style.get('font_regular', 'Helvetica')
-        size_title = float(pdf_style.get('size_title', 7.0) or 7.0)
-        size_date = float(pdf_style.get('size_date', 8.0) or 8.0)
-        size_contact = float(pdf_style.get('size_contact', 6.5) or 6.5)
-        line_width = float(pdf_style.get('line_width', 1.2) or 1.2)
+        style = {
+            'stamp_color': typo.get('colors', {}).get('stamp', '#2e3192'),
+            'date_color': typo.get('colors', {}).get('date', '#dc143c'),
+            'font_bold': pdf_style.get('font_bold', 'Helvetica-Bold'),
+            'font_regular': pdf_style.get('font_regular', 'Helvetica'),
+            'size_title': float(pdf_style.get('size_title', 7.0) or 7.0),
+            'size_date': float(pdf_style.get('size_date', 8.0) or 8.0),
+            'size_contact': float(pdf_style.get('size_contact', 6.5) or 6.5),
+            'line_width': float(pdf_style.get('line_width', 1.2) or 1.2),
+        }
     except Exception:
-        stamp_color = '#2e3192'
-        date_color = '#dc143c'
-        font_bold = 'Helvetica-Bold'
-        font_regular = 'Helvetica'
-        size_title = 7.0
-        size_date = 8.0
-        size_contact = 6.5
-        line_width = 1.2
+        style = {
+            'stamp_color': '#2e3192',
+            'date_color': '#dc143c',
+            'font_bold': 'Helvetica-Bold',
+            'font_regular': 'Helvetica',
+            'size_title': 7.0,
+            'size_date': 8.0,
+            'size_contact': 6.5,
+            'line_width': 1.2,
+        }
+    style['stamp_hex'] = colors.HexColor(style['stamp_color'])
+    style['date_hex'] = colors.HexColor(style['date_color'])
+    _receipt_pdf_assets['stamp_style'] = style
+    return style
+
+
+def _receipt_pdf_version(signature_bytes=None, stamped: bool = True, **fields) -> dict:
+    """Cache version for a receipt PDF: the drawn fields plus layout, stamp date and signature."""
+    version = dict(fields)
+    version['layout'] = RECEIPT_PDF_LAYOUT_VERSION
+    if stamped:
+        # The stamp carries today's date, so a stamped PDF is only reusable on the same day.
+        version['stamp_date'] = datetime.now().strftime('%d %b %Y').upper()
+        version['stamp_style'] = {k: v for k, v in _receipt_pdf_stamp_style().items() if not k.endswith('_hex')}
+        version['stamp_raster'] = STAMP_PDF_RASTER
+    if signature_bytes:
+        version['signature'] = hashlib.sha256(signature_bytes).hexdigest()[:16]
+    return version
+
+
+def _receipt_pdf_rows(items, *attrs) -> list:
+    return [[getattr(it, a, None) for a in attrs] for it in (items or [])]
+
+
+def _receipt_pdf_response(kind: str, record_id, version: dict, build, filename: str):
+    cache = _get_receipt_pdf_cache() if _REPORTLAB_AVAILABLE else None
+    if cache is not None:
+        pdf_bytes, _ = cache.get_or_build(kind, record_id, version, build)
+    else:
+        pdf_bytes = build()
+    return Response(pdf_bytes, mimetype='application/pdf', headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/admin/receipts/pdf-cache')
+@login_required
+def receipt_pdf_cache_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    cache = _get_receipt_pdf_cache()
+    return jsonify(cache.stats() if cache else {'enabled': False})
+
+
+@app.route('/admin/receipts/stamp-cache')
+@login_required
+def stamp_signature_cache_stats_view():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    from utils.stamp_signature import stamp_signature_cache_stats
+    return jsonify(stamp_signature_cache_stats())
+
+
+def _receipt_pdf_stamp_image(facility_name: str, phone1: str, phone2: str, width_mm: float):
+    """ImageReader over today's pre-rasterized stamp, decoded once per day and layout."""
+    stamp_date = datetime.now().strftime('%d %b %Y').upper()
+    key = ('stamp_image', facility_name, phone1, phone2, round(width_mm, 2), stamp_date)
+    cached = _receipt_pdf_assets.get('stamp_image')
+    if cached and cached[0] == key:
+        return cached[1]
+    from utils.stamp_signature import rubber_stamp_png
+    png = rubber_stamp_png(facility_name, phone1, phone2, current_date=stamp_date, width_mm=width_mm, height_mm=22.0)
+    reader = ImageReader(BytesIO(png)) if png else None
+    _receipt_pdf_assets['stamp_image'] = (key, reader)
+    return reader
+
+
+def _draw_rubber_stamp_pdf(c, page_w, y, facility_name='MAKOKHA MEDICAL CENTRE', phone1='0741 256 531', phone2='0713 580 997'):
+    style = _receipt_pdf_stamp_style()
+    font_bold = style['font_bold']
+    font_regular = style['font_regular']
 
     stamp_w = page_w - 10 * mm
     stamp_h = 22 * mm
     stamp_x = 5 * mm
     stamp_y = max(12 * mm, y - stamp_h)
 
-    c.setStrokeColor(colors.HexColor(stamp_color))
-    c.setLineWidth(line_width)
+    if STAMP_PDF_RASTER:
+        reader = _receipt_pdf_stamp_image(facility_name, phone1, phone2, stamp_w / mm)
+        if reader is not None:
+            c.drawImage(reader, stamp_x, stamp_y, width=stamp_w, height=stamp_h, mask='auto')
+            return stamp_y
+
+    c.setStrokeColor(style['stamp_hex'])
+    c.setLineWidth(style['line_width'])
     c.rect(stamp_x, stamp_y, stamp_w, stamp_h, stroke=1, fill=0)
 
-    c.setFillColor(colors.HexColor(stamp_color))
-    c.setFont(font_bold, size_title)
+    c.setFillColor(style['stamp_hex'])
+    c.setFont(font_bold, style['size_title'])
     c.drawCentredString(page_w / 2, stamp_y + stamp_h - 6 * mm, facility_name)
 
-    c.setFillColor(colors.HexColor(date_color))
-    c.setFont(font_bold, size_date)
+    c.setFillColor(style['date_hex'])
+    c.setFont(font_bold, style['size_date'])
     c.drawCentredString(page_w / 2, stamp_y + stamp_h - 12 * mm, datetime.now().strftime('%d %b %Y').upper())
 
-    c.setFillColor(colors.HexColor(stamp_color))
-    c.setFont(font_regular, size_contact)
+    c.setFillColor(style['stamp_hex'])
+    c.setFont(font_regular, style['size_contact'])
     c.drawCentredString(page_w / 2, stamp_y + 4 * mm, f'Tel: {phone1} / {phone2}')
 
     c.setFillColor(colors.black)
@@ -33455,6 +35638,9 @@ def api_sale_receipt_pdf(sale_id: int):
         except Exception:
             pass
 
+    if amount_given is None and getattr(sale, 'amount_given', None) is not None:
+        amount_given, change = sale.amount_given, sale.change_amount
+
     tx_receipt_html = None
     try:
         tx = (
@@ -33483,9 +35669,8 @@ def api_sale_receipt_pdf(sale_id: int):
 
         # Logo
         try:
-            logo_path = os.path.join(app.root_path, 'static', 'images', 'logo.png')
-            if os.path.exists(logo_path):
-                c.drawImage(logo_path, (page_w - 18 * mm) / 2, y - 18 * mm, width=18 * mm, height=18 * mm, preserveAspectRatio=True, mask='auto')
+            if logo_reader is not None:
+                c.drawImage(logo_reader, (page_w - 18 * mm) / 2, y - 18 * mm, width=18 * mm, height=18 * mm, preserveAspectRatio=True, mask='auto')
                 y -= 20 * mm
         except Exception:
             pass
@@ -33610,15 +35795,17 @@ def api_sale_receipt_pdf(sale_id: int):
 
         return buf.getvalue()
 
-    pdf_bytes = _generate_pdf_bytes()
-    filename = f"receipt-{sale.sale_number}.pdf"
-    return Response(
-        pdf_bytes,
-        mimetype='application/pdf',
-        headers={
-            'Content-Disposition': f'attachment; filename={filename}'
-        },
+    logo_reader, logo_version = _receipt_pdf_logo()
+    version = _receipt_pdf_version(
+        signature_bytes,
+        sale=[sale.sale_number, created_str, served_by, float(sale.total_amount or 0), sale.payment_method],
+        patient=[patient_name, getattr(patient, 'age', None), getattr(patient, 'gender', None), getattr(patient, 'ip_number', None), getattr(patient, 'op_number', None)] if patient else None,
+        items=_receipt_pdf_rows(items, 'id', 'description', 'quantity', 'unit_price', 'total_price', 'drug_id', 'service_id', 'lab_test_id', 'imaging_test_id'),
+        cash=[amount_given, change],
+        logo=logo_version,
     )
+    filename = f"receipt-{sale.sale_number}.pdf"
+    return _receipt_pdf_response('sale', sale.id, version, _generate_pdf_bytes, filename)
 
 
 @app.route('/api/sales/<int:sale_id>/share-whatsapp', methods=['POST'])
@@ -33666,12 +35853,9 @@ def api_sale_share_whatsapp(sale_id: int):
     if not to_msisdn:
         return jsonify({'success': False, 'error': 'Enter a valid phone number for WhatsApp (e.g. 0712xxxxxx or +2547xxxxxxx).'}), 400
 
-    # Reuse the PDF generation logic by calling the PDF endpoint implementation.
-    # (Generated here again to avoid internal HTTP calls.)
+    # Reuse the PDF endpoint implementation (no internal HTTP call); a receipt
+    # that was already downloaded is served from the receipt PDF cache.
     try:
-        # Generate bytes by calling the same function path.
-        # NOTE: This relies on the local helper inside api_sale_receipt_pdf; keep in sync.
-        # To avoid duplication in the future, consider extracting to a module-level helper.
         pdf_resp = api_sale_receipt_pdf(sale_id)
         if isinstance(pdf_resp, Response) and pdf_resp.mimetype == 'application/pdf':
             pdf_bytes = pdf_resp.get_data()
@@ -33843,114 +36027,130 @@ def api_refund_receipt_pdf(refund_id: int):
         except Exception:
             signature_bytes = None
 
-    buf = BytesIO()
-    page_w, page_h = (80 * mm, 240 * mm)
-    c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
-    y = page_h - 10 * mm
-
-    c.setFont('Helvetica-Bold', 10)
-    c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
-    y -= 5 * mm
-    c.setFont('Helvetica', 7)
-    c.drawCentredString(page_w / 2, y, 'REFUND RECEIPT')
-    y -= 4 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
-
-    def _kv(label: str, value: str):
-        nonlocal y
-        c.setFont('Helvetica-Bold', 7)
-        c.drawString(5 * mm, y, f'{label}:')
-        c.setFont('Helvetica', 7)
-        c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
-        y -= 4 * mm
-
-    _kv('Refund', refund.refund_number)
-    _kv('Date', created_str)
-    _kv('Served By', served_by)
-    if patient_name:
-        _kv('Patient', patient_name)
     try:
-        if refund.sale and refund.sale.sale_number:
-            _kv('Orig Sale', refund.sale.sale_number)
+        orig_sale_number = refund.sale.sale_number if refund.sale else None
     except Exception:
-        pass
+        orig_sale_number = None
+    version = _receipt_pdf_version(
+        signature_bytes,
+        refund=[refund.refund_number, created_str, served_by, patient_name, orig_sale_number, float(refund.total_amount or 0)],
+        items=[
+            [getattr(getattr(it, 'sale_item', None), 'drug_name', None), getattr(getattr(it, 'sale_item', None), 'description', None),
+             it.quantity, it.unit_price, it.total_price]
+            for it in (refund.items or [])
+        ],
+    )
 
-    y -= 1 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
+    def _generate_pdf_bytes() -> bytes:
+        buf = BytesIO()
+        page_w, page_h = (80 * mm, 240 * mm)
+        c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
+        y = page_h - 10 * mm
 
-    c.setFont('Helvetica-Bold', 8)
-    c.drawString(5 * mm, y, 'Items')
-    y -= 4 * mm
-    c.setFont('Helvetica', 7)
-    for it in (refund.items or []):
-        desc = ''
+        c.setFont('Helvetica-Bold', 10)
+        c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
+        y -= 5 * mm
+        c.setFont('Helvetica', 7)
+        c.drawCentredString(page_w / 2, y, 'REFUND RECEIPT')
+        y -= 4 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 4 * mm
+
+        def _kv(label: str, value: str):
+            nonlocal y
+            c.setFont('Helvetica-Bold', 7)
+            c.drawString(5 * mm, y, f'{label}:')
+            c.setFont('Helvetica', 7)
+            c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
+            y -= 4 * mm
+
+        _kv('Refund', refund.refund_number)
+        _kv('Date', created_str)
+        _kv('Served By', served_by)
+        if patient_name:
+            _kv('Patient', patient_name)
         try:
-            desc = (getattr(getattr(it, 'sale_item', None), 'drug_name', None) or getattr(getattr(it, 'sale_item', None), 'description', None) or 'Item')
+            if refund.sale and refund.sale.sale_number:
+                _kv('Orig Sale', refund.sale.sale_number)
         except Exception:
-            desc = 'Item'
-        qty = int(getattr(it, 'quantity', 1) or 1)
-        unit = float(getattr(it, 'unit_price', 0) or 0)
-        total = float(getattr(it, 'total_price', 0) or (unit * qty))
-
-        c.drawString(5 * mm, y, str(desc)[:44])
-        y -= 3.5 * mm
-        c.setFont('Helvetica', 6.5)
-        c.drawString(7 * mm, y, f"{qty} x {unit:,.2f}")
-        c.drawRightString(page_w - 5 * mm, y, f"{total:,.2f}")
+            pass
+
+        y -= 1 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 4 * mm
+
+        c.setFont('Helvetica-Bold', 8)
+        c.drawString(5 * mm, y, 'Items')
         y -= 4 * mm
         c.setFont('Helvetica', 7)
+        for it in (refund.items or []):
+            desc = ''
+            try:
+                desc = (getattr(getattr(it, 'sale_item', None), 'drug_name', None) or getattr(getattr(it, 'sale_item', None), 'description', None) or 'Item')
+            except Exception:
+                desc = 'Item'
+            qty = int(getattr(it, 'quantity', 1) or 1)
+            unit = float(getattr(it, 'unit_price', 0) or 0)
+            total = float(getattr(it, 'total_price', 0) or (unit * qty))
 
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 5 * mm
-    c.setFont('Helvetica-Bold', 9)
-    c.drawString(5 * mm, y, 'TOTAL REFUND')
-    c.drawRightString(page_w - 5 * mm, y, f"KSh {float(refund.total_amount or 0):,.2f}")
-    y -= 6 * mm
+            c.drawString(5 * mm, y, str(desc)[:44])
+            y -= 3.5 * mm
+            c.setFont('Helvetica', 6.5)
+            c.drawString(7 * mm, y, f"{qty} x {unit:,.2f}")
+            c.drawRightString(page_w - 5 * mm, y, f"{total:,.2f}")
+            y -= 4 * mm
+            c.setFont('Helvetica', 7)
 
-    # Stamp
-    try:
-        stamp_y = _draw_rubber_stamp_pdf(c, page_w, y)
-    except Exception:
-        # Fallback: keep existing behavior if helper isn't in scope for any reason
-        stamp_w = page_w - 10 * mm
-        stamp_h = 22 * mm
-        stamp_x = 5 * mm
-        stamp_y = max(12 * mm, y - stamp_h)
-        c.setStrokeColor(colors.HexColor('#2e3192'))
-        c.setLineWidth(1.2)
-        c.rect(stamp_x, stamp_y, stamp_w, stamp_h, stroke=1, fill=0)
-        c.setFont('Helvetica-Bold', 7)
-        c.setFillColor(colors.HexColor('#2e3192'))
-        c.drawCentredString(page_w / 2, stamp_y + stamp_h - 6 * mm, 'MAKOKHA MEDICAL CENTRE')
-        c.setFillColor(colors.HexColor('#dc143c'))
-        c.setFont('Helvetica-Bold', 8)
-        c.drawCentredString(page_w / 2, stamp_y + stamp_h - 12 * mm, datetime.now().strftime('%d %b %Y').upper())
-        c.setFillColor(colors.HexColor('#2e3192'))
-        c.setFont('Helvetica', 6.5)
-        c.drawCentredString(page_w / 2, stamp_y + 4 * mm, 'Tel: 0741 256 531 / 0713 580 997')
-        c.setFillColor(colors.black)
-    y = stamp_y - 6 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 5 * mm
+        c.setFont('Helvetica-Bold', 9)
+        c.drawString(5 * mm, y, 'TOTAL REFUND')
+        c.drawRightString(page_w - 5 * mm, y, f"KSh {float(refund.total_amount or 0):,.2f}")
+        y -= 6 * mm
 
-    if signature_bytes:
+        # Stamp
         try:
-            img = ImageReader(BytesIO(signature_bytes))
-            sig_w = 35 * mm
-            sig_h = 14 * mm
-            c.drawImage(img, 5 * mm, max(5 * mm, y - sig_h), width=sig_w, height=sig_h, preserveAspectRatio=True, mask='auto')
-            c.setFont('Helvetica', 6.5)
-            c.drawString(5 * mm, max(5 * mm, y - sig_h) - 3 * mm, 'Signed')
+            stamp_y = _draw_rubber_stamp_pdf(c, page_w, y)
         except Exception:
-            pass
+            # Fallback: keep existing behavior if helper isn't in scope for any reason
+            stamp_w = page_w - 10 * mm
+            stamp_h = 22 * mm
+            stamp_x = 5 * mm
+            stamp_y = max(12 * mm, y - stamp_h)
+            c.setStrokeColor(colors.HexColor('#2e3192'))
+            c.setLineWidth(1.2)
+            c.rect(stamp_x, stamp_y, stamp_w, stamp_h, stroke=1, fill=0)
+            c.setFont('Helvetica-Bold', 7)
+            c.setFillColor(colors.HexColor('#2e3192'))
+            c.drawCentredString(page_w / 2, stamp_y + stamp_h - 6 * mm, 'MAKOKHA MEDICAL CENTRE')
+            c.setFillColor(colors.HexColor('#dc143c'))
+            c.setFont('Helvetica-Bold', 8)
+            c.drawCentredString(page_w / 2, stamp_y + stamp_h - 12 * mm, datetime.now().strftime('%d %b %Y').upper())
+            c.setFillColor(colors.HexColor('#2e3192'))
+            c.setFont('Helvetica', 6.5)
+            c.drawCentredString(page_w / 2, stamp_y + 4 * mm, 'Tel: 0741 256 531 / 0713 580 997')
+            c.setFillColor(colors.black)
+        y = stamp_y - 6 * mm
 
-    c.showPage()
-    c.save()
-    buf.seek(0)
+        if signature_bytes:
+            try:
+                img = ImageReader(BytesIO(signature_bytes))
+                sig_w = 35 * mm
+                sig_h = 14 * mm
+                c.drawImage(img, 5 * mm, max(5 * mm, y - sig_h), width=sig_w, height=sig_h, preserveAspectRatio=True, mask='auto')
+                c.setFont('Helvetica', 6.5)
+                c.drawString(5 * mm, max(5 * mm, y - sig_h) - 3 * mm, 'Signed')
+            except Exception:
+                pass
+
+        c.showPage()
+        c.save()
+        buf.seek(0)
+
+        return buf.getvalue()
 
-    pdf_bytes = buf.getvalue()
     filename = f"refund-{refund.refund_number}.pdf"
-    return Response(pdf_bytes, mimetype='application/pdf', headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return _receipt_pdf_response('refund', refund.id, version, _generate_pdf_bytes, filename)
 
 
 @app.route('/api/refunds/<int:refund_id>/share-whatsapp', methods=['POST'])
@@ -34091,169 +36291,181 @@ def api_controlled_sale_receipt_pdf(sale_id: int):
     except Exception:
         pass
 
-    buf = BytesIO()
-    page_w, page_h = (80 * mm, 260 * mm)
-    c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
-    y = page_h - 10 * mm
-
-    c.setFont('Helvetica-Bold', 10)
-    c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
-    y -= 5 * mm
-    c.setFont('Helvetica', 7)
-    c.drawCentredString(page_w / 2, y, 'CONTROLLED DRUGS RECEIPT')
-    y -= 4 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
-
-    def _kv(label: str, value: str):
-        nonlocal y
-        c.setFont('Helvetica-Bold', 7)
-        c.drawString(5 * mm, y, f'{label}:')
+    patient = getattr(sale, 'patient', None)
+    version = _receipt_pdf_version(
+        signature_bytes,
+        sale=[getattr(sale, 'sale_number', None), created_str, served_by, float(getattr(sale, 'total_amount', 0) or 0), getattr(sale, 'payment_method', None)],
+        customer=[getattr(sale, a, None) for a in ('customer_name', 'customer_phone', 'customer_age', 'customer_gender', 'diagnosis', 'destination')],
+        patient=[patient_name] + [getattr(patient, a, None) for a in ('phone', 'age', 'gender', 'destination')] if patient else None,
+        items=_receipt_pdf_rows(sale.items, 'id', 'controlled_drug_name', 'quantity', 'unit_price', 'total_price'),
+        cash=[amount_given, change],
+    )
+
+    def _generate_pdf_bytes() -> bytes:
+        buf = BytesIO()
+        page_w, page_h = (80 * mm, 260 * mm)
+        c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
+        y = page_h - 10 * mm
+
+        c.setFont('Helvetica-Bold', 10)
+        c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
+        y -= 5 * mm
         c.setFont('Helvetica', 7)
-        c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
+        c.drawCentredString(page_w / 2, y, 'CONTROLLED DRUGS RECEIPT')
+        y -= 4 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
         y -= 4 * mm
 
-    _kv('Sale', str(getattr(sale, 'sale_number', '') or sale.id))
-    _kv('Date', created_str)
-    _kv('Served By', served_by)
+        def _kv(label: str, value: str):
+            nonlocal y
+            c.setFont('Helvetica-Bold', 7)
+            c.drawString(5 * mm, y, f'{label}:')
+            c.setFont('Helvetica', 7)
+            c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
+            y -= 4 * mm
 
-    # Customer/Patient details (mirror pharmacist controlled receipt)
-    customer_name = str(getattr(sale, 'customer_name', '') or '').strip()
-    customer_phone = str(getattr(sale, 'customer_phone', '') or '').strip()
-    customer_age = str(getattr(sale, 'customer_age', '') or '').strip()
-    customer_gender = str(getattr(sale, 'customer_gender', '') or '').strip()
-    diagnosis = str(getattr(sale, 'diagnosis', '') or '').strip()
-    destination = str(getattr(sale, 'destination', '') or '').strip()
+        _kv('Sale', str(getattr(sale, 'sale_number', '') or sale.id))
+        _kv('Date', created_str)
+        _kv('Served By', served_by)
 
-    if not customer_name and getattr(sale, 'patient', None):
-        try:
-            customer_name = str(getattr(sale.patient, 'get_decrypted_name', '') or '').strip()
-        except Exception:
-            customer_name = ''
-    if not customer_phone and getattr(sale, 'patient', None):
-        try:
-            customer_phone = str(getattr(sale.patient, 'phone', '') or '').strip()
-        except Exception:
-            customer_phone = ''
-    if not customer_age and getattr(sale, 'patient', None):
-        try:
-            customer_age = str(getattr(sale.patient, 'age', '') or '').strip()
-        except Exception:
-            customer_age = ''
-    if not customer_gender and getattr(sale, 'patient', None):
-        try:
-            customer_gender = str(getattr(sale.patient, 'gender', '') or '').strip()
-        except Exception:
-            customer_gender = ''
-    if not destination and getattr(sale, 'patient', None):
-        try:
-            destination = str(getattr(sale.patient, 'destination', '') or '').strip()
-        except Exception:
-            destination = ''
-
-    if customer_name:
-        _kv('Customer', customer_name)
-    if customer_phone:
-        _kv('Phone', customer_phone)
-    if customer_age or customer_gender:
-        _kv('Age/Sex', f"{customer_age} / {customer_gender}".strip(' /'))
-    if diagnosis:
-        _kv('Dx', diagnosis)
-    if destination:
-        _kv('Destination', destination)
-
-    y -= 1 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
-
-    c.setFont('Helvetica-Bold', 8)
-    c.drawString(5 * mm, y, 'Items')
-    y -= 4 * mm
-    c.setFont('Helvetica', 7)
-
-    for it in (sale.items or []):
-        desc = (getattr(it, 'controlled_drug_name', '') or '').strip() or 'Drug'
-        qty = int(getattr(it, 'quantity', 1) or 1)
-        unit = float(getattr(it, 'unit_price', 0) or 0)
-        total = float(getattr(it, 'total_price', 0) or (unit * qty))
-
-        c.drawString(5 * mm, y, desc[:44])
-        y -= 3.5 * mm
-        c.setFont('Helvetica', 6.5)
-        c.drawString(7 * mm, y, f"{qty} x {unit:,.2f}")
-        c.drawRightString(page_w - 5 * mm, y, f"{total:,.2f}")
-        y -= 4 * mm
-        c.setFont('Helvetica', 7)
-        if y < 55 * mm:
-            c.showPage()
-            y = page_h - 10 * mm
-
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 5 * mm
-    c.setFont('Helvetica-Bold', 9)
-    c.drawString(5 * mm, y, 'TOTAL')
-    c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
-    y -= 5 * mm
-
-    c.setFont('Helvetica-Bold', 7)
-    c.drawString(5 * mm, y, 'PAYMENT SUMMARY')
-    y -= 4 * mm
-    c.setFont('Helvetica', 7)
-    _kv('Method', str((getattr(sale, 'payment_method', '') or '').upper()))
-    _kv('Amount', f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
-    if (str(getattr(sale, 'payment_method', '') or '').lower().strip() == 'cash') and amount_given is not None:
-        _kv('Amount Given', f"KSh {float(amount_given or 0):,.2f}")
-        bal = change
-        if bal is None:
+        # Customer/Patient details (mirror pharmacist controlled receipt)
+        customer_name = str(getattr(sale, 'customer_name', '') or '').strip()
+        customer_phone = str(getattr(sale, 'customer_phone', '') or '').strip()
+        customer_age = str(getattr(sale, 'customer_age', '') or '').strip()
+        customer_gender = str(getattr(sale, 'customer_gender', '') or '').strip()
+        diagnosis = str(getattr(sale, 'diagnosis', '') or '').strip()
+        destination = str(getattr(sale, 'destination', '') or '').strip()
+
+        if not customer_name and getattr(sale, 'patient', None):
+            try:
+                customer_name = str(getattr(sale.patient, 'get_decrypted_name', '') or '').strip()
+            except Exception:
+                customer_name = ''
+        if not customer_phone and getattr(sale, 'patient', None):
+            try:
+                customer_phone = str(getattr(sale.patient, 'phone', '') or '').strip()
+            except Exception:
+                customer_phone = ''
+        if not customer_age and getattr(sale, 'patient', None):
+            try:
+                customer_age = str(getattr(sale.patient, 'age', '') or '').strip()
+            except Exception:
+                customer_age = ''
+        if not customer_gender and getattr(sale, 'patient', None):
+            try:
+                customer_gender = str(getattr(sale.patient, 'gender', '') or '').strip()
+            except Exception:
+                customer_gender = ''
+        if not destination and getattr(sale, 'patient', None):
             try:
-                bal = float(amount_given) - float(getattr(sale, 'total_amount', 0) or 0)
+                destination = str(getattr(sale.patient, 'destination', '') or '').strip()
             except Exception:
-                bal = None
-        if bal is not None:
-            label = 'Balance' if float(bal) >= 0 else 'Balance Due'
-            _kv(label, f"KSh {float(bal):,.2f}")
-    y -= 2 * mm
+                destination = ''
+
+        if customer_name:
+            _kv('Customer', customer_name)
+        if customer_phone:
+            _kv('Phone', customer_phone)
+        if customer_age or customer_gender:
+            _kv('Age/Sex', f"{customer_age} / {customer_gender}".strip(' /'))
+        if diagnosis:
+            _kv('Dx', diagnosis)
+        if destination:
+            _kv('Destination', destination)
+
+        y -= 1 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 4 * mm
 
-    try:
-        stamp_y = _draw_rubber_stamp_pdf(c, page_w, y)
-    except Exception:
-        stamp_w = page_w - 10 * mm
-        stamp_h = 22 * mm
-        stamp_x = 5 * mm
-        stamp_y = max(12 * mm, y - stamp_h)
-        c.setStrokeColor(colors.HexColor('#2e3192'))
-        c.setLineWidth(1.2)
-        c.rect(stamp_x, stamp_y, stamp_w, stamp_h, stroke=1, fill=0)
-        c.setFont('Helvetica-Bold', 7)
-        c.setFillColor(colors.HexColor('#2e3192'))
-        c.drawCentredString(page_w / 2, stamp_y + stamp_h - 6 * mm, 'MAKOKHA MEDICAL CENTRE')
-        c.setFillColor(colors.HexColor('#dc143c'))
         c.setFont('Helvetica-Bold', 8)
-        c.drawCentredString(page_w / 2, stamp_y + stamp_h - 12 * mm, datetime.now().strftime('%d %b %Y').upper())
-        c.setFillColor(colors.HexColor('#2e3192'))
-        c.setFont('Helvetica', 6.5)
-        c.drawCentredString(page_w / 2, stamp_y + 4 * mm, 'Tel: 0741 256 531 / 0713 580 997')
-        c.setFillColor(colors.black)
-    y = stamp_y - 6 * mm
+        c.drawString(5 * mm, y, 'Items')
+        y -= 4 * mm
+        c.setFont('Helvetica', 7)
 
-    if signature_bytes:
-        try:
-            img = ImageReader(BytesIO(signature_bytes))
-            sig_w = 35 * mm
-            sig_h = 14 * mm
-            c.drawImage(img, 5 * mm, max(5 * mm, y - sig_h), width=sig_w, height=sig_h, preserveAspectRatio=True, mask='auto')
+        for it in (sale.items or []):
+            desc = (getattr(it, 'controlled_drug_name', '') or '').strip() or 'Drug'
+            qty = int(getattr(it, 'quantity', 1) or 1)
+            unit = float(getattr(it, 'unit_price', 0) or 0)
+            total = float(getattr(it, 'total_price', 0) or (unit * qty))
+
+            c.drawString(5 * mm, y, desc[:44])
+            y -= 3.5 * mm
             c.setFont('Helvetica', 6.5)
-            c.drawString(5 * mm, max(5 * mm, y - sig_h) - 3 * mm, 'Signed')
+            c.drawString(7 * mm, y, f"{qty} x {unit:,.2f}")
+            c.drawRightString(page_w - 5 * mm, y, f"{total:,.2f}")
+            y -= 4 * mm
+            c.setFont('Helvetica', 7)
+            if y < 55 * mm:
+                c.showPage()
+                y = page_h - 10 * mm
+
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 5 * mm
+        c.setFont('Helvetica-Bold', 9)
+        c.drawString(5 * mm, y, 'TOTAL')
+        c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
+        y -= 5 * mm
+
+        c.setFont('Helvetica-Bold', 7)
+        c.drawString(5 * mm, y, 'PAYMENT SUMMARY')
+        y -= 4 * mm
+        c.setFont('Helvetica', 7)
+        _kv('Method', str((getattr(sale, 'payment_method', '') or '').upper()))
+        _kv('Amount', f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
+        if (str(getattr(sale, 'payment_method', '') or '').lower().strip() == 'cash') and amount_given is not None:
+            _kv('Amount Given', f"KSh {float(amount_given or 0):,.2f}")
+            bal = change
+            if bal is None:
+                try:
+                    bal = float(amount_given) - float(getattr(sale, 'total_amount', 0) or 0)
+                except Exception:
+                    bal = None
+            if bal is not None:
+                label = 'Balance' if float(bal) >= 0 else 'Balance Due'
+                _kv(label, f"KSh {float(bal):,.2f}")
+        y -= 2 * mm
+
+        try:
+            stamp_y = _draw_rubber_stamp_pdf(c, page_w, y)
         except Exception:
-            pass
+            stamp_w = page_w - 10 * mm
+            stamp_h = 22 * mm
+            stamp_x = 5 * mm
+            stamp_y = max(12 * mm, y - stamp_h)
+            c.setStrokeColor(colors.HexColor('#2e3192'))
+            c.setLineWidth(1.2)
+            c.rect(stamp_x, stamp_y, stamp_w, stamp_h, stroke=1, fill=0)
+            c.setFont('Helvetica-Bold', 7)
+            c.setFillColor(colors.HexColor('#2e3192'))
+            c.drawCentredString(page_w / 2, stamp_y + stamp_h - 6 * mm, 'MAKOKHA MEDICAL CENTRE')
+            c.setFillColor(colors.HexColor('#dc143c'))
+            c.setFont('Helvetica-Bold', 8)
+            c.drawCentredString(page_w / 2, stamp_y + stamp_h - 12 * mm, datetime.now().strftime('%d %b %Y').upper())
+            c.setFillColor(colors.HexColor('#2e3192'))
+            c.setFont('Helvetica', 6.5)
+            c.drawCentredString(page_w / 2, stamp_y + 4 * mm, 'Tel: 0741 256 531 / 0713 580 997')
+            c.setFillColor(colors.black)
+        y = stamp_y - 6 * mm
 
-    c.showPage()
-    c.save()
-    buf.seek(0)
+        if signature_bytes:
+            try:
+                img = ImageReader(BytesIO(signature_bytes))
+                sig_w = 35 * mm
+                sig_h = 14 * mm
+                c.drawImage(img, 5 * mm, max(5 * mm, y - sig_h), width=sig_w, height=sig_h, preserveAspectRatio=True, mask='auto')
+                c.setFont('Helvetica', 6.5)
+                c.drawString(5 * mm, max(5 * mm, y - sig_h) - 3 * mm, 'Signed')
+            except Exception:
+                pass
+
+        c.showPage()
+        c.save()
+        buf.seek(0)
+
+        return buf.getvalue()
 
-    pdf_bytes = buf.getvalue()
     filename = f"controlled-receipt-{getattr(sale, 'sale_number', sale.id)}.pdf"
-    return Response(pdf_bytes, mimetype='application/pdf', headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return _receipt_pdf_response('controlled_sale', sale.id, version, _generate_pdf_bytes, filename)
 
 
 @app.route('/api/controlled-sales/<int:sale_id>/share-whatsapp', methods=['POST'])
@@ -34372,49 +36584,6 @@ def api_transaction_receipt_pdf(transaction_id: int):
     except Exception:
         sale = refund = expense = purchase = None
 
-    buf = BytesIO()
-    page_w, page_h = (80 * mm, 260 * mm)
-    c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
-    y = page_h - 10 * mm
-
-    def _ensure_space(min_y: float = 20 * mm):
-        nonlocal y
-        if y < min_y:
-            c.showPage()
-            y = page_h - 10 * mm
-
-    def _kv(label: str, value: str):
-        nonlocal y
-        _ensure_space()
-        c.setFont('Helvetica-Bold', 7)
-        c.drawString(5 * mm, y, f'{label}:')
-        c.setFont('Helvetica', 7)
-        c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
-        y -= 4 * mm
-
-    def _section(title: str):
-        nonlocal y
-        _ensure_space(30 * mm)
-        y -= 2 * mm
-        c.setFont('Helvetica-Bold', 8)
-        c.drawString(5 * mm, y, title)
-        y -= 4 * mm
-
-    def _table_row(col1: str, col2: str, col3: str, col4: str):
-        nonlocal y
-        _ensure_space(26 * mm)
-        c.setFont('Helvetica', 6.5)
-        # Column layout within 70mm printable width
-        x1 = 5 * mm
-        x2 = 43 * mm
-        x3 = 54 * mm
-        x4 = page_w - 5 * mm
-        c.drawString(x1, y, (col1 or '')[:28])
-        c.drawRightString(x2, y, (col2 or '')[:10])
-        c.drawRightString(x3, y, (col3 or '')[:10])
-        c.drawRightString(x4, y, (col4 or '')[:12])
-        y -= 3.8 * mm
-
     # Optional cash metadata (query/body/receipt_html)
     amount_given = request.args.get('amount_given', type=float)
     change = request.args.get('change', type=float)
@@ -34435,122 +36604,182 @@ def api_transaction_receipt_pdf(transaction_id: int):
     except Exception:
         pass
 
-    # Header
-    c.setFont('Helvetica-Bold', 10)
-    c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
-    y -= 5 * mm
-    c.setFont('Helvetica', 7)
-    c.drawCentredString(page_w / 2, y, 'TRANSACTION RECEIPT')
-    y -= 4 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
-
-    # Meta (matches admin/transaction_receipt.html)
-    _kv('Receipt #', str(getattr(tx, 'receipt_number', '') or f"TX-{tx.id}"))
-    _kv('Transaction #', str(getattr(tx, 'transaction_number', '') or ''))
-    _kv('Type', str(getattr(tx, 'transaction_type', '') or '').capitalize())
-    try:
-        _kv('Date', tx.created_at.strftime('%Y-%m-%d %H:%M') if tx.created_at else '')
-    except Exception:
-        _kv('Date', '')
-    if getattr(tx, 'receipt_reprinted_at', None):
+    version = _receipt_pdf_version(
+        stamped=False,
+        tx=[getattr(tx, a, None) for a in ('receipt_number', 'transaction_number', 'transaction_type', 'created_at', 'receipt_reprinted_at', 'notes', 'amount', 'payment_method')]
+        + [getattr(getattr(tx, 'user', None), 'username', None)],
+        sale=[sale.total_amount, sale.payment_method, _receipt_pdf_rows(sale.items, 'id', 'drug_name', 'description', 'quantity', 'unit_price', 'total_price')] if sale else None,
+        refund=[refund.total_amount, [
+            [getattr(getattr(it, 'sale_item', None), 'drug_name', None), getattr(getattr(getattr(it, 'sale_item', None), 'drug', None), 'name', None),
+             it.quantity, it.unit_price, it.total_price]
+            for it in (refund.items or [])
+        ]] if refund else None,
+        expense=[getattr(expense, 'category', None), getattr(expense, 'description', None)] if expense else None,
+        purchase=[getattr(purchase, 'supplier', None), getattr(purchase, 'invoice_number', None)] if purchase else None,
+        cash=[amount_given, change],
+    )
+
+    def _generate_pdf_bytes() -> bytes:
+        buf = BytesIO()
+        page_w, page_h = (80 * mm, 260 * mm)
+        c = rl_canvas.Canvas(buf, pagesize=(page_w, page_h))
+        y = page_h - 10 * mm
+
+        def _ensure_space(min_y: float = 20 * mm):
+            nonlocal y
+            if y < min_y:
+                c.showPage()
+                y = page_h - 10 * mm
+
+        def _kv(label: str, value: str):
+            nonlocal y
+            _ensure_space()
+            c.setFont('Helvetica-Bold', 7)
+            c.drawString(5 * mm, y, f'{label}:')
+            c.setFont('Helvetica', 7)
+            c.drawRightString(page_w - 5 * mm, y, (value or '')[:60])
+            y -= 4 * mm
+
+        def _section(title: str):
+            nonlocal y
+            _ensure_space(30 * mm)
+            y -= 2 * mm
+            c.setFont('Helvetica-Bold', 8)
+            c.drawString(5 * mm, y, title)
+            y -= 4 * mm
+
+        def _table_row(col1: str, col2: str, col3: str, col4: str):
+            nonlocal y
+            _ensure_space(26 * mm)
+            c.setFont('Helvetica', 6.5)
+            # Column layout within 70mm printable width
+            x1 = 5 * mm
+            x2 = 43 * mm
+            x3 = 54 * mm
+            x4 = page_w - 5 * mm
+            c.drawString(x1, y, (col1 or '')[:28])
+            c.drawRightString(x2, y, (col2 or '')[:10])
+            c.drawRightString(x3, y, (col3 or '')[:10])
+            c.drawRightString(x4, y, (col4 or '')[:12])
+            y -= 3.8 * mm
+
+        # Header
+        c.setFont('Helvetica-Bold', 10)
+        c.drawCentredString(page_w / 2, y, 'MAKOKHA MEDICAL CENTRE')
+        y -= 5 * mm
+        c.setFont('Helvetica', 7)
+        c.drawCentredString(page_w / 2, y, 'TRANSACTION RECEIPT')
+        y -= 4 * mm
+        c.line(5 * mm, y, page_w - 5 * mm, y)
+        y -= 4 * mm
+
+        # Meta (matches admin/transaction_receipt.html)
+        _kv('Receipt #', str(getattr(tx, 'receipt_number', '') or f"TX-{tx.id}"))
+        _kv('Transaction #', str(getattr(tx, 'transaction_number', '') or ''))
+        _kv('Type', str(getattr(tx, 'transaction_type', '') or '').capitalize())
         try:
-            _kv('Reprinted', tx.receipt_reprinted_at.strftime('%Y-%m-%d %H:%M'))
+            _kv('Date', tx.created_at.strftime('%Y-%m-%d %H:%M') if tx.created_at else '')
         except Exception:
-            pass
-    processed_by = getattr(getattr(tx, 'user', None), 'username', '') or ''
-    _kv('Processed By', processed_by)
-    notes = str(getattr(tx, 'notes', '') or '')
-    if notes:
-        _kv('Notes', notes[:60])
-
-    y -= 1 * mm
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 4 * mm
-
-    # Body
-    if sale:
-        _section('Sale Items')
-        _table_row('Drug', 'Qty', 'Unit', 'Total')
-        c.line(5 * mm, y, page_w - 5 * mm, y)
-        y -= 3 * mm
-        for it in (getattr(sale, 'items', None) or []):
-            desc = (getattr(it, 'drug_name', None) or getattr(it, 'description', None) or '').strip() or 'Item'
-            qty = int(getattr(it, 'quantity', 0) or 0)
-            unit = float(getattr(it, 'unit_price', 0) or 0)
-            total = float(getattr(it, 'total_price', 0) or (unit * qty))
-            _table_row(desc, str(qty), f"{unit:,.2f}", f"{total:,.2f}")
+            _kv('Date', '')
+        if getattr(tx, 'receipt_reprinted_at', None):
+            try:
+                _kv('Reprinted', tx.receipt_reprinted_at.strftime('%Y-%m-%d %H:%M'))
+            except Exception:
+                pass
+        processed_by = getattr(getattr(tx, 'user', None), 'username', '') or ''
+        _kv('Processed By', processed_by)
+        notes = str(getattr(tx, 'notes', '') or '')
+        if notes:
+            _kv('Notes', notes[:60])
+
         y -= 1 * mm
         c.line(5 * mm, y, page_w - 5 * mm, y)
-        y -= 5 * mm
-        c.setFont('Helvetica-Bold', 8)
-        c.drawString(5 * mm, y, 'Total:')
-        c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
-        y -= 6 * mm
-    elif refund:
-        _section('Refund Items')
-        _table_row('Item', 'Qty', 'Unit', 'Total')
-        c.line(5 * mm, y, page_w - 5 * mm, y)
-        y -= 3 * mm
-        for it in (getattr(refund, 'items', None) or []):
-            sale_item = getattr(it, 'sale_item', None)
-            desc = (getattr(sale_item, 'drug_name', None) or getattr(getattr(sale_item, 'drug', None), 'name', None) or '').strip() or 'Item'
-            qty = int(getattr(it, 'quantity', 0) or 0)
-            unit = float(getattr(it, 'unit_price', 0) or 0)
-            total = float(getattr(it, 'total_price', 0) or (unit * qty))
-            _table_row(desc, str(qty), f"{unit:,.2f}", f"{total:,.2f}")
-        y -= 1 * mm
+        y -= 4 * mm
+
+        # Body
+        if sale:
+            _section('Sale Items')
+            _table_row('Drug', 'Qty', 'Unit', 'Total')
+            c.line(5 * mm, y, page_w - 5 * mm, y)
+            y -= 3 * mm
+            for it in (getattr(sale, 'items', None) or []):
+                desc = (getattr(it, 'drug_name', None) or getattr(it, 'description', None) or '').strip() or 'Item'
+                qty = int(getattr(it, 'quantity', 0) or 0)
+                unit = float(getattr(it, 'unit_price', 0) or 0)
+                total = float(getattr(it, 'total_price', 0) or (unit * qty))
+                _table_row(desc, str(qty), f"{unit:,.2f}", f"{total:,.2f}")
+            y -= 1 * mm
+            c.line(5 * mm, y, page_w - 5 * mm, y)
+            y -= 5 * mm
+            c.setFont('Helvetica-Bold', 8)
+            c.drawString(5 * mm, y, 'Total:')
+            c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
+            y -= 6 * mm
+        elif refund:
+            _section('Refund Items')
+            _table_row('Item', 'Qty', 'Unit', 'Total')
+            c.line(5 * mm, y, page_w - 5 * mm, y)
+            y -= 3 * mm
+            for it in (getattr(refund, 'items', None) or []):
+                sale_item = getattr(it, 'sale_item', None)
+                desc = (getattr(sale_item, 'drug_name', None) or getattr(getattr(sale_item, 'drug', None), 'name', None) or '').strip() or 'Item'
+                qty = int(getattr(it, 'quantity', 0) or 0)
+                unit = float(getattr(it, 'unit_price', 0) or 0)
+                total = float(getattr(it, 'total_price', 0) or (unit * qty))
+                _table_row(desc, str(qty), f"{unit:,.2f}", f"{total:,.2f}")
+            y -= 1 * mm
+            c.line(5 * mm, y, page_w - 5 * mm, y)
+            y -= 5 * mm
+            c.setFont('Helvetica-Bold', 8)
+            c.drawString(5 * mm, y, 'Refund Total:')
+            c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(refund, 'total_amount', 0) or 0):,.2f}")
+            y -= 6 * mm
+        elif expense:
+            _section('Expense')
+            _kv('Category', str(getattr(expense, 'category', '') or ''))
+            _kv('Description', str(getattr(expense, 'description', '') or '')[:60])
+        elif purchase:
+            _section('Purchase')
+            _kv('Supplier', str(getattr(purchase, 'supplier', '') or ''))
+            _kv('Invoice #', str(getattr(purchase, 'invoice_number', '') or ''))
+
+        # Always show transaction amount at bottom
+        _ensure_space(24 * mm)
         c.line(5 * mm, y, page_w - 5 * mm, y)
         y -= 5 * mm
-        c.setFont('Helvetica-Bold', 8)
-        c.drawString(5 * mm, y, 'Refund Total:')
-        c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(refund, 'total_amount', 0) or 0):,.2f}")
+        c.setFont('Helvetica-Bold', 9)
+        c.drawString(5 * mm, y, 'Amount')
+        c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(tx, 'amount', 0) or 0):,.2f}")
         y -= 6 * mm
-    elif expense:
-        _section('Expense')
-        _kv('Category', str(getattr(expense, 'category', '') or ''))
-        _kv('Description', str(getattr(expense, 'description', '') or '')[:60])
-    elif purchase:
-        _section('Purchase')
-        _kv('Supplier', str(getattr(purchase, 'supplier', '') or ''))
-        _kv('Invoice #', str(getattr(purchase, 'invoice_number', '') or ''))
-
-    # Always show transaction amount at bottom
-    _ensure_space(24 * mm)
-    c.line(5 * mm, y, page_w - 5 * mm, y)
-    y -= 5 * mm
-    c.setFont('Helvetica-Bold', 9)
-    c.drawString(5 * mm, y, 'Amount')
-    c.drawRightString(page_w - 5 * mm, y, f"KSh {float(getattr(tx, 'amount', 0) or 0):,.2f}")
-    y -= 6 * mm
-
-    # Payment summary for customer-pay (sale) transactions
-    if sale:
-        pm = str((getattr(sale, 'payment_method', None) or getattr(tx, 'payment_method', None) or '')).strip().lower()
-        c.setFont('Helvetica-Bold', 8)
-        c.drawString(5 * mm, y, 'Payment Summary')
-        y -= 4 * mm
-        _kv('Method', str((getattr(sale, 'payment_method', None) or getattr(tx, 'payment_method', None) or '').upper()))
-        _kv('Amount', f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
-        if pm == 'cash' and amount_given is not None:
-            _kv('Amount Given', f"KSh {float(amount_given or 0):,.2f}")
-            bal = change
-            if bal is None:
-                try:
-                    bal = float(amount_given) - float(getattr(sale, 'total_amount', 0) or 0)
-                except Exception:
-                    bal = None
-            if bal is not None:
-                label = 'Balance' if float(bal) >= 0 else 'Balance Due'
-                _kv(label, f"KSh {float(bal):,.2f}")
 
-    c.showPage()
-    c.save()
-    buf.seek(0)
+        # Payment summary for customer-pay (sale) transactions
+        if sale:
+            pm = str((getattr(sale, 'payment_method', None) or getattr(tx, 'payment_method', None) or '')).strip().lower()
+            c.setFont('Helvetica-Bold', 8)
+            c.drawString(5 * mm, y, 'Payment Summary')
+            y -= 4 * mm
+            _kv('Method', str((getattr(sale, 'payment_method', None) or getattr(tx, 'payment_method', None) or '').upper()))
+            _kv('Amount', f"KSh {float(getattr(sale, 'total_amount', 0) or 0):,.2f}")
+            if pm == 'cash' and amount_given is not None:
+                _kv('Amount Given', f"KSh {float(amount_given or 0):,.2f}")
+                bal = change
+                if bal is None:
+                    try:
+                        bal = float(amount_given) - float(getattr(sale, 'total_amount', 0) or 0)
+                    except Exception:
+                        bal = None
+                if bal is not None:
+                    label = 'Balance' if float(bal) >= 0 else 'Balance Due'
+                    _kv(label, f"KSh {float(bal):,.2f}")
+
+        c.showPage()
+        c.save()
+        buf.seek(0)
+
+        return buf.getvalue()
 
-    pdf_bytes = buf.getvalue()
     filename = f"transaction-{getattr(tx, 'receipt_number', '') or tx.id}.pdf"
-    return Response(pdf_bytes, mimetype='application/pdf', headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return _receipt_pdf_response('transaction', tx.id, version, _generate_pdf_bytes, filename)
 
 
 @app.route('/api/transactions/<int:transaction_id>/share-whatsapp', methods=['POST'])
@@ -34750,6 +36979,116 @@ def api_patient_completed_services(patient_id: int):
         return jsonify([])
 
 
+# =================================================================================================
+# CATALOGUE SEARCH INDEX
+# =================================================================================================
+# Typeahead search for drugs, controlled drugs and services (utils/catalog_search.py):
+# pg_trgm GIN indexes on PostgreSQL, an in-process prefix/trigram index elsewhere.
+
+_CATALOG_SEARCH_COLUMNS = {
+    'drug': (Drug, Drug.name, Drug.specification),
+    'controlled': (ControlledDrug, ControlledDrug.name, ControlledDrug.specification),
+    'service': (Service, Service.name, Service.description),
+}
+_catalog_trgm_ready = False
+
+
+def _catalog_index_loader(key: str):
+    def _load():
+        model, primary, secondary = _CATALOG_SEARCH_COLUMNS[key]
+        with db.engine.connect() as conn:
+            return conn.execute(db.select(model.id, primary, secondary)).all()
+    return _load
+
+
+def _catalog_index_signature(key: str):
+    def _signature():
+        model = _CATALOG_SEARCH_COLUMNS[key][0]
+        with db.engine.connect() as conn:
+            return tuple(conn.execute(
+                db.select(func.count(model.id), func.max(model.id), func.max(model.updated_at))
+            ).one())
+    return _signature
+
+
+_catalog_search_indexes = {
+    key: CatalogSearchIndex(key, _catalog_index_loader(key), _catalog_index_signature(key))
+    for key in _CATALOG_SEARCH_COLUMNS
+}
+
+
+def _ensure_catalog_search_index(engine) -> None:
+    """PostgreSQL: enable pg_trgm and create the trigram indexes used by the typeahead endpoints."""
+    global _catalog_trgm_ready
+    try:
+        columns = []
+        for model, primary, secondary in _CATALOG_SEARCH_COLUMNS.values():
+            columns.append((model.__table__.name, primary.key))
+            columns.append((model.__table__.name, secondary.key))
+        _catalog_trgm_ready = ensure_trgm_indexes(engine, columns)
+    except Exception as e:
+        _catalog_trgm_ready = False
+        app.logger.warning(f"Catalogue trigram indexes unavailable, typeahead falls back to plain ILIKE: {e}")
+
+
+def catalog_search(key: str, q: str, limit: int, *filters) -> list:
+    """Rows of catalogue `key` matching `q`, best match first, restricted by `filters` (e.g. stock)."""
+    model, primary, secondary = _CATALOG_SEARCH_COLUMNS[key]
+    query = model.query.filter(*filters)
+    terms = catalog_query_terms(q)
+    if not terms:
+        return query.order_by(primary, model.id).limit(limit).all()
+
+    qn = catalog_normalize(q)
+    if db.engine.dialect.name != 'sqlite':
+        order = [catalog_sql_rank(primary, secondary, qn)]
+        if _catalog_trgm_ready:
+            order.append(catalog_sql_similarity(primary, qn).desc())
+        return (
+            query.filter(*catalog_sql_match_filter(primary, secondary, terms))
+            .order_by(*order, primary, model.id)
+            .limit(limit)
+            .all()
+        )
+
+    ranked = [row_id for _, row_id in _catalog_search_indexes[key].search(q)]
+    chunk = max(limit * 4, 200)
+    out = []
+    for i in range(0, len(ranked), chunk):
+        ids = ranked[i:i + chunk]
+        found = {r.id: r for r in query.filter(model.id.in_(ids)).all()}
+        out.extend(found[row_id] for row_id in ids if row_id in found)
+        if len(out) >= limit:
+            break
+    return out[:limit]
+
+
+@event.listens_for(db.session, 'after_flush')
+def _catalog_search_after_flush(session, flush_context):
+    """Remember which catalogues changed so their in-process index is rebuilt after commit."""
+    try:
+        keys = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            for key, (model, _, _) in _CATALOG_SEARCH_COLUMNS.items():
+                if isinstance(obj, model):
+                    keys.add(key)
+        if keys:
+            session.info.setdefault('catalog_search_dirty', set()).update(keys)
+    except Exception:
+        pass
+
+
+@event.listens_for(db.session, 'after_commit')
+def _catalog_search_after_commit(session):
+    for key in session.info.pop('catalog_search_dirty', None) or ():
+        _catalog_search_indexes[key].invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _catalog_search_after_rollback(session):
+    session.info.pop('catalog_search_dirty', None)
+
+
 @app.route('/api/drugs/search')
 @login_required
 def api_drugs_search():
@@ -34757,18 +37096,14 @@ def api_drugs_search():
     limit = request.args.get('limit', 25, type=int)
     limit = max(1, min(int(limit or 25), 100))
 
-    query = Drug.query.filter(Drug.remaining_quantity > 0)
-    if q:
-        like = f"%{q}%"
-        query = query.filter(or_(Drug.name.ilike(like), Drug.generic_name.ilike(like)))
-
-    rows = query.order_by(Drug.name).limit(limit).all()
+    rows = catalog_search('drug', q, limit, Drug.remaining_quantity > 0)
     return jsonify([
         {
             'id': d.id,
             'name': d.name,
-            'generic_name': d.generic_name,
+            'specification': d.specification,
             'remaining_quantity': int(d.remaining_quantity or 0),
+            'stock_status': d.stock_status,
         }
         for d in rows
     ])
@@ -34781,18 +37116,14 @@ def api_controlled_drugs_search():
     limit = request.args.get('limit', 25, type=int)
     limit = max(1, min(int(limit or 25), 100))
 
-    query = ControlledDrug.query.filter(ControlledDrug.remaining_quantity > 0)
-    if q:
-        like = f"%{q}%"
-        query = query.filter(or_(ControlledDrug.name.ilike(like), ControlledDrug.generic_name.ilike(like)))
-
-    rows = query.order_by(ControlledDrug.name).limit(limit).all()
+    rows = catalog_search('controlled', q, limit, ControlledDrug.remaining_quantity > 0)
     return jsonify([
         {
             'id': d.id,
             'name': d.name,
-            'generic_name': d.generic_name,
+            'specification': d.specification,
             'remaining_quantity': int(d.remaining_quantity or 0),
+            'stock_status': d.stock_status,
         }
         for d in rows
     ])
@@ -34805,12 +37136,7 @@ def api_services_search():
     limit = request.args.get('limit', 20, type=int)
     limit = max(1, min(int(limit or 20), 50))
 
-    query = Service.query.filter_by(is_active=True)
-    if q:
-        like = f"%{q}%"
-        query = query.filter(or_(Service.name.ilike(like), Service.description.ilike(like)))
-
-    rows = query.order_by(Service.name).limit(limit).all()
+    rows = catalog_search('service', q, limit, Service.is_active.is_(True))
     return jsonify([
         {
             'id': s.id,
@@ -35288,6 +37614,10 @@ def initialize_database():
 
             # Ensure all tables/columns exist (runtime-safe migration for older DBs).
             created_tables, added_cols = _ensure_all_tables_and_columns(engine)
+            _ensure_message_search_index(engine)
+            _ensure_unread_counters(engine)
+            _ensure_catalog_search_index(engine)
+            _ensure_stock_on_hand(engine)
             if created_tables or added_cols:
                 app.logger.info(
                     "Schema sync applied: created %d tables, added %d columns.",
@@ -37504,49 +39834,66 @@ def download_payroll_receipt_employee(receipt_id):
 @app.route('/api/communication/users', methods=['GET'])
 @login_required
 def api_communication_users():
-    """Get list of all users for communication"""
+    """Get list of all users for communication.
+
+    Built from a fixed number of grouped queries (users, unread counters, online
+    status, conversation settings, blocks) regardless of how many users exist.
+    """
     try:
         # Get all users except current user
         users = User.query.filter(User.id != current_user.id, User.is_active == True).all()
+
+        unread_by_user = {}
+        try:
+            unread_by_user = get_unread_by_sender(current_user.id)
+        except Exception:
+            unread_by_user = {}
+
+        status_by_user = {
+            st.user_id: st for st in UserOnlineStatus.query.filter(UserOnlineStatus.user_id != current_user.id).all()
+        }
+
+        # Conversation settings + blocks (safe fallback if tables not created yet)
+        settings_by_user = {}
+        blocked_by_me_ids = set()
+        blocked_me_ids = set()
+        try:
+            for conversation, settings in (
+                db.session.query(Conversation, ConversationSettings)
+                .join(ConversationSettings, ConversationSettings.conversation_id == Conversation.id)
+                .filter(
+                    ConversationSettings.user_id == current_user.id,
+                    or_(Conversation.user1_id == current_user.id, Conversation.user2_id == current_user.id),
+                )
+                .all()
+            ):
+                other_id = conversation.user2_id if conversation.user1_id == current_user.id else conversation.user1_id
+                settings_by_user.setdefault(other_id, settings)
+
+            for block in BlockedUser.query.filter(
+                or_(BlockedUser.blocker_id == current_user.id, BlockedUser.blocked_id == current_user.id)
+            ).all():
+                if block.blocker_id == current_user.id:
+                    blocked_by_me_ids.add(block.blocked_id)
+                else:
+                    blocked_me_ids.add(block.blocker_id)
+        except Exception:
+            settings_by_user = {}
+            blocked_by_me_ids = set()
+            blocked_me_ids = set()
         
         users_data = []
         for user in users:
-            # Get unread message count from this user
-            unread_count = Message.query.filter_by(
-                sender_id=user.id,
-                recipient_id=current_user.id,
-                is_read=False
-            ).count()
-            
+            unread_count = unread_by_user.get(user.id, 0)
+
             # Get online status
-            status = UserOnlineStatus.query.filter_by(user_id=user.id).first()
+            status = status_by_user.get(user.id)
             is_online = status.is_online if status else False
             last_seen = isoformat_eat(status.last_seen) if (status and status.last_seen) else None
 
-            # Conversation settings + blocks (safe fallback if tables not created yet)
-            settings = None
-            blocked_by_me = False
-            blocked_me = False
-            try:
-                conversation = Conversation.query.filter(
-                    or_(
-                        and_(Conversation.user1_id == current_user.id, Conversation.user2_id == user.id),
-                        and_(Conversation.user1_id == user.id, Conversation.user2_id == current_user.id)
-                    )
-                ).first()
-
-                if conversation:
-                    settings = ConversationSettings.query.filter_by(
-                        user_id=current_user.id,
-                        conversation_id=conversation.id
-                    ).first()
-
-                blocked_by_me = BlockedUser.query.filter_by(blocker_id=current_user.id, blocked_id=user.id).first() is not None
-                blocked_me = BlockedUser.query.filter_by(blocker_id=user.id, blocked_id=current_user.id).first() is not None
-            except Exception:
-                settings = None
-                blocked_by_me = False
-                blocked_me = False
+            settings = settings_by_user.get(user.id)
+            blocked_by_me = user.id in blocked_by_me_ids
+            blocked_me = user.id in blocked_me_ids
             
             profile_picture = None
             try:
@@ -37675,10 +40022,76 @@ def api_communication_e2e_public_key(user_id: int):
         return jsonify({'success': False, 'error': 'Failed to fetch key'}), 500
 
 
+CONVERSATION_PAGE_SIZE_DEFAULT = 50
+CONVERSATION_PAGE_SIZE_MAX = 200
+
+
+def _encode_message_cursor(msg) -> str:
+    """Opaque keyset cursor for a message: its (created_at, id) position."""
+    raw = f"{msg.created_at.isoformat() if msg.created_at else ''}|{msg.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_message_cursor(cursor: str):
+    """Return (created_at, id) for a cursor, or raise ValueError."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    created_raw, _, id_raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8').partition('|')
+    if not created_raw or not id_raw:
+        raise ValueError('invalid cursor')
+    return datetime.fromisoformat(created_raw), int(id_raw)
+
+
+def _conversation_messages_page(conversation_id: int, limit: int, before=None, after=None):
+    """Fetch one page of messages in chronological order using keyset pagination.
+
+    Without a cursor the newest `limit` messages are returned. `before` pages towards
+    older messages, `after` towards newer ones. Returns (messages, has_more_before,
+    has_more_after).
+    """
+    query = Message.query.filter(Message.conversation_id == conversation_id)
+    if after is not None:
+        created_at, msg_id = after
+        query = query.filter(or_(
+            Message.created_at > created_at,
+            (Message.created_at == created_at) & (Message.id > msg_id),
+        ))
+        rows = query.order_by(Message.created_at.asc(), Message.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        return rows[:limit], True, has_more
+
+    if before is not None:
+        created_at, msg_id = before
+        query = query.filter(or_(
+            Message.created_at < created_at,
+            (Message.created_at == created_at) & (Message.id < msg_id),
+        ))
+    rows = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more, before is not None
+
+
 @app.route('/api/communication/conversation/<int:other_user_id>', methods=['GET'])
 @login_required
 def api_communication_conversation(other_user_id):
-    """Get conversation and messages with another user"""
+    """Get conversation and a page of messages with another user.
+
+    Query params: `limit` (page size), and optionally `before` or `after` cursors
+    taken from a previous response's `page` block.
+    """
+    limit = request.args.get('limit', CONVERSATION_PAGE_SIZE_DEFAULT, type=int) or CONVERSATION_PAGE_SIZE_DEFAULT
+    limit = max(1, min(limit, CONVERSATION_PAGE_SIZE_MAX))
+    try:
+        before_cursor = request.args.get('before') or None
+        after_cursor = request.args.get('after') or None
+        before = _decode_message_cursor(before_cursor) if before_cursor else None
+        after = _decode_message_cursor(after_cursor) if after_cursor else None
+    except Exception:
+        return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+    if before is not None and after is not None:
+        return jsonify({'success': False, 'error': 'Use either before or after, not both'}), 400
+
     try:
         # Find or create conversation
         conversation = Conversation.query.filter(
@@ -37697,8 +40110,10 @@ def api_communication_conversation(other_user_id):
             db.session.add(conversation)
             db.session.commit()
         
-        # Get messages
-        messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+        # Get one page of messages; side-table lookups below are scoped to this page.
+        messages, has_more_before, has_more_after = _conversation_messages_page(
+            conversation.id, limit, before=before, after=after
+        )
 
         messages_data = []
         try:
@@ -37795,7 +40210,14 @@ def api_communication_conversation(other_user_id):
                 'id': conversation.id,
                 'conversation_id': conversation.conversation_id
             },
-            'messages': messages_data
+            'messages': messages_data,
+            'page': {
+                'limit': limit,
+                'has_more_before': has_more_before,
+                'has_more_after': has_more_after,
+                'before_cursor': _encode_message_cursor(messages[0]) if messages else before_cursor,
+                'after_cursor': _encode_message_cursor(messages[-1]) if messages else after_cursor,
+            }
         })
     
     except Exception as e:
@@ -37915,11 +40337,7 @@ def api_communication_mark_read():
             msg.read_at = get_eat_now()
             
             # Notify sender that message was read via Socket.IO
-            sender_socket = None
-            for sid, uid in active_sockets.items():
-                if uid == sender_id:
-                    sender_socket = sid
-                    break
+            sender_socket = _socket_for_user(sender_id)
             
             if sender_socket:
                 socketio.emit('message_read', {
@@ -37941,10 +40359,7 @@ def api_communication_mark_read():
 def api_communication_unread_count():
     """Get total unread message count for current user"""
     try:
-        unread_count = Message.query.filter_by(
-            recipient_id=current_user.id,
-            is_read=False
-        ).count()
+        unread_count = get_unread_total(current_user.id)
         
         return jsonify({'success': True, 'unread_count': unread_count})
     
@@ -37953,31 +40368,300 @@ def api_communication_unread_count():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# =================================================================================================
+# UNREAD COUNTERS
+# =================================================================================================
+
+def _unread_apply_deltas(conn, deltas: dict) -> None:
+    """Add {(user_id, other_user_id): delta} to the counters, never going below zero."""
+    table = MessageUnreadCounter.__table__
+    now = get_eat_now()
+    for (user_id, other_user_id), delta in deltas.items():
+        if not delta:
+            continue
+        result = conn.execute(
+            table.update()
+            .where(table.c.user_id == user_id, table.c.other_user_id == other_user_id)
+            .values(
+                unread_count=case((table.c.unread_count + delta < 0, 0), else_=table.c.unread_count + delta),
+                updated_at=now,
+            )
+        )
+        if result.rowcount or delta < 0:
+            continue
+        values = {'user_id': user_id, 'other_user_id': other_user_id, 'unread_count': delta, 'updated_at': now}
+        stmt = None
+        if conn.dialect.name in ('postgresql', 'sqlite'):
+            if conn.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            stmt = dialect_insert(table).values(**values).on_conflict_do_update(
+                index_elements=['user_id', 'other_user_id'],
+                set_={'unread_count': table.c.unread_count + delta, 'updated_at': now},
+            )
+        conn.execute(stmt if stmt is not None else table.insert().values(**values))
+
+
+def rebuild_unread_counters(engine) -> int:
+    """Recompute every counter from the messages table; returns the number of pairs."""
+    table = MessageUnreadCounter.__table__
+    msgs = Message.__table__
+    with engine.begin() as conn:
+        conn.execute(table.delete())
+        rows = conn.execute(
+            db.select(msgs.c.recipient_id, msgs.c.sender_id, func.count())
+            .where(or_(msgs.c.is_read.is_(False), msgs.c.is_read.is_(None)))
+            .group_by(msgs.c.recipient_id, msgs.c.sender_id)
+        ).all()
+        now = get_eat_now()
+        if rows:
+            conn.execute(table.insert(), [
+                {'user_id': r[0], 'other_user_id': r[1], 'unread_count': int(r[2]), 'updated_at': now}
+                for r in rows
+            ])
+    return len(rows)
+
+
+def _ensure_unread_counters(engine) -> None:
+    """Seed the counters once for databases that predate them."""
+    try:
+        table = MessageUnreadCounter.__table__
+        with engine.connect() as conn:
+            if conn.execute(db.select(table.c.id).limit(1)).first() is not None:
+                return
+        pairs = rebuild_unread_counters(engine)
+        if pairs:
+            app.logger.info("Unread counters seeded for %d conversations.", pairs)
+    except Exception as e:
+        app.logger.warning(f"Unread counter seeding failed: {e}")
+
+
+def get_unread_total(user_id: int) -> int:
+    table = MessageUnreadCounter.__table__
+    total = db.session.execute(
+        db.select(func.coalesce(func.sum(table.c.unread_count), 0)).where(table.c.user_id == user_id)
+    ).scalar()
+    return int(total or 0)
+
+
+def get_unread_by_sender(user_id: int) -> dict:
+    table = MessageUnreadCounter.__table__
+    rows = db.session.execute(
+        db.select(table.c.other_user_id, table.c.unread_count)
+        .where(table.c.user_id == user_id, table.c.unread_count > 0)
+    ).all()
+    return {int(r[0]): int(r[1]) for r in rows}
+
+
+@event.listens_for(db.session, 'after_flush')
+def _unread_counters_after_flush(session, flush_context):
+    """Turn new/read/deleted messages into counter deltas within the same transaction."""
+    deltas = {}
+    try:
+        for obj in session.new:
+            if isinstance(obj, Message) and not obj.is_read:
+                key = (obj.recipient_id, obj.sender_id)
+                deltas[key] = deltas.get(key, 0) + 1
+        for obj in session.dirty:
+            if not isinstance(obj, Message):
+                continue
+            hist = sa_inspect(obj).attrs.is_read.history
+            if not hist.has_changes():
+                continue
+            was_read = bool(hist.deleted[0]) if hist.deleted else False
+            if was_read != bool(obj.is_read):
+                key = (obj.recipient_id, obj.sender_id)
+                deltas[key] = deltas.get(key, 0) + (-1 if obj.is_read else 1)
+        for obj in session.deleted:
+            if isinstance(obj, Message) and not obj.is_read:
+                key = (obj.recipient_id, obj.sender_id)
+                deltas[key] = deltas.get(key, 0) - 1
+        deltas = {k: v for k, v in deltas.items() if v and k[0] is not None and k[1] is not None}
+        if not deltas:
+            return
+        # Savepoint: a counter failure must not abort the caller's transaction (PostgreSQL).
+        with session.connection().begin_nested() as sp:
+            _unread_apply_deltas(sp.connection, deltas)
+        session.info.setdefault('unread_counter_users', set()).update(k[0] for k in deltas)
+    except Exception as e:
+        try:
+            app.logger.warning(f"Unread counter update failed: {e}")
+        except Exception:
+            pass
+
+
+@event.listens_for(db.session, 'after_commit')
+def _unread_counters_push(session):
+    """Push fresh unread totals to the affected users' sockets (room user:<id>)."""
+    user_ids = session.info.pop('unread_counter_users', None)
+    if not user_ids:
+        return
+    try:
+        table = MessageUnreadCounter.__table__
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                db.select(table.c.user_id, table.c.other_user_id, table.c.unread_count)
+                .where(table.c.user_id.in_(sorted(user_ids)))
+            ).all()
+        by_user = {uid: {} for uid in user_ids}
+        for uid, other, count in rows:
+            by_user.setdefault(uid, {})[int(other)] = int(count or 0)
+        for uid, per_sender in by_user.items():
+            socketio.emit('unread_update', {
+                'unread_count': sum(per_sender.values()),
+                'by_user': {str(k): v for k, v in per_sender.items()},
+            }, room=f"user:{int(uid)}")
+    except Exception as e:
+        try:
+            app.logger.warning(f"Unread counter push failed: {e}")
+        except Exception:
+            pass
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _unread_counters_discard(session):
+    session.info.pop('unread_counter_users', None)
+
+
+# =================================================================================================
+# MESSAGE SEARCH INDEX
+# =================================================================================================
+
+def _message_search_row(msg) -> dict:
+    return {
+        'message_id': msg.message_id,
+        'conversation_id': msg.conversation_id,
+        'sender_id': msg.sender_id,
+        'recipient_id': msg.recipient_id,
+        'created_at': msg.created_at,
+        'content': msg.content,
+    }
+
+
+def rebuild_message_search_index(engine, batch_size: int = 1000) -> int:
+    """Re-index every searchable (non-E2E, not deleted) message; returns the number indexed."""
+    if not message_search_index.ready:
+        return 0
+    msgs = Message.__table__
+    deleted = db.select(MessageDeletion.__table__.c.message_id)
+    indexed = 0
+    last_id = 0
+    with engine.begin() as conn:
+        message_search_index.clear(conn)
+        while True:
+            rows = conn.execute(
+                db.select(msgs.c.id, msgs.c.message_id, msgs.c.conversation_id, msgs.c.sender_id,
+                          msgs.c.recipient_id, msgs.c.created_at, msgs.c.content)
+                .where(msgs.c.id > last_id, msgs.c.message_id.not_in(deleted))
+                .order_by(msgs.c.id)
+                .limit(batch_size)
+            ).mappings().all()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            batch = [_message_search_row(r) for r in rows if _message_is_searchable(r['content'])]
+            message_search_index.upsert(conn, batch)
+            indexed += len(batch)
+    return indexed
+
+
+def _ensure_message_search_index(engine) -> None:
+    """Create the full-text index for chat messages (backfilling it on first creation)."""
+    try:
+        if message_search_index.ensure_schema(engine):
+            count = rebuild_message_search_index(engine)
+            app.logger.info("Message search index created (%s); indexed %d messages.", message_search_index.backend, count)
+    except Exception as e:
+        message_search_index.backend = None
+        app.logger.warning(f"Message search index unavailable, falling back to ILIKE search: {e}")
+
+
+@event.listens_for(db.session, 'after_flush')
+def _message_search_after_flush(session, flush_context):
+    """Keep the message search index in step with sends, edits and deletes."""
+    if not message_search_index.ready:
+        return
+    upserts = []
+    removals = []
+    try:
+        for obj in session.new:
+            if isinstance(obj, Message):
+                (upserts if _message_is_searchable(obj.content) else removals).append(obj)
+            elif isinstance(obj, MessageDeletion):
+                removals.append(obj)
+        for obj in session.dirty:
+            if isinstance(obj, Message) and sa_inspect(obj).attrs.content.history.has_changes():
+                (upserts if _message_is_searchable(obj.content) else removals).append(obj)
+        for obj in session.deleted:
+            if isinstance(obj, Message):
+                removals.append(obj)
+        if not upserts and not removals:
+            return
+        # Savepoint: an index failure must not abort the caller's transaction (PostgreSQL).
+        with session.connection().begin_nested() as sp:
+            conn = sp.connection
+            message_search_index.remove(conn, [o.message_id for o in removals if o.message_id])
+            message_search_index.upsert(conn, [_message_search_row(o) for o in upserts if o.message_id])
+    except Exception as e:
+        try:
+            app.logger.warning(f"Message search index update failed: {e}")
+        except Exception:
+            pass
+
+
 @app.route('/api/communication/search', methods=['GET'])
 @login_required
 def api_communication_search():
-    """Search messages in a 1:1 conversation."""
+    """Search the current user's messages, ranked, with highlighted snippets.
+
+    With `other_user_id` the search is limited to that 1:1 conversation;
+    without it, it spans all of the current user's conversations.
+    """
     try:
         q = (request.args.get('q') or '').strip()
         other_user_id = request.args.get('other_user_id', type=int)
+        limit = max(1, min(request.args.get('limit', 50, type=int) or 50, 100))
 
-        if not q or not other_user_id:
-            return jsonify({'success': False, 'error': 'Missing q or other_user_id'}), 400
+        if not q:
+            return jsonify({'success': False, 'error': 'Missing q'}), 400
 
-        conversation = Conversation.query.filter(
-            or_(
-                and_(Conversation.user1_id == current_user.id, Conversation.user2_id == other_user_id),
-                and_(Conversation.user1_id == other_user_id, Conversation.user2_id == current_user.id)
-            )
-        ).first()
+        conversation = None
+        if other_user_id:
+            conversation = Conversation.query.filter(
+                or_(
+                    and_(Conversation.user1_id == current_user.id, Conversation.user2_id == other_user_id),
+                    and_(Conversation.user1_id == other_user_id, Conversation.user2_id == current_user.id)
+                )
+            ).first()
 
-        if not conversation:
-            return jsonify({'success': True, 'messages': []})
+            if not conversation:
+                return jsonify({'success': True, 'messages': []})
+
+        ranks = {}
+        if message_search_index.ready and _message_query_terms(q):
+            try:
+                hits = message_search_index.search(
+                    db.session.connection(), current_user.id, q,
+                    conversation_id=conversation.id if conversation else None, limit=limit,
+                )
+                ranks = {h['message_id']: h['rank'] for h in hits}
+                results = Message.query.filter(Message.message_id.in_(list(ranks))).all() if ranks else []
+                results.sort(key=lambda m: (ranks.get(m.message_id, 0.0), m.created_at or datetime.min), reverse=True)
+            except Exception as e:
+                app.logger.warning(f"Message search index query failed, using ILIKE: {e}")
+                db.session.rollback()
+                ranks = {}
+                results = None
+        else:
+            results = None
 
-        base_q = Message.query.filter_by(conversation_id=conversation.id)
-        base_q = base_q.filter(Message.content.ilike(f"%{q}%"))
-        base_q = base_q.order_by(Message.created_at.desc()).limit(50)
-        results = base_q.all()
+        if results is None:
+            base_q = Message.query.filter(or_(Message.sender_id == current_user.id, Message.recipient_id == current_user.id))
+            if conversation:
+                base_q = base_q.filter(Message.conversation_id == conversation.id)
+            base_q = base_q.filter(Message.content.ilike(f"%{q}%"))
+            results = base_q.order_by(Message.created_at.desc()).limit(limit).all()
 
         deletions = set(
             d.message_id for d in MessageDeletion.query.filter(
@@ -37985,15 +40669,21 @@ def api_communication_search():
             ).all()
         ) if results else set()
 
+        terms = _message_query_terms(q)
         payload = []
         for m in results:
             if m.message_id in deletions:
                 continue
+            other_id = m.recipient_id if m.sender_id == current_user.id else m.sender_id
             payload.append({
                 'message_id': m.message_id,
+                'conversation_id': m.conversation_id,
+                'other_user_id': other_id,
                 'sender_id': m.sender_id,
                 'recipient_id': m.recipient_id,
                 'content': m.content,
+                'snippet': highlight_snippet(m.content, terms) if _message_is_searchable(m.content) else '',
+                'rank': round(ranks.get(m.message_id, 0.0), 6),
                 'created_at': isoformat_eat(m.created_at),
             })
 
@@ -38440,8 +41130,50 @@ def api_communication_ice_servers():
 # Socket.IO Event Handlers
 from flask_socketio import emit, join_room, leave_room
 
-# Store active socket connections
-active_sockets = {}
+# Socket presence (sid <-> user) shared by all workers; see utils/presence.py.
+# PRESENCE_BACKEND: memory (single worker) | redis | fakeredis | database.
+_presence_backend_name = (os.getenv('PRESENCE_BACKEND') or ('redis' if os.getenv('REDIS_URL') else 'memory')).strip().lower()
+PRESENCE_TTL_SECONDS = int(os.getenv('PRESENCE_TTL_SECONDS', '90') or 90)
+_presence_registry = None
+_presence_lock = threading.Lock()
+
+
+def _presence():
+    global _presence_registry
+    if _presence_registry is None:
+        with _presence_lock:
+            if _presence_registry is None:
+                try:
+                    _presence_registry = build_presence_registry(
+                        _presence_backend_name,
+                        ttl_seconds=PRESENCE_TTL_SECONDS,
+                        redis_url=os.getenv('REDIS_URL') or '',
+                        engine=db.engine,
+                        table=SocketPresence.__table__,
+                    )
+                except Exception as e:
+                    app.logger.error(f"Presence backend '{_presence_backend_name}' unavailable, using in-process registry: {e}")
+                    _presence_registry = build_presence_registry('memory', ttl_seconds=PRESENCE_TTL_SECONDS)
+    return _presence_registry
+
+
+def _socket_for_user(user_id):
+    """A live Socket.IO sid for `user_id` on any worker, or None."""
+    try:
+        return _presence().sid_for_user(user_id)
+    except Exception as e:
+        app.logger.warning(f"Presence lookup failed: {e}")
+        return None
+
+
+def _socket_user_id(sid=None):
+    """User id registered for a sid (defaults to the current socket), or None."""
+    try:
+        return _presence().user_for_sid(sid or request.sid)
+    except Exception as e:
+        app.logger.warning(f"Presence lookup failed: {e}")
+        return None
+
 
 @socketio.on('connect')
 def handle_connect():
@@ -38449,17 +41181,30 @@ def handle_connect():
     app.logger.info(f'Client connected: {request.sid}')
 
 
+@socketio.on('presence_heartbeat')
+def handle_presence_heartbeat(data=None):
+    """Refresh this socket's presence TTL (re-registering it if it already expired)."""
+    try:
+        if not _presence().touch(request.sid):
+            user_id = (data or {}).get('user_id')
+            if user_id:
+                _presence().add(request.sid, user_id)
+    except Exception as e:
+        app.logger.warning(f"Presence heartbeat failed: {e}")
+
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
     # Update user online status
-    user_id = active_sockets.pop(request.sid, None)
+    try:
+        user_id = _presence().remove(request.sid)
+        remaining_sid = _socket_for_user(user_id) if user_id else None
+    except Exception as e:
+        app.logger.warning(f"Presence removal failed: {e}")
+        user_id, remaining_sid = None, None
     if user_id:
-        still_online = False
-        try:
-            still_online = any(int(uid) == int(user_id) for uid in active_sockets.values())
-        except Exception:
-            still_online = any(uid == user_id for uid in active_sockets.values())
+        still_online = remaining_sid is not None
 
         status = UserOnlineStatus.query.filter_by(user_id=user_id).first()
         if status:
@@ -38467,16 +41212,6 @@ def handle_disconnect():
 
             if still_online:
                 # User still has another active tab/device connected; keep them online.
-                remaining_sid = None
-                for sid, uid in active_sockets.items():
-                    try:
-                        if int(uid) == int(user_id):
-                            remaining_sid = sid
-                            break
-                    except Exception:
-                        if uid == user_id:
-                            remaining_sid = sid
-                            break
                 status.is_online = True
                 status.socket_id = remaining_sid
 
@@ -38548,8 +41283,13 @@ def handle_user_connected(data):
         except Exception:
             pass
     
-    # Store socket connection
-    active_sockets[request.sid] = user_id
+    # Register socket presence (visible to every worker)
+    try:
+        _presence().add(request.sid, user_id)
+        if _presence().backend_name == 'database':
+            _presence().backend.purge_expired()
+    except Exception as e:
+        app.logger.warning(f"Presence registration failed: {e}")
     
     # Update or create online status
     status = UserOnlineStatus.query.filter_by(user_id=user_id).first()
@@ -38624,11 +41364,7 @@ def handle_send_message(data):
             app.logger.error(f"Message encryption failed: {e}, sending plaintext")
     
     # Get receiver's socket
-    receiver_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            receiver_socket = sid
-            break
+    receiver_socket = _socket_for_user(receiver_id)
     
     if receiver_socket:
         # Decrypt message for receiver (happens client-side in production)
@@ -38659,11 +41395,7 @@ def handle_send_message(data):
                 db.session.commit()
                 
                 # Notify sender that message was delivered
-                sender_socket = None
-                for sid, uid in active_sockets.items():
-                    if uid == message.get('sender_id'):
-                        sender_socket = sid
-                        break
+                sender_socket = _socket_for_user(message.get('sender_id'))
                 
                 if sender_socket:
                     socketio.emit('message_delivered', {
@@ -38691,11 +41423,7 @@ def handle_message_received(data):
             db.session.commit()
             
             # Notify sender
-            sender_socket = None
-            for sid, uid in active_sockets.items():
-                if uid == sender_id:
-                    sender_socket = sid
-                    break
+            sender_socket = _socket_for_user(sender_id)
             
             if sender_socket:
                 socketio.emit('message_delivered', {
@@ -38710,17 +41438,13 @@ def handle_typing(data):
     """Handle typing indicator"""
     receiver_id = data.get('receiver_id')
     is_typing = data.get('is_typing')
-    user_id = active_sockets.get(request.sid)
+    user_id = _socket_user_id()
     
     if not receiver_id or user_id is None:
         return
     
     # Get receiver's socket
-    receiver_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            receiver_socket = sid
-            break
+    receiver_socket = _socket_for_user(receiver_id)
     
     if receiver_socket:
         socketio.emit('typing_status', {
@@ -38772,17 +41496,13 @@ def handle_initiate_call(data):
 
     # Fallback: use in-memory socket map for caller id.
     if caller_id is None:
-        caller_id = active_sockets.get(request.sid)
+        caller_id = _socket_user_id()
     
     if not receiver_id or not call_type or not call_id:
         return
     
     # Get receiver's socket
-    receiver_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            receiver_socket = sid
-            break
+    receiver_socket = _socket_for_user(receiver_id)
     
     if receiver_socket:
         socketio.emit('incoming_call', {
@@ -38835,11 +41555,7 @@ def handle_accept_call(data):
         return
     
     # Get caller's socket
-    caller_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            caller_socket = sid
-            break
+    caller_socket = _socket_for_user(receiver_id)
     
     if caller_socket:
         socketio.emit('call_accepted', {
@@ -38868,11 +41584,7 @@ def handle_reject_call(data):
         return
     
     # Get caller's socket
-    caller_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            caller_socket = sid
-            break
+    caller_socket = _socket_for_user(receiver_id)
     
     if caller_socket:
         socketio.emit('call_rejected', {
@@ -38894,7 +41606,7 @@ def handle_end_call(data):
             c = CallLog.query.filter_by(call_id=call_id).first()
             if c:
                 # End call should notify the other party.
-                sender_user_id = active_sockets.get(request.sid)
+                sender_user_id = _socket_user_id()
                 if sender_user_id == c.caller_id:
                     receiver_id = c.receiver_id
                 else:
@@ -38906,11 +41618,7 @@ def handle_end_call(data):
         return
     
     # Get other party's socket
-    other_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            other_socket = sid
-            break
+    other_socket = _socket_for_user(receiver_id)
     
     if other_socket:
         socketio.emit('call_ended', {
@@ -38938,17 +41646,13 @@ def handle_webrtc_offer(data):
         receiver_id = call_log.receiver_id
 
     if caller_id is None:
-        caller_id = active_sockets.get(request.sid)
+        caller_id = _socket_user_id()
     
     if not receiver_id or not offer:
         return
     
     # Get receiver's socket
-    receiver_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            receiver_socket = sid
-            break
+    receiver_socket = _socket_for_user(receiver_id)
     
     if receiver_socket:
         socketio.emit('webrtc_offer', {
@@ -38980,11 +41684,7 @@ def handle_webrtc_answer(data):
         return
     
     # Get caller's socket
-    caller_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            caller_socket = sid
-            break
+    caller_socket = _socket_for_user(receiver_id)
     
     if caller_socket:
         socketio.emit('webrtc_answer', {
@@ -39013,7 +41713,7 @@ def handle_webrtc_ice_candidate(data):
     # Route candidate to the other party based on call log + sender id.
     if call_log:
         try:
-            sender_user_id = active_sockets.get(request.sid)
+            sender_user_id = _socket_user_id()
             if sender_user_id == call_log.caller_id:
                 receiver_id = call_log.receiver_id
             else:
@@ -39025,11 +41725,7 @@ def handle_webrtc_ice_candidate(data):
         return
     
     # Get other party's socket
-    other_socket = None
-    for sid, uid in active_sockets.items():
-        if uid == receiver_id:
-            other_socket = sid
-            break
+    other_socket = _socket_for_user(receiver_id)
     
     if other_socket:
         socketio.emit('webrtc_ice_candidate', {
@@ -6,6 +6,9 @@ from dotenv import load_dotenv
 from cryptography.fernet import Fernet, InvalidToken
 from flask import current_app
 
+from utils.decrypt_cache import DecryptCache
+from utils.encrypted_type import decrypt_batch
+
 load_dotenv()
 
 
@@ -133,12 +136,30 @@ class Config:
     # Encryption keys (set by init_fernet)
     FERNET_KEY: Optional[str] = None
     BACKUP_ENCRYPTION_KEY: Optional[str] = None
+    # HMAC key for patient search tokens (utils/blind_index.py); bytes, set by init_fernet.
+    BLIND_INDEX_KEY: Optional[bytes] = None
     fernet: Optional[Fernet] = None
     legacy_fernets: Tuple[Fernet, ...] = tuple()
+    # Decrypted field values (process memory only, keyed by ciphertext); 0 disables the shared LRU.
+    DECRYPT_CACHE_MAX_ENTRIES = _parse_int(_get_env("DECRYPT_CACHE_MAX_ENTRIES", "4096"), 4096)
+    DECRYPT_CACHE_REQUEST_ENTRIES = _parse_int(_get_env("DECRYPT_CACHE_REQUEST_ENTRIES", "2048"), 2048)
+    decrypt_cache = DecryptCache(DECRYPT_CACHE_MAX_ENTRIES, DECRYPT_CACHE_REQUEST_ENTRIES)
 
     # Backups
     AWS_BACKUP_BUCKET = _get_env("AWS_BACKUP_BUCKET")
     BACKUP_TABLES = _parse_csv(_get_env("BACKUP_TABLES", ""))  # optional whitelist
+    # Tables exported concurrently (each on its own pooled connection).
+    BACKUP_EXPORT_WORKERS = _parse_int(_get_env("BACKUP_EXPORT_WORKERS", "3"), 3)
+    # Plaintext bytes per authenticated encryption chunk in streamed backups.
+    BACKUP_CHUNK_SIZE_BYTES = _parse_int(_get_env("BACKUP_CHUNK_SIZE_BYTES", str(1024 * 1024)), 1024 * 1024)
+    # Rows per executemany() batch when restoring a backup.
+    BACKUP_RESTORE_BATCH_ROWS = _parse_int(_get_env("BACKUP_RESTORE_BATCH_ROWS", "2000"), 2000)
+    # Scheduled/disaster-recovery backups are incremental against the previous backup
+    # until the full base is older than BACKUP_FULL_INTERVAL_DAYS or the chain reaches
+    # BACKUP_MAX_INCREMENTS links.
+    BACKUP_INCREMENTAL_ENABLED = _parse_bool(_get_env("BACKUP_INCREMENTAL_ENABLED", "true"), True)
+    BACKUP_FULL_INTERVAL_DAYS = _parse_int(_get_env("BACKUP_FULL_INTERVAL_DAYS", "7"), 7)
+    BACKUP_MAX_INCREMENTS = _parse_int(_get_env("BACKUP_MAX_INCREMENTS", "400"), 400)
 
     @classmethod
     def init_secrets(cls, app):
@@ -195,9 +216,20 @@ class Config:
                 app.logger.error(f"Ignoring invalid legacy Fernet key: {e}")
 
         cls.legacy_fernets = tuple(legacy)
+        # Cached plaintext belongs to the previous key set.
+        cls.decrypt_cache.clear()
         app.config["FERNET_KEY"] = cls.FERNET_KEY
         app.logger.info("Fernet initialized. Legacy keys count: %d", len(cls.legacy_fernets))
 
+        # Blind-index key for searchable patient fields. Prefer a dedicated key so rotating
+        # FERNET_KEY does not invalidate the search index; otherwise derive one from it.
+        from utils.blind_index import derive_blind_index_key
+        blind_key_env = _get_env("BLIND_INDEX_KEY")
+        if blind_key_env:
+            cls.BLIND_INDEX_KEY = derive_blind_index_key(_validate_fernet_key(blind_key_env, "BLIND_INDEX_KEY"))
+        else:
+            cls.BLIND_INDEX_KEY = derive_blind_index_key(cls.FERNET_KEY)
+
         # Backup encryption key (separate from app data key)
         backup_key_env = _get_env("BACKUP_ENCRYPTION_KEY")
         if not backup_key_env:
@@ -250,6 +282,10 @@ class Config:
             return encrypted_data
         if not cls.fernet:
             raise RuntimeError("Fernet not initialized. Call Config.init_fernet(app) at startup.")
+        return cls.decrypt_cache.get_or_decrypt(s, cls._decrypt_token)
+
+    @classmethod
+    def _decrypt_token(cls, s: str) -> str:
         try:
             return cls.fernet.decrypt(s.encode()).decode()
         except InvalidToken:
@@ -265,6 +301,14 @@ class Config:
             current_app.logger.error(f"Decryption failed: {e}")
             return "[Decryption Error]"
 
+    @classmethod
+    def decrypt_many(cls, values: Sequence[Optional[str]]) -> List[Optional[str]]:
+        """Decrypt a column of values in one batch (see utils.encrypted_type.decrypt_batch).
+
+        Results also land in the decrypt cache, so later per-value calls are hits.
+        """
+        return decrypt_batch(values, decrypt=cls.decrypt_data)
+
     @staticmethod
     def encrypt_data_static(data: Optional[str]) -> str:
         return Config.encrypt_data(data)
@@ -284,4 +328,10 @@ class Config:
             "s3_bucket": cls.AWS_BACKUP_BUCKET or "",
             "encryption_key": cls.BACKUP_ENCRYPTION_KEY,
             "tables_to_backup": cls.BACKUP_TABLES,  # may be empty; treat as "all non-system tables"
+            "export_workers": cls.BACKUP_EXPORT_WORKERS,
+            "chunk_size_bytes": cls.BACKUP_CHUNK_SIZE_BYTES,
+            "restore_batch_rows": cls.BACKUP_RESTORE_BATCH_ROWS,
+            "incremental_enabled": cls.BACKUP_INCREMENTAL_ENABLED,
+            "full_interval_days": cls.BACKUP_FULL_INTERVAL_DAYS,
+            "max_increments": cls.BACKUP_MAX_INCREMENTS,
         }
@@ -0,0 +1,66 @@
+"""Build blind-index search tokens for existing patients.
+
+New and edited patients get their `patient_search_tokens` rows automatically;
+this one-time maintenance script fills them in for rows created before the
+index existed (or after rotating BLIND_INDEX_KEY).
+
+Usage (Windows PowerShell):
+  C:/Users/makok/Desktop/Makokha-Medical-Centre/venv/Scripts/python.exe scripts/backfill_patient_search_index.py
+
+Key:
+- Tokens are keyed with BLIND_INDEX_KEY when set, otherwise with a key derived
+  from FERNET_KEY. Run this again whenever that key changes.
+
+Safety:
+- Idempotent: each patient's tokens are replaced, never duplicated.
+- Commits per batch, so it can be interrupted and re-run.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from app import app, db, Patient, patient_search_values, rebuild_patient_search_tokens
+
+BATCH_SIZE = 500
+
+
+def main() -> int:
+    with app.app_context():
+        total = db.session.query(db.func.count(Patient.id)).scalar() or 0
+        done = 0
+        failed = 0
+        last_id = 0
+        while True:
+            batch = (
+                Patient.query
+                .filter(Patient.id > last_id)
+                .order_by(Patient.id)
+                .limit(BATCH_SIZE)
+                .all()
+            )
+            if not batch:
+                break
+            conn = db.session.connection()
+            for patient in batch:
+                try:
+                    rebuild_patient_search_tokens(conn, patient.id, patient_search_values(patient))
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"failed: patient {patient.id}: {e}")
+            last_id = batch[-1].id
+            db.session.commit()
+            print(f"indexed: {done}/{total}")
+
+    print(f"done: {done}/{total} patients indexed" + (f", {failed} failed" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,144 @@
+"""Compare NullPool with GreenQueuePool under eventlet on real endpoints.
+
+Each pool mode runs in its own subprocess (eventlet monkey-patching and the
+engine's pool class are fixed at import time). The child imports the app with
+SOCKETIO_ASYNC_MODE=eventlet, logs in as the first admin user through the
+Flask test client and requests a few read-heavy pages from concurrent green
+threads.
+
+Usage (Windows PowerShell):
+  C:/Users/makok/Desktop/Makokha-Medical-Centre/venv/Scripts/python.exe scripts/benchmark_db_pool.py --requests 200 --concurrency 10
+
+Point DATABASE_URL at the Postgres instance you want to measure; the NullPool
+cost is mostly the TCP/TLS connect, so a local SQLite file shows little gap.
+
+Output: per mode, requests/s, p50/p95 latency and (for the green pool) the
+checkout wait metrics from GreenQueuePool.stats().
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    '/api/patients?q=a',
+    '/api/communication/users',
+    '/admin/patients',
+    '/admin/drugs',
+]
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_worker(requests: int, concurrency: int) -> dict:
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import eventlet  # noqa: F401  (patched by app import)
+    from eventlet import GreenPool
+
+    from app import app, db, User
+
+    with app.app_context():
+        # role is an encrypted column, so match it after decryption.
+        admin = next((u for u in User.query.order_by(User.id).all() if u.role == 'admin'), None)
+        if admin is None:
+            raise SystemExit('No admin user found; create one first (scripts/create_admin.py).')
+        admin_id = admin.id
+        pool = db.engine.pool
+
+    def one(i: int) -> tuple[str, float, int]:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(admin_id)
+            sess['_fresh'] = True
+        path = ENDPOINTS[i % len(ENDPOINTS)]
+        started = time.perf_counter()
+        resp = client.get(path)
+        return path, time.perf_counter() - started, resp.status_code
+
+    # Warm-up so both modes start from the same cache state.
+    for i in range(len(ENDPOINTS)):
+        one(i)
+    if hasattr(pool, 'wait_stats'):
+        pool.wait_stats.reset()
+
+    started = time.perf_counter()
+    results = list(GreenPool(concurrency).imap(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [r[1] for r in results]
+    per_endpoint = {}
+    for path in ENDPOINTS:
+        lat = [r[1] for r in results if r[0] == path]
+        per_endpoint[path] = {
+            'p50_ms': round(_percentile(lat, 0.50) * 1000, 2),
+            'p95_ms': round(_percentile(lat, 0.95) * 1000, 2),
+            'errors': sum(1 for r in results if r[0] == path and r[2] >= 500),
+        }
+    out = {
+        'pool_class': type(pool).__name__,
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'rps': round(requests / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 2),
+        'endpoints': per_endpoint,
+    }
+    if hasattr(pool, 'stats'):
+        out['pool'] = pool.stats()
+    return out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--worker', choices=['null', 'green'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.requests, args.concurrency)))
+        return 0
+
+    results = {}
+    for mode in ('null', 'green'):
+        env = dict(os.environ, SOCKETIO_ASYNC_MODE='eventlet', SQLALCHEMY_EVENTLET_POOL=mode, FAST_DEV='1')
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', mode,
+             '--requests', str(args.requests), '--concurrency', str(args.concurrency)],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        lines = [ln for ln in proc.stdout.splitlines() if ln.startswith('{')]
+        if proc.returncode != 0 or not lines:
+            print(f'{mode}: failed (exit {proc.returncode})')
+            print(proc.stderr[-2000:])
+            return 1
+        results[mode] = json.loads(lines[-1])
+
+    for mode, r in results.items():
+        print(f"{mode:5s} {r['pool_class']:15s} {r['rps']:8.1f} req/s  p50 {r['p50_ms']:8.2f} ms  p95 {r['p95_ms']:8.2f} ms")
+        for path, e in r['endpoints'].items():
+            print(f"        {path:32s} p50 {e['p50_ms']:8.2f} ms  p95 {e['p95_ms']:8.2f} ms  5xx {e['errors']}")
+        if 'pool' in r:
+            print(f"        pool: {json.dumps(r['pool'])}")
+    null_rps, green_rps = results['null']['rps'], results['green']['rps']
+    if null_rps:
+        print(f'green/null throughput: {green_rps / null_rps:.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,205 @@
+"""Micro-benchmark for the WAF request scan (utils/custom_waf.py).
+
+Runs `waf.check_request()` on realistic clinic requests (typeahead search,
+patient registration form, cart checkout JSON, long clinical note, encrypted
+chat message) in a bare Flask request context, with two rule engines:
+
+  before  the original matcher: every pattern string passed to
+          `re.search(..., re.IGNORECASE)` in turn, SQL inputs lowercased first
+  after   WAFRuleEngine: one compiled alternation per category behind the
+          literal prefilter, plus the per-request scan limit (requests over
+          it are rejected with 413, so the ~1 MB bulk note is expected to be
+          refused by `after` and is timed as a rejection)
+
+Request parsing (form/JSON) is cached by Flask after the first call, so the
+numbers are the scan cost per request. Before timing, both engines must give
+the same verdict for every clinic request and for a set of attack payloads.
+
+Usage (Windows PowerShell):
+  C:/Users/makok/Desktop/Makokha-Medical-Centre/venv/Scripts/python.exe scripts/benchmark_waf.py --iterations 2000
+
+Does not import app.py or touch the database.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from flask import Flask
+
+from utils.custom_waf import CustomWAF, WAFRuleEngine
+
+
+class LegacyRuleEngine(WAFRuleEngine):
+    """The per-pattern loop the WAF used before the compiled rules."""
+
+    _PATTERNS = {
+        'sql_injection': WAFRuleEngine.SQL_INJECTION_PATTERNS,
+        'xss': WAFRuleEngine.XSS_PATTERNS,
+        'path_traversal': WAFRuleEngine.PATH_TRAVERSAL_PATTERNS,
+        'command_injection': WAFRuleEngine.COMMAND_INJECTION_PATTERNS,
+    }
+
+    @staticmethod
+    def fold(text):
+        return None
+
+    @classmethod
+    def matches(cls, attack_type, text, folded=None):
+        if not text:
+            return False
+        if attack_type == 'sql_injection':
+            text = text.lower()
+        for pattern in cls._PATTERNS[attack_type]:
+            if re.search(pattern, text, re.IGNORECASE):
+                return True
+        return False
+
+
+NOTE = (
+    "Pt is a 34 y/o female, c/o headache x3/7 & intermittent fever; no vomiting. "
+    "Known hypertensive on amlodipine 5mg OD (adherent). BP 142/91 mmHg, PR 88 b/min, "
+    "Temp 38.1C, SpO2 97% on room air. Chest: clear, no added sounds. Abdomen soft, non-tender. "
+    "Labs: Hb=11.2 g/dL (low), WBC 9.8 x10^9/L, MPS +ve (P. falciparum), RBS 6.4 mmol/L. "
+    "Imp: uncomplicated malaria; HTN - suboptimal control. "
+    "Plan: AL 80/480mg BD x3/7, PCM 1g TDS PRN, continue amlodipine, review BP in 2/52. "
+    "Advised on fluids & mosquito net use. Next of kin informed (husband, 0712 345 678). "
+)
+
+SCENARIOS = [
+    ('typeahead search (GET)', dict(
+        path='/pharmacist/search_drugs', method='GET',
+        query_string={'q': 'amoxicillin 500', 'limit': '20', 'in_stock': '1'},
+    )),
+    ('patient registration (form)', dict(
+        path='/receptionist/patients/new', method='POST',
+        data={
+            'csrf_token': 'IjQ1ZmE3Y2E0ZTJlMjQxYTliZjg2ZjFkYzE3ZjI3YjE4Ig.Zx1mVQ.abc',
+            'name': "Wanjiru O'Brien Achieng",
+            'date_of_birth': '1990-04-17',
+            'gender': 'Female',
+            'phone': '+254 712 345 678',
+            'email': 'w.achieng@example.co.ke',
+            'address': 'P.O. Box 123-50200, Bungoma',
+            'next_of_kin': 'Otieno Achieng (husband) - 0722 111 222',
+            'allergies': 'Penicillin (rash); sulfa drugs',
+            'notes': 'Referred from Kimilili SDH for review & follow-up.',
+        },
+    )),
+    ('cart checkout (JSON)', dict(
+        path='/pharmacist/cart_sale', method='POST',
+        json={
+            'patient_id': 1842,
+            'items': [{'drug_id': 10 + i, 'quantity': 1 + i % 3, 'dosage': '1x3 for 5 days'} for i in range(8)],
+            'payment_method': 'cash',
+            'amount_given': 2500,
+            'notes': 'Counselled on dosage & side effects',
+        },
+    )),
+    ('clinical note (JSON, ~2 KB)', dict(
+        path='/doctor/patient/1842/notes', method='POST',
+        json={'patient_id': 1842, 'note_type': 'consultation', 'content': NOTE * 3},
+    )),
+    ('encrypted chat message (JSON)', dict(
+        path='/api/chat/send', method='POST',
+        json={
+            'conversation_id': 77,
+            'ct': 'q' * 1400, 'iv': 'AbCdEfGhIjKlMnOp', 'ek': 'Z' * 344,
+            'public_jwk': {'kty': 'RSA', 'n': 'x' * 342, 'e': 'AQAB'},
+            'client_ts': '2026-10-17T08:15:00+03:00',
+        },
+    )),
+    ('bulk note (JSON, ~1 MB)', dict(
+        path='/doctor/patient/1842/notes', method='POST',
+        json={'patient_id': 1842, 'note_type': 'import', 'content': NOTE * 1400},
+    )),
+]
+
+ATTACKS = [
+    dict(path='/pharmacist/search_drugs', query_string={'q': "x' OR '1'='1"}),
+    dict(path='/pharmacist/search_drugs', query_string={'q': 'a; cat /etc/shadow'}),
+    dict(path='/pharmacist/search_drugs', query_string={'q': '1 union select password from users'}),
+    dict(path='/files/../../etc/passwd'),
+    dict(path='/receptionist/patients/new', method='POST', data={'name': '<script>alert(1)</script>'}),
+    dict(path='/receptionist/patients/new', method='POST', data={'notes': 'drop table patients; --'}),
+    dict(path='/api/chat/send', method='POST', json={'text': '<img src=x onerror=alert(1)>'}),
+    dict(path='/api/chat/send', method='POST', json={'text': 'javascript:void(0)'}),
+]
+
+
+def _ctx(flask_app, spec):
+    # 127.0.0.1 is whitelisted, so violations never auto-block the benchmark client.
+    return flask_app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}, **spec)
+
+
+def _waf(engine) -> CustomWAF:
+    w = CustomWAF()
+    w.rule_engine = engine
+    if engine is not WAFRuleEngine:
+        w.max_scan_bytes = 0  # the old scan had no budget
+    return w
+
+
+def _time_per_request(flask_app, waf, spec, iterations: int) -> float:
+    with _ctx(flask_app, spec):
+        waf.check_request()  # parse form/JSON once
+        started = time.perf_counter()
+        for _ in range(iterations):
+            waf.check_request()
+        return (time.perf_counter() - started) / iterations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='WAF per-request scan benchmark.')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.getLogger('utils.custom_waf').setLevel(logging.ERROR)
+    flask_app = Flask(__name__)
+    before, after = _waf(LegacyRuleEngine), _waf(WAFRuleEngine)
+
+    mismatches = 0
+    for spec in [s for _, s in SCENARIOS] + ATTACKS:
+        verdicts = []
+        for w in (before, after):
+            with _ctx(flask_app, spec):
+                verdicts.append(w.check_request()[:2])
+        if spec is SCENARIOS[-1][1]:
+            if verdicts[1] != (False, 'oversized'):
+                mismatches += 1
+                print(f"oversized request not rejected: after {verdicts[1]}")
+            continue
+        if verdicts[0] != verdicts[1]:
+            mismatches += 1
+            print(f"verdict mismatch on {spec.get('path')}: before {verdicts[0]} after {verdicts[1]}")
+    blocked = 0
+    for spec in ATTACKS:
+        with _ctx(flask_app, spec):
+            blocked += not after.check_request()[0]
+    print(f"verdicts: {len(SCENARIOS) + len(ATTACKS) - mismatches} agree, {mismatches} differ; "
+          f"{blocked}/{len(ATTACKS)} attack payloads blocked")
+
+    print(f"\n{'scenario':32} {'bytes':>9} {'before us':>11} {'after us':>10} {'speedup':>8}")
+    for name, spec in SCENARIOS:
+        size = len(json.dumps(spec.get('json') or spec.get('data') or spec.get('query_string') or {}))
+        iterations = max(5, args.iterations // max(1, size // 4096))
+        t_before = _time_per_request(flask_app, before, spec, iterations)
+        t_after = _time_per_request(flask_app, after, spec, iterations)
+        print(f"{name:32} {size:>9} {t_before * 1e6:>11.1f} {t_after * 1e6:>10.1f} {t_before / t_after:>7.1f}x")
+    print(f"\nscan limit: {after.max_scan_bytes} characters per request "
+          f"({after.counters['oversized_rejected']} oversized requests rejected during the run)")
+    return 0 if mismatches == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,142 @@
+"""Concurrency stress test for cart stock reservation (utils/stock_reservation.py).
+
+Creates a temporary drug with a fixed stock, then runs many parallel
+checkouts against it from worker threads, each in its own app context and
+transaction. Each checkout commits only if reserve_stock() succeeded.
+Afterwards it checks that:
+  - units sold == sum of quantities of the successful checkouts
+  - units sold <= stock (no oversell) and the stored remaining_quantity matches
+
+`--naive` runs the old pattern (read remaining, then sold_quantity += qty)
+for comparison; on PostgreSQL it typically shows lost updates/oversell.
+
+Usage (Windows PowerShell):
+  C:/Users/makok/Desktop/Makokha-Medical-Centre/venv/Scripts/python.exe scripts/stress_stock_reservation.py --stock 500 --workers 16 --checkouts 100
+
+Safety:
+- Uses the database configured for the app (DATABASE_URL). The test drug
+  (drug_number STRESS-<random>) is deleted at the end, even on failure.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from app import app, db, Drug
+from utils.stock_reservation import reserve_stock
+
+
+def _checkout(drug_id: int, qty: int, naive: bool) -> bool:
+    with app.app_context():
+        try:
+            if naive:
+                drug = db.session.get(Drug, drug_id)
+                if drug.remaining_quantity < qty:
+                    db.session.rollback()
+                    return False
+                time.sleep(0.001)  # widen the read/write window like a real request would
+                drug.sold_quantity = (drug.sold_quantity or 0) + qty
+                db.session.commit()
+                return True
+            result = reserve_stock(db.session, Drug, [(drug_id, qty)])
+            if not result.ok:
+                db.session.rollback()
+                return False
+            db.session.commit()
+            return True
+        except Exception:
+            db.session.rollback()
+            return False
+        finally:
+            db.session.remove()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Parallel checkout stress test for stock reservation.')
+    parser.add_argument('--stock', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--checkouts', type=int, default=100, help='checkouts per worker')
+    parser.add_argument('--max-qty', type=int, default=3)
+    parser.add_argument('--naive', action='store_true', help='use the old unlocked read/increment pattern')
+    args = parser.parse_args()
+
+    with app.app_context():
+        drug = Drug(
+            drug_number=f'STRESS-{random.randint(100000, 999999)}',
+            name='Stress test drug',
+            buying_price=1,
+            selling_price=1,
+            stocked_quantity=args.stock,
+            sold_quantity=0,
+            expiry_date=date(date.today().year + 5, 1, 1),
+        )
+        db.session.add(drug)
+        db.session.commit()
+        drug_id = drug.id
+
+    sold_by_workers = []
+    lock = threading.Lock()
+
+    def worker():
+        sold = 0
+        for _ in range(args.checkouts):
+            qty = random.randint(1, args.max_qty)
+            if _checkout(drug_id, qty, args.naive):
+                sold += qty
+        with lock:
+            sold_by_workers.append(sold)
+
+    try:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        with app.app_context():
+            drug = db.session.get(Drug, drug_id)
+            db_sold = int(drug.sold_quantity or 0)
+            stored_remaining = drug.on_hand_quantity
+            dialect = db.engine.dialect.name
+        expected_sold = sum(sold_by_workers)
+        attempts = args.workers * args.checkouts
+
+        print(f"mode: {'naive' if args.naive else 'reserve_stock'}  database: {dialect}")
+        print(f"{attempts} checkouts in {elapsed:.2f}s ({attempts / elapsed:.0f}/s)")
+        print(f"stock {args.stock}, units sold per successful checkouts {expected_sold}, sold_quantity in DB {db_sold}")
+        print(f"stored remaining_quantity {stored_remaining} (expected {args.stock - db_sold})")
+
+        ok = True
+        if db_sold > args.stock:
+            print(f"FAIL: oversold by {db_sold - args.stock}")
+            ok = False
+        if db_sold != expected_sold:
+            print(f"FAIL: lost updates: DB sold {db_sold} != confirmed {expected_sold}")
+            ok = False
+        if not args.naive and stored_remaining != args.stock - db_sold:
+            print("FAIL: stored remaining_quantity out of step")
+            ok = False
+        print('PASS' if ok else 'FAILED')
+        return 0 if ok else 1
+    finally:
+        with app.app_context():
+            drug = db.session.get(Drug, drug_id)
+            if drug is not None:
+                db.session.delete(drug)
+                db.session.commit()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -31,6 +31,8 @@ class CommunicationSystem {
         // Messaging UX state
         this._messageCache = new Map();
         this._usersCache = new Map();
+        this._conversationPage = null; // { before_cursor, has_more_before, ... } for the open chat
+        this._loadingOlderMessages = false;
         this._replyToMessageId = null;
         this._isChatBlocked = false;
         this._emojiPickerEl = null;
@@ -379,6 +381,15 @@ class CommunicationSystem {
                 this.socket.emit('user_connected', { user_id: this.currentUserId });
             }
 
+            // Keep this socket's presence entry alive on the server (entries expire without it).
+            if (!this._presenceHeartbeat) {
+                this._presenceHeartbeat = setInterval(() => {
+                    if (this.socket && this.socket.connected && this.currentUserId) {
+                        this.socket.emit('presence_heartbeat', { user_id: this.currentUserId });
+                    }
+                }, 30000);
+            }
+
             // Refresh unread badge on (re)connect
             this.updateFloatIconBadge().catch(() => {});
 
@@ -390,6 +401,11 @@ class CommunicationSystem {
             console.log('Disconnected from Socket.IO server');
         });
 
+        // Server-pushed unread counters (replaces polling /api/communication/unread_count)
+        this.socket.on('unread_update', (data) => {
+            this.applyUnreadUpdate(data);
+        });
+
         // Message events
         this.socket.on('new_message', (data) => {
             this.handleNewMessage(data);
@@ -1496,6 +1512,7 @@ class CommunicationSystem {
             
             const data = await response.json();
             this.activeConversation = data.conversation;
+            this._conversationPage = data.page || null;
             await this.displayMessages(data.messages);
             
             // Mark messages as read
@@ -1523,9 +1540,60 @@ class CommunicationSystem {
         
         // Scroll to bottom
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
+
+        // Older history is fetched page by page when the user scrolls to the top.
+        if (!messagesContainer._olderMessagesScrollBound) {
+            messagesContainer._olderMessagesScrollBound = true;
+            messagesContainer.addEventListener('scroll', () => {
+                if (messagesContainer.scrollTop < 40) {
+                    this.loadOlderMessages().catch(() => {});
+                }
+            });
+        }
+    }
+
+    async loadOlderMessages() {
+        const page = this._conversationPage;
+        const otherUserId = this.activeChatUserId;
+        if (!page || !page.has_more_before || !page.before_cursor || !otherUserId || this._loadingOlderMessages) return;
+
+        const messagesContainer = document.getElementById('messages-container');
+        if (!messagesContainer) return;
+
+        this._loadingOlderMessages = true;
+        try {
+            const params = new URLSearchParams({ before: page.before_cursor, limit: String(page.limit || 50) });
+            const response = await fetch(`/api/communication/conversation/${otherUserId}?${params.toString()}`, {
+                headers: {
+                    'X-CSRFToken': this.getCSRFToken()
+                }
+            });
+            if (!response.ok) return;
+            const data = await response.json();
+            // Ignore the response if the user switched chats meanwhile.
+            if (otherUserId !== this.activeChatUserId || !data.page) return;
+
+            this._conversationPage = {
+                ...page,
+                before_cursor: data.page.before_cursor,
+                has_more_before: data.page.has_more_before
+            };
+
+            const previousHeight = messagesContainer.scrollHeight;
+            const older = data.messages || [];
+            // Prepend newest-first so the batch ends up in chronological order.
+            for (let i = older.length - 1; i >= 0; i--) {
+                const displayMsg = await this.prepareMessageForDisplay(older[i]);
+                this.appendMessage(displayMsg, false, true);
+            }
+            // Keep the viewport on the message the user was looking at.
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+        } finally {
+            this._loadingOlderMessages = false;
+        }
     }
 
-    appendMessage(message, scrollToBottom = true) {
+    appendMessage(message, scrollToBottom = true, prepend = false) {
         const messagesContainer = document.getElementById('messages-container');
         if (!messagesContainer) return;
 
@@ -1613,7 +1681,11 @@ class CommunicationSystem {
 
         this.attachMessageInteractionHandlers(messageDiv);
         
-        messagesContainer.appendChild(messageDiv);
+        if (prepend) {
+            messagesContainer.insertBefore(messageDiv, messagesContainer.firstChild);
+        } else {
+            messagesContainer.appendChild(messageDiv);
+        }
         
         if (scrollToBottom) {
             messagesContainer.scrollTop = messagesContainer.scrollHeight;
@@ -1865,8 +1937,7 @@ class CommunicationSystem {
                     // no-op
                 }
 
-                // Refresh float icon badge
-                this.updateFloatIconBadge().catch(() => {});
+                // Float icon badge is refreshed by the server's unread_update push.
             }
         } catch (error) {
             console.error('Error marking messages as read:', error);
@@ -2563,9 +2634,44 @@ class CommunicationSystem {
                 badge.textContent = parseInt(badge.textContent) + 1;
             }
         }
-        
-        // Update float icon badge
-        this.updateFloatIconBadge();
+        // Float icon badge is refreshed by the server's unread_update push.
+    }
+
+    applyUnreadUpdate(data) {
+        if (!data) return;
+        const byUser = data.by_user || {};
+        document.querySelectorAll('.user-item[data-user-id]').forEach((userItem) => {
+            const count = parseInt(byUser[userItem.dataset.userId] || 0, 10);
+            let badge = userItem.querySelector('.unread-badge');
+            if (count > 0) {
+                if (!badge) {
+                    badge = document.createElement('span');
+                    badge.className = 'unread-badge';
+                    userItem.appendChild(badge);
+                }
+                badge.textContent = String(count);
+            } else if (badge) {
+                badge.remove();
+            }
+        });
+        this._usersCache.forEach((user, id) => {
+            user.unread_count = parseInt(byUser[String(id)] || 0, 10);
+        });
+        this.setFloatIconBadge(parseInt(data.unread_count || 0, 10));
+    }
+
+    setFloatIconBadge(count) {
+        const badge = document.getElementById('unread-messages-count');
+        const floatIcon = document.getElementById('communication-float-icon');
+        if (!badge || !floatIcon) return;
+        if (count > 0) {
+            badge.textContent = count;
+            badge.style.display = 'block';
+            floatIcon.classList.add('has-unread');
+        } else {
+            badge.style.display = 'none';
+            floatIcon.classList.remove('has-unread');
+        }
     }
 
     async updateFloatIconBadge() {
@@ -2579,19 +2685,7 @@ class CommunicationSystem {
             if (!response.ok) return;
             
             const data = await response.json();
-            const badge = document.getElementById('unread-messages-count');
-            const floatIcon = document.getElementById('communication-float-icon');
-            
-            if (badge && floatIcon) {
-                if (data.unread_count > 0) {
-                    badge.textContent = data.unread_count;
-                    badge.style.display = 'block';
-                    floatIcon.classList.add('has-unread');
-                } else {
-                    badge.style.display = 'none';
-                    floatIcon.classList.remove('has-unread');
-                }
-            }
+            this.setFloatIconBadge(parseInt(data.unread_count || 0, 10));
         } catch (error) {
             console.error('Error updating unread count:', error);
         }
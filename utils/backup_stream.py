@@ -0,0 +1,486 @@
+"""utils/backup_stream.py
+
+Streaming, chunked encryption for database backups.
+
+Why:
+- The legacy backup format is a single Fernet token over the whole zip, which
+  forces the entire archive into memory on both backup and restore.
+- This module encrypts in fixed-size authenticated chunks so backups can be
+  written straight to a local file or an S3 multipart upload with constant
+  memory, regardless of database size.
+
+File format (v2):
+- MAGIC + nonce_prefix(8 bytes) + chunk_size(uint32 BE)
+- Repeated frames: flags(1 byte) + ct_len(uint32 BE) + AESGCM(ciphertext||tag)
+  * nonce = nonce_prefix || frame_index(uint32 BE)
+  * AAD   = MAGIC || nonce_prefix || frame_index || flags
+  * flags bit 0 marks the final frame; a stream without a final frame is
+    treated as truncated.
+
+The AES-GCM key is derived (HKDF-SHA256) from BACKUP_ENCRYPTION_KEY, so no new
+secret has to be provisioned. Legacy whole-file Fernet backups remain readable
+through `open_backup_plaintext`. Restores open the archive through
+`open_backup_seekable`, which decrypts individual frames on demand so zipfile
+can read members in any order without a plaintext copy of the backup.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import os
+import struct
+from typing import BinaryIO, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+MAGIC = b"MMCBK2\n"
+_NONCE_PREFIX_LEN = 8
+_HEADER_LEN = len(MAGIC) + _NONCE_PREFIX_LEN + 4
+_FRAME_HEADER = struct.Struct(">BI")
+_FLAG_FINAL = 0x01
+_TAG_LEN = 16
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# S3 requires every part except the last to be at least 5 MiB.
+DEFAULT_S3_PART_SIZE = 8 * 1024 * 1024
+_MIN_S3_PART_SIZE = 5 * 1024 * 1024
+
+
+class BackupStreamError(Exception):
+    """Raised when a chunked backup stream is corrupt, truncated or tampered with."""
+
+
+def derive_stream_key(fernet_key: str | bytes) -> bytes:
+    """Derive the 32-byte AES-GCM stream key from a Fernet key string."""
+    raw = fernet_key.encode("utf-8") if isinstance(fernet_key, str) else bytes(fernet_key)
+    material = base64.urlsafe_b64decode(raw.strip())
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"mmc-backup-stream-v2",
+    ).derive(material)
+
+
+def is_stream_format(head: bytes) -> bool:
+    return isinstance(head, (bytes, bytearray)) and bytes(head[: len(MAGIC)]) == MAGIC
+
+
+def _nonce(prefix: bytes, index: int) -> bytes:
+    return prefix + struct.pack(">I", index)
+
+
+def _aad(prefix: bytes, index: int, flags: int) -> bytes:
+    return MAGIC + prefix + struct.pack(">IB", index, flags)
+
+
+class ChunkedEncryptWriter(io.RawIOBase):
+    """Write-only stream that encrypts plaintext into authenticated chunks.
+
+    Exposes `tell()` (plaintext bytes written) but not `seek()`, which makes
+    zipfile fall back to streaming mode with data descriptors. The SHA-256 of the
+    plaintext is available as `plaintext_sha256` after close().
+    """
+
+    def __init__(self, raw: BinaryIO, key: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__()
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self._raw = raw
+        self._aead = AESGCM(key)
+        self._chunk_size = int(chunk_size)
+        self._prefix = os.urandom(_NONCE_PREFIX_LEN)
+        self._index = 0
+        self._buf = bytearray()
+        self._hash = hashlib.sha256()
+        self._plain_written = 0
+        self.ciphertext_bytes = 0
+        self.plaintext_sha256: Optional[str] = None
+        self._emit(MAGIC + self._prefix + struct.pack(">I", self._chunk_size))
+
+    def _emit(self, data: bytes) -> None:
+        self._raw.write(data)
+        self.ciphertext_bytes += len(data)
+
+    def _emit_frame(self, chunk: bytes, final: bool) -> None:
+        if self._index > 0xFFFFFFFF:
+            raise BackupStreamError("backup stream too large for nonce space")
+        flags = _FLAG_FINAL if final else 0
+        ct = self._aead.encrypt(_nonce(self._prefix, self._index), bytes(chunk), _aad(self._prefix, self._index, flags))
+        self._emit(_FRAME_HEADER.pack(flags, len(ct)) + ct)
+        self._index += 1
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if self.closed:
+            raise ValueError("write to closed ChunkedEncryptWriter")
+        data = bytes(b)
+        if not data:
+            return 0
+        self._hash.update(data)
+        self._plain_written += len(data)
+        self._buf.extend(data)
+        while len(self._buf) >= self._chunk_size:
+            chunk = bytes(self._buf[: self._chunk_size])
+            del self._buf[: self._chunk_size]
+            self._emit_frame(chunk, final=False)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._plain_written
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            # Always emit a final frame (possibly empty) so truncation is detectable.
+            self._emit_frame(bytes(self._buf), final=True)
+            self._buf = bytearray()
+            self.plaintext_sha256 = self._hash.hexdigest()
+            try:
+                self._raw.flush()
+            except Exception:
+                pass
+        finally:
+            super().close()
+
+
+class ChunkedDecryptReader(io.RawIOBase):
+    """Read-only stream yielding the plaintext of a chunked backup."""
+
+    def __init__(self, raw: BinaryIO, key: bytes):
+        super().__init__()
+        self._raw = raw
+        self._aead = AESGCM(key)
+        header = self._read_exact(_HEADER_LEN)
+        if not is_stream_format(header):
+            raise BackupStreamError("not a chunked backup stream")
+        self._prefix = header[len(MAGIC): len(MAGIC) + _NONCE_PREFIX_LEN]
+        (chunk_size,) = struct.unpack(">I", header[len(MAGIC) + _NONCE_PREFIX_LEN:])
+        self._max_ct = int(chunk_size) + _TAG_LEN
+        self._index = 0
+        self._pending = b""
+        self._finished = False
+        self._hash = hashlib.sha256()
+
+    def _read_exact(self, n: int) -> bytes:
+        out = bytearray()
+        while len(out) < n:
+            piece = self._raw.read(n - len(out))
+            if not piece:
+                break
+            out.extend(piece)
+        return bytes(out)
+
+    def _next_frame(self) -> bytes:
+        head = self._read_exact(_FRAME_HEADER.size)
+        if len(head) < _FRAME_HEADER.size:
+            raise BackupStreamError("backup stream truncated (missing final chunk)")
+        flags, ct_len = _FRAME_HEADER.unpack(head)
+        if ct_len < _TAG_LEN or ct_len > self._max_ct:
+            raise BackupStreamError("backup stream has an invalid chunk length")
+        ct = self._read_exact(ct_len)
+        if len(ct) < ct_len:
+            raise BackupStreamError("backup stream truncated inside a chunk")
+        try:
+            chunk = self._aead.decrypt(_nonce(self._prefix, self._index), ct, _aad(self._prefix, self._index, flags))
+        except InvalidTag as e:
+            raise BackupStreamError(f"backup chunk {self._index} failed authentication") from e
+        self._index += 1
+        if flags & _FLAG_FINAL:
+            self._finished = True
+            if self._raw.read(1):
+                raise BackupStreamError("unexpected data after final backup chunk")
+        self._hash.update(chunk)
+        return chunk
+
+    @property
+    def plaintext_sha256(self) -> Optional[str]:
+        """SHA-256 of the plaintext, available once the stream has been fully read."""
+        return self._hash.hexdigest() if self._finished else None
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._raw.close()
+        finally:
+            super().close()
+
+    def readinto(self, b) -> int:
+        while not self._pending and not self._finished:
+            self._pending = self._next_frame()
+        if not self._pending:
+            return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+class ChunkedDecryptSeekableReader(io.RawIOBase):
+    """Random-access plaintext view over a chunked backup in a seekable file.
+
+    Every frame except the last carries exactly `chunk_size` plaintext bytes, so
+    a plaintext offset maps directly to a frame position. Only the frame being
+    read is held in memory, which lets zipfile open the archive (central
+    directory first, then members in any order) without ever materialising the
+    plaintext on disk or in RAM. Each frame is authenticated as it is read and
+    the last frame must carry the final flag, so truncation is still detected.
+    """
+
+    def __init__(self, raw: BinaryIO, key: bytes):
+        super().__init__()
+        self._raw = raw
+        self._aead = AESGCM(key)
+        raw.seek(0)
+        header = raw.read(_HEADER_LEN)
+        if len(header) < _HEADER_LEN or not is_stream_format(header):
+            raise BackupStreamError("not a chunked backup stream")
+        self._prefix = header[len(MAGIC): len(MAGIC) + _NONCE_PREFIX_LEN]
+        (chunk_size,) = struct.unpack(">I", header[len(MAGIC) + _NONCE_PREFIX_LEN:])
+        if chunk_size <= 0:
+            raise BackupStreamError("backup stream has an invalid chunk size")
+        self._chunk_size = int(chunk_size)
+        self._full_frame_len = _FRAME_HEADER.size + self._chunk_size + _TAG_LEN
+
+        body_len = raw.seek(0, io.SEEK_END) - _HEADER_LEN
+        self._full_frames, last_len = divmod(body_len, self._full_frame_len)
+        last_plain = last_len - _FRAME_HEADER.size - _TAG_LEN
+        if last_plain < 0:
+            raise BackupStreamError("backup stream truncated (missing final chunk)")
+        self._size = self._full_frames * self._chunk_size + last_plain
+        self._pos = 0
+        self._cached_index = -1
+        self._cached = b""
+
+    def _frame(self, index: int) -> bytes:
+        if index == self._cached_index:
+            return self._cached
+        final = index == self._full_frames
+        expected_len = (
+            self._size - index * self._chunk_size if final else self._chunk_size
+        ) + _TAG_LEN
+        self._raw.seek(_HEADER_LEN + index * self._full_frame_len)
+        head = self._raw.read(_FRAME_HEADER.size)
+        if len(head) < _FRAME_HEADER.size:
+            raise BackupStreamError("backup stream truncated inside a chunk")
+        flags, ct_len = _FRAME_HEADER.unpack(head)
+        if ct_len != expected_len or bool(flags & _FLAG_FINAL) != final:
+            raise BackupStreamError(f"backup chunk {index} has an unexpected layout")
+        ct = self._raw.read(ct_len)
+        if len(ct) < ct_len:
+            raise BackupStreamError("backup stream truncated inside a chunk")
+        try:
+            chunk = self._aead.decrypt(_nonce(self._prefix, index), ct, _aad(self._prefix, index, flags))
+        except InvalidTag as e:
+            raise BackupStreamError(f"backup chunk {index} failed authentication") from e
+        self._cached_index = index
+        self._cached = chunk
+        return chunk
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError("negative seek position")
+        self._pos = pos
+        return pos
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._cached = b""
+            self._raw.close()
+        finally:
+            super().close()
+
+    def readinto(self, b) -> int:
+        if self._pos >= self._size:
+            return 0
+        index, offset = divmod(self._pos, self._chunk_size)
+        chunk = self._frame(index)
+        n = min(len(b), len(chunk) - offset)
+        b[:n] = chunk[offset: offset + n]
+        self._pos += n
+        return n
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """Write-only stream that uploads to S3 as a multipart upload.
+
+    Call close() to complete the upload or abort() to discard it; at most one
+    part is buffered in memory.
+    """
+
+    def __init__(self, client, bucket: str, key: str, *, part_size: int = DEFAULT_S3_PART_SIZE, extra_args: Optional[dict] = None):
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = max(int(part_size), _MIN_S3_PART_SIZE)
+        self._buf = bytearray()
+        self._parts: list[dict] = []
+        self._written = 0
+        resp = client.create_multipart_upload(Bucket=bucket, Key=key, **(extra_args or {}))
+        self._upload_id = resp["UploadId"]
+
+    def writable(self) -> bool:
+        return True
+
+    def _upload_part(self, data: bytes) -> None:
+        number = len(self._parts) + 1
+        resp = self._client.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        self._parts.append({"PartNumber": number, "ETag": resp["ETag"]})
+
+    def write(self, b) -> int:
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        data = bytes(b)
+        self._buf.extend(data)
+        self._written += len(data)
+        while len(self._buf) >= self._part_size:
+            part = bytes(self._buf[: self._part_size])
+            del self._buf[: self._part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+        finally:
+            self._buf = bytearray()
+            super().close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buf or not self._parts:
+                self._upload_part(bytes(self._buf))
+                self._buf = bytearray()
+            self._client.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        except Exception:
+            try:
+                self._client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+            except Exception:
+                pass
+            raise
+        finally:
+            super().close()
+
+
+def open_backup_plaintext(raw: BinaryIO, fernet_key: str) -> BinaryIO:
+    """Return a readable plaintext stream for an encrypted backup file.
+
+    Chunked (v2) backups are decrypted lazily. Legacy backups are a single Fernet
+    token and have to be decrypted in memory. The returned stream owns `raw`:
+    closing it closes `raw`.
+    """
+    head = raw.read(len(MAGIC))
+    if is_stream_format(head):
+        rest = io.BufferedReader(_PrefixedReader(head, raw))
+        return io.BufferedReader(ChunkedDecryptReader(rest, derive_stream_key(fernet_key)), buffer_size=DEFAULT_CHUNK_SIZE)
+    try:
+        token = head + raw.read()
+    finally:
+        try:
+            raw.close()
+        except Exception:
+            pass
+    return io.BytesIO(Fernet(fernet_key.encode() if isinstance(fernet_key, str) else fernet_key).decrypt(token))
+
+
+def open_backup_seekable(raw: BinaryIO, fernet_key: str) -> BinaryIO:
+    """Return a seekable plaintext stream (suitable for zipfile) for a backup file.
+
+    `raw` must be seekable. Chunked (v2) backups are decrypted one frame at a
+    time on demand; legacy Fernet backups fall back to an in-memory buffer. The
+    returned stream owns `raw`.
+    """
+    head = raw.read(len(MAGIC))
+    if is_stream_format(head):
+        return io.BufferedReader(ChunkedDecryptSeekableReader(raw, derive_stream_key(fernet_key)), buffer_size=64 * 1024)
+    raw.seek(0)
+    return open_backup_plaintext(raw, fernet_key)
+
+
+class _PrefixedReader(io.RawIOBase):
+    """Re-attach bytes already consumed (for format sniffing) to the front of a stream."""
+
+    def __init__(self, prefix: bytes, raw: BinaryIO):
+        super().__init__()
+        self._prefix = bytes(prefix)
+        self._raw = raw
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._raw.close()
+        finally:
+            super().close()
+
+    def readinto(self, b) -> int:
+        if self._prefix:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        data = self._raw.read(len(b))
+        if not data:
+            return 0
+        n = len(data)
+        b[:n] = data
+        return n
@@ -0,0 +1,171 @@
+"""utils/blind_index.py
+
+Keyed blind-index tokens for searching encrypted patient fields.
+
+Why:
+- Patient name/phone/next-of-kin values are stored as Fernet tokens, so SQL
+  filters (LIKE/ILIKE) never match them and lookups had to decrypt every row.
+- This module turns a plaintext value into a small set of HMAC-SHA256 tokens
+  (word trigrams and leading pairs, phone numbers and their prefixes/suffixes). The
+  tokens are stored in an indexed side table and the search input is tokenised
+  the same way, so matching becomes an indexed equality query.
+
+Security notes:
+- Tokens are keyed with BLIND_INDEX_KEY (or a key derived from FERNET_KEY), so
+  they cannot be recomputed without the key. They do reveal equality (two rows
+  sharing a token share that fragment), which is the usual blind-index trade-off.
+- Tokens are bound to the field they came from, so a name fragment never matches
+  a phone fragment.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import re
+import unicodedata
+from typing import Iterable
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+NAME_FIELDS = ("name", "nok_name")
+PHONE_FIELDS = ("phone", "nok_contact")
+
+# Shortest search fragment that is looked up at all (shorter input matches too much).
+MIN_QUERY_LENGTH = 2
+_MIN_PHONE_FRAGMENT = 4
+_GRAM = 3
+
+_NON_ALNUM_RE = re.compile(r"[^0-9a-z ]+")
+_SPACES_RE = re.compile(r"\s+")
+_NON_DIGIT_RE = re.compile(r"\D+")
+
+
+def derive_blind_index_key(fernet_key: str | bytes) -> bytes:
+    """Derive a 32-byte HMAC key from a Fernet key when no BLIND_INDEX_KEY is configured."""
+    raw = fernet_key.encode("utf-8") if isinstance(fernet_key, str) else bytes(fernet_key)
+    material = base64.urlsafe_b64decode(raw.strip())
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"mmc-patient-blind-index-v1",
+    ).derive(material)
+
+
+def normalize_name(value: str | None) -> str:
+    """Casefold, strip accents and punctuation, collapse whitespace."""
+    if not value:
+        return ""
+    s = unicodedata.normalize("NFKD", str(value))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch)).casefold()
+    s = _NON_ALNUM_RE.sub(" ", s)
+    return _SPACES_RE.sub(" ", s).strip()
+
+
+def normalize_phone(value: str | None) -> str:
+    """Digits only, with Kenyan numbers in local form (+254712... / 712... -> 0712...)."""
+    if not value:
+        return ""
+    digits = _NON_DIGIT_RE.sub("", str(value))
+    if digits.startswith("254") and len(digits) == 12:
+        digits = "0" + digits[3:]
+    elif len(digits) == 9 and digits[0] in "17":
+        digits = "0" + digits
+    return digits
+
+
+def _normalize_phone_query(query: str | None) -> str:
+    """Like normalize_phone, but also maps partial international input (+2547...) to local form."""
+    digits = normalize_phone(query)
+    if digits.startswith("254") and len(digits) > 3:
+        digits = "0" + digits[3:]
+    return digits
+
+
+def _token(key: bytes, field: str, kind: str, value: str) -> str:
+    msg = f"{field}\x1f{kind}\x1f{value}".encode("utf-8")
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()
+
+
+def _name_fragments(normalized: str) -> set[tuple[str, str]]:
+    out: set[tuple[str, str]] = set()
+    if not normalized:
+        return out
+    for word in normalized.split(" "):
+        # Words shorter than a trigram are only searchable by their leading pair.
+        if len(word) >= MIN_QUERY_LENGTH:
+            out.add(("prefix", word[:MIN_QUERY_LENGTH]))
+        for i in range(len(word) - _GRAM + 1):
+            out.add(("gram", word[i:i + _GRAM]))
+    return out
+
+
+def _phone_fragments(normalized: str) -> set[tuple[str, str]]:
+    out: set[tuple[str, str]] = set()
+    if not normalized:
+        return out
+    out.add(("exact", normalized))
+    for n in range(_MIN_PHONE_FRAGMENT, len(normalized)):
+        out.add(("prefix", normalized[:n]))
+        out.add(("suffix", normalized[-n:]))
+    return out
+
+
+def index_tokens(key: bytes, field: str, value: str | None) -> set[str]:
+    """Return every token stored for a plaintext field value."""
+    if field in PHONE_FIELDS:
+        fragments = _phone_fragments(normalize_phone(value))
+    else:
+        fragments = _name_fragments(normalize_name(value))
+    return {_token(key, field, kind, frag) for kind, frag in fragments}
+
+
+def query_token_groups(key: bytes, field: str, query: str | None) -> list[set[str]]:
+    """Tokenise search input for one field.
+
+    Returns a list of alternatives; a row matches the query when it carries every
+    token of at least one alternative. Returns [] when the input is too short or
+    empty to search on.
+    """
+    if field in PHONE_FIELDS:
+        digits = _normalize_phone_query(query)
+        if len(digits) < _MIN_PHONE_FRAGMENT:
+            return []
+        return [{_token(key, field, kind, digits)} for kind in ("exact", "prefix", "suffix")]
+
+    normalized = normalize_name(query)
+    if len(normalized.replace(" ", "")) < MIN_QUERY_LENGTH:
+        return []
+    required: set[str] = set()
+    for word in normalized.split(" "):
+        if len(word) < MIN_QUERY_LENGTH:
+            continue
+        if len(word) < _GRAM:
+            required.add(_token(key, field, "prefix", word))
+            continue
+        # Substring semantics: every trigram of the word must be present. The
+        # caller re-checks candidates against the decrypted value.
+        for i in range(len(word) - _GRAM + 1):
+            required.add(_token(key, field, "gram", word[i:i + _GRAM]))
+    return [required] if required else []
+
+
+def value_matches(field: str, value: str | None, query: str | None) -> bool:
+    """Plaintext check used to drop n-gram false positives after the indexed lookup."""
+    if field in PHONE_FIELDS:
+        q = _normalize_phone_query(query)
+        return bool(q) and q in normalize_phone(value)
+    v = normalize_name(value)
+    words = [w for w in normalize_name(query).split(" ") if len(w) >= MIN_QUERY_LENGTH]
+    return bool(words) and all(w in v for w in words)
+
+
+def iter_field_tokens(key: bytes, values: dict[str, str | None]) -> Iterable[tuple[str, str]]:
+    """Yield (field, token) pairs for a mapping of field -> plaintext."""
+    for field, value in values.items():
+        for tok in index_tokens(key, field, value):
+            yield field, tok
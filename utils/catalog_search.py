@@ -0,0 +1,223 @@
+"""utils/catalog_search.py
+
+Typeahead search over the drug, controlled drug and service catalogues.
+
+Why:
+- The pharmacy/doctor typeahead endpoints ran `ILIKE '%q%'` on every keystroke,
+  a sequential scan of the catalogue.
+- PostgreSQL: `pg_trgm` GIN indexes on the searched columns serve the same
+  ILIKE filters, and ranking + stock filtering happen in one SQL query.
+- SQLite (local/dev): an in-process index per catalogue (sorted word list for
+  short prefixes, trigram postings for longer terms) finds and ranks the
+  matching ids; one `WHERE id IN (...)` query then applies the stock filter.
+  The index is rebuilt lazily after catalogue writes (`invalidate()`) or when
+  the table's (count, max id, max updated_at) signature changes.
+
+Match rules (identical on both backends, all query terms must match):
+- terms of 3+ characters match anywhere in the primary or secondary text;
+- shorter terms match the start of a word.
+Rank (lower is better) for the whole query string q:
+  0 name == q, 1 name starts with q, 2 a name word starts with q,
+  3 name contains q, 4 secondary text contains q, 5 terms matched separately.
+"""
+
+from __future__ import annotations
+
+import bisect
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import case, func, literal, or_, text
+
+
+MIN_INFIX_TERM = 3
+_MAX_TERMS = 5
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(value) -> str:
+    return _SPACE_RE.sub(' ', value).strip().lower() if isinstance(value, str) else ''
+
+
+def query_terms(q: str) -> list[str]:
+    out: list[str] = []
+    for t in normalize(q).split(' '):
+        if t and t not in out:
+            out.append(t)
+    return out[:_MAX_TERMS]
+
+
+def _like_escape(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _term_matches(term: str, primary: str, secondary: str) -> bool:
+    if len(term) >= MIN_INFIX_TERM:
+        return term in primary or term in secondary
+    return (
+        primary.startswith(term) or (' ' + term) in primary
+        or secondary.startswith(term) or (' ' + term) in secondary
+    )
+
+
+def rank_of(q: str, primary: str, secondary: str) -> int:
+    if primary == q:
+        return 0
+    if primary.startswith(q):
+        return 1
+    if (' ' + q) in primary:
+        return 2
+    if q in primary:
+        return 3
+    if q in secondary:
+        return 4
+    return 5
+
+
+# ---------------------------------------------------------------------- SQL side
+
+def sql_match_filter(primary_col, secondary_col, terms: list[str]):
+    """AND of per-term ILIKE conditions matching `_term_matches`."""
+    conds = []
+    for t in terms:
+        e = _like_escape(t)
+        if len(t) >= MIN_INFIX_TERM:
+            like = f'%{e}%'
+            conds.append(or_(primary_col.ilike(like, escape='\\'), secondary_col.ilike(like, escape='\\')))
+        else:
+            conds.append(or_(
+                primary_col.ilike(f'{e}%', escape='\\'), primary_col.ilike(f'% {e}%', escape='\\'),
+                secondary_col.ilike(f'{e}%', escape='\\'), secondary_col.ilike(f'% {e}%', escape='\\'),
+            ))
+    return conds
+
+
+def sql_rank(primary_col, secondary_col, q: str):
+    """CASE expression equal to `rank_of` for the whole query string."""
+    e = _like_escape(q)
+    p = func.lower(primary_col)
+    return case(
+        (p == q, 0),
+        (primary_col.ilike(f'{e}%', escape='\\'), 1),
+        (primary_col.ilike(f'% {e}%', escape='\\'), 2),
+        (primary_col.ilike(f'%{e}%', escape='\\'), 3),
+        (secondary_col.ilike(f'%{e}%', escape='\\'), 4),
+        else_=5,
+    )
+
+
+def sql_similarity(primary_col, q: str):
+    return func.similarity(primary_col, literal(q))
+
+
+def ensure_trgm_indexes(engine, columns: Iterable[tuple[str, str]]) -> bool:
+    """PostgreSQL: enable pg_trgm and add GIN trigram indexes on (table, column) pairs.
+
+    Returns True when pg_trgm is available (so similarity() may be used).
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    with engine.begin() as conn:
+        for table, column in columns:
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON "{table}" USING gin ({column} gin_trgm_ops)'
+            ))
+    return True
+
+
+# ---------------------------------------------------------------------- in-process index
+
+class _Snapshot:
+    def __init__(self, rows: Iterable[tuple]):
+        self.docs: dict[int, tuple[str, str]] = {}
+        words: list[tuple[str, int]] = []
+        self.grams: dict[str, set[int]] = {}
+        for row_id, primary, secondary in rows:
+            p, s = normalize(primary), normalize(secondary)
+            self.docs[row_id] = (p, s)
+            for w in set(p.split(' ')) | set(s.split(' ')):
+                if w:
+                    words.append((w, row_id))
+            for doc in (p, s):
+                for i in range(len(doc) - 2):
+                    self.grams.setdefault(doc[i:i + 3], set()).add(row_id)
+        words.sort()
+        self.words = words
+
+    def _prefix_ids(self, prefix: str) -> set[int]:
+        lo = bisect.bisect_left(self.words, (prefix, -1))
+        out: set[int] = set()
+        for i in range(lo, len(self.words)):
+            w, row_id = self.words[i]
+            if not w.startswith(prefix):
+                break
+            out.add(row_id)
+        return out
+
+    def _infix_ids(self, term: str) -> set[int]:
+        ids: Optional[set[int]] = None
+        for i in range(len(term) - 2):
+            posting = self.grams.get(term[i:i + 3])
+            if not posting:
+                return set()
+            ids = set(posting) if ids is None else ids & posting
+            if not ids:
+                return set()
+        return ids or set()
+
+    def search(self, q: str, terms: list[str]) -> list[tuple[int, str, int]]:
+        seed = max(terms, key=len)
+        ids = self._infix_ids(seed) if len(seed) >= MIN_INFIX_TERM else self._prefix_ids(seed)
+        out = []
+        for row_id in ids:
+            p, s = self.docs[row_id]
+            if all(_term_matches(t, p, s) for t in terms):
+                out.append((rank_of(q, p, s), p, row_id))
+        out.sort()
+        return out
+
+
+class CatalogSearchIndex:
+    """Lazily (re)built in-process index for one catalogue table."""
+
+    def __init__(self, name: str, loader: Callable[[], Iterable[tuple]],
+                 signature: Callable[[], tuple], *, check_interval: float = 5.0):
+        self.name = name
+        self.loader = loader
+        self.signature = signature
+        self.check_interval = float(check_interval)
+        self.builds = 0
+        self._lock = threading.Lock()
+        self._snapshot: Optional[_Snapshot] = None
+        self._signature = None
+        self._checked_at = 0.0
+
+    def invalidate(self) -> None:
+        self._snapshot = None
+
+    def _current(self) -> _Snapshot:
+        snap = self._snapshot
+        now = time.monotonic()
+        if snap is not None and now - self._checked_at < self.check_interval:
+            return snap
+        with self._lock:
+            snap = self._snapshot
+            sig = self.signature()
+            if snap is None or sig != self._signature:
+                snap = _Snapshot(self.loader())
+                self._snapshot = snap
+                self._signature = sig
+                self.builds += 1
+            self._checked_at = time.monotonic()
+            return snap
+
+    def search(self, q: str) -> list[tuple[int, int]]:
+        """All matching (rank, id) pairs, best first (ties by name)."""
+        terms = query_terms(q)
+        if not terms:
+            return []
+        return [(rank, row_id) for rank, _, row_id in self._current().search(normalize(q), terms)]
@@ -13,6 +13,20 @@ Features:
 - Suspicious pattern detection
 - IP-based blocking and whitelisting
 - Automatic threat blocking
+
+Matching:
+- Each pattern lists the literals it cannot match without (e.g. `<script`,
+  or a SQL verb AND `from/into/where/...`). For an ASCII value only the
+  patterns whose literals are all present are searched, as ONE precompiled,
+  case-insensitive alternation (compiled once per combination and cached);
+  most clinic input never reaches the regex engine. Non-ASCII values
+  search the full category alternation, because re's Unicode case folding is
+  wider than `str.lower()`.
+- A request's query args, form fields and JSON body may carry at most
+  `max_scan_bytes` characters in total. Larger requests are rejected with 413
+  instead of being partly scanned, except on the path prefixes listed in
+  `scan_exempt_paths` (explicit bulk/upload routes), where the head and tail
+  of every field are scanned. Uploaded files are not part of the scan.
 """
 
 import re
@@ -28,6 +42,46 @@ import json
 logger = logging.getLogger(__name__)
 
 
+def _alternation(patterns: List[str]):
+    return re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE)
+
+
+class _CompiledRule:
+    """One attack category: its patterns behind per-pattern literal prefilters."""
+
+    def __init__(self, patterns: List[str], requires: List[Tuple[Tuple[str, ...], ...]],
+                 lowercase: bool = False):
+        if len(patterns) != len(requires):
+            raise ValueError('every pattern needs its prefilter literals')
+        self.patterns = list(patterns)
+        # requires[i]: groups of lowercase literals; pattern i can only match when
+        # every group has at least one literal in the lowercased text.
+        self.requires = [tuple(frozenset(group) for group in groups) for groups in requires]
+        self.literals = tuple(sorted({lit for groups in requires for group in groups for lit in group}))
+        self.regex = _alternation(self.patterns)
+        # Search text.lower() (SQL rules always did; it differs from IGNORECASE for e.g. 'İ').
+        self.lowercase = lowercase
+        self._subsets: Dict[Tuple[int, ...], re.Pattern] = {}
+
+    def match(self, text: str, folded: Optional[str]) -> bool:
+        # folded: lowercased ASCII text, or None to skip the prefilter.
+        if folded is None:
+            return self.regex.search(text.lower() if self.lowercase else text) is not None
+        present = {lit for lit in self.literals if lit in folded}
+        if not present:
+            return False
+        hit = tuple(
+            i for i, groups in enumerate(self.requires)
+            if all(not present.isdisjoint(group) for group in groups)
+        )
+        if not hit:
+            return False
+        regex = self._subsets.get(hit)
+        if regex is None:
+            regex = self._subsets[hit] = _alternation([self.patterns[i] for i in hit])
+        return regex.search(folded) is not None
+
+
 class WAFRuleEngine:
     """Core rule engine for detecting malicious patterns"""
     
@@ -76,56 +130,96 @@ class WAFRuleEngine:
         'x-rewrite-url',
     ]
     
+    # Prefilter literals per pattern (same order as the lists above): each pattern
+    # needs one literal from every group. See _CompiledRule.
+    _SQL_VERBS = ('union', 'select', 'insert', 'update', 'delete', 'drop', 'create',
+                  'alter', 'exec', 'script', 'javascript')
+    _SHELL_COMMANDS = ('cat', 'ls', 'pwd', 'wget', 'curl', 'nc', 'bash', 'sh', 'cmd', 'powershell')
+    SQL_INJECTION_TRIGGERS = [
+        (_SQL_VERBS, ('from', 'into', 'where', 'table', 'database')),
+        (("';", "'--", "'|", "')"),),
+        (('=',), ('or', '1=1', "'='")),
+        (('/*', '*/', '--', '#', 'xp_', 'sp_'),),
+        (('exec',), ('sp', 'xp')),
+    ]
+    XSS_TRIGGERS = [
+        (('<script',), ('</script',)),
+        (('javascript:',),),
+        (('on',), ('=',)),
+        (('<iframe',),),
+        (('<object',),),
+        (('<embed',),),
+        (('eval',), ('(',)),
+        (('expression',), ('(',)),
+    ]
+    PATH_TRAVERSAL_TRIGGERS = [
+        (('../', '..\\'),),
+        (('etc',), ('passwd',)),
+        (('windows',), ('system32',)),
+        (('%2e%2e/', '%2e%2e\\'),),
+        (('..%2f',),),
+    ]
+    COMMAND_INJECTION_TRIGGERS = [
+        ((';', '&', '|', '`', '$'), _SHELL_COMMANDS),
+        (('$(',), (')',)),
+        (('`',),),
+        (('|',), ('cat', 'ls', 'pwd', 'wget')),
+    ]
+
+    RULES: Dict[str, _CompiledRule] = {}
+
+    @staticmethod
+    def fold(text: str) -> Optional[str]:
+        """Prefilter form of `text`: lowercase if ASCII, else None (always run the regex)."""
+        return text.lower() if text.isascii() else None
+
     @classmethod
-    def check_sql_injection(cls, text: str) -> bool:
-        """Check for SQL injection patterns"""
+    def matches(cls, attack_type: str, text: str, folded: Optional[str] = None) -> bool:
+        """Check one category; pass `folded=cls.fold(text)` when checking several."""
         if not text:
             return False
-        text_lower = text.lower()
-        for pattern in cls.SQL_INJECTION_PATTERNS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return True
-        return False
-    
+        if folded is None:
+            folded = cls.fold(text)
+        return cls.RULES[attack_type].match(text, folded)
+
+    @classmethod
+    def check_sql_injection(cls, text: str) -> bool:
+        """Check for SQL injection patterns"""
+        return cls.matches('sql_injection', text)
+
     @classmethod
     def check_xss(cls, text: str) -> bool:
         """Check for XSS patterns"""
-        if not text:
-            return False
-        for pattern in cls.XSS_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
-    
+        return cls.matches('xss', text)
+
     @classmethod
     def check_path_traversal(cls, text: str) -> bool:
         """Check for path traversal attempts"""
-        if not text:
-            return False
-        for pattern in cls.PATH_TRAVERSAL_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
-    
+        return cls.matches('path_traversal', text)
+
     @classmethod
     def check_command_injection(cls, text: str) -> bool:
         """Check for command injection attempts"""
-        if not text:
-            return False
-        for pattern in cls.COMMAND_INJECTION_PATTERNS:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
-    
+        return cls.matches('command_injection', text)
+
     @classmethod
     def check_suspicious_headers(cls, headers: dict) -> Tuple[bool, Optional[str]]:
         """Check for suspicious or malicious headers"""
+        present = {h.lower() for h in headers.keys()}
         for header in cls.SUSPICIOUS_HEADERS:
-            if header in [h.lower() for h in headers.keys()]:
+            if header in present:
                 return True, header
         return False, None
 
 
+WAFRuleEngine.RULES = {
+    'sql_injection': _CompiledRule(WAFRuleEngine.SQL_INJECTION_PATTERNS, WAFRuleEngine.SQL_INJECTION_TRIGGERS, lowercase=True),
+    'xss': _CompiledRule(WAFRuleEngine.XSS_PATTERNS, WAFRuleEngine.XSS_TRIGGERS),
+    'path_traversal': _CompiledRule(WAFRuleEngine.PATH_TRAVERSAL_PATTERNS, WAFRuleEngine.PATH_TRAVERSAL_TRIGGERS),
+    'command_injection': _CompiledRule(WAFRuleEngine.COMMAND_INJECTION_PATTERNS, WAFRuleEngine.COMMAND_INJECTION_TRIGGERS),
+}
+
+
 class WAFBlocklist:
     """Manage blocked IPs and automatic threat detection"""
     
@@ -233,6 +327,11 @@ class CustomWAF:
         self.enabled = True
         self.log_violations = True
         self.block_on_detection = True
+        # Characters of args/form/JSON allowed per request (0 = no limit).
+        self.max_scan_bytes = 256 * 1024
+        # Path prefixes allowed past the limit; only each field's head and tail is scanned there.
+        self.scan_exempt_paths: Tuple[str, ...] = ()
+        self.counters = {'oversized_rejected': 0, 'partial_scans': 0}
         
         # Severity scores
         self.SEVERITY = {
@@ -245,6 +344,15 @@ class CustomWAF:
             'invalid_input': 15,
         }
 
+    # Categories checked per source, in order, and how a hit is described.
+    ARG_CHECKS = ('sql_injection', 'xss', 'command_injection')
+    BODY_CHECKS = ('sql_injection', 'xss')
+    ATTACK_LABELS = {
+        'sql_injection': 'SQL injection',
+        'xss': 'XSS attempt',
+        'command_injection': 'Command injection',
+    }
+
     def _sanitize_json_for_scans(self, data):
         """Redact high-entropy fields from JSON payloads before regex scanning."""
         try:
@@ -323,95 +431,68 @@ class CustomWAF:
             if self.block_on_detection:
                 return False, 'path_traversal', 'Path traversal attempt detected'
         
-        # Check query parameters
-        for key, value in request.args.items():
-            value_str = str(value)
-            
-            if self.rule_engine.check_sql_injection(value_str):
-                self.blocklist.record_violation(
-                    client_ip,
-                    self.SEVERITY['sql_injection'],
-                    'sql_injection'
-                )
-                if self.block_on_detection:
-                    return False, 'sql_injection', f'SQL injection in parameter: {key}'
-            
-            if self.rule_engine.check_xss(value_str):
-                self.blocklist.record_violation(
-                    client_ip,
-                    self.SEVERITY['xss'],
-                    'xss'
-                )
-                if self.block_on_detection:
-                    return False, 'xss', f'XSS attempt in parameter: {key}'
-            
-            if self.rule_engine.check_command_injection(value_str):
+        # Check query parameters, form data and JSON payload within the scan budget
+        fields = list(self._scan_fields())
+        budget = self.max_scan_bytes if self.max_scan_bytes and self.max_scan_bytes > 0 else None
+        if budget is not None:
+            total = sum(len(text) for _, _, text, _ in fields)
+            if total > budget:
+                if not self._scan_exempt(request.path):
+                    # Fail closed: an unscanned remainder would be a bypass.
+                    self.counters['oversized_rejected'] += 1
+                    return False, 'oversized', f'Request input of {total} characters exceeds the {budget} character scan limit'
+                self.counters['partial_scans'] += 1
+                logger.debug(f"WAF: scanning head and tail of oversized fields on {request.path}")
+                half = max(1, budget // 2)
+                fields = [
+                    (where, key, (text[:half] + '\n' + text[-half:]) if len(text) > budget else text, checks)
+                    for where, key, text, checks in fields
+                ]
+
+        for where, key, text, checks in fields:
+            folded = self.rule_engine.fold(text)
+            for attack_type in checks:
+                if not text or not self.rule_engine.matches(attack_type, text, folded):
+                    continue
                 self.blocklist.record_violation(
                     client_ip,
-                    self.SEVERITY['command_injection'],
-                    'command_injection'
+                    self.SEVERITY[attack_type],
+                    attack_type
                 )
                 if self.block_on_detection:
-                    return False, 'command_injection', f'Command injection in parameter: {key}'
+                    label = self.ATTACK_LABELS[attack_type]
+                    detail = f'{label} in {where}: {key}' if key is not None else f'{label} in {where}'
+                    return False, attack_type, detail
         
-        # Check form data (POST requests)
+        # Request passed all checks
+        return True, None, None
+    
+    def _scan_exempt(self, path: str) -> bool:
+        """True when `path` is under one of the configured scan-limit exempt prefixes."""
+        return any(prefix and path.startswith(prefix) for prefix in self.scan_exempt_paths)
+
+    def _scan_fields(self):
+        """(where, key, text, checks) for every value of the current request to scan."""
+        for key, value in request.args.items():
+            yield 'parameter', key, str(value), self.ARG_CHECKS
+
+        # Form data (POST requests)
         if request.method == 'POST' and request.form:
             for key, value in request.form.items():
                 # Skip CSRF token validation
                 if key == 'csrf_token':
                     continue
-                
-                value_str = str(value)
-                
-                if self.rule_engine.check_sql_injection(value_str):
-                    self.blocklist.record_violation(
-                        client_ip,
-                        self.SEVERITY['sql_injection'],
-                        'sql_injection'
-                    )
-                    if self.block_on_detection:
-                        return False, 'sql_injection', f'SQL injection in form field: {key}'
-                
-                if self.rule_engine.check_xss(value_str):
-                    self.blocklist.record_violation(
-                        client_ip,
-                        self.SEVERITY['xss'],
-                        'xss'
-                    )
-                    if self.block_on_detection:
-                        return False, 'xss', f'XSS attempt in form field: {key}'
-        
-        # Check JSON payload
+                yield 'form field', key, str(value), self.BODY_CHECKS
+
         if request.is_json:
             try:
                 json_data = request.get_json()
-                if json_data:
-                    sanitized = self._sanitize_json_for_scans(json_data)
-                    json_str = json.dumps(sanitized)
-                    
-                    if self.rule_engine.check_sql_injection(json_str):
-                        self.blocklist.record_violation(
-                            client_ip,
-                            self.SEVERITY['sql_injection'],
-                            'sql_injection'
-                        )
-                        if self.block_on_detection:
-                            return False, 'sql_injection', 'SQL injection in JSON payload'
-                    
-                    if self.rule_engine.check_xss(json_str):
-                        self.blocklist.record_violation(
-                            client_ip,
-                            self.SEVERITY['xss'],
-                            'xss'
-                        )
-                        if self.block_on_detection:
-                            return False, 'xss', 'XSS attempt in JSON payload'
+                json_str = json.dumps(self._sanitize_json_for_scans(json_data)) if json_data else None
             except Exception:
-                pass  # Invalid JSON, let Flask handle it
-        
-        # Request passed all checks
-        return True, None, None
-    
+                json_str = None  # Invalid JSON, let Flask handle it
+            if json_str:
+                yield 'JSON payload', None, json_str, self.BODY_CHECKS
+
     def log_attack(self, client_ip: str, attack_type: str, details: str):
         """Log attack attempt"""
         if self.log_violations:
@@ -462,6 +543,13 @@ def waf_protected(f):
             except Exception:
                 pass
             
+            if attack_type == 'oversized':
+                return jsonify({
+                    'error': 'Request Too Large',
+                    'message': 'Your request is too large to be checked by security policies.',
+                    'code': 'WAF_TOO_LARGE'
+                }), 413
+
             # Return 403 Forbidden with minimal information
             return jsonify({
                 'error': 'Access Denied',
@@ -510,8 +598,8 @@ def init_waf(app):
             except Exception:
                 pass
             
-            # Return 403 Forbidden
-            abort(403)
+            # Too large to scan: 413; otherwise 403 Forbidden
+            abort(413 if attack_type == 'oversized' else 403)
     
     # Cleanup task (run periodically)
     def cleanup_task():
@@ -533,6 +621,19 @@ def init_waf(app):
     # Start cleanup task
     cleanup_task()
     
+    try:
+        max_scan = app.config.get('WAF_MAX_SCAN_BYTES')
+        if max_scan is not None:
+            waf.max_scan_bytes = int(max_scan)
+    except Exception:
+        pass
+    try:
+        exempt = app.config.get('WAF_SCAN_EXEMPT_PATHS')
+        if exempt:
+            waf.scan_exempt_paths = tuple(str(p).strip() for p in exempt if str(p).strip())
+    except Exception:
+        pass
+
     app.logger.info("Custom WAF initialized and active")
 
 
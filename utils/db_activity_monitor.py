@@ -11,14 +11,31 @@ Safety/privacy:
 - Never logs bound parameters/values
 - Truncates statements and provides a hash for correlation
 - Best-effort only; must never break runtime
+
+Modes (DB_ACTIVITY_MODE):
+- "aggregate" (default): each statement only updates in-memory counters keyed by
+  the SQL text (count, rows, errors, latency histogram -> p50/p95/p99). Every
+  DB_ACTIVITY_SUMMARY_SECONDS the busiest statements are emitted to SIEM as
+  summaries. Individual events are still emitted for slow statements
+  (>= DB_ACTIVITY_SLOW_MS), DDL and a DB_ACTIVITY_SAMPLE_RATE fraction of
+  the rest; `_compact_sql`/hashing only run for those and once per summary row.
+  Write statements are never sampled for the Comprehensive Audit: each one
+  still gets its audit entry, unless DB_ACTIVITY_AUDIT_WRITES is False.
+- "per_statement": the original behaviour, one SIEM event (and one audit entry
+  for writes) per statement.
 """
 
 from __future__ import annotations
 
+import atexit
+import bisect
 import hashlib
+import random
 import re
+import threading
 import time
-from typing import Any, Optional
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
 
 
 _WS_RE = re.compile(r"\s+")
@@ -46,6 +63,108 @@ def _stmt_hash(stmt: str) -> str:
     return hashlib.sha256((stmt or "").encode("utf-8", errors="ignore")).hexdigest()
 
 
+_WRITE_OPS = ("INSERT", "UPDATE", "DELETE", "ALTER", "DROP", "CREATE", "TRUNCATE")
+_DDL_OPS = ("CREATE", "ALTER", "DROP", "TRUNCATE")
+
+# Latency histogram bucket upper bounds (ms); the last bucket is open-ended.
+_LATENCY_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _StatementStats:
+    __slots__ = ("op", "count", "rows", "total_ms", "max_ms", "buckets")
+
+    def __init__(self, op: str):
+        self.op = op
+        self.count = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(_LATENCY_BOUNDS_MS) + 1)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (capped at the max seen)."""
+        target = max(1, int(q * self.count + 0.999999))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                if i < len(_LATENCY_BOUNDS_MS):
+                    return min(float(_LATENCY_BOUNDS_MS[i]), self.max_ms)
+                break
+        return self.max_ms
+
+
+class DBActivityAggregator:
+    """Per-statement counters for the current summary window (thread-safe)."""
+
+    OTHER_KEY = "<other statements>"
+
+    def __init__(self, window_seconds: float = 60.0, max_statements: int = 2000):
+        self.window_seconds = max(1.0, float(window_seconds))
+        self.max_statements = max(1, int(max_statements))
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _StatementStats] = {}
+        self._window_start = time.time()
+        self._next_flush = time.monotonic() + self.window_seconds
+
+    def record(self, statement: str, duration_ms: Optional[float], rowcount: Any) -> _StatementStats:
+        with self._lock:
+            entry = self._stats.get(statement)
+            if entry is None:
+                if len(self._stats) >= self.max_statements:
+                    statement = self.OTHER_KEY
+                    entry = self._stats.get(statement)
+                if entry is None:
+                    entry = self._stats[statement] = _StatementStats(
+                        "OTHER" if statement is self.OTHER_KEY else _sql_op(statement)
+                    )
+            entry.count += 1
+            if isinstance(rowcount, int) and rowcount > 0:
+                entry.rows += rowcount
+            if duration_ms is not None:
+                entry.total_ms += duration_ms
+                if duration_ms > entry.max_ms:
+                    entry.max_ms = duration_ms
+                entry.buckets[bisect.bisect_left(_LATENCY_BOUNDS_MS, duration_ms)] += 1
+            return entry
+
+    def due(self) -> bool:
+        return time.monotonic() >= self._next_flush
+
+    def drain(self, force: bool = False) -> Optional[tuple]:
+        """(window_start, window_end, {statement: stats}) and start a new window.
+
+        Returns None when the window is not over yet (unless `force`).
+        """
+        with self._lock:
+            if not force and time.monotonic() < self._next_flush:
+                return None
+            stats, self._stats = self._stats, {}
+            start, self._window_start = self._window_start, time.time()
+            self._next_flush = time.monotonic() + self.window_seconds
+        return start, self._window_start, stats
+
+
+def _summary_rows(stats: Dict[str, _StatementStats], top: int) -> List[Dict[str, Any]]:
+    ranked = sorted(stats.items(), key=lambda kv: kv[1].total_ms, reverse=True)[: max(0, int(top))]
+    rows = []
+    for statement, st in ranked:
+        rows.append({
+            "op": st.op,
+            "statement": _compact_sql(statement),
+            "statement_hash": _stmt_hash(statement),
+            "count": st.count,
+            "rows": st.rows,
+            "total_ms": round(st.total_ms, 2),
+            "avg_ms": round(st.total_ms / st.count, 3) if st.count else None,
+            "p50_ms": round(st.percentile(0.50), 3),
+            "p95_ms": round(st.percentile(0.95), 3),
+            "p99_ms": round(st.percentile(0.99), 3),
+            "max_ms": round(st.max_ms, 3),
+        })
+    return rows
+
+
 def init_db_activity_monitor(app: Any, engine: Any) -> None:
     """Attach SQLAlchemy engine listeners.
 
@@ -66,6 +185,126 @@ def init_db_activity_monitor(app: Any, engine: Any) -> None:
 
         from sqlalchemy import event
 
+        aggregate = str(app.config.get("DB_ACTIVITY_MODE", "aggregate") or "").strip().lower() != "per_statement"
+        slow_ms = float(app.config.get("DB_ACTIVITY_SLOW_MS", 500))
+        sample_rate = float(app.config.get("DB_ACTIVITY_SAMPLE_RATE", 0.01))
+        summary_top = int(app.config.get("DB_ACTIVITY_SUMMARY_TOP", 50))
+        aggregator: Optional[DBActivityAggregator] = None
+        if aggregate:
+            aggregator = DBActivityAggregator(
+                window_seconds=float(app.config.get("DB_ACTIVITY_SUMMARY_SECONDS", 60)),
+                max_statements=int(app.config.get("DB_ACTIVITY_MAX_STATEMENTS", 2000)),
+            )
+        setattr(engine, "_db_activity_aggregator", aggregator)
+
+        audit_writes = app.config.get("DB_ACTIVITY_AUDIT_WRITES") is not False
+
+        def _emit_statement(statement, op, duration_ms, executemany, rowcount, reason=None, siem=True):
+            duration_int = int(duration_ms) if duration_ms is not None else None
+            compact = _compact_sql(statement)
+            h = _stmt_hash(statement)
+
+            # Emit to SIEM if enabled/initialized.
+            try:
+                from utils.siem import get_siem, SIEMEventType, SIEMSeverity
+
+                client = get_siem() if siem else None
+                if client is not None and app.config.get("SIEM_ENABLED") is not False:
+                    sev = SIEMSeverity.INFO
+                    if op in _WRITE_OPS or reason == "slow":
+                        sev = SIEMSeverity.WARNING
+
+                    meta = {
+                        "op": op,
+                        "duration_ms": duration_int,
+                        "statement": compact,
+                        "statement_hash": h,
+                        "executemany": bool(executemany),
+                        "rowcount": rowcount,
+                    }
+                    if reason:
+                        meta["reason"] = reason
+                    client.emit_simple(
+                        event_type=SIEMEventType.DB_ACTIVITY,
+                        severity=sev,
+                        source="db.activity",
+                        message=f"DB {op} ({duration_int}ms)" if duration_int is not None else f"DB {op}",
+                        ip=None,
+                        endpoint=None,
+                        meta=meta,
+                        tags=["db", "slow"] if reason == "slow" else ["db"],
+                    )
+            except Exception:
+                pass
+
+            # Comprehensive audit: only log write-ish operations to avoid noise.
+            try:
+                if op in _WRITE_OPS and audit_writes:
+                    from utils.comprehensive_audit import comprehensive_audit, AuditEventType, AuditSeverity
+
+                    if app.config.get("COMPREHENSIVE_AUDIT_ENABLED") is not False:
+                        comprehensive_audit.log_event(
+                            event_type=AuditEventType.SECURITY_ALERT,
+                            user_id=None,
+                            action="db_activity",
+                            severity=AuditSeverity.MEDIUM,
+                            metadata={
+                                "op": op,
+                                "duration_ms": duration_int,
+                                "statement": compact,
+                                "statement_hash": h,
+                            },
+                        )
+            except Exception:
+                pass
+
+        def _emit_summary(force: bool = False) -> None:
+            drained = aggregator.drain(force=force) if aggregator is not None else None
+            if not drained or not drained[2]:
+                return
+            window_start, window_end, stats = drained
+            try:
+                from utils.siem import get_siem, SIEMEventType, SIEMSeverity
+
+                client = get_siem()
+                if client is None or app.config.get("SIEM_ENABLED") is False:
+                    return
+                window = {
+                    "window_start": datetime.fromtimestamp(window_start, timezone.utc).isoformat(),
+                    "window_seconds": round(window_end - window_start, 1),
+                }
+                rows = _summary_rows(stats, summary_top)
+                for row in rows:
+                    client.emit_simple(
+                        event_type=SIEMEventType.DB_ACTIVITY,
+                        severity=SIEMSeverity.INFO,
+                        source="db.activity.summary",
+                        message=f"DB {row['op']} x{row['count']} (p95 {row['p95_ms']}ms)",
+                        meta={**row, **window},
+                        tags=["db", "summary"],
+                    )
+                client.emit_simple(
+                    event_type=SIEMEventType.DB_ACTIVITY,
+                    severity=SIEMSeverity.INFO,
+                    source="db.activity.summary",
+                    message=f"DB activity: {sum(st.count for st in stats.values())} statements, {len(stats)} distinct",
+                    meta={
+                        "statements": sum(st.count for st in stats.values()),
+                        "distinct_statements": len(stats),
+                        "rows": sum(st.rows for st in stats.values()),
+                        "total_ms": round(sum(st.total_ms for st in stats.values()), 2),
+                        "reported_statements": len(rows),
+                        **window,
+                    },
+                    tags=["db", "summary"],
+                )
+            except Exception:
+                pass
+
+        if aggregator is not None:
+            setattr(engine, "_db_activity_flush", lambda: _emit_summary(force=True))
+            atexit.register(_emit_summary, True)
+
         @event.listens_for(engine, "before_cursor_execute")
         def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # type: ignore[no-redef]
             try:
@@ -75,7 +314,7 @@ def init_db_activity_monitor(app: Any, engine: Any) -> None:
                 except Exception:
                     pass
                 # context is a SQLAlchemy ExecutionContext; attach timing only.
-                setattr(context, "_dbam_start", time.time())
+                setattr(context, "_dbam_start", time.perf_counter())
             except Exception:
                 return
 
@@ -88,64 +327,31 @@ def init_db_activity_monitor(app: Any, engine: Any) -> None:
                 except Exception:
                     pass
                 start = getattr(context, "_dbam_start", None)
-                duration_ms: Optional[int] = None
+                duration_ms: Optional[float] = None
                 if isinstance(start, (int, float)):
-                    duration_ms = int((time.time() - float(start)) * 1000)
-
-                op = _sql_op(statement)
-                compact = _compact_sql(statement)
-                h = _stmt_hash(statement)
-
-                # Emit to SIEM if enabled/initialized.
-                try:
-                    from utils.siem import get_siem, SIEMEventType, SIEMSeverity
-
-                    client = get_siem()
-                    if client is not None and app.config.get("SIEM_ENABLED") is not False:
-                        sev = SIEMSeverity.INFO
-                        if op in ("INSERT", "UPDATE", "DELETE", "ALTER", "DROP", "CREATE", "TRUNCATE"):
-                            sev = SIEMSeverity.WARNING
-
-                        client.emit_simple(
-                            event_type=SIEMEventType.DB_ACTIVITY,
-                            severity=sev,
-                            source="db.activity",
-                            message=f"DB {op} ({duration_ms}ms)" if duration_ms is not None else f"DB {op}",
-                            ip=None,
-                            endpoint=None,
-                            meta={
-                                "op": op,
-                                "duration_ms": duration_ms,
-                                "statement": compact,
-                                "statement_hash": h,
-                                "executemany": bool(executemany),
-                                "rowcount": getattr(cursor, "rowcount", None),
-                            },
-                            tags=["db"],
-                        )
-                except Exception:
-                    pass
-
-                # Comprehensive audit: only log write-ish operations to avoid noise.
-                try:
-                    if op in ("INSERT", "UPDATE", "DELETE", "ALTER", "DROP", "CREATE", "TRUNCATE"):
-                        from utils.comprehensive_audit import comprehensive_audit, AuditEventType, AuditSeverity
-
-                        if app.config.get("COMPREHENSIVE_AUDIT_ENABLED") is not False:
-                            comprehensive_audit.log_event(
-                                event_type=AuditEventType.SECURITY_ALERT,
-                                user_id=None,
-                                action="db_activity",
-                                severity=AuditSeverity.MEDIUM,
-                                metadata={
-                                    "op": op,
-                                    "duration_ms": duration_ms,
-                                    "statement": compact,
-                                    "statement_hash": h,
-                                },
-                            )
-                except Exception:
-                    pass
+                    duration_ms = (time.perf_counter() - float(start)) * 1000.0
+                rowcount = getattr(cursor, "rowcount", None)
+
+                if aggregator is None:
+                    _emit_statement(statement, _sql_op(statement), duration_ms, executemany, rowcount)
+                    return
+
+                entry = aggregator.record(statement, duration_ms, rowcount)
+                op = entry.op if entry.op != "OTHER" else _sql_op(statement)
+                reason = None
+                if op in _DDL_OPS:
+                    reason = "ddl"
+                elif duration_ms is not None and duration_ms >= slow_ms:
+                    reason = "slow"
+                elif sample_rate > 0 and random.random() < sample_rate:
+                    reason = "sample"
+                if reason is not None:
+                    _emit_statement(statement, op, duration_ms, executemany, rowcount, reason)
+                elif op in _WRITE_OPS and audit_writes:
+                    # Audit entries for writes are not sampled; only the SIEM event is.
+                    _emit_statement(statement, op, duration_ms, executemany, rowcount, siem=False)
+                if aggregator.due():
+                    _emit_summary()
 
             except Exception:
                 return
@@ -0,0 +1,125 @@
+"""utils/decrypt_cache.py
+
+In-memory cache of decrypted field values, keyed by ciphertext.
+
+Why:
+- List pages render the same encrypted patient fields several times per row
+  (`get_decrypted_name`, `decrypted_phone`, ...), and every call ran a full
+  Fernet HMAC verify + AES decrypt.
+- A Fernet token is immutable, so the plaintext for a given ciphertext never
+  changes while the key set stays the same; caching by ciphertext needs no
+  invalidation on row updates (new values get new tokens).
+
+Layers:
+- Per-request memo on `flask.g`: lock-free, dropped with the request.
+- Process-local LRU shared by threads, bounded by DECRYPT_CACHE_MAX_ENTRIES.
+
+Security notes:
+- Plaintext only lives in process memory; nothing is written to disk.
+- Only successful decryptions are cached; error placeholders are not.
+- `clear()` must be called when keys change (Config.init_fernet does this), and
+  bumps a generation so decryptions started before the clear are not stored.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from flask import g, has_app_context
+
+
+_REQUEST_MEMO_ATTR = "_decrypt_cache_memo"
+
+
+class DecryptCache:
+    """Thread-safe, size-bounded LRU of ciphertext -> plaintext with a per-request memo."""
+
+    def __init__(self, max_entries: int = 4096, request_memo_entries: int = 2048):
+        self.max_entries = max(0, int(max_entries))
+        self.request_memo_entries = max(0, int(request_memo_entries))
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.request_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _request_memo(self) -> Optional[dict]:
+        if not self.request_memo_entries or not has_app_context():
+            return None
+        memo = g.get(_REQUEST_MEMO_ATTR)
+        if memo is None:
+            memo = {}
+            setattr(g, _REQUEST_MEMO_ATTR, memo)
+        return memo
+
+    def get_or_decrypt(self, ciphertext: str, decrypt: Callable[[str], str]) -> str:
+        """Return the cached plaintext for `ciphertext`, calling `decrypt` on a miss.
+
+        Results starting with "[Decryption Error" are returned but never cached.
+        """
+        memo = self._request_memo()
+        if memo is not None:
+            value = memo.get(ciphertext)
+            if value is not None:
+                self.request_hits += 1
+                return value
+
+        if self.max_entries:
+            with self._lock:
+                value = self._data.get(ciphertext)
+                if value is not None:
+                    self._data.move_to_end(ciphertext)
+                    self.hits += 1
+                generation = self._generation
+            if value is not None:
+                self._remember(memo, ciphertext, value)
+                return value
+        else:
+            generation = self._generation
+
+        self.misses += 1
+        value = decrypt(ciphertext)
+        if not isinstance(value, str) or value.startswith("[Decryption Error"):
+            return value
+
+        if self.max_entries:
+            with self._lock:
+                if generation == self._generation:
+                    self._data[ciphertext] = value
+                    self._data.move_to_end(ciphertext)
+                    while len(self._data) > self.max_entries:
+                        self._data.popitem(last=False)
+                        self.evictions += 1
+        if generation == self._generation:
+            self._remember(memo, ciphertext, value)
+        return value
+
+    def _remember(self, memo: Optional[dict], ciphertext: str, value: str) -> None:
+        if memo is not None and len(memo) < self.request_memo_entries:
+            memo[ciphertext] = value
+
+    def clear(self) -> None:
+        """Drop every cached plaintext (call on key rotation)."""
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+        if has_app_context():
+            g.pop(_REQUEST_MEMO_ATTR, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._data)
+        lookups = self.hits + self.request_hits + self.misses
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "request_hits": self.request_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.request_hits) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,262 @@
+"""utils/dosage_index.py
+
+Process-wide, indexed copy of the dosage index book (`dosage_index.json`).
+
+Why:
+- `_load_dosage_index_book()` re-read and re-parsed the JSON on every call and
+  `_lookup_index_dosage_by_name()` then scanned the entries linearly, so a
+  catalogue pass cost one file parse per drug.
+- The book is now parsed once and re-parsed only when a candidate file's
+  mtime/size changes (checked at most every `check_interval` seconds).
+
+Lookups, in order:
+- exact:       case-insensitive name (or alias) match, same as before.
+- normalized:  strengths, dosage forms, salts and punctuation stripped, so
+               "Amoxicillin 500mg Caps" finds "Amoxicillin" and
+               "Metformin HCl" finds "Metformin hydrochloride".
+- fuzzy:       trigram similarity on the normalized key (spelling variants),
+               rejected below `min_score` or when two entries tie.
+
+Only exact matches are safe to apply unattended; normalized and fuzzy matches
+are suggestions (Prednisone scores 0.71 against Prednisolone) for an admin to
+confirm.
+
+Entries may list brand/generic names under `aliases`, `brand_names`,
+`synonyms` or `generic_name`; those are indexed like the main name.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+
+FUZZY_MIN_SCORE = 0.6
+ALIAS_KEYS = ('aliases', 'brand_names', 'synonyms', 'generic_name')
+
+_STRENGTH_RE = re.compile(
+    r"\b\d+(?:\.\d+)?\s*(?:mg|mcg|ug|µg|g|kg|ml|l|iu|units?|mmol|meq|%)"
+    r"(?:\s*/\s*\d*(?:\.\d+)?\s*(?:mg|mcg|g|ml|l|dose|tab|cap))?\b",
+    re.IGNORECASE,
+)
+_NON_WORD_RE = re.compile(r"[^a-z0-9]+")
+_STOP_WORDS = frozenset({
+    # dosage forms / packaging
+    'tab', 'tabs', 'tablet', 'tablets', 'cap', 'caps', 'capsule', 'capsules',
+    'syrup', 'susp', 'suspension', 'inj', 'injection', 'infusion', 'amp', 'ampoule',
+    'vial', 'cream', 'ointment', 'oint', 'gel', 'drops', 'drop', 'eye', 'ear',
+    'nasal', 'spray', 'inhaler', 'supp', 'suppository', 'pessary', 'sachet',
+    'powder', 'solution', 'soln', 'elixir', 'lotion', 'oral', 'iv', 'im', 'sc',
+    'er', 'sr', 'xr', 'mr', 'cr', 'dt', 'ec', 'pack', 'bottle',
+    # salts / esters. Cations, chloride and combination words ('plus', 'forte',
+    # 'base') are NOT stripped: they tell different drugs apart (potassium vs
+    # sodium bicarbonate, "Losartan Plus" vs losartan).
+    'hcl', 'hydrochloride', 'hydrobromide', 'sulfate', 'sulphate', 'phosphate',
+    'maleate', 'citrate', 'acetate', 'tartrate', 'succinate', 'fumarate',
+    'mesylate', 'besylate', 'bromide', 'nitrate', 'trihydrate', 'monohydrate',
+    'dihydrate', 'anhydrous',
+})
+
+
+def exact_key(name) -> str:
+    return (name or '').strip().lower() if isinstance(name, str) else ''
+
+
+def normalize_key(name) -> str:
+    """Name with strengths, dosage forms, salts and punctuation removed."""
+    s = exact_key(name)
+    if not s:
+        return ''
+    s = _STRENGTH_RE.sub(' ', s)
+    words = [w for w in _NON_WORD_RE.sub(' ', s).split() if w not in _STOP_WORDS and not w.isdigit()]
+    return ' '.join(words) or _NON_WORD_RE.sub(' ', exact_key(name)).strip()
+
+
+def trigrams(key: str) -> set[str]:
+    """pg_trgm-style trigrams: each word padded with two leading and one trailing space."""
+    out: set[str] = set()
+    for word in key.split():
+        padded = f'  {word} '
+        out.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return out
+
+
+def _entry_names(entry: dict) -> list[str]:
+    names = [entry.get('name')]
+    for k in ALIAS_KEYS:
+        v = entry.get(k)
+        if isinstance(v, str):
+            names.append(v)
+        elif isinstance(v, (list, tuple)):
+            names.extend(x for x in v if isinstance(x, str))
+    return [n for n in names if isinstance(n, str) and n.strip()]
+
+
+class _Index:
+    def __init__(self, entries: list):
+        self.entries = entries
+        self.exact: dict[str, dict] = {}
+        self.normalized: dict[str, dict] = {}
+        self.keys: list[tuple[str, set[str], dict]] = []
+        self.postings: dict[str, list[int]] = {}
+        seen_norm: set[str] = set()
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            for name in _entry_names(entry):
+                # First entry wins, matching the old linear scan.
+                self.exact.setdefault(exact_key(name), entry)
+                norm = normalize_key(name)
+                if not norm:
+                    continue
+                self.normalized.setdefault(norm, entry)
+                if norm in seen_norm:
+                    continue
+                seen_norm.add(norm)
+                grams = trigrams(norm)
+                idx = len(self.keys)
+                self.keys.append((norm, grams, entry))
+                for g in grams:
+                    self.postings.setdefault(g, []).append(idx)
+
+    def fuzzy(self, norm: str, min_score: float) -> Optional[tuple[dict, float]]:
+        grams = trigrams(norm)
+        if not grams:
+            return None
+        overlap: dict[int, int] = {}
+        for g in grams:
+            for idx in self.postings.get(g, ()):
+                overlap[idx] = overlap.get(idx, 0) + 1
+        best: Optional[tuple[dict, float]] = None
+        tied = False
+        for idx, shared in overlap.items():
+            _, other, entry = self.keys[idx]
+            score = shared / (len(grams) + len(other) - shared)
+            if best is None or score > best[1]:
+                best, tied = (entry, score), False
+            elif score == best[1] and entry is not best[0]:
+                tied = True
+        if best is None or best[1] < min_score or tied:
+            return None
+        return best
+
+
+class DosageIndexBook:
+    """Cached, indexed dosage index book loaded from the first usable candidate path."""
+
+    def __init__(self, paths: Iterable[str], *, check_interval: float = 1.0,
+                 on_error: Optional[Callable[[str, Exception], None]] = None,
+                 memo_entries: int = 4096):
+        self.paths = list(paths)
+        self.check_interval = float(check_interval)
+        self.on_error = on_error
+        self.memo_entries = int(memo_entries)
+        self.reloads = 0
+        self.source_path: Optional[str] = None
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = 0.0
+        self._index = _Index([])
+        self._memo: dict = {}
+
+    def _file_signature(self):
+        sig = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                sig.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                continue
+        return tuple(sig)
+
+    def _parse(self) -> list:
+        self.source_path = None
+        for path in self.paths:
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f) or {}
+                    entries = data.get('entries')
+                    if isinstance(entries, list):
+                        self.source_path = path
+                        return entries
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(path, e)
+        return []
+
+    def _current(self) -> _Index:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval and self._signature is not None:
+            return self._index
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at < self.check_interval and self._signature is not None:
+                return self._index
+            sig = self._file_signature()
+            if sig != self._signature:
+                self._index = _Index(self._parse())
+                self._memo = {}
+                self._signature = sig
+                self.reloads += 1
+            self._checked_at = now
+            return self._index
+
+    def reload(self) -> None:
+        """Force a re-read on the next access."""
+        with self._lock:
+            self._signature = None
+            self._checked_at = 0.0
+
+    def entries(self) -> list:
+        return self._current().entries
+
+    def lookup(self, name, *, fuzzy: bool = True, min_score: float = FUZZY_MIN_SCORE) -> Optional[dict]:
+        """Best entry for `name`: {'entry', 'match': exact|normalized|fuzzy, 'score'} or None."""
+        index = self._current()
+        memo_key = (name, fuzzy, min_score)
+        memo = self._memo
+        if memo_key in memo:
+            return memo[memo_key]
+
+        result = None
+        key = exact_key(name)
+        if key:
+            entry = index.exact.get(key)
+            if entry is not None:
+                result = {'entry': entry, 'match': 'exact', 'score': 1.0}
+            else:
+                norm = normalize_key(name)
+                entry = index.normalized.get(norm) if norm else None
+                if entry is not None:
+                    result = {'entry': entry, 'match': 'normalized', 'score': 1.0}
+                elif fuzzy and norm:
+                    found = index.fuzzy(norm, min_score)
+                    if found:
+                        result = {'entry': found[0], 'match': 'fuzzy', 'score': round(found[1], 3)}
+
+        if len(memo) < self.memo_entries:
+            memo[memo_key] = result
+        return result
+
+    def lookup_many(self, names: Iterable, *, fuzzy: bool = True, min_score: float = FUZZY_MIN_SCORE) -> dict:
+        """{name: lookup(name)} for a whole catalogue pass (one reload check, duplicates looked up once)."""
+        self._current()
+        out: dict = {}
+        for name in names:
+            if name not in out:
+                out[name] = self.lookup(name, fuzzy=fuzzy, min_score=min_score)
+        return out
+
+    def stats(self) -> dict:
+        index = self._index
+        return {
+            'entries': len(index.entries),
+            'names': len(index.exact),
+            'reloads': self.reloads,
+            'source': self.source_path,
+        }
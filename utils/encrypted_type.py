@@ -1,7 +1,65 @@
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.types import TypeDecorator, LargeBinary, Text
 from .encryption import EncryptionUtils
-from flask import current_app
+from flask import current_app, has_app_context
+
+# Batches with fewer distinct tokens than this are decrypted inline; thread start-up
+# and hand-off cost more than they save on small result sets.
+BATCH_DECRYPT_MIN_PARALLEL = 256
+BATCH_DECRYPT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+_batch_pool = None
+
+
+def _get_batch_pool():
+    global _batch_pool
+    if _batch_pool is None:
+        _batch_pool = ThreadPoolExecutor(max_workers=BATCH_DECRYPT_WORKERS, thread_name_prefix='batch-decrypt')
+    return _batch_pool
+
+
+def _as_text(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode('utf-8', errors='ignore')
+    return str(value)
+
+
+def decrypt_batch(values, decrypt=None, *, min_parallel=None):
+    """Decrypt a column of values at once; returns a list aligned with `values`.
+
+    - None stays None and values not starting with 'gAAAA' are returned as text
+      without touching the cipher.
+    - Each distinct token is decrypted once.
+    - Large batches are split across a small thread pool (Fernet's HMAC/AES run
+      in native code); workers run inside the caller's app context so
+      `decrypt` can log.
+    """
+    decrypt = decrypt or EncryptionUtils.decrypt_data
+    threshold = BATCH_DECRYPT_MIN_PARALLEL if min_parallel is None else min_parallel
+    texts = [None if v is None else _as_text(v) for v in values]
+    tokens = list({t for t in texts if t is not None and t.startswith('gAAAA')})
+    if not tokens:
+        return texts
+
+    if len(tokens) < max(1, threshold) or BATCH_DECRYPT_WORKERS < 2:
+        plain = {t: decrypt(t) for t in tokens}
+    else:
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def run(chunk):
+            if app is None:
+                return [(t, decrypt(t)) for t in chunk]
+            with app.app_context():
+                return [(t, decrypt(t)) for t in chunk]
+
+        size = -(-len(tokens) // BATCH_DECRYPT_WORKERS)
+        chunks = [tokens[i:i + size] for i in range(0, len(tokens), size)]
+        plain = {}
+        for pairs in _get_batch_pool().map(run, chunks):
+            plain.update(pairs)
+
+    return [plain.get(t, t) if t is not None else None for t in texts]
 
 class EncryptedType(TypeDecorator):
     """
@@ -77,36 +135,10 @@ class EncryptedType(TypeDecorator):
             return None
 
         try:
-            # Normalize to string for downstream logic
-            if isinstance(value, (bytes, bytearray, memoryview)):
-                raw = bytes(value).decode('utf-8', errors='ignore')
-            else:
-                raw = str(value)
-
-            if getattr(dialect, 'name', None) == 'sqlite':
-                decrypted_value = EncryptionUtils.decrypt_data(raw)
-                try:
-                    return json.loads(decrypted_value)
-                except (json.JSONDecodeError, TypeError):
-                    return decrypted_value
-
-            # Non-sqlite DBs may store plaintext (existing schemas) OR encrypted tokens.
-            looks_like_fernet = raw.startswith('gAAAA')
-            if looks_like_fernet:
-                dec = EncryptionUtils.decrypt_data(raw)
-                # If decryption failed, keep the raw value rather than replacing with an error string.
-                if isinstance(dec, str) and dec.startswith('[Decryption Error'):
-                    return raw
-                try:
-                    return json.loads(dec)
-                except (json.JSONDecodeError, TypeError):
-                    return dec
-
-            # Plaintext path
-            try:
-                return json.loads(raw)
-            except (json.JSONDecodeError, TypeError):
-                return raw
+            raw = _as_text(value)
+            # Only Fernet tokens go through the cipher; legacy plaintext is passed through.
+            dec = EncryptionUtils.decrypt_data(raw) if raw.startswith('gAAAA') else raw
+            return self._finish_result(raw, dec, dialect)
         except Exception as e:
             try:
                 current_app.logger.error(f"Decryption failed for value: {str(e)}")
@@ -114,6 +146,16 @@ class EncryptedType(TypeDecorator):
                 pass
             return value
 
+    @staticmethod
+    def _finish_result(raw, dec, dialect):
+        # If decryption failed on non-sqlite, keep the raw value rather than an error string.
+        if getattr(dialect, 'name', None) != 'sqlite' and isinstance(dec, str) and dec.startswith('[Decryption Error'):
+            return raw
+        try:
+            return json.loads(dec)
+        except (json.JSONDecodeError, TypeError):
+            return dec
+
     @property
     def python_type(self):
         # This hints to SQLAlchemy about the type of data to expect
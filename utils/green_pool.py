@@ -0,0 +1,208 @@
+"""utils/green_pool.py
+
+Connection pool that is safe under eventlet green threads.
+
+Why:
+- Under `eventlet.monkey_patch()` on Python 3.12, SQLAlchemy's QueuePool can fail
+  with "cannot notify on un-acquired lock" (its queue is built on
+  threading.Condition). app.py worked around that with NullPool, which opens a
+  new TCP + TLS connection to Postgres for every session checkout.
+- GreenQueuePool keeps up to `pool_size` idle connections in a deque and bounds
+  concurrent checkouts (pool_size + max_overflow) with a single semaphore:
+  eventlet's green Semaphore when eventlet has patched threading, otherwise
+  threading.BoundedSemaphore. No Condition objects are involved.
+
+pre_ping / recycle / reset-on-return are inherited from sqlalchemy.pool.Pool,
+so `pool_pre_ping` and `pool_recycle` engine options work unchanged.
+
+Every checkout records how long it waited for a slot; `stats()` returns the
+counters (and recent-wait percentiles) for logging or the benchmark script.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Any
+
+from sqlalchemy import exc
+from sqlalchemy.pool import Pool
+
+
+_RECENT_WAITS = 1024
+
+
+def _eventlet_patched() -> bool:
+    try:
+        from eventlet import patcher
+        return bool(patcher.is_monkey_patched('thread'))
+    except Exception:
+        return False
+
+
+def _make_semaphore(value: int):
+    if _eventlet_patched():
+        from eventlet.semaphore import BoundedSemaphore
+        return BoundedSemaphore(value)
+    return threading.BoundedSemaphore(value)
+
+
+class PoolWaitStats:
+    """Checkout wait counters; updates are plain attribute writes (no locks needed)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.checkouts = 0
+        self.waited = 0          # checkouts that could not get a slot immediately
+        self.timeouts = 0
+        self.connects = 0        # new DB-API connections opened
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent: deque = deque(maxlen=_RECENT_WAITS)
+
+    def record(self, wait: float) -> None:
+        self.checkouts += 1
+        self.total_wait += wait
+        if wait > 0.001:
+            self.waited += 1
+        if wait > self.max_wait:
+            self.max_wait = wait
+        self._recent.append(wait)
+
+    def as_dict(self) -> dict:
+        recent = sorted(self._recent)
+
+        def pct(p: float) -> float:
+            if not recent:
+                return 0.0
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))] * 1000, 3)
+
+        return {
+            'checkouts': self.checkouts,
+            'waited': self.waited,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'avg_wait_ms': round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'p50_wait_ms': pct(0.50),
+            'p95_wait_ms': pct(0.95),
+        }
+
+
+class GreenQueuePool(Pool):
+    """Size-limited pool (pool_size idle + max_overflow extra) without threading.Condition."""
+
+    def __init__(
+        self,
+        creator,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        timeout: float = 30.0,
+        use_lifo: bool = True,
+        **kw: Any,
+    ):
+        Pool.__init__(self, creator, **kw)
+        self._size = max(1, int(pool_size))
+        self._max_overflow = max(0, int(max_overflow))
+        self._timeout = float(timeout)
+        self._use_lifo = bool(use_lifo)
+        self._idle: deque = deque()
+        self._slots = _make_semaphore(self._size + self._max_overflow)
+        self._checked_out = 0
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            if not self._slots.acquire(timeout=self._timeout):
+                self.wait_stats.timeouts += 1
+                raise exc.TimeoutError(
+                    "GreenQueuePool limit of size %d overflow %d reached, "
+                    "connection timed out, timeout %0.2f"
+                    % (self._size, self._max_overflow, self._timeout),
+                    code="3o7r",
+                )
+        self.wait_stats.record(time.perf_counter() - started)
+        self._checked_out += 1
+        try:
+            try:
+                return self._idle.pop() if self._use_lifo else self._idle.popleft()
+            except IndexError:
+                pass
+            self.wait_stats.connects += 1
+            return self._create_connection()
+        except BaseException:
+            self._checked_out -= 1
+            self._slots.release()
+            raise
+
+    def _do_return_conn(self, record) -> None:
+        try:
+            if len(self._idle) < self._size:
+                self._idle.append(record)
+            else:
+                record.close()
+        finally:
+            self._checked_out -= 1
+            self._slots.release()
+
+    def recreate(self) -> "GreenQueuePool":
+        self.logger.info("Pool recreating")
+        return self.__class__(
+            self._creator,
+            pool_size=self._size,
+            max_overflow=self._max_overflow,
+            timeout=self._timeout,
+            use_lifo=self._use_lifo,
+            pre_ping=self._pre_ping,
+            recycle=self._recycle,
+            echo=self.echo,
+            logging_name=self._orig_logging_name,
+            reset_on_return=self._reset_on_return,
+            _dispatch=self.dispatch,
+            dialect=self._dialect,
+        )
+
+    def dispose(self) -> None:
+        while True:
+            try:
+                record = self._idle.pop()
+            except IndexError:
+                break
+            record.close()
+        self.logger.info("Pool disposed. %s", self.status())
+
+    def status(self) -> str:
+        return (
+            "GreenQueuePool size: %d  Connections in pool: %d "
+            "Max overflow: %d Current Checked out connections: %d"
+            % (self._size, self.checkedin(), self._max_overflow, self.checkedout())
+        )
+
+    def size(self) -> int:
+        return self._size
+
+    def timeout(self) -> float:
+        return self._timeout
+
+    def checkedin(self) -> int:
+        return len(self._idle)
+
+    def checkedout(self) -> int:
+        return self._checked_out
+
+    def overflow(self) -> int:
+        return max(0, self._checked_out - self._size)
+
+    def stats(self) -> dict:
+        data = self.wait_stats.as_dict()
+        data.update({
+            'pool_size': self._size,
+            'max_overflow': self._max_overflow,
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+        })
+        return data
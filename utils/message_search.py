@@ -0,0 +1,203 @@
+"""utils/message_search.py
+
+Full-text search index for staff chat messages.
+
+Why:
+- Chat search used `Message.content ILIKE '%q%'`, a sequential scan that cannot
+  rank results, and E2E payloads (JSON ciphertext) could only produce junk hits.
+- This module keeps a side index of searchable (non-E2E, not deleted) messages:
+  - PostgreSQL: `message_search_index` table with a `tsvector` column + GIN index.
+  - SQLite: `message_search_fts` FTS5 virtual table (local/dev databases).
+  Other dialects (or SQLite builds without FTS5) report `backend is None` and
+  callers fall back to ILIKE.
+
+Queries are tokenised into words and matched as prefixes (all words required).
+Highlight snippets are built in Python from the stored plaintext so the HTML
+escaping is under our control.
+"""
+
+from __future__ import annotations
+
+import html
+import json
+import re
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+
+
+PG_TABLE = "message_search_index"
+SQLITE_TABLE = "message_search_fts"
+TS_CONFIG = "simple"  # language-neutral: staff chat mixes English and Swahili
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_MAX_QUERY_TERMS = 8
+_SNIPPET_CHARS = 160
+
+
+def is_e2e_payload(val) -> bool:
+    """True for client-side end-to-end encrypted message bodies (JSON with e2e=true)."""
+    if not isinstance(val, str):
+        return False
+    s = val.strip()
+    if not (s.startswith('{') and s.endswith('}')):
+        return False
+    try:
+        obj = json.loads(s)
+        return isinstance(obj, dict) and bool(obj.get('e2e')) is True
+    except Exception:
+        return False
+
+
+def is_searchable(content) -> bool:
+    return isinstance(content, str) and bool(content.strip()) and not is_e2e_payload(content)
+
+
+def query_terms(q: str) -> list[str]:
+    """Lower-cased word terms of a search string (deduplicated, capped)."""
+    out: list[str] = []
+    for w in _WORD_RE.findall((q or '').lower()):
+        if w not in out:
+            out.append(w)
+        if len(out) >= _MAX_QUERY_TERMS:
+            break
+    return out
+
+
+def highlight_snippet(content: str, terms: Iterable[str], width: int = _SNIPPET_CHARS) -> str:
+    """HTML-escaped excerpt around the first match with matched word prefixes in <mark>."""
+    content = content or ''
+    terms = [t for t in terms if t]
+    if not terms:
+        return html.escape(content[:width])
+    pattern = re.compile(r"\b(" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE | re.UNICODE)
+    first = pattern.search(content)
+    start = 0
+    if first and first.start() > width // 3:
+        start = first.start() - width // 3
+    end = min(len(content), start + width)
+    excerpt = content[start:end]
+
+    parts = []
+    pos = 0
+    for m in pattern.finditer(excerpt):
+        parts.append(html.escape(excerpt[pos:m.start()]))
+        parts.append('<mark>' + html.escape(m.group(0)) + '</mark>')
+        pos = m.end()
+    parts.append(html.escape(excerpt[pos:]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(content) else '')
+
+
+class MessageSearchIndex:
+    """Dialect-specific maintenance and querying of the message search index."""
+
+    def __init__(self):
+        self.backend: Optional[str] = None  # 'postgresql' | 'sqlite' | None
+
+    @property
+    def ready(self) -> bool:
+        return self.backend is not None
+
+    def ensure_schema(self, engine) -> bool:
+        """Create the index structures if missing; returns True when they were just created."""
+        dialect = engine.dialect.name
+        with engine.begin() as conn:
+            if dialect == 'postgresql':
+                existed = conn.execute(text("SELECT to_regclass(:t)"), {'t': PG_TABLE}).scalar() is not None
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {PG_TABLE} ("
+                    " message_id VARCHAR(36) PRIMARY KEY,"
+                    " conversation_id INTEGER,"
+                    " sender_id INTEGER NOT NULL,"
+                    " recipient_id INTEGER NOT NULL,"
+                    " created_at TIMESTAMP,"
+                    " content TEXT NOT NULL,"
+                    " document TSVECTOR NOT NULL)"
+                ))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{PG_TABLE}_document ON {PG_TABLE} USING GIN (document)"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{PG_TABLE}_sender ON {PG_TABLE} (sender_id)"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{PG_TABLE}_recipient ON {PG_TABLE} (recipient_id)"))
+            elif dialect == 'sqlite':
+                existed = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = :t"), {'t': SQLITE_TABLE}
+                ).first() is not None
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} USING fts5("
+                    " content, message_id UNINDEXED, conversation_id UNINDEXED,"
+                    " sender_id UNINDEXED, recipient_id UNINDEXED, created_at UNINDEXED,"
+                    " tokenize = 'unicode61 remove_diacritics 2')"
+                ))
+            else:
+                self.backend = None
+                return False
+        self.backend = dialect
+        return not existed
+
+    # ------------------------------------------------------------------ writes
+
+    def upsert(self, conn, rows: list[dict]) -> None:
+        """Index rows with keys message_id, conversation_id, sender_id, recipient_id, created_at, content."""
+        if not self.backend or not rows:
+            return
+        if self.backend == 'postgresql':
+            conn.execute(text(
+                f"INSERT INTO {PG_TABLE} (message_id, conversation_id, sender_id, recipient_id, created_at, content, document)"
+                f" VALUES (:message_id, :conversation_id, :sender_id, :recipient_id, :created_at, :content, to_tsvector('{TS_CONFIG}', :content))"
+                " ON CONFLICT (message_id) DO UPDATE SET content = EXCLUDED.content, document = EXCLUDED.document"
+            ), rows)
+        else:
+            self.remove(conn, [r['message_id'] for r in rows])
+            conn.execute(text(
+                f"INSERT INTO {SQLITE_TABLE} (content, message_id, conversation_id, sender_id, recipient_id, created_at)"
+                " VALUES (:content, :message_id, :conversation_id, :sender_id, :recipient_id, :created_at)"
+            ), rows)
+
+    def remove(self, conn, message_ids: list[str]) -> None:
+        if not self.backend or not message_ids:
+            return
+        table = PG_TABLE if self.backend == 'postgresql' else SQLITE_TABLE
+        for i in range(0, len(message_ids), 500):
+            chunk = list(message_ids[i:i + 500])
+            params = {f'm{j}': mid for j, mid in enumerate(chunk)}
+            placeholders = ', '.join(f':m{j}' for j in range(len(chunk)))
+            conn.execute(text(f"DELETE FROM {table} WHERE message_id IN ({placeholders})"), params)
+
+    def clear(self, conn) -> None:
+        if self.backend == 'postgresql':
+            conn.execute(text(f"TRUNCATE {PG_TABLE}"))
+        elif self.backend == 'sqlite':
+            conn.execute(text(f"DELETE FROM {SQLITE_TABLE}"))
+
+    # ------------------------------------------------------------------ reads
+
+    def search(self, conn, user_id: int, q: str, *, conversation_id: Optional[int] = None, limit: int = 50) -> list[dict]:
+        """Ranked matches visible to `user_id`: [{message_id, rank}], best first."""
+        terms = query_terms(q)
+        if not self.backend or not terms:
+            return []
+        params = {'uid': user_id, 'limit': int(limit)}
+        scope = "(sender_id = :uid OR recipient_id = :uid)"
+        if conversation_id is not None:
+            scope += " AND conversation_id = :cid"
+            params['cid'] = conversation_id
+
+        if self.backend == 'postgresql':
+            params['tsq'] = ' & '.join(f"{t}:*" for t in terms)
+            sql = (
+                f"SELECT message_id, ts_rank_cd(document, query) AS rank"
+                f" FROM {PG_TABLE}, to_tsquery('{TS_CONFIG}', :tsq) AS query"
+                f" WHERE document @@ query AND {scope}"
+                " ORDER BY rank DESC, created_at DESC LIMIT :limit"
+            )
+        else:
+            params['match'] = ' '.join('"' + t.replace('"', '""') + '"*' for t in terms)
+            # bm25() is lower-is-better; negate so both backends rank descending.
+            sql = (
+                f"SELECT message_id, -bm25({SQLITE_TABLE}) AS rank FROM {SQLITE_TABLE}"
+                f" WHERE {SQLITE_TABLE} MATCH :match AND {scope}"
+                f" ORDER BY bm25({SQLITE_TABLE}), created_at DESC LIMIT :limit"
+            )
+        return [{'message_id': r[0], 'rank': float(r[1] or 0.0)} for r in conn.execute(text(sql), params)]
+
+
+message_search_index = MessageSearchIndex()
@@ -0,0 +1,189 @@
+"""utils/pdf_cache.py
+
+Disk-backed, content-addressed cache for generated receipt PDFs.
+
+Why:
+- The receipt PDF endpoints rebuilt the ReportLab document (logo, rubber
+  stamp, signature image) on every download, and the WhatsApp share endpoints
+  rebuilt the same PDF again by calling them.
+
+How:
+- The caller describes everything that ends up on the page (item rows,
+  amounts, cash given/change, reprint info, signature, stamp date, layout
+  version) as a JSON-serialisable `version`. Its SHA-256 is the file name:
+  `<root>/<kind>/<record_id>-<digest>.pdf`. Any change to the inputs is a new
+  key, so there is no invalidation to forget; older versions of the same
+  record are removed when a new one is written.
+- Writes go to a temp file and are moved into place (safe across workers).
+- Hits touch the file's mtime; when the cache grows past `max_bytes` the
+  least recently used files are deleted until it is under 90% of the limit.
+- Optional `encrypt`/`decrypt` callables keep patient data encrypted at rest.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Optional
+
+
+def version_digest(kind: str, record_id, version) -> str:
+    payload = json.dumps([kind, str(record_id), version], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+class PdfCache:
+    def __init__(self, root: str, *, max_bytes: int = 200 * 1024 * 1024,
+                 encrypt: Optional[Callable[[bytes], bytes]] = None,
+                 decrypt: Optional[Callable[[bytes], bytes]] = None,
+                 on_error: Optional[Callable[[str, Exception], None]] = None):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.encrypt = encrypt
+        self.decrypt = decrypt
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._bytes: Optional[int] = None
+        self.counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'errors': 0}
+
+    def _error(self, where: str, e: Exception) -> None:
+        self.counters['errors'] += 1
+        if self.on_error:
+            try:
+                self.on_error(where, e)
+            except Exception:
+                pass
+
+    def _dir(self, kind: str) -> str:
+        return os.path.join(self.root, kind)
+
+    def path_for(self, kind: str, record_id, version) -> str:
+        return os.path.join(self._dir(kind), f'{record_id}-{version_digest(kind, record_id, version)}.pdf')
+
+    def get(self, kind: str, record_id, version) -> Optional[bytes]:
+        path = self.path_for(kind, record_id, version)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self._error('read', e)
+            return None
+        try:
+            data = self.decrypt(blob) if self.decrypt else blob
+        except Exception as e:
+            # Unreadable (e.g. key rotated): treat as a miss and let it be rewritten.
+            self._error('decrypt', e)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, kind: str, record_id, version, data: bytes) -> None:
+        directory = self._dir(kind)
+        path = self.path_for(kind, record_id, version)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            blob = self.encrypt(data) if self.encrypt else data
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(blob)
+                os.replace(tmp, path)
+            except Exception:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        except Exception as e:
+            self._error('write', e)
+            return
+
+        self.counters['writes'] += 1
+        removed = self._remove_other_versions(directory, str(record_id), os.path.basename(path))
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_size()
+            else:
+                self._bytes += len(blob) - removed
+            over = self._bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def get_or_build(self, kind: str, record_id, version, build: Callable[[], bytes]) -> tuple[bytes, bool]:
+        """(pdf_bytes, was_cached)."""
+        data = self.get(kind, record_id, version)
+        if data is not None:
+            self.counters['hits'] += 1
+            return data, True
+        self.counters['misses'] += 1
+        data = build()
+        self.put(kind, record_id, version, data)
+        return data, False
+
+    def invalidate(self, kind: str, record_id) -> None:
+        """Drop every cached version of one record."""
+        self._remove_other_versions(self._dir(kind), str(record_id), None)
+
+    def _remove_other_versions(self, directory: str, record_id: str, keep: Optional[str]) -> int:
+        prefix = f'{record_id}-'
+        freed = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return 0
+        for name in names:
+            if name.startswith(prefix) and name.endswith('.pdf') and name != keep:
+                p = os.path.join(directory, name)
+                try:
+                    size = os.path.getsize(p)
+                    os.remove(p)
+                    freed += size
+                except OSError:
+                    continue
+        return freed
+
+    def _files(self) -> list[tuple[float, int, str]]:
+        out = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.pdf'):
+                    continue
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, p))
+        return out
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self) -> None:
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            target = int(self.max_bytes * 0.9)
+            for _, size, p in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(p)
+                    total -= size
+                    self.counters['evictions'] += 1
+                except OSError:
+                    continue
+            self._bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._bytes
+        return dict(self.counters, bytes=size, max_bytes=self.max_bytes, root=self.root)
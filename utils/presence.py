@@ -0,0 +1,266 @@
+"""utils/presence.py
+
+Socket presence registry: which Socket.IO sids belong to which user.
+
+Why:
+- The old per-process `active_sockets` dict was scanned linearly to find a
+  user's socket, and a user connected to worker A was invisible to worker B.
+- The registry keeps O(1) sid -> user and user -> sids maps in a backend shared
+  by all workers. Entries expire after `ttl_seconds` unless refreshed by a
+  heartbeat, so a crashed worker's sockets age out instead of leaving users
+  "online" forever.
+
+Backends:
+- memory:    per-process dicts (single worker / tests).
+- redis:     shared Redis (also works with `fakeredis` for local runs).
+- database:  a `socket_presence` table on the app database, for multi-worker
+             deployments without Redis.
+
+Emitting to a sid owned by another worker needs a Socket.IO message queue
+(SOCKETIO_MESSAGE_QUEUE / REDIS_URL); the registry only answers "where".
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select, update
+
+
+def _uid(user_id) -> Optional[int]:
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryPresenceBackend:
+    name = 'memory'
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._sid_user: dict[str, int] = {}
+        self._sid_expiry: dict[str, float] = {}
+        self._user_sids: dict[int, set[str]] = {}
+
+    def _drop(self, sid: str) -> Optional[int]:
+        user_id = self._sid_user.pop(sid, None)
+        self._sid_expiry.pop(sid, None)
+        if user_id is not None:
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    self._user_sids.pop(user_id, None)
+        return user_id
+
+    def add(self, sid: str, user_id: int) -> None:
+        with self._lock:
+            self._drop(sid)
+            self._sid_user[sid] = user_id
+            self._sid_expiry[sid] = time.monotonic() + self.ttl
+            self._user_sids.setdefault(user_id, set()).add(sid)
+
+    def remove(self, sid: str) -> Optional[int]:
+        with self._lock:
+            return self._drop(sid)
+
+    def touch(self, sid: str) -> bool:
+        with self._lock:
+            if sid not in self._sid_user:
+                return False
+            self._sid_expiry[sid] = time.monotonic() + self.ttl
+            return True
+
+    def user_for_sid(self, sid: str) -> Optional[int]:
+        with self._lock:
+            exp = self._sid_expiry.get(sid)
+            if exp is None:
+                return None
+            if exp < time.monotonic():
+                self._drop(sid)
+                return None
+            return self._sid_user.get(sid)
+
+    def sids_for_user(self, user_id: int) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            sids = list(self._user_sids.get(user_id, ()))
+            live = []
+            for sid in sids:
+                if self._sid_expiry.get(sid, 0) < now:
+                    self._drop(sid)
+                else:
+                    live.append(sid)
+            return live
+
+
+class RedisPresenceBackend:
+    """sid keys with TTL plus one sorted set per user scored by expiry time."""
+
+    name = 'redis'
+
+    def __init__(self, client, ttl_seconds: int, prefix: str = 'presence'):
+        self.client = client
+        self.ttl = ttl_seconds
+        self.prefix = prefix
+
+    def _sid_key(self, sid: str) -> str:
+        return f'{self.prefix}:sid:{sid}'
+
+    def _user_key(self, user_id: int) -> str:
+        return f'{self.prefix}:user:{user_id}'
+
+    def add(self, sid: str, user_id: int) -> None:
+        previous = self.client.get(self._sid_key(sid))
+        pipe = self.client.pipeline()
+        if previous is not None and _uid(previous) != user_id:
+            pipe.zrem(self._user_key(_uid(previous)), sid)
+        pipe.set(self._sid_key(sid), user_id, ex=self.ttl)
+        pipe.zadd(self._user_key(user_id), {sid: time.time() + self.ttl})
+        pipe.expire(self._user_key(user_id), self.ttl)
+        pipe.execute()
+
+    def remove(self, sid: str) -> Optional[int]:
+        user_id = _uid(self.client.get(self._sid_key(sid)))
+        pipe = self.client.pipeline()
+        pipe.delete(self._sid_key(sid))
+        if user_id is not None:
+            pipe.zrem(self._user_key(user_id), sid)
+        pipe.execute()
+        return user_id
+
+    def touch(self, sid: str) -> bool:
+        user_id = _uid(self.client.get(self._sid_key(sid)))
+        if user_id is None:
+            return False
+        pipe = self.client.pipeline()
+        pipe.expire(self._sid_key(sid), self.ttl)
+        pipe.zadd(self._user_key(user_id), {sid: time.time() + self.ttl})
+        pipe.expire(self._user_key(user_id), self.ttl)
+        pipe.execute()
+        return True
+
+    def user_for_sid(self, sid: str) -> Optional[int]:
+        return _uid(self.client.get(self._sid_key(sid)))
+
+    def sids_for_user(self, user_id: int) -> list[str]:
+        key = self._user_key(user_id)
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zrange(key, 0, -1)
+        _, sids = pipe.execute()
+        return [s.decode() if isinstance(s, bytes) else s for s in sids]
+
+
+class DatabasePresenceBackend:
+    """Rows of (sid, user_id, expires_at) in a shared table; each call is one short transaction."""
+
+    name = 'database'
+
+    def __init__(self, engine, table, ttl_seconds: int):
+        self.engine = engine
+        self.table = table
+        self.ttl = ttl_seconds
+
+    def _expiry(self) -> float:
+        return time.time() + self.ttl
+
+    def add(self, sid: str, user_id: int) -> None:
+        t = self.table
+        with self.engine.begin() as conn:
+            conn.execute(delete(t).where(t.c.sid == sid))
+            conn.execute(insert(t).values(sid=sid, user_id=user_id, expires_at=self._expiry()))
+
+    def remove(self, sid: str) -> Optional[int]:
+        t = self.table
+        with self.engine.begin() as conn:
+            user_id = conn.execute(select(t.c.user_id).where(t.c.sid == sid)).scalar()
+            conn.execute(delete(t).where(t.c.sid == sid))
+        return user_id
+
+    def touch(self, sid: str) -> bool:
+        t = self.table
+        with self.engine.begin() as conn:
+            return conn.execute(update(t).where(t.c.sid == sid).values(expires_at=self._expiry())).rowcount > 0
+
+    def user_for_sid(self, sid: str) -> Optional[int]:
+        t = self.table
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(t.c.user_id).where(t.c.sid == sid, t.c.expires_at >= time.time())
+            ).scalar()
+
+    def sids_for_user(self, user_id: int) -> list[str]:
+        t = self.table
+        with self.engine.connect() as conn:
+            return list(conn.execute(
+                select(t.c.sid).where(t.c.user_id == user_id, t.c.expires_at >= time.time())
+            ).scalars())
+
+    def purge_expired(self) -> int:
+        t = self.table
+        with self.engine.begin() as conn:
+            return conn.execute(delete(t).where(t.c.expires_at < time.time())).rowcount or 0
+
+    def count(self) -> int:
+        t = self.table
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(t)).scalar() or 0
+
+
+class PresenceRegistry:
+    """Backend-agnostic facade used by the Socket.IO handlers."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def backend_name(self) -> str:
+        return self.backend.name
+
+    def add(self, sid: str, user_id) -> Optional[int]:
+        uid = _uid(user_id)
+        if uid is not None and sid:
+            self.backend.add(sid, uid)
+        return uid
+
+    def remove(self, sid: str) -> Optional[int]:
+        return self.backend.remove(sid) if sid else None
+
+    def touch(self, sid: str) -> bool:
+        return bool(sid) and self.backend.touch(sid)
+
+    def user_for_sid(self, sid: str) -> Optional[int]:
+        return self.backend.user_for_sid(sid) if sid else None
+
+    def sids_for_user(self, user_id) -> list[str]:
+        uid = _uid(user_id)
+        return self.backend.sids_for_user(uid) if uid is not None else []
+
+    def sid_for_user(self, user_id) -> Optional[str]:
+        sids = self.sids_for_user(user_id)
+        return sids[0] if sids else None
+
+    def is_online(self, user_id) -> bool:
+        return bool(self.sids_for_user(user_id))
+
+
+def build_presence_registry(backend: str, *, ttl_seconds: int, redis_url: str = '', engine=None, table=None) -> PresenceRegistry:
+    """Create the registry for PRESENCE_BACKEND ('memory' | 'redis' | 'fakeredis' | 'database')."""
+    backend = (backend or 'memory').strip().lower()
+    ttl = max(10, int(ttl_seconds))
+    if backend == 'redis':
+        import redis  # listed in requirements.txt
+        return PresenceRegistry(RedisPresenceBackend(redis.Redis.from_url(redis_url), ttl))
+    if backend == 'fakeredis':
+        import fakeredis  # optional: local multi-worker stand-in
+        return PresenceRegistry(RedisPresenceBackend(fakeredis.FakeRedis(), ttl))
+    if backend == 'database':
+        if engine is None or table is None:
+            raise ValueError('database presence backend needs an engine and table')
+        return PresenceRegistry(DatabasePresenceBackend(engine, table, ttl))
+    return PresenceRegistry(MemoryPresenceBackend(ttl))
@@ -0,0 +1,165 @@
+"""utils/receipt_queue.py
+
+Background render queue for sale receipts.
+
+Why:
+- Checkout re-queried the sale with joinedloads, rendered the receipt
+  template and sanitized the HTML inside the request, before commit, so every
+  sale paid for a render the cashier might never open.
+- Checkout now only writes stock, sale and ledger rows; the receipt job is
+  queued after the commit and rendered by a worker thread.
+
+Semantics:
+- Jobs are keyed (e.g. ('sale', 42)); queueing a key that is already pending
+  just replaces its payload, so a sale is rendered at most once per queueing.
+- A failed render is retried with exponential backoff up to `max_attempts`;
+  render functions must be idempotent (skip when the artifact already exists).
+- Receipt endpoints call `take(key)` to render a pending job on demand, or
+  `wait(key)` when the worker is rendering it right now. If that on-demand
+  render fails, the endpoint hands the job back with `enqueue`.
+- The queue is per process: a job lost to a restart, or queued in another
+  worker, is rendered on demand by the receipt endpoint the first time someone
+  opens it. Payloads are therefore only hints (e.g. base URL); render functions
+  read everything the receipt shows from the database.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Hashable, Optional
+
+
+class ReceiptRenderQueue:
+    def __init__(self, render: Callable[[Hashable, Optional[dict]], None], *,
+                 max_attempts: int = 5, retry_delay: float = 2.0,
+                 on_error: Optional[Callable[[Hashable, Exception, int], None]] = None,
+                 name: str = 'receipt-render'):
+        self.render = render
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay = float(retry_delay)
+        self.on_error = on_error
+        self.name = name
+        self._cond = threading.Condition()
+        self._pending: dict = {}      # key -> [payload, attempts, due (monotonic)]
+        self._in_flight: set = set()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.counters = {'queued': 0, 'rendered': 0, 'retried': 0, 'failed': 0, 'taken': 0}
+
+    # ------------------------------------------------------------------ producer side
+    def enqueue(self, key: Hashable, payload: Optional[dict] = None) -> None:
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[0] = payload
+            else:
+                self._pending[key] = [payload, 0, time.monotonic()]
+                self.counters['queued'] += 1
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def take(self, key: Hashable) -> tuple[bool, Optional[dict]]:
+        """Remove a pending job so the caller can render it now: (was_pending, payload)."""
+        with self._cond:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return False, None
+            self.counters['taken'] += 1
+            self._cond.notify_all()
+            return True, entry[0]
+
+    def peek(self, key: Hashable) -> Optional[dict]:
+        """Payload of a pending job without removing it."""
+        with self._cond:
+            entry = self._pending.get(key)
+            return entry[0] if entry is not None else None
+
+    def wait(self, key: Hashable, timeout: float = 5.0) -> bool:
+        """Block until `key` is neither pending nor being rendered. False on timeout."""
+        deadline = time.monotonic() + float(timeout)
+        with self._cond:
+            while key in self._in_flight or key in self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def wait_idle(self, timeout: float = 30.0) -> bool:
+        deadline = time.monotonic() + float(timeout)
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, pending=len(self._pending), in_flight=len(self._in_flight))
+
+    # ------------------------------------------------------------------ worker side
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                if self._pending:
+                    key = min(self._pending, key=lambda k: self._pending[k][2])
+                    payload, attempts, due = self._pending[key]
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        del self._pending[key]
+                        self._in_flight.add(key)
+                        return key, payload, attempts
+                    self._cond.wait(delay)
+                else:
+                    self._cond.wait()
+
+    def _finish(self, key, payload, attempts: int, error: Optional[Exception]) -> None:
+        with self._cond:
+            self._in_flight.discard(key)
+            if error is None:
+                self.counters['rendered'] += 1
+            elif attempts < self.max_attempts and key not in self._pending:
+                self.counters['retried'] += 1
+                due = time.monotonic() + self.retry_delay * (2 ** (attempts - 1))
+                self._pending[key] = [payload, attempts, due]
+            elif key not in self._pending:
+                self.counters['failed'] += 1
+            self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            key, payload, attempts = job
+            error = None
+            try:
+                self.render(key, payload)
+            except Exception as e:
+                error = e
+                if self.on_error:
+                    try:
+                        self.on_error(key, e, attempts + 1)
+                    except Exception:
+                        pass
+            self._finish(key, payload, attempts + 1, error)
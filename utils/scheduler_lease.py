@@ -0,0 +1,99 @@
+"""utils/scheduler_lease.py
+
+Database lease used to elect one scheduler leader across worker processes.
+
+Why:
+- Every gunicorn worker starts its own APScheduler, so without coordination
+  backups, report emails and stock alerts ran once per worker.
+- Workers compete for a single row in `scheduler_leases`. The holder renews it
+  every few seconds; if it stops (crash, restart) the lease expires after
+  `ttl_seconds` and another worker takes over on its next attempt.
+
+The acquire/renew step is a single conditional UPDATE (or the first INSERT),
+so it works the same on PostgreSQL and SQLite without advisory locks.
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import case, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+
+def default_holder_id() -> str:
+    """host:pid:random, unique per process."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    def __init__(self, engine, table, name: str, *, ttl_seconds: int = 60, holder: str | None = None):
+        self.engine = engine
+        self.table = table
+        self.name = name
+        self.ttl = timedelta(seconds=max(5, int(ttl_seconds)))
+        self.holder = holder or default_holder_id()
+        self._expires_at: datetime | None = None
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def try_acquire(self) -> bool:
+        """Take or renew the lease; returns True while this process is the leader."""
+        t = self.table
+        now = self._now()
+        expires = now + self.ttl
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(t)
+                .where(t.c.name == self.name)
+                .where((t.c.holder == self.holder) | (t.c.expires_at < now))
+                .values(
+                    acquired_at=case((t.c.holder == self.holder, t.c.acquired_at), else_=now),
+                    holder=self.holder,
+                    expires_at=expires,
+                    renewed_at=now,
+                )
+            )
+            if result.rowcount:
+                self._expires_at = expires
+                return True
+            exists = conn.execute(select(t.c.name).where(t.c.name == self.name)).first() is not None
+        if exists:
+            self._expires_at = None
+            return False
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(t).values(
+                    name=self.name, holder=self.holder, acquired_at=now, renewed_at=now, expires_at=expires,
+                ))
+            self._expires_at = expires
+            return True
+        except IntegrityError:
+            # Another worker inserted first.
+            self._expires_at = None
+            return False
+
+    def is_leader(self) -> bool:
+        """True if the last successful acquire has not expired yet (no DB round-trip)."""
+        return self._expires_at is not None and self._expires_at > self._now()
+
+    def release(self) -> None:
+        t = self.table
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(t)
+                .where(t.c.name == self.name, t.c.holder == self.holder)
+                .values(expires_at=self._now())
+            )
+        self._expires_at = None
+
+    def current(self) -> dict | None:
+        t = self.table
+        with self.engine.connect() as conn:
+            row = conn.execute(select(t).where(t.c.name == self.name)).mappings().first()
+        return dict(row) if row else None
@@ -11,16 +11,22 @@ Goals:
 
 This module is designed to be dependency-free (stdlib only) and not break
 existing functionality if it cannot initialize (fails closed to logging only).
+
+Storage writes are buffered: `append()` only queues the event (the DB activity
+monitor emits one per SQL statement) and a background thread writes batches
+through one open handle per day. See SIEMStorage.
 """
 
 from __future__ import annotations
 
+import atexit
 import json
 import logging
 import os
 import threading
 import time
-from dataclasses import dataclass, asdict
+import weakref
+from dataclasses import dataclass, asdict, fields
 from datetime import datetime, timezone
 from enum import Enum
 from collections import deque
@@ -65,6 +71,9 @@ class SIEMEvent:
     meta: Optional[Dict[str, Any]] = None
 
 
+_EVENT_FIELDS = tuple(f.name for f in fields(SIEMEvent))
+
+
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -100,25 +109,236 @@ def _redact_meta(meta: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
 
 
 class SIEMStorage:
-    """Append-only JSONL storage with daily rotation in instance/siem."""
+    """Append-only JSONL storage with daily rotation in instance/siem.
+
+    With `buffered=True` events go into a bounded in-memory buffer and a writer
+    thread flushes them when `flush_events` are queued or `flush_interval`
+    seconds after the first one, whichever comes first (HIGH/CRITICAL events
+    are flushed right away). Each batch is ONE `os.write` on an O_APPEND
+    handle kept open for the current day, so lines from several worker
+    processes never interleave.
+
+    When the buffer holds `max_buffer` events:
+    - HIGH/CRITICAL events are never dropped: the caller flushes the buffer
+      itself (backpressure) and then queues the event;
+    - other events wait up to `block_timeout` seconds for room when
+      `overflow="block"`, and are dropped (counted) otherwise or on timeout.
+
+    `flush()` writes everything queued so far; `close()` (registered with
+    atexit) stops the thread and flushes.
+    """
+
+    _NEVER_DROP = frozenset({SIEMSeverity.HIGH.value, SIEMSeverity.CRITICAL.value})
 
-    def __init__(self, base_dir: str):
+    def __init__(
+        self,
+        base_dir: str,
+        buffered: bool = True,
+        max_buffer: int = 10000,
+        flush_events: int = 200,
+        flush_interval: float = 1.0,
+        overflow: str = "drop",
+        block_timeout: float = 0.05,
+    ):
         self.base_dir = base_dir
         os.makedirs(self.base_dir, exist_ok=True)
+        self._lock = threading.Lock()  # serialises file writes; taken before _cond
+        self.buffered = bool(buffered)
+        self.max_buffer = max(1, int(max_buffer))
+        self.flush_events = max(1, min(int(flush_events), self.max_buffer))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.overflow = overflow if overflow in ("drop", "block") else "drop"
+        self.block_timeout = max(0.0, float(block_timeout))
+
+        self._cond = threading.Condition()
+        self._buffer: Deque[Tuple[str, SIEMEvent]] = deque()
+        self._first_queued_at = 0.0
+        self._urgent = False
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._closed = False
+
+        self._fd: Optional[int] = None
+        self._fd_day: Optional[str] = None
+        self._fd_pid: Optional[int] = None
+
+        self.counters: Dict[str, int] = {
+            "queued": 0,
+            "written": 0,
+            "batches": 0,
+            "dropped": 0,
+            "blocked": 0,
+            "inline_flushes": 0,
+            "write_errors": 0,
+            "max_depth": 0,
+        }
+        if self.buffered:
+            atexit.register(self.close)
+            if hasattr(os, "register_at_fork"):
+                ref = weakref.ref(self)
+                os.register_at_fork(after_in_child=lambda: ref() is not None and ref()._after_fork())
+
+    def _after_fork(self) -> None:
+        # The child must not reuse locks a parent thread may have held at fork time,
+        # nor re-write events still queued in the parent.
         self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._buffer.clear()
+        self._urgent = False
+        self._thread = None
+        self._close_fd()
 
     def _path_for_day(self, day: str) -> str:
         return os.path.join(self.base_dir, f"events-{day}.jsonl")
 
+    @staticmethod
+    def _serialize(event: SIEMEvent) -> str:
+        # Shallow field copy: asdict() deep-copies and cost most of the write time.
+        payload = {name: getattr(event, name) for name in _EVENT_FIELDS}
+        payload["meta"] = _redact_meta(payload.get("meta"))
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
     def append(self, event: SIEMEvent) -> None:
         day = event.ts[:10].replace("-", "")  # YYYYMMDD
-        path = self._path_for_day(day)
-        payload = asdict(event)
-        payload["meta"] = _redact_meta(payload.get("meta"))
-        line = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        if not self.buffered or self._closed:
+            with self._lock:
+                self._write_lines([(day, self._serialize(event))])
+            return
+
+        while True:
+            with self._cond:
+                if len(self._buffer) < self.max_buffer:
+                    self._enqueue(day, event)
+                    return
+                if event.severity not in self._NEVER_DROP:
+                    if self.overflow == "block":
+                        self.counters["blocked"] += 1
+                        self._cond.wait_for(lambda: len(self._buffer) < self.max_buffer, self.block_timeout)
+                        if len(self._buffer) < self.max_buffer:
+                            self._enqueue(day, event)
+                            return
+                    self.counters["dropped"] += 1
+                    return
+                self.counters["inline_flushes"] += 1
+            self.flush()
+
+    def _enqueue(self, day: str, event: SIEMEvent) -> None:
+        # Caller holds self._cond.
+        if not self._buffer:
+            self._first_queued_at = time.monotonic()
+        self._buffer.append((day, event))
+        depth = len(self._buffer)
+        self.counters["queued"] += 1
+        if depth > self.counters["max_depth"]:
+            self.counters["max_depth"] = depth
+        if self._thread is None or not self._thread.is_alive():
+            self._start_writer()
+        if event.severity in self._NEVER_DROP:
+            self._urgent = True  # write security alerts without waiting for the interval
+        if depth == 1 or depth >= self.flush_events or self._urgent:
+            self._cond.notify_all()
+
+    def _start_writer(self) -> None:
+        # Caller holds self._cond. Also restarts the writer in a forked worker.
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run_writer, name="siem-writer", daemon=True)
+        self._thread.start()
+
+    def _run_writer(self) -> None:
+        while True:
+            with self._cond:
+                while not self._buffer and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                deadline = self._first_queued_at + self.flush_interval
+                while len(self._buffer) < self.flush_events and not self._stopping and not self._urgent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def _drain(self) -> List[Tuple[str, SIEMEvent]]:
+        with self._cond:
+            batch = list(self._buffer)
+            self._buffer.clear()
+            self._urgent = False
+            self._cond.notify_all()
+        return batch
+
+    def flush(self) -> None:
+        """Write every queued event now (in the calling thread)."""
+        with self._lock:
+            batch = self._drain()
+            if not batch:
+                return
+            lines: List[Tuple[str, str]] = []
+            for day, event in batch:
+                try:
+                    lines.append((day, self._serialize(event)))
+                except Exception:
+                    self.counters["write_errors"] += 1
+            self._write_lines(lines)
+
+    def _write_lines(self, lines: List[Tuple[str, str]]) -> None:
+        # Caller holds self._lock. One write per day present in the batch.
+        start = 0
+        while start < len(lines):
+            day = lines[start][0]
+            end = start
+            while end < len(lines) and lines[end][0] == day:
+                end += 1
+            data = "".join(line + "\n" for _, line in lines[start:end]).encode("utf-8")
+            try:
+                fd = self._fd_for_day(day)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                self.counters["written"] += end - start
+                self.counters["batches"] += 1
+            except Exception as e:
+                self.counters["write_errors"] += 1
+                self.counters["dropped"] += end - start
+                self._close_fd()
+                logger.error("SIEM storage write failed (%d events lost): %s", end - start, e)
+            start = end
+
+    def _fd_for_day(self, day: str) -> int:
+        pid = os.getpid()
+        if self._fd is None or self._fd_day != day or self._fd_pid != pid:
+            self._close_fd()
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            self._fd = os.open(self._path_for_day(day), flags, 0o644)
+            self._fd_day = day
+            self._fd_pid = pid
+        return self._fd
+
+    def _close_fd(self) -> None:
+        fd, self._fd, self._fd_day = self._fd, None, None
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Stop the writer thread, flush what is queued and close the file."""
+        with self._cond:
+            self._closed = True
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.flush()
         with self._lock:
-            with open(path, "a", encoding="utf-8") as f:
-                f.write(line + "\n")
+            self._close_fd()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return dict(self.counters, depth=len(self._buffer), buffered=self.buffered,
+                        overflow=self.overflow, max_buffer=self.max_buffer)
 
     def iter_events(
         self,
@@ -126,6 +346,7 @@ class SIEMStorage:
         limit: int = 5000,
     ) -> Iterable[Dict[str, Any]]:
         count = 0
+        self.flush()
         for day in days:
             path = self._path_for_day(day)
             if not os.path.exists(path):
@@ -432,7 +653,21 @@ def init_siem(app=None) -> SIEMClient:
     global _siem_client
 
     base_dir = os.path.join(os.getcwd(), "instance", "siem")
-    storage = SIEMStorage(base_dir)
+    config = getattr(app, "config", None) or {}
+    storage = SIEMStorage(
+        base_dir,
+        buffered=config.get("SIEM_BUFFERED", True) is not False,
+        max_buffer=int(config.get("SIEM_BUFFER_MAX_EVENTS", 10000)),
+        flush_events=int(config.get("SIEM_FLUSH_EVENTS", 200)),
+        flush_interval=float(config.get("SIEM_FLUSH_INTERVAL_SECONDS", 1.0)),
+        overflow=str(config.get("SIEM_OVERFLOW_POLICY", "drop")),
+        block_timeout=float(config.get("SIEM_BLOCK_TIMEOUT_SECONDS", 0.05)),
+    )
+    if _siem_client is not None:
+        try:
+            _siem_client.storage.close()
+        except Exception:
+            pass
     _siem_client = SIEMClient(storage)
     try:
         if app is not None and app.config.get("SIEM_ENABLED") is False:
@@ -1,10 +1,81 @@
 """
 Digital Stamp and Signature Generator
 Generates dynamic, date-stamped official stamps and loads hand-drawn signatures
+
+The generated markup only depends on the arguments, the date and the
+STAMP_* typography env vars, so results are memoized per (arguments, env)
+and the memo is reset when the date rolls over.
 """
-from datetime import datetime
+from datetime import datetime, date
+from io import BytesIO
 from markupsafe import Markup
 import os
+import threading
+import time
+
+
+_TYPOGRAPHY_ENV = (
+    'STAMP_COLOR', 'STAMP_DATE_COLOR', 'STAMP_SVG_FONT_BOLD', 'STAMP_SVG_FONT_REGULAR',
+    'STAMP_PDF_FONT_BOLD', 'STAMP_PDF_FONT_REGULAR', 'STAMP_PDF_SIZE_TITLE',
+    'STAMP_PDF_SIZE_DATE', 'STAMP_PDF_SIZE_CONTACT', 'STAMP_PDF_LINE_WIDTH',
+)
+_MEMO_MAX_ENTRIES = 256
+_ENV_RECHECK_SECONDS = 1.0
+_memo_lock = threading.Lock()
+_memo = {}
+_memo_day = None
+_memo_stats = {'hits': 0, 'misses': 0, 'resets': 0}
+_env_key = (0.0, None)
+_day_strings = (None, '', '')
+
+
+def _typography_env_key():
+    # Reading ten env vars costs more than building a stamp; re-read at most once a second.
+    global _env_key
+    expires, key = _env_key
+    now = time.monotonic()
+    if key is None or now >= expires:
+        key = tuple(os.getenv(name) for name in _TYPOGRAPHY_ENV)
+        _env_key = (now + _ENV_RECHECK_SECONDS, key)
+    return key
+
+
+def _today_strings():
+    """(today, stamp date "21 DEC 2025", signature date "21 December 2025")."""
+    global _day_strings
+    today = date.today()
+    if _day_strings[0] != today:
+        now = datetime.now()
+        _day_strings = (today, now.strftime('%d %b %Y').upper(), now.strftime('%d %B %Y'))
+    return _day_strings
+
+
+def _memoized(kind, key, build):
+    """Return build() for (kind, key, typography env), reusing it for the rest of the day."""
+    global _memo_day
+    today = _today_strings()[0]
+    full_key = (kind, key, _typography_env_key())
+    with _memo_lock:
+        if _memo_day != today:
+            if _memo:
+                _memo_stats['resets'] += 1
+            _memo.clear()
+            _memo_day = today
+        if full_key in _memo:
+            _memo_stats['hits'] += 1
+            return _memo[full_key]
+    value = build()
+    with _memo_lock:
+        if len(_memo) >= _MEMO_MAX_ENTRIES:
+            _memo.clear()
+        _memo[full_key] = value
+        _memo_stats['misses'] += 1
+    return value
+
+
+def stamp_signature_cache_stats() -> dict:
+    with _memo_lock:
+        return dict(_memo_stats, entries=len(_memo), day=_memo_day.isoformat() if _memo_day else None)
 
 
 def _env_float(name: str, default: float) -> float:
@@ -88,8 +159,13 @@ def generate_rubber_stamp(facility_name="MAKOKHA MEDICAL CENTRE",
     """
     if current_date is None:
         # Format: "21 DEC 2025"
-        current_date = datetime.now().strftime('%d %b %Y').upper()
+        current_date = _today_strings()[1]
 
+    args = (facility_name, email, phone1, phone2, current_date, stamp_color, size)
+    return _memoized('stamp_svg', args, lambda: _build_rubber_stamp(*args))
+
+
+def _build_rubber_stamp(facility_name, email, phone1, phone2, current_date, stamp_color, size):
     typo = get_stamp_typography()
     svg_bold = typo['svg']['font_bold']
     svg_regular = typo['svg']['font_regular']
@@ -221,8 +297,13 @@ def generate_digital_signature(signer_name="Makokha",
         Markup: HTML comment indicating signature pad should be used
     """
     if signature_date is None:
-        signature_date = datetime.now().strftime('%d %B %Y')
-    
+        signature_date = _today_strings()[2]
+
+    args = (signer_name, signer_title, signature_date, include_date, user_id)
+    return _memoized('signature_html', args, lambda: _build_digital_signature(signer_title, signature_date))
+
+
+def _build_digital_signature(signer_title, signature_date):
     # Return a marker that indicates signature pad component should be included
     # The actual rendering is handled by the signature_pad.html template
     signature_html = f"""
@@ -235,6 +316,61 @@ def generate_digital_signature(signer_name="Makokha",
     return Markup(signature_html)
 
 
+def _pil_font(bold, size_px):
+    from PIL import ImageFont
+    names = ('DejaVuSans-Bold.ttf', 'arialbd.ttf', 'Arial Bold.ttf') if bold else ('DejaVuSans.ttf', 'arial.ttf', 'Arial.ttf')
+    for name in names:
+        try:
+            return ImageFont.truetype(name, size_px)
+        except Exception:
+            continue
+    return ImageFont.load_default(size=size_px)
+
+
+def rubber_stamp_png(facility_name="MAKOKHA MEDICAL CENTRE",
+                     phone1="0741 256 531",
+                     phone2="0713 580 997",
+                     current_date=None,
+                     width_mm=70.0,
+                     height_mm=22.0,
+                     dpi=300):
+    """Pre-rasterized PDF receipt stamp (border, facility, red date, phones) as PNG bytes.
+
+    Same layout as the vector stamp drawn on receipt PDFs. Returns None when
+    Pillow is not installed.
+    """
+    if current_date is None:
+        current_date = _today_strings()[1]
+
+    def _build():
+        try:
+            from PIL import Image, ImageDraw
+        except Exception:
+            return None
+        typo = get_stamp_typography()
+        pdf = typo['pdf']
+        px_per_mm = dpi / 25.4
+        px_per_pt = dpi / 72.0
+        w, h = int(round(width_mm * px_per_mm)), int(round(height_mm * px_per_mm))
+        img = Image.new('RGBA', (w, h), (255, 255, 255, 0))
+        draw = ImageDraw.Draw(img)
+        line = max(1, int(round(pdf['line_width'] * px_per_pt)))
+        draw.rectangle([0, 0, w - 1, h - 1], outline=typo['colors']['stamp'], width=line)
+
+        def _centred(text, baseline_mm_from_bottom, font, fill):
+            y = h - baseline_mm_from_bottom * px_per_mm
+            draw.text((w / 2, y), text, font=font, fill=fill, anchor='ms')
+
+        _centred(facility_name, height_mm - 6, _pil_font(True, int(pdf['size_title'] * px_per_pt)), typo['colors']['stamp'])
+        _centred(current_date, height_mm - 12, _pil_font(True, int(pdf['size_date'] * px_per_pt)), typo['colors']['date'])
+        _centred(f'Tel: {phone1} / {phone2}', 4, _pil_font(False, int(pdf['size_contact'] * px_per_pt)), typo['colors']['stamp'])
+        out = BytesIO()
+        img.save(out, format='PNG', optimize=True)
+        return out.getvalue()
+
+    return _memoized('stamp_png', (facility_name, phone1, phone2, current_date, width_mm, height_mm, dpi), _build)
+
+
 def get_current_stamp_date():
     """Get current date formatted for stamp"""
     return datetime.now().strftime('%d %b %Y')
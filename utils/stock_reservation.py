@@ -0,0 +1,128 @@
+"""utils/stock_reservation.py
+
+Atomic stock reservation for multi-line cart sales.
+
+Why:
+- Cart checkouts loaded each drug with `session.get()` inside the item loop
+  (one query per line), checked `remaining_quantity` in Python and then did
+  `drug.sold_quantity += qty`. Two concurrent checkouts could both pass the
+  check and one decrement would overwrite the other (lost update / oversell).
+
+How:
+- All cart rows are loaded in ONE query ordered by id with `FOR UPDATE`
+  (PostgreSQL/MySQL lock them in a consistent order, so concurrent carts
+  cannot deadlock; SQLite ignores the clause and relies on its write lock).
+- Every line is validated before anything is written; duplicate lines for the
+  same item are summed.
+- Each decrement is a guarded UPDATE
+  (`... WHERE id = :id AND stocked - sold >= :qty`), so even without row locks
+  the database itself refuses to oversell. A zero rowcount fails the whole
+  reservation; the caller rolls back its transaction.
+
+The model needs `id`, `name`, `stocked_quantity`, `sold_quantity` and the stored
+`on_hand_quantity` column (see Drug / ControlledDrug).
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from sqlalchemy import func, update
+
+
+@dataclass
+class ReservationLine:
+    index: int
+    item_id: int
+    quantity: int
+    record: object = None
+    available: Optional[int] = None
+    ok: bool = False
+    error: Optional[str] = None
+
+
+@dataclass
+class StockReservation:
+    lines: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.lines) and all(line.ok for line in self.lines)
+
+    @property
+    def failed(self) -> Optional[ReservationLine]:
+        return next((line for line in self.lines if not line.ok), None)
+
+    def records(self) -> dict:
+        return {line.item_id: line.record for line in self.lines if line.record is not None}
+
+
+def _remaining(record) -> int:
+    return int(record.stocked_quantity or 0) - int(record.sold_quantity or 0)
+
+
+def reserve_stock(session, model, items: Iterable[tuple], *, lock: bool = True) -> StockReservation:
+    """Validate and decrement stock for [(item_id, quantity), ...] in one pass.
+
+    On success every line has `ok=True` and `record` set, and the decrements are
+    part of the session's current transaction (commit or roll back as usual).
+    On failure nothing is decremented if validation failed; if a guarded UPDATE
+    lost a race, earlier lines of this call were already decremented and the
+    caller must roll back (`result.ok` is False in both cases).
+    """
+    lines = [
+        ReservationLine(index=i, item_id=int(item_id), quantity=int(qty))
+        for i, (item_id, qty) in enumerate(items)
+    ]
+    result = StockReservation(lines=lines)
+    if not lines:
+        return result
+
+    ids = sorted({line.item_id for line in lines})
+    query = session.query(model).filter(model.id.in_(ids)).order_by(model.id)
+    if lock:
+        # populate_existing: rows already in the identity map get the locked values.
+        query = query.with_for_update().populate_existing()
+    rows = {r.id: r for r in query.all()}
+
+    totals: dict[int, int] = {}
+    for line in lines:
+        totals[line.item_id] = totals.get(line.item_id, 0) + line.quantity
+
+    for line in lines:
+        record = rows.get(line.item_id)
+        line.record = record
+        if record is None:
+            line.error = 'not_found'
+            continue
+        line.available = _remaining(record)
+        if line.quantity <= 0:
+            line.error = 'invalid_quantity'
+        elif line.available < totals[line.item_id]:
+            line.error = 'insufficient_stock'
+        else:
+            line.ok = True
+    if not result.ok:
+        return result
+
+    table_cols = model.__table__.c
+    for item_id in ids:
+        qty = totals[item_id]
+        sold = func.coalesce(table_cols.sold_quantity, 0)
+        res = session.execute(
+            update(model.__table__)
+            .where(table_cols.id == item_id, table_cols.stocked_quantity - sold >= qty)
+            .values(
+                sold_quantity=sold + qty,
+                remaining_quantity=table_cols.stocked_quantity - (sold + qty),
+            )
+        )
+        if res.rowcount != 1:
+            for line in lines:
+                if line.item_id == item_id:
+                    line.ok = False
+                    line.error = 'insufficient_stock'
+            return result
+        session.expire(rows[item_id], ['sold_quantity', 'on_hand_quantity'])
+    return result